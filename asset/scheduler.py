@@ -6,6 +6,7 @@ This module is used to register scheduled tasks
 
 from datetime import date, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
+from horilla.horilla_scheduler import start_scheduler
 from notifications.signals import notify
 
 
@@ -76,4 +77,4 @@ def notify_expiring_documents():
 scheduler = BackgroundScheduler()
 scheduler.add_job(notify_expiring_assets, "interval", days=1)
 scheduler.add_job(notify_expiring_documents, "interval", days=1)
-scheduler.start()
+start_scheduler(scheduler)
@@ -0,0 +1,52 @@
+import sys
+from itertools import islice
+from django.core.management.base import BaseCommand
+from attendance.methods.punches import ingest_punches, read_punches
+
+
+class Command(BaseCommand):
+    help = "Applies biometric punches from a csv of badge id,timestamp lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "file", nargs="?", default="-", help="Csv file, - for the standard input"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="Number of punches applied per batch",
+        )
+
+    def handle(self, *args, **options):
+        file = (
+            sys.stdin
+            if options["file"] == "-"
+            else open(options["file"], encoding="utf-8", newline="")
+        )
+        totals = {"clock_in": 0, "clock_out": 0, "late_come": 0, "early_out": 0}
+        skipped = 0
+        try:
+            while True:
+                lines = list(islice(file, options["batch_size"]))
+                if not lines:
+                    break
+                punches, invalid = read_punches(lines)
+                for line in invalid:
+                    self.stderr.write(f"Invalid punch: {line}")
+                result = ingest_punches(punches)
+                for error in result["errors"]:
+                    self.stderr.write(error)
+                for key in totals:
+                    totals[key] += result[key]
+                skipped += result["skipped"] + len(invalid)
+        finally:
+            if file is not sys.stdin:
+                file.close()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{totals['clock_in']} check-ins, {totals['clock_out']} check-outs, "
+                f"{totals['late_come']} late comes, {totals['early_out']} early outs, "
+                f"{skipped} punches skipped"
+            )
+        )
@@ -0,0 +1,50 @@
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from attendance.methods.rollups import rebuild_attendance_rollups
+from attendance.models import Attendance
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the daily attendance rollups from the attendances, month by month"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--start", type=date.fromisoformat, help="First day, YYYY-MM-DD"
+        )
+        parser.add_argument("--end", type=date.fromisoformat, help="Last day, YYYY-MM-DD")
+
+    def periods(self, start_date, end_date):
+        """
+        (start, end) of the months between the dates
+        """
+        while start_date <= end_date:
+            next_month = (start_date.replace(day=1) + timedelta(days=32)).replace(day=1)
+            yield start_date, min(end_date, next_month - timedelta(days=1))
+            start_date = next_month
+
+    def handle(self, *args, **options):
+        dates = Attendance._base_manager.dates("attendance_date", "day")
+        start_date = options["start"] or dates.first()
+        end_date = options["end"] or dates.last()
+        if start_date is None or end_date is None:
+            self.stdout.write("No attendances to roll up")
+            return
+        if start_date > end_date:
+            raise CommandError("--start must be before --end")
+        employee_rollups = department_rollups = 0
+        for period_start, period_end in self.periods(start_date, end_date):
+            month_employees, month_departments = rebuild_attendance_rollups(
+                period_start, period_end
+            )
+            employee_rollups += month_employees
+            department_rollups += month_departments
+            self.stdout.write(
+                f"{period_start:%B %Y}: {month_employees} employee days, "
+                f"{month_departments} department days"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Attendance rollups rebuilt, {employee_rollups} employee days, "
+                f"{department_rollups} department days"
+            )
+        )
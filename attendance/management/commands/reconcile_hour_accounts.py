@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from attendance.methods.hour_account import MONTHS, reconcile_hour_accounts
+from attendance.models import Attendance, AttendanceOverTime
+
+
+class Command(BaseCommand):
+    help = "Rewrites the hour accounts from the attendances, one aggregate per month"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--year", type=int, help="Only the months of the year")
+        parser.add_argument(
+            "--month", type=int, help="Only the month, 1 to 12, needs --year"
+        )
+
+    def months(self, year, month):
+        """
+        (year, month) of the attendances and hour accounts to reconcile
+        """
+        if month is not None:
+            return [(year, month)]
+        attendances = Attendance._base_manager.all()
+        accounts = AttendanceOverTime._base_manager.all()
+        if year is not None:
+            attendances = attendances.filter(attendance_date__year=year)
+            accounts = accounts.filter(year=str(year))
+        months = {
+            (day.year, day.month)
+            for day in attendances.dates("attendance_date", "month")
+        }
+        for account_year, account_month in accounts.values_list(
+            "year", "month"
+        ).distinct():
+            if account_month in MONTHS and str(account_year).isdigit():
+                months.add((int(account_year), MONTHS.index(account_month) + 1))
+        return sorted(months)
+
+    def handle(self, *args, **options):
+        year = options["year"]
+        month = options["month"]
+        if month is not None and (year is None or not 1 <= month <= 12):
+            raise CommandError("--month must be 1 to 12 and comes with --year")
+        corrected = created = 0
+        for month_year, month_number in self.months(year, month):
+            month_corrected, month_created = reconcile_hour_accounts(
+                month_year, month_number
+            )
+            corrected += month_corrected
+            created += month_created
+            if month_corrected or month_created:
+                self.stdout.write(
+                    f"{MONTHS[month_number - 1].capitalize()} {month_year}: "
+                    f"{month_corrected} corrected, {month_created} created"
+                )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Hour accounts reconciled, {corrected} corrected, {created} created"
+            )
+        )
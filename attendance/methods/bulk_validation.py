@@ -0,0 +1,177 @@
+"""
+bulk_validation.py
+
+This module is used to validate attendances and approve their overtime in
+bulk. The flags of the attendances are written with one UPDATE, then their
+history, work records, hour accounts and daily rollups are brought up to
+date once for the whole selection, each hour account of an employee month
+being written once, and the employees get their notifications with one
+insert.
+"""
+
+from django.db import transaction
+from django.db.models import F
+from simple_history.utils import get_history_manager_for_model
+from attendance.methods.hour_account import (
+    apply_hour_account_deltas,
+    approved_leave_days,
+    hour_account_deltas,
+)
+from attendance.methods.rollups import refresh_attendance_rollups
+from attendance.models import Attendance
+from notifications.models import bulk_notify
+
+
+def _update_attendances(attendances, values, user=None):
+    """
+    Write the values to the attendances with one UPDATE and bring the data
+    derived from the attendances up to date
+
+    Args:
+        attendances (list): Attendance instances, already changed in memory
+        values (dict): the UPDATE of the changed fields
+        user (User): the user the history is recorded for
+    """
+    from payroll.methods.work_records import write_attendance_work_records
+
+    if not attendances:
+        return
+    previous_states = [
+        attendance.stored_hour_account_state() for attendance in attendances
+    ]
+    current_states = [attendance.hour_account_state() for attendance in attendances]
+    for attendance in attendances:
+        # the work record gets the status of a save, not of a first save
+        attendance.first_save = False
+    with transaction.atomic():
+        Attendance._base_manager.filter(
+            pk__in=[attendance.pk for attendance in attendances]
+        ).update(**values)
+        get_history_manager_for_model(Attendance).bulk_history_create(
+            attendances, update=True, default_user=user, batch_size=500
+        )
+        write_attendance_work_records(attendances)
+        apply_hour_account_deltas(
+            hour_account_deltas(
+                zip(previous_states, current_states),
+                approved_leave_days(previous_states + current_states),
+            )
+        )
+        refresh_attendance_rollups(
+            (attendance.employee_id_id, attendance.attendance_date)
+            for attendance in attendances
+        )
+    for attendance, state in zip(attendances, current_states):
+        attendance._loaded_values = state
+
+
+def validate_attendances(attendances, user=None):
+    """
+    This method is used to validate the attendances, the attendances with a
+    pending update request are left as they are
+
+    Args:
+        attendances: Attendance queryset
+        user (User): the user validating the attendances
+
+    Returns:
+        tuple: (validated attendances, attendances with a pending request)
+    """
+    attendances = list(
+        attendances.select_related("employee_id__employee_user_id").order_by("id")
+    )
+    validated = [
+        attendance
+        for attendance in attendances
+        if not attendance.is_validate_request
+    ]
+    pending = [
+        attendance for attendance in attendances if attendance.is_validate_request
+    ]
+    changed = [
+        attendance for attendance in validated if not attendance.attendance_validated
+    ]
+    for attendance in changed:
+        attendance.attendance_validated = True
+    _update_attendances(changed, {"attendance_validated": True}, user)
+    return validated, pending
+
+
+def approve_overtimes(attendances, user=None):
+    """
+    This method is used to approve the overtime of the attendances
+
+    Args:
+        attendances: Attendance queryset
+        user (User): the user approving the overtime
+
+    Returns:
+        list: the attendances
+    """
+    attendances = list(
+        attendances.select_related("employee_id__employee_user_id").order_by("id")
+    )
+    changed = [
+        attendance
+        for attendance in attendances
+        if not attendance.attendance_overtime_approve
+        or attendance.approved_overtime_second != attendance.overtime_second
+    ]
+    for attendance in changed:
+        attendance.attendance_overtime_approve = True
+        attendance.approved_overtime_second = attendance.overtime_second
+    _update_attendances(
+        changed,
+        {
+            "attendance_overtime_approve": True,
+            "approved_overtime_second": F("overtime_second"),
+        },
+        user,
+    )
+    return attendances
+
+
+def notify_validated(sender, attendances):
+    """
+    This method is used to notify the employees of their validated
+    attendances with one insert
+    """
+    bulk_notify(
+        sender,
+        [
+            {
+                "recipient": attendance.employee_id.employee_user_id,
+                "verb": f"Your attendance for the date {attendance.attendance_date} is validated",
+                "verb_ar": f"تم التحقق من حضورك في تاريخ {attendance.attendance_date}",
+                "verb_de": f"Ihre Anwesenheit für das Datum {attendance.attendance_date} wurde bestätigt",
+                "verb_es": f"Se ha validado su asistencia para la fecha {attendance.attendance_date}",
+                "verb_fr": f"Votre présence pour la date {attendance.attendance_date} est validée",
+                "redirect": f"/attendance/view-my-attendance?id={attendance.id}",
+            }
+            for attendance in attendances
+        ],
+        icon="checkmark",
+    )
+
+
+def notify_overtime_approved(sender, attendances):
+    """
+    This method is used to notify the employees of their approved overtime
+    with one insert
+    """
+    bulk_notify(
+        sender,
+        [
+            {
+                "recipient": attendance.employee_id.employee_user_id,
+                "verb": f"Overtime approved for {attendance.attendance_date}'s attendance",
+                "verb_ar": f"تمت الموافقة على العمل الإضافي لحضور تاريخ {attendance.attendance_date}",
+                "verb_de": f"Überstunden für die Anwesenheit am {attendance.attendance_date} genehmigt",
+                "verb_es": f"Horas extra aprobadas para la asistencia del {attendance.attendance_date}",
+                "verb_fr": f"Heures supplémentaires approuvées pour la présence du {attendance.attendance_date}",
+                "redirect": f"/attendance/attendance-overtime-view?id={attendance.id}",
+            }
+            for attendance in attendances
+        ],
+        icon="checkmark",
+    )
@@ -0,0 +1,227 @@
+"""
+dashboard_metrics.py
+
+This module is used to compute the numbers of the attendance dashboard
+with aggregate queries, counted and summed by the database and grouped by
+department, instead of loading the rows to count them. The department
+charts read the daily department rollups. The results are
+kept in the cache for ATTENDANCE_DASHBOARD_CACHE_TIMEOUT seconds per
+selected company and dates.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Exists, F, OuterRef, Q, Sum
+from base.thread_local_middleware import _thread_locals
+
+DASHBOARD_CACHE_TIMEOUT = 60
+DEPARTMENT_FIELD = "employee_id__employee_work_info__department_id"
+
+
+def selected_company():
+    """
+    This method is used to get the company selected in the session, "all"
+    when no company is selected
+    """
+    request = getattr(_thread_locals, "request", None)
+    company = None
+    if request is not None:
+        company = request.session.get("selected_company")
+    return company or "all"
+
+
+def company_queryset(model):
+    """
+    This method is used to get the records of the model in the selected
+    company, like the HorillaCompanyManager does, without its duplicate
+    check queries
+    """
+    queryset = model._base_manager.all()
+    if selected_company() != "all" and hasattr(model, "company_filter"):
+        queryset = queryset.filter(model.company_filter)
+    return queryset
+
+
+def cached_metric(name, compute, *parts):
+    """
+    This method is used to get a dashboard metric from the cache, it is
+    computed and cached when missing
+
+    Args:
+        name (str): name of the metric
+        compute: function computing the metric
+        parts: the values the metric depends on, like its dates
+    """
+    timeout = getattr(
+        settings, "ATTENDANCE_DASHBOARD_CACHE_TIMEOUT", DASHBOARD_CACHE_TIMEOUT
+    )
+    if not timeout:
+        return compute()
+    key = "_".join(
+        str(part) for part in ("attendance_dashboard", name, selected_company(), *parts)
+    )
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout)
+    return value
+
+
+def day_counts(day):
+    """
+    This method is used to count the employees and the attendances of the day
+    with two aggregate queries
+
+    Returns:
+        dict: total_employees (active employees with a shift), expected
+            (active employees not on an approved leave), attendances,
+            late_come and on_time counts
+    """
+    from attendance.models import Attendance
+    from employee.models import Employee
+    from leave.models import LeaveRequest
+
+    def compute():
+        on_leave = LeaveRequest._base_manager.filter(
+            employee_id=OuterRef("pk"),
+            start_date__lte=day,
+            end_date__gte=day,
+            status="approved",
+        )
+        employees = (
+            company_queryset(Employee)
+            .filter(is_active=True)
+            .aggregate(
+                active=Count("id"),
+                total_employees=Count(
+                    "id", filter=Q(employee_work_info__shift_id__isnull=False)
+                ),
+                on_leave=Count("id", filter=Q(Exists(on_leave))),
+            )
+        )
+        attendances = (
+            company_queryset(Attendance)
+            .filter(attendance_date=day)
+            .aggregate(
+                attendances=Count("id", distinct=True),
+                late_come=Count(
+                    "late_come_early_out",
+                    filter=Q(late_come_early_out__type="late_come"),
+                    distinct=True,
+                ),
+            )
+        )
+        return {
+            "total_employees": employees["total_employees"],
+            "expected": employees["active"] - employees["on_leave"],
+            "attendances": attendances["attendances"],
+            "late_come": attendances["late_come"],
+            "on_time": attendances["attendances"] - attendances["late_come"],
+        }
+
+    return cached_metric("day", compute, day)
+
+
+def company_rollups():
+    """
+    This method is used to get the department rollups of the selected
+    company, the rollups without a company belong to every company
+    """
+    from attendance.models import AttendanceDepartmentRollup
+
+    rollups = AttendanceDepartmentRollup._base_manager.all()
+    company = selected_company()
+    if company != "all":
+        rollups = rollups.filter(Q(company_id=company) | Q(company_id__isnull=True))
+    return rollups
+
+
+def department_counts(start_date, end_date):
+    """
+    This method is used to count the on time, late come and early out
+    attendances of the departments between the dates from their daily
+    rollups
+
+    Returns:
+        list: {"label": department, "data": [on time, late come, early out]}
+            of the departments having attendances
+    """
+    from base.models import Department
+
+    def compute():
+        counts = {
+            row["department_id"]: row
+            for row in company_rollups()
+            .filter(date__range=(start_date, end_date), department_id__isnull=False)
+            .order_by()
+            .values("department_id")
+            .annotate(
+                present=Sum("present"),
+                late_come=Sum("late_come"),
+                early_out=Sum("early_out"),
+            )
+        }
+        data_set = []
+        for department_id, department in company_queryset(Department).values_list(
+            "id", "department"
+        ):
+            row = counts.get(department_id)
+            if row is None:
+                continue
+            data = [
+                row["present"] - row["late_come"],
+                row["late_come"],
+                row["early_out"],
+            ]
+            if any(data):
+                data_set.append({"label": department, "data": data})
+        return data_set
+
+    return cached_metric("departments", compute, start_date, end_date)
+
+
+def department_overtime_hours(start_date, end_date):
+    """
+    This method is used to sum the approved overtime hours of the
+    departments between the dates from their daily rollups
+
+    Returns:
+        dict: {department: overtime hours}
+    """
+
+    def compute():
+        return {
+            row["department"]: (row["overtime"] or 0) / 3600
+            for row in company_rollups()
+            .filter(
+                date__range=(start_date, end_date),
+                department_id__isnull=False,
+                overtime_second__gt=0,
+            )
+            .order_by("department_id__department")
+            .values(department=F("department_id__department"))
+            .annotate(overtime=Sum("overtime_second"))
+        }
+
+    return cached_metric("overtime", compute, start_date, end_date)
+
+
+def department_hour_accounts(records):
+    """
+    This method is used to sum the worked and pending seconds of the hour
+    accounts of each department with one query
+
+    Args:
+        records: AttendanceOverTime queryset
+
+    Returns:
+        dict: {department: (worked seconds, pending seconds)}
+    """
+    return {
+        row["department"]: (row["worked"] or 0, row["pending"] or 0)
+        for row in records.order_by()
+        .values(department=F(f"{DEPARTMENT_FIELD}__department"))
+        .annotate(
+            worked=Sum("hour_account_second"), pending=Sum("hour_pending_second")
+        )
+    }
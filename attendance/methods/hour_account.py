@@ -0,0 +1,402 @@
+"""
+hour_account.py
+
+This module is used to keep the monthly hour accounts (AttendanceOverTime)
+of the employees as running totals. Instead of summing the attendances of
+the month again, the share of an attendance in the worked, pending and
+approved overtime seconds of its month is added or removed when the
+attendance is created, changed or deleted. The days of an approved leave
+are not counted, the accounts of the months of a leave request are written
+again from the attendances when its approval changes.
+"""
+
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import (
+    Case,
+    Exists,
+    IntegerField,
+    OuterRef,
+    Q,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Cast, Coalesce, Least, StrIndex, Substr
+
+MONTHS = [
+    "january",
+    "february",
+    "march",
+    "april",
+    "may",
+    "june",
+    "july",
+    "august",
+    "september",
+    "october",
+    "november",
+    "december",
+]
+
+
+def format_seconds(seconds):
+    """
+    Seconds in the H:M format of the hour account fields
+    """
+    seconds = max(0, int(seconds))
+    return f"{seconds // 3600:02d}:{(seconds % 3600) // 60:02d}"
+
+
+def hour_seconds(value):
+    """
+    Seconds of a time in H:M format
+    """
+    hours, minutes = (value or "00:00").split(":")[:2]
+    return int(hours) * 3600 + int(minutes) * 60
+
+
+def account_key(employee_id, attendance_date):
+    """
+    The (employee id, year, month) of the hour account of an attendance
+    """
+    return (
+        employee_id,
+        str(attendance_date.year),
+        attendance_date.strftime("%B").lower(),
+    )
+
+
+def on_approved_leave(employee_id, attendance_date):
+    """
+    Whether the employee is on an approved leave on the date
+    """
+    from leave.models import LeaveRequest
+
+    return LeaveRequest._base_manager.filter(
+        employee_id=employee_id,
+        start_date__lte=attendance_date,
+        end_date__gte=attendance_date,
+        status="approved",
+    ).exists()
+
+
+def hour_account_share(state, on_leave=None):
+    """
+    This method is used to get the share of an attendance in its hour account
+
+    Args:
+        state (dict): attendance values, employee_id_id, attendance_date,
+            attendance_validated, minimum_hour, at_work_second and
+            approved_overtime_second
+        on_leave (bool): whether the day is on an approved leave, looked up
+            when not given
+
+    Returns:
+        tuple: (worked seconds, pending seconds, approved overtime seconds)
+    """
+    worked = pending = 0
+    if state["attendance_validated"]:
+        if on_leave is None:
+            on_leave = on_approved_leave(
+                state["employee_id_id"], state["attendance_date"]
+            )
+        if not on_leave:
+            minimum_second = hour_seconds(state["minimum_hour"])
+            worked = min(minimum_second, state["at_work_second"] or 0)
+            pending = minimum_second - worked
+    return worked, pending, state["approved_overtime_second"] or 0
+
+
+def _get_account(employee_id, year, month):
+    from attendance.models import AttendanceOverTime
+
+    account = (
+        AttendanceOverTime._base_manager.select_for_update()
+        .filter(employee_id=employee_id, year=year, month=month)
+        .first()
+    )
+    if account is None:
+        account = AttendanceOverTime(employee_id_id=employee_id, year=year, month=month)
+        account.save()
+    return account
+
+
+def apply_hour_account_deltas(deltas):
+    """
+    This method is used to add the deltas to the hour accounts, missing
+    accounts are created
+
+    Args:
+        deltas (dict): {(employee id, year, month): [worked, pending, overtime]}
+            seconds to add
+    """
+    from attendance.models import AttendanceOverTime
+
+    with transaction.atomic():
+        for (employee_id, year, month), (worked, pending, overtime) in deltas.items():
+            if not (worked or pending or overtime):
+                continue
+            account = _get_account(employee_id, year, month)
+            hour_account_second = max(0, (account.hour_account_second or 0) + worked)
+            hour_pending_second = max(0, (account.hour_pending_second or 0) + pending)
+            overtime_second = max(0, (account.overtime_second or 0) + overtime)
+            AttendanceOverTime._base_manager.filter(pk=account.pk).update(
+                hour_account_second=hour_account_second,
+                worked_hours=format_seconds(hour_account_second),
+                hour_pending_second=hour_pending_second,
+                pending_hours=format_seconds(hour_pending_second),
+                overtime_second=overtime_second,
+                overtime=format_seconds(overtime_second),
+            )
+
+
+def approved_leave_days(states):
+    """
+    This method is used to find, with one query, which of the validated
+    attendances fall on an approved leave
+
+    Args:
+        states (list): attendance values, like hour_account_share takes
+
+    Returns:
+        set: (employee id, attendance date) on an approved leave
+    """
+    from leave.models import LeaveRequest
+
+    keys = {
+        (state["employee_id_id"], state["attendance_date"])
+        for state in states
+        if state is not None and state["attendance_validated"]
+    }
+    if not keys:
+        return set()
+    dates = [attendance_date for _employee_id, attendance_date in keys]
+    leaves = defaultdict(list)
+    for employee_id, start_date, end_date in LeaveRequest._base_manager.filter(
+        employee_id__in={employee_id for employee_id, _date in keys},
+        start_date__lte=max(dates),
+        end_date__gte=min(dates),
+        status="approved",
+    ).values_list("employee_id", "start_date", "end_date"):
+        leaves[employee_id].append((start_date, end_date))
+    return {
+        (employee_id, attendance_date)
+        for employee_id, attendance_date in keys
+        if any(
+            start_date <= attendance_date <= end_date
+            for start_date, end_date in leaves[employee_id]
+        )
+    }
+
+
+def hour_account_deltas(changes, leave_days=None):
+    """
+    This method is used to get the hour account deltas of attendance changes
+
+    Args:
+        changes (list): (previous state, new state) of the attendances, None
+            for a created or a deleted attendance
+        leave_days (set): (employee id, date) on an approved leave, from
+            approved_leave_days, looked up per attendance when not given
+
+    Returns:
+        dict: {(employee id, year, month): [worked, pending, overtime]}
+    """
+    deltas = defaultdict(lambda: [0, 0, 0])
+    for previous, current in changes:
+        if previous == current:
+            continue
+        on_leave = None
+        if (
+            leave_days is None
+            and previous is not None
+            and current is not None
+            and previous["employee_id_id"] == current["employee_id_id"]
+            and previous["attendance_date"] == current["attendance_date"]
+            and (previous["attendance_validated"] or current["attendance_validated"])
+        ):
+            # the leave of the day is looked up once for both states
+            on_leave = on_approved_leave(
+                current["employee_id_id"], current["attendance_date"]
+            )
+        for state, sign in ((previous, -1), (current, 1)):
+            if state is None or state["employee_id_id"] is None:
+                continue
+            if leave_days is not None:
+                on_leave = (
+                    state["employee_id_id"],
+                    state["attendance_date"],
+                ) in leave_days
+            key = account_key(state["employee_id_id"], state["attendance_date"])
+            for index, seconds in enumerate(hour_account_share(state, on_leave)):
+                deltas[key][index] += sign * seconds
+    return deltas
+
+
+def _minimum_seconds():
+    """
+    minimum_hour of the attendance in seconds, as a database expression
+    """
+    separator = StrIndex("minimum_hour", Value(":"))
+    hours = Cast(Substr("minimum_hour", 1, separator - 1), IntegerField())
+    minutes = Cast(Substr("minimum_hour", separator + 1), IntegerField())
+    return hours * 3600 + minutes * 60
+
+
+def month_hour_accounts(year, month, employee_ids=None):
+    """
+    This method is used to sum the hour accounts of every employee of the
+    month with one aggregate query
+
+    Args:
+        year (int): year
+        month (int): month number, 1 to 12
+        employee_ids (list): only the accounts of these employees
+
+    Returns:
+        dict: {employee id: (worked, pending, overtime)} seconds
+    """
+    from attendance.models import Attendance
+    from leave.models import LeaveRequest
+
+    minimum_seconds = _minimum_seconds()
+    on_leave = LeaveRequest._base_manager.filter(
+        employee_id=OuterRef("employee_id"),
+        start_date__lte=OuterRef("attendance_date"),
+        end_date__gte=OuterRef("attendance_date"),
+        status="approved",
+    )
+    counted = Q(attendance_validated=True) & ~Q(Exists(on_leave))
+    attendances = Attendance._base_manager.filter(
+        attendance_date__year=year,
+        attendance_date__month=month,
+        employee_id__isnull=False,
+    )
+    if employee_ids is not None:
+        attendances = attendances.filter(employee_id__in=employee_ids)
+    rows = (
+        attendances.order_by()
+        .values("employee_id")
+        .annotate(
+            worked=Sum(
+                Case(
+                    When(
+                        counted,
+                        then=Least(minimum_seconds, Coalesce("at_work_second", 0)),
+                    ),
+                    default=0,
+                    output_field=IntegerField(),
+                )
+            ),
+            minimum=Sum(
+                Case(
+                    When(counted, then=minimum_seconds),
+                    default=0,
+                    output_field=IntegerField(),
+                )
+            ),
+            overtime=Sum("approved_overtime_second"),
+        )
+    )
+    return {
+        row["employee_id"]: (
+            row["worked"] or 0,
+            (row["minimum"] or 0) - (row["worked"] or 0),
+            row["overtime"] or 0,
+        )
+        for row in rows
+    }
+
+
+def reconcile_hour_accounts(year, month, employee_ids=None):
+    """
+    This method is used to write the hour accounts of the month from the
+    attendances, the accounts that drifted are corrected and the missing
+    ones created
+
+    Args:
+        year (int): year
+        month (int): month number, 1 to 12
+        employee_ids (list): only the accounts of these employees
+
+    Returns:
+        tuple: (number of corrected accounts, number of created accounts)
+    """
+    from attendance.models import AttendanceOverTime
+
+    month_name = MONTHS[month - 1]
+    totals = month_hour_accounts(year, month, employee_ids)
+    accounts = AttendanceOverTime._base_manager.filter(
+        year=str(year), month=month_name
+    )
+    if employee_ids is not None:
+        accounts = accounts.filter(employee_id__in=employee_ids)
+    accounts = {account.employee_id_id: account for account in accounts}
+    changed = []
+    created = []
+    for employee_id in set(totals) | set(accounts):
+        worked, pending, overtime = totals.get(employee_id, (0, 0, 0))
+        account = accounts.get(employee_id)
+        if account is None:
+            if not (worked or pending or overtime):
+                continue
+            account = AttendanceOverTime(
+                employee_id_id=employee_id,
+                year=str(year),
+                month=month_name,
+                month_sequence=month - 1,
+            )
+            created.append(account)
+        elif (
+            account.hour_account_second,
+            account.hour_pending_second,
+            account.overtime_second,
+        ) == (worked, pending, overtime):
+            continue
+        else:
+            changed.append(account)
+        account.hour_account_second = worked
+        account.worked_hours = format_seconds(worked)
+        account.hour_pending_second = pending
+        account.pending_hours = format_seconds(pending)
+        account.overtime_second = overtime
+        account.overtime = format_seconds(overtime)
+    with transaction.atomic():
+        AttendanceOverTime._base_manager.bulk_update(
+            changed,
+            [
+                "hour_account_second",
+                "worked_hours",
+                "hour_pending_second",
+                "pending_hours",
+                "overtime_second",
+                "overtime",
+            ],
+            batch_size=500,
+        )
+        AttendanceOverTime._base_manager.bulk_create(created, batch_size=500)
+    return len(changed), len(created)
+
+
+def reconcile_leave_hour_accounts(states):
+    """
+    This method is used to write again the hour accounts of the months of
+    approved leave requests, when they are approved, cancelled, moved or
+    deleted
+
+    Args:
+        states (list): values of the leave requests, employee_id, start_date,
+            end_date and status, before and after the change
+    """
+    employee_ids = defaultdict(set)
+    for state in states:
+        if state is None or state["status"] != "approved":
+            continue
+        year, month = state["start_date"].year, state["start_date"].month
+        end_date = state["end_date"] or state["start_date"]
+        while (year, month) <= (end_date.year, end_date.month):
+            employee_ids[(year, month)].add(state["employee_id"])
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    for (year, month), ids in employee_ids.items():
+        reconcile_hour_accounts(year, month, list(ids))
@@ -0,0 +1,87 @@
+"""
+online_employees.py
+
+This module is used to keep the ids of the employees currently clocked in,
+the employees having an open attendance of today or yesterday, in the
+cache. The set is read once from the attendances and then kept up to date
+by the clock-in and clock-out events, so the online status of the employee
+cards is shown without a query. The set is kept per day, and for at most
+ONLINE_EMPLOYEES_CACHE_TIMEOUT seconds so a lost concurrent update does not
+last.
+"""
+
+from datetime import date, timedelta
+from django.conf import settings
+from django.core.cache import cache
+
+ONLINE_EMPLOYEES_KEY = "attendance_online_employees_{day}"
+ONLINE_EMPLOYEES_CACHE_TIMEOUT = 60 * 10
+
+
+def _timeout():
+    return getattr(
+        settings, "ONLINE_EMPLOYEES_CACHE_TIMEOUT", ONLINE_EMPLOYEES_CACHE_TIMEOUT
+    )
+
+
+def _key(today=None):
+    return ONLINE_EMPLOYEES_KEY.format(day=today or date.today())
+
+
+def get_online_employee_ids():
+    """
+    This method is used to get the ids of the employees currently clocked in
+
+    Returns:
+        frozenset: ids of the employees with an open attendance of today or
+            yesterday
+    """
+    from attendance.models import Attendance
+
+    today = date.today()
+    employee_ids = cache.get(_key(today))
+    if employee_ids is None:
+        employee_ids = frozenset(
+            Attendance._base_manager.filter(
+                attendance_date__gte=today - timedelta(days=1),
+                attendance_date__lte=today,
+                attendance_clock_out_date__isnull=True,
+                employee_id__isnull=False,
+            ).values_list("employee_id", flat=True)
+        )
+        cache.set(_key(today), employee_ids, _timeout())
+    return employee_ids
+
+
+def update_online_employees(attendances):
+    """
+    This method is used to apply the clock-in and clock-out of attendances to
+    the cached set, an open attendance puts its employee online and a closed
+    one takes it offline
+
+    Args:
+        attendances (list): saved Attendance instances
+    """
+    today = date.today()
+    employee_ids = cache.get(_key(today))
+    if employee_ids is None:
+        # read from the attendances on the next request
+        return
+    online = set(employee_ids)
+    for attendance in attendances:
+        if not today - timedelta(days=1) <= attendance.attendance_date <= today:
+            continue
+        if attendance.attendance_clock_out_date is None:
+            online.add(attendance.employee_id_id)
+        else:
+            online.discard(attendance.employee_id_id)
+    if online != employee_ids:
+        cache.set(_key(today), frozenset(online), _timeout())
+
+
+def invalidate_online_employees():
+    """
+    This method is used to drop the cached set, it is read again from the
+    attendances
+    """
+    cache.delete(_key())
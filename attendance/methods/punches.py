@@ -0,0 +1,462 @@
+"""
+punches.py
+
+This module is used to apply the punches of the biometric devices, a punch
+is a (badge id, timestamp) event. The punches of a batch are grouped by
+employee, each punch checks the employee in or out like the clock-in and
+clock-out views do, and the activities, attendances and late come / early
+out records are written in bulk at the end of the batch.
+"""
+
+import csv
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+from attendance.methods.hour_account import (
+    apply_hour_account_deltas,
+    approved_leave_days,
+    hour_account_deltas,
+)
+from attendance.methods.online_employees import update_online_employees
+from attendance.methods.rollups import refresh_attendance_rollups
+from attendance.methods.save_lookups import get_shift_day_id, get_validation_at_work
+from attendance.methods.schedule_cache import grace_seconds, shift_schedule
+from attendance.models import (
+    Attendance,
+    AttendanceActivity,
+    AttendanceLateComeEarlyOut,
+    format_time,
+    strtime_seconds,
+)
+from employee.models import Employee
+from leave.calendar_cache import get_employee_company_id
+
+MID_DAY_SECONDS = 12 * 3600
+
+ATTENDANCE_PUNCH_FIELDS = [
+    "attendance_clock_out",
+    "attendance_clock_out_date",
+    "attendance_worked_hour",
+    "attendance_overtime",
+    "attendance_validated",
+    "at_work_second",
+    "overtime_second",
+    "approved_overtime_second",
+    "attendance_day",
+    "minimum_hour",
+]
+
+
+def parse_punch(badge_id, timestamp):
+    """
+    This method is used to parse a punch
+
+    Args:
+        badge_id: badge id of the employee
+        timestamp (str or datetime): time of the punch, ISO format when a string
+
+    Returns:
+        tuple: (badge id, local naive datetime), None when the punch is invalid
+    """
+    if isinstance(timestamp, str):
+        timestamp = parse_datetime(timestamp.strip())
+    if badge_id in (None, "") or not isinstance(timestamp, datetime):
+        return None
+    if timezone.is_aware(timestamp):
+        timestamp = timezone.make_naive(timestamp)
+    return (str(badge_id).strip(), timestamp.replace(microsecond=0))
+
+
+def read_punches(lines):
+    """
+    This method is used to read punches from csv lines of badge id,timestamp
+
+    Returns:
+        tuple: (punches, invalid lines)
+    """
+    punches = []
+    invalid = []
+    for row in csv.reader(lines):
+        if not row or row[0].strip().lower() in ("badge", "badge_id", "badge id"):
+            continue
+        punch = parse_punch(row[0], row[1] if len(row) > 1 else None)
+        if punch is None:
+            invalid.append(",".join(row))
+        else:
+            punches.append(punch)
+    return punches, invalid
+
+
+def _seconds(moment):
+    return moment.hour * 3600 + moment.minute * 60
+
+
+def _activity_seconds(activity):
+    in_datetime = datetime.combine(activity.clock_in_date, activity.clock_in)
+    out_datetime = datetime.combine(activity.clock_out_date, activity.clock_out)
+    difference = out_datetime - in_datetime
+    return difference.days * 24 * 3600 + difference.seconds
+
+
+class PunchBatch:
+    """
+    Applies a batch of punches, the state of the employees is read with a
+    fixed number of queries whatever the number of punches
+    """
+
+    def __init__(self, punches):
+        self.punches = defaultdict(list)
+        for badge_id, timestamp in punches:
+            self.punches[badge_id].append(timestamp)
+        self.result = {
+            "clock_in": 0,
+            "clock_out": 0,
+            "late_come": 0,
+            "early_out": 0,
+            "skipped": 0,
+            "errors": [],
+        }
+        self.new_activities = []
+        self.closed_activities = []
+        self.new_attendances = []
+        self.changed_attendances = []
+        self.new_late_early = []
+        self.removed_late_early = []
+
+    def _load(self):
+        """
+        Read the employees, their activities and attendances since the day
+        before the first punch and their late come and early out records
+        """
+        last_activity = AttendanceActivity._base_manager.filter(
+            employee_id=OuterRef("pk")
+        ).order_by("-attendance_date", "-id")
+        last_attendance = Attendance._base_manager.filter(
+            employee_id=OuterRef("pk")
+        ).order_by("-attendance_date", "-id")
+        self.employees = {}
+        for employee in (
+            Employee._base_manager.filter(
+                badge_id__in=list(self.punches), is_active=True
+            )
+            .select_related(
+                "employee_work_info__shift_id",
+                "employee_work_info__work_type_id",
+            )
+            .annotate(
+                last_activity_id=Subquery(last_activity.values("id")[:1]),
+                last_attendance_id=Subquery(last_attendance.values("id")[:1]),
+            )
+        ):
+            self.employees.setdefault(employee.badge_id, employee)
+        employee_ids = [employee.id for employee in self.employees.values()]
+        first_day = min(
+            min(timestamps) for timestamps in self.punches.values()
+        ).date() - timedelta(days=1)
+
+        self.activities = defaultdict(list)
+        for activity in AttendanceActivity._base_manager.filter(
+            Q(employee_id__in=employee_ids, attendance_date__gte=first_day)
+            | Q(
+                id__in=[
+                    employee.last_activity_id
+                    for employee in self.employees.values()
+                    if employee.last_activity_id
+                ]
+            )
+        ).order_by("attendance_date", "id"):
+            self.activities[activity.employee_id_id].append(activity)
+
+        self.attendances = defaultdict(dict)
+        for attendance in Attendance._base_manager.filter(
+            Q(employee_id__in=employee_ids, attendance_date__gte=first_day)
+            | Q(
+                id__in=[
+                    employee.last_attendance_id
+                    for employee in self.employees.values()
+                    if employee.last_attendance_id
+                ]
+            )
+        ):
+            self.attendances[attendance.employee_id_id][
+                attendance.attendance_date
+            ] = attendance
+
+        self.late_early = defaultdict(dict)
+        for record in AttendanceLateComeEarlyOut._base_manager.filter(
+            attendance_id__in=[
+                attendance.id
+                for attendances in self.attendances.values()
+                for attendance in attendances.values()
+            ]
+        ):
+            self.late_early[record.attendance_id_id][record.type] = record
+
+        self.validation_at_work = strtime_seconds(get_validation_at_work())
+
+    def schedule(self, shift, day_id):
+        """
+        (minimum hour, start seconds, end seconds) of the shift on the day
+        """
+        return shift_schedule(shift.id if shift else None, day_id)
+
+    def grace_seconds(self, shift, employee):
+        """
+        Grace time of the shift, the default grace time of the employee's
+        company otherwise
+        """
+        return grace_seconds(
+            shift.id if shift else None, get_employee_company_id(employee)
+        )
+
+    def _late_early(self, attendance):
+        """
+        Late come / early out records of the attendance, True for the
+        records marked in this batch
+        """
+        return self.late_early[attendance.pk or id(attendance)]
+
+    def _mark(self, attendance, record_type):
+        self._late_early(attendance)[record_type] = True
+        self.new_late_early.append(
+            AttendanceLateComeEarlyOut(
+                attendance_id=attendance,
+                employee_id=attendance.employee_id,
+                type=record_type,
+            )
+        )
+        self.result[record_type] += 1
+
+    def _latest_attendance(self, employee):
+        attendances = self.attendances[employee.id]
+        if not attendances:
+            return None
+        return attendances[max(attendances)]
+
+    def clock_in(self, employee, moment):
+        """
+        Check in the employee at the moment, like the clock-in view
+        """
+        work_info = employee.employee_work_info
+        shift = work_info.shift_id
+        date_today = moment.date()
+        attendance_date = date_today
+        day_id = get_shift_day_id(date_today.strftime("%A").lower())
+        minimum_hour, start_time, end_time = self.schedule(shift, day_id)
+        now_sec = _seconds(moment)
+        if start_time > end_time and MID_DAY_SECONDS > now_sec:
+            # night shift punched before noon belongs to the previous day
+            attendance_date = date_today - timedelta(days=1)
+            day_id = get_shift_day_id(attendance_date.strftime("%A").lower())
+            minimum_hour, start_time, end_time = self.schedule(shift, day_id)
+
+        activity = AttendanceActivity(
+            employee_id=employee,
+            attendance_date=attendance_date,
+            clock_in_date=date_today,
+            shift_day_id=day_id,
+            clock_in=moment.time(),
+            in_datetime=timezone.make_aware(moment),
+        )
+        self.activities[employee.id].append(activity)
+        self.new_activities.append(activity)
+
+        attendance = self.attendances[employee.id].get(attendance_date)
+        if attendance is None:
+            attendance = Attendance(
+                employee_id=employee,
+                shift_id=shift,
+                work_type_id=work_info.work_type_id,
+                attendance_date=attendance_date,
+                attendance_day_id=day_id,
+                attendance_clock_in=moment.time().replace(second=0),
+                attendance_clock_in_date=date_today,
+                minimum_hour=minimum_hour,
+            )
+            # the minimum hour of a holiday is cleared on the check-in save
+            attendance.compute_hours(get_employee_company_id(employee))
+            self.attendances[employee.id][attendance_date] = attendance
+            self.new_attendances.append(attendance)
+            late_sec = now_sec - self.grace_seconds(shift, employee)
+            if start_time > end_time:
+                late = late_sec < MID_DAY_SECONDS or late_sec > start_time
+            else:
+                late = start_time < late_sec
+            if late:
+                self._mark(attendance, "late_come")
+        else:
+            attendance.attendance_clock_out = None
+            attendance.attendance_clock_out_date = None
+            self._changed(attendance)
+            record = self._late_early(attendance).pop("early_out", None)
+            if record is True:
+                # early out marked earlier in this batch
+                self.new_late_early = [
+                    item
+                    for item in self.new_late_early
+                    if not (item.attendance_id is attendance and item.type == "early_out")
+                ]
+                self.result["early_out"] -= 1
+            elif record is not None:
+                self.removed_late_early.append(record.id)
+        self.result["clock_in"] += 1
+
+    def clock_out(self, employee, moment):
+        """
+        Check out the employee at the moment, like the clock-out view
+        """
+        attendance = self._latest_attendance(employee)
+        activities = self.activities[employee.id]
+        if attendance is None or not activities:
+            self.result["skipped"] += 1
+            return
+        shift = employee.employee_work_info.shift_id
+        _minimum_hour, start_time, end_time = self.schedule(
+            shift, attendance.attendance_day_id
+        )
+        now_sec = _seconds(moment)
+        if "early_out" not in self._late_early(attendance):
+            if start_time > end_time:
+                early = now_sec >= MID_DAY_SECONDS or now_sec < end_time
+            else:
+                early = end_time > now_sec
+            if early:
+                self._mark(attendance, "early_out")
+
+        activity = activities[-1]
+        activity.clock_out = moment.time()
+        activity.clock_out_date = moment.date()
+        activity.out_datetime = timezone.make_aware(moment)
+        if activity.pk is not None:
+            self.closed_activities.append(activity)
+        duration = sum(
+            _activity_seconds(item)
+            for item in activities
+            if item.attendance_date == activity.attendance_date
+            and item.clock_out is not None
+        )
+        attendance.attendance_clock_out = moment.time().replace(second=0)
+        attendance.attendance_clock_out_date = moment.date()
+        attendance.attendance_worked_hour = format_time(duration)
+        attendance.attendance_validated = self.validation_at_work >= strtime_seconds(
+            attendance.attendance_worked_hour
+        )
+        self._changed(attendance)
+        self.result["clock_out"] += 1
+
+    def _changed(self, attendance):
+        if attendance.pk is not None and attendance not in self.changed_attendances:
+            self.changed_attendances.append(attendance)
+
+    def apply(self):
+        """
+        This method is used to apply the punches
+
+        Returns:
+            dict: number of check-ins, check-outs, late comes, early outs and
+                skipped punches, and the errors
+        """
+        if not self.punches:
+            return self.result
+        self._load()
+        for badge_id, timestamps in self.punches.items():
+            employee = self.employees.get(badge_id)
+            if employee is None:
+                self.result["errors"].append(f"Invalid Badge ID given {badge_id}")
+                continue
+            if getattr(employee, "employee_work_info", None) is None:
+                self.result["errors"].append(
+                    f"Work information of {badge_id} is not filled"
+                )
+                continue
+            activities = self.activities[employee.id]
+            last_event = None
+            if activities:
+                last = activities[-1]
+                last_event = datetime.combine(
+                    last.clock_out_date or last.clock_in_date,
+                    last.clock_out or last.clock_in,
+                )
+            for moment in sorted(timestamps):
+                if last_event is not None and moment <= last_event:
+                    # repeated or already applied punch
+                    self.result["skipped"] += 1
+                    continue
+                if activities and activities[-1].clock_out is None:
+                    self.clock_out(employee, moment)
+                else:
+                    self.clock_in(employee, moment)
+                last_event = moment
+        self._write()
+        return self.result
+
+    def _write(self):
+        """
+        Write the changes of the batch
+        """
+        touched = self.new_attendances + self.changed_attendances
+        previous_states = [
+            attendance.stored_hour_account_state() for attendance in touched
+        ]
+        for attendance in touched:
+            attendance.compute_hours(get_employee_company_id(attendance.employee_id))
+
+        with transaction.atomic():
+            if self.new_attendances:
+                bulk_create_with_history(self.new_attendances, Attendance)
+            if self.changed_attendances:
+                bulk_update_with_history(
+                    self.changed_attendances,
+                    Attendance,
+                    ATTENDANCE_PUNCH_FIELDS,
+                    manager=Attendance._base_manager,
+                )
+            if touched:
+                from payroll.methods.work_records import (
+                    write_attendance_work_records,
+                )
+
+                write_attendance_work_records(touched)
+                current_states = [
+                    attendance.hour_account_state() for attendance in touched
+                ]
+                apply_hour_account_deltas(
+                    hour_account_deltas(
+                        zip(previous_states, current_states),
+                        approved_leave_days(previous_states + current_states),
+                    )
+                )
+                for attendance, state in zip(touched, current_states):
+                    attendance._loaded_values = state
+
+            AttendanceActivity._base_manager.bulk_create(self.new_activities)
+            AttendanceActivity._base_manager.bulk_update(
+                self.closed_activities, ["clock_out", "clock_out_date", "out_datetime"]
+            )
+            AttendanceLateComeEarlyOut._base_manager.filter(
+                id__in=self.removed_late_early
+            ).delete()
+            AttendanceLateComeEarlyOut._base_manager.bulk_create(self.new_late_early)
+            refresh_attendance_rollups(
+                (attendance.employee_id_id, attendance.attendance_date)
+                for attendance in touched
+            )
+        update_online_employees(touched)
+
+
+def ingest_punches(punches):
+    """
+    This method is used to apply a batch of punches
+
+    Args:
+        punches (list): (badge id, datetime) events, like parse_punch returns
+
+    Returns:
+        dict: number of check-ins, check-outs, late comes, early outs and
+            skipped punches, and the errors
+    """
+    return PunchBatch(punches).apply()
@@ -0,0 +1,275 @@
+"""
+rollups.py
+
+This module is used to keep the daily attendance rollups, the totals of
+the attendances of each employee and each department per day that the
+dashboards read instead of the attendances. The rollups of the employee
+days whose attendances changed are refreshed from these attendances, and
+the department rollups get the difference. The rollups of a period can
+also be rebuilt from scratch.
+"""
+
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from attendance.methods.hour_account import hour_seconds
+
+ROLLUP_FIELDS = [
+    "present",
+    "late_come",
+    "early_out",
+    "worked_second",
+    "overtime_second",
+    "pending_second",
+]
+
+
+def _late_early_count(record_type):
+    """
+    Number of the late come or early out records of the attendance, as a
+    subquery
+    """
+    from attendance.models import AttendanceLateComeEarlyOut
+
+    return Coalesce(
+        Subquery(
+            AttendanceLateComeEarlyOut._base_manager.filter(
+                attendance_id=OuterRef("pk"), type=record_type
+            )
+            .order_by()
+            .values("attendance_id")
+            .annotate(count=Count("id"))
+            .values("count")
+        ),
+        0,
+    )
+
+
+def employee_rollups(attendances):
+    """
+    This method is used to sum the attendances into the daily rollups of the
+    employees with one query
+
+    Args:
+        attendances: Attendance queryset
+
+    Returns:
+        dict: {(employee id, date): rollup values}
+    """
+    rollups = {}
+    for row in (
+        attendances.filter(employee_id__isnull=False)
+        .order_by()
+        .annotate(
+            late_come_count=_late_early_count("late_come"),
+            early_out_count=_late_early_count("early_out"),
+        )
+        .values(
+            "employee_id",
+            "attendance_date",
+            "at_work_second",
+            "minimum_hour",
+            "approved_overtime_second",
+            "attendance_validated",
+            "late_come_count",
+            "early_out_count",
+            company=F("employee_id__employee_work_info__company_id"),
+            department=F("employee_id__employee_work_info__department_id"),
+        )
+        .iterator(chunk_size=2000)
+    ):
+        key = (row["employee_id"], row["attendance_date"])
+        rollup = rollups.setdefault(
+            key,
+            {
+                "company_id_id": row["company"],
+                "department_id_id": row["department"],
+                **{field: 0 for field in ROLLUP_FIELDS},
+            },
+        )
+        at_work_second = row["at_work_second"] or 0
+        rollup["present"] += 1
+        rollup["late_come"] += row["late_come_count"]
+        rollup["early_out"] += row["early_out_count"]
+        rollup["worked_second"] += at_work_second
+        # the approved overtime counts once the attendance is validated
+        if row["attendance_validated"]:
+            rollup["overtime_second"] += row["approved_overtime_second"] or 0
+        rollup["pending_second"] += max(
+            0, hour_seconds(row["minimum_hour"]) - at_work_second
+        )
+    return rollups
+
+
+def apply_department_deltas(deltas):
+    """
+    This method is used to add the deltas to the department rollups, the
+    missing rollups are created and the empty ones deleted
+
+    Args:
+        deltas (dict): {(date, company id, department id): [delta of each
+            ROLLUP_FIELDS]}
+    """
+    from attendance.models import AttendanceDepartmentRollup
+
+    deltas = {key: delta for key, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+    rows = {
+        (row.date, row.company_id_id, row.department_id_id): row
+        for row in AttendanceDepartmentRollup._base_manager.select_for_update().filter(
+            date__in={day for day, _company_id, _department_id in deltas}
+        )
+    }
+    to_create = []
+    to_update = []
+    to_delete = []
+    for (day, company_id, department_id), delta in deltas.items():
+        row = rows.get((day, company_id, department_id))
+        if row is None:
+            row = AttendanceDepartmentRollup(
+                date=day, company_id_id=company_id, department_id_id=department_id
+            )
+            to_create.append(row)
+        elif any(
+            getattr(row, field) + change for field, change in zip(ROLLUP_FIELDS, delta)
+        ):
+            to_update.append(row)
+        else:
+            to_delete.append(row.pk)
+            continue
+        for field, change in zip(ROLLUP_FIELDS, delta):
+            setattr(row, field, getattr(row, field) + change)
+    AttendanceDepartmentRollup._base_manager.bulk_create(to_create, batch_size=1000)
+    AttendanceDepartmentRollup._base_manager.bulk_update(
+        to_update, ROLLUP_FIELDS, batch_size=1000
+    )
+    AttendanceDepartmentRollup._base_manager.filter(pk__in=to_delete).delete()
+
+
+def refresh_attendance_rollups(keys):
+    """
+    This method is used to refresh the daily rollups of employee days from
+    their attendances, the department rollups get the differences
+
+    Args:
+        keys (list): (employee id, date) of the changed attendances
+    """
+    from attendance.models import Attendance, AttendanceDailyRollup
+
+    keys = {
+        (employee_id, day)
+        for employee_id, day in keys
+        if employee_id is not None and day is not None
+    }
+    if not keys:
+        return
+    employee_ids = {employee_id for employee_id, _day in keys}
+    dates = [day for _employee_id, day in keys]
+    with transaction.atomic():
+        # every key gets a rollup row to lock, the attendances are read once
+        # the rows are locked so two refreshes of a day don't interleave
+        AttendanceDailyRollup._base_manager.bulk_create(
+            [
+                AttendanceDailyRollup(employee_id_id=employee_id, date=day)
+                for employee_id, day in keys
+            ],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+        stored = {
+            (row.employee_id_id, row.date): row
+            for row in AttendanceDailyRollup._base_manager.select_for_update().filter(
+                employee_id__in=employee_ids, date__range=(min(dates), max(dates))
+            )
+        }
+        current = employee_rollups(
+            Attendance._base_manager.filter(
+                employee_id__in=employee_ids,
+                attendance_date__range=(min(dates), max(dates)),
+            )
+        )
+        deltas = defaultdict(lambda: [0] * len(ROLLUP_FIELDS))
+        to_update = []
+        to_delete = []
+        for key in keys:
+            row = stored[key]
+            values = current.get(key)
+            delta = deltas[(row.date, row.company_id_id, row.department_id_id)]
+            for index, field in enumerate(ROLLUP_FIELDS):
+                delta[index] -= getattr(row, field)
+            if values is None:
+                to_delete.append(row.pk)
+                continue
+            delta = deltas[
+                (key[1], values["company_id_id"], values["department_id_id"])
+            ]
+            for index, field in enumerate(ROLLUP_FIELDS):
+                delta[index] += values[field]
+            if any(getattr(row, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(row, field, value)
+                to_update.append(row)
+        AttendanceDailyRollup._base_manager.filter(pk__in=to_delete).delete()
+        AttendanceDailyRollup._base_manager.bulk_update(
+            to_update,
+            ["company_id", "department_id"] + ROLLUP_FIELDS,
+            batch_size=1000,
+        )
+        apply_department_deltas(deltas)
+
+
+def rebuild_attendance_rollups(start_date, end_date):
+    """
+    This method is used to write the daily rollups of the employees and the
+    departments between the dates from the attendances
+
+    Returns:
+        tuple: (number of employee rollups, number of department rollups)
+    """
+    from attendance.models import (
+        Attendance,
+        AttendanceDailyRollup,
+        AttendanceDepartmentRollup,
+    )
+
+    rollups = employee_rollups(
+        Attendance._base_manager.filter(
+            attendance_date__range=(start_date, end_date)
+        )
+    )
+    departments = defaultdict(lambda: [0] * len(ROLLUP_FIELDS))
+    for (_employee_id, day), values in rollups.items():
+        total = departments[
+            (day, values["company_id_id"], values["department_id_id"])
+        ]
+        for index, field in enumerate(ROLLUP_FIELDS):
+            total[index] += values[field]
+    with transaction.atomic():
+        AttendanceDailyRollup._base_manager.filter(
+            date__range=(start_date, end_date)
+        ).delete()
+        AttendanceDepartmentRollup._base_manager.filter(
+            date__range=(start_date, end_date)
+        ).delete()
+        AttendanceDailyRollup._base_manager.bulk_create(
+            [
+                AttendanceDailyRollup(employee_id_id=employee_id, date=day, **values)
+                for (employee_id, day), values in rollups.items()
+            ],
+            batch_size=1000,
+        )
+        AttendanceDepartmentRollup._base_manager.bulk_create(
+            [
+                AttendanceDepartmentRollup(
+                    date=day,
+                    company_id_id=company_id,
+                    department_id_id=department_id,
+                    **dict(zip(ROLLUP_FIELDS, total)),
+                )
+                for (day, company_id, department_id), total in departments.items()
+            ],
+            batch_size=1000,
+        )
+    return len(rollups), len(departments)
@@ -0,0 +1,92 @@
+"""
+save_lookups.py
+
+This module is used to keep the lookups of Attendance.save in the cache,
+the shift day ids and the overtime cutoff, at work limit and minimum
+overtime to approve of the attendance validation condition. The cached values are dropped by the
+model signals.
+"""
+
+from django.core.cache import cache
+
+SHIFT_DAYS_KEY = "attendance_shift_day_ids"
+VALIDATION_CONDITION_KEY = "attendance_validation_condition"
+CACHE_TIMEOUT = 60 * 60 * 24
+
+# at work limit of the validation when no condition is set
+DEFAULT_VALIDATION_AT_WORK = "09:00"
+
+
+def get_shift_day_id(day):
+    """
+    This method is used to get the id of the EmployeeShiftDay of a week day
+
+    Args:
+        day (str): lower case day name, like "monday"
+    """
+    from base.models import EmployeeShiftDay
+
+    shift_days = cache.get(SHIFT_DAYS_KEY)
+    if shift_days is None or day not in shift_days:
+        shift_days = {}
+        for shift_day_id, shift_day in EmployeeShiftDay._base_manager.order_by(
+            "-id"
+        ).values_list("id", "day"):
+            shift_days[shift_day] = shift_day_id
+        cache.set(SHIFT_DAYS_KEY, shift_days, CACHE_TIMEOUT)
+    if day not in shift_days:
+        raise EmployeeShiftDay.DoesNotExist(f"No shift day {day}")
+    return shift_days[day]
+
+
+def _validation_condition():
+    from attendance.models import AttendanceValidationCondition
+
+    condition = cache.get(VALIDATION_CONDITION_KEY)
+    if condition is None:
+        condition = (
+            AttendanceValidationCondition._base_manager.order_by("id")
+            .values(
+                "overtime_cutoff",
+                "validation_at_work",
+                "minimum_overtime_to_approve",
+            )
+            .first()
+        ) or {
+            "overtime_cutoff": None,
+            "validation_at_work": None,
+            "minimum_overtime_to_approve": None,
+        }
+        cache.set(VALIDATION_CONDITION_KEY, condition, CACHE_TIMEOUT)
+    return condition
+
+
+def get_overtime_cutoff():
+    """
+    This method is used to get the overtime cutoff of the attendance
+    validation condition, None when there is no cutoff
+    """
+    return _validation_condition()["overtime_cutoff"] or None
+
+
+def get_validation_at_work():
+    """
+    This method is used to get the at work limit under which an attendance
+    is validated on check-out
+    """
+    return _validation_condition()["validation_at_work"] or DEFAULT_VALIDATION_AT_WORK
+
+
+def get_minimum_overtime_to_approve():
+    """
+    This method is used to get the minimum overtime an attendance needs to
+    have its overtime approved
+    """
+    return _validation_condition()["minimum_overtime_to_approve"] or "00:00"
+
+
+def invalidate_save_lookups():
+    """
+    This method is used to drop the cached lookups
+    """
+    cache.delete_many([SHIFT_DAYS_KEY, VALIDATION_CONDITION_KEY])
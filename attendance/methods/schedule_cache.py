@@ -0,0 +1,140 @@
+"""
+schedule_cache.py
+
+This module is used to keep the clock-in configuration in the cache, the
+weekly schedule table of the shifts and the grace times of every company,
+so checking in and out does not read them again. The cached values are
+dropped by the model signals.
+"""
+
+import time
+from django.core.cache import cache
+from django.db.models import Q
+from attendance.methods.save_lookups import CACHE_TIMEOUT
+
+SHIFT_SCHEDULES_KEY = "attendance_shift_schedules"
+GRACE_TIMES_KEY = "attendance_grace_times"
+GRACE_TIMES_VERSION_KEY = f"{GRACE_TIMES_KEY}_version"
+
+# schedule of a day the shift has no schedule for
+NO_SCHEDULE = ("00:00", 0, 0)
+
+
+def _time_seconds(value):
+    return value.hour * 3600 + value.minute * 60
+
+
+def get_shift_schedules():
+    """
+    This method is used to get the weekly schedule table of the shifts
+
+    Returns:
+        dict: {shift id: {shift day id: (minimum hour, start seconds,
+            end seconds)}}
+    """
+    from base.models import EmployeeShiftSchedule
+
+    schedules = cache.get(SHIFT_SCHEDULES_KEY)
+    if schedules is None:
+        schedules = {}
+        for (
+            shift_id,
+            day_id,
+            minimum_hour,
+            start_time,
+            end_time,
+        ) in EmployeeShiftSchedule._base_manager.order_by("id").values_list(
+            "shift_id", "day_id", "minimum_working_hour", "start_time", "end_time"
+        ):
+            if start_time is None or end_time is None:
+                continue
+            schedules.setdefault(shift_id, {}).setdefault(
+                day_id,
+                (minimum_hour, _time_seconds(start_time), _time_seconds(end_time)),
+            )
+        cache.set(SHIFT_SCHEDULES_KEY, schedules, CACHE_TIMEOUT)
+    return schedules
+
+
+def shift_schedule(shift_id, day_id):
+    """
+    This method is used to get the schedule of a shift on a week day
+
+    Args:
+        shift_id (int): id of the shift
+        day_id (int): id of the EmployeeShiftDay
+
+    Returns:
+        tuple: (minimum hour, start seconds, end seconds)
+    """
+    return get_shift_schedules().get(shift_id, {}).get(day_id, NO_SCHEDULE)
+
+
+def get_grace_times(company_id=None):
+    """
+    This method is used to get the grace times of the shifts and the
+    default grace time of the company
+
+    Args:
+        company_id (int): company of the employee, the default grace time is
+            the one of the company or of no company, any company when None
+
+    Returns:
+        dict: {"default": seconds or None, "shifts": {shift id: seconds}},
+            an inactive grace time of a shift allows 0 seconds
+    """
+    from attendance.models import GraceTime
+    from base.models import EmployeeShift
+
+    version = cache.get_or_set(GRACE_TIMES_VERSION_KEY, time.time_ns(), None)
+    key = f"{GRACE_TIMES_KEY}_{version}_{company_id or 'all'}"
+    grace_times = cache.get(key)
+    if grace_times is None:
+        company_filter = (
+            Q()
+            if company_id is None
+            else Q(company_id=company_id) | Q(company_id__isnull=True)
+        )
+        grace_times = {
+            "default": GraceTime._base_manager.filter(
+                company_filter, is_default=True, is_active=True
+            )
+            .order_by("id")
+            .values_list("allowed_time_in_secs", flat=True)
+            .first(),
+            "shifts": {
+                shift_id: allowed_time_in_secs if is_active else 0
+                for shift_id, is_active, allowed_time_in_secs in (
+                    EmployeeShift._base_manager.filter(
+                        grace_time_id__isnull=False
+                    ).values_list(
+                        "id",
+                        "grace_time_id__is_active",
+                        "grace_time_id__allowed_time_in_secs",
+                    )
+                )
+            },
+        }
+        cache.set(key, grace_times, CACHE_TIMEOUT)
+    return grace_times
+
+
+def grace_seconds(shift_id, company_id=None):
+    """
+    This method is used to get the grace time allowed on the check-in of a
+    shift, the grace time of the shift has the higher priority over the
+    default one of the employee's company
+    """
+    grace_times = get_grace_times(company_id)
+    if shift_id in grace_times["shifts"]:
+        return grace_times["shifts"][shift_id] or 0
+    return grace_times["default"] or 0
+
+
+def invalidate_schedule_cache():
+    """
+    This method is used to drop the cached schedules and the grace times of
+    every company
+    """
+    cache.delete(SHIFT_SCHEDULES_KEY)
+    cache.set(GRACE_TIMES_VERSION_KEY, time.time_ns(), None)
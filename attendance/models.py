@@ -10,27 +10,47 @@ import json
 import contextlib
 import datetime as dt
 from datetime import datetime, date, timedelta
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
 from django.core.exceptions import ValidationError
 from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
 import pandas as pd
-from base.models import Company, EmployeeShift, EmployeeShiftDay, WorkType
+from base.models import (
+    Company,
+    Department,
+    EmployeeShift,
+    EmployeeShiftDay,
+    EmployeeShiftSchedule,
+    WorkType,
+)
 from base.horilla_company_manager import HorillaCompanyManager
-from employee.models import Employee
+from employee.models import Employee, EmployeeWorkInformation
 from horilla.models import HorillaModel
 from horilla_audit.models import HorillaAuditInfo, HorillaAuditLog
+from leave.calendar_cache import get_employee_company_id, is_non_working_day
 from leave.models import (
-    WEEK_DAYS,
     WEEKS,
-    CompanyLeave,
-    Holiday,
     LeaveRequest,
     LeaveType,
 )
 from attendance.methods.differentiate import get_diff_dict
+from attendance.methods.hour_account import (
+    apply_hour_account_deltas,
+    hour_account_deltas,
+    reconcile_leave_hour_accounts,
+)
+from attendance.methods.online_employees import (
+    invalidate_online_employees,
+    update_online_employees,
+)
+from attendance.methods.rollups import refresh_attendance_rollups
+from attendance.methods.save_lookups import (
+    get_overtime_cutoff,
+    get_shift_day_id,
+    invalidate_save_lookups,
+)
+from attendance.methods.schedule_cache import invalidate_schedule_cache
 
 # Create your models here.
 
@@ -93,6 +113,17 @@ def validate_time_in_minutes(value):
         raise ValidationError(_("Invalid format,  excepted MM:SS")) from e
 
 
+# attendance values the share in the monthly hour account is computed from
+HOUR_ACCOUNT_FIELDS = [
+    "employee_id_id",
+    "attendance_date",
+    "attendance_validated",
+    "minimum_hour",
+    "at_work_second",
+    "approved_overtime_second",
+]
+
+
 def attendance_date_validate(date):
     """
     Validates if the provided date is not a future date.
@@ -345,7 +376,58 @@ class Attendance(HorillaModel):
             pending_hours = format_time(pending_seconds)
             return pending_hours
 
-    def save(self, *args, **kwargs):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def hour_account_state(self):
+        """
+        This method is used to return the values the hour account share of the
+        attendance is computed from
+        """
+        return {field: getattr(self, field) for field in HOUR_ACCOUNT_FIELDS}
+
+    def stored_hour_account_state(self):
+        """
+        This method is used to return the hour account values of the stored
+        attendance, None for a new attendance
+        """
+        if self.pk is None:
+            return None
+        loaded_values = getattr(self, "_loaded_values", {})
+        if all(field in loaded_values for field in HOUR_ACCOUNT_FIELDS):
+            return {field: loaded_values[field] for field in HOUR_ACCOUNT_FIELDS}
+        return (
+            Attendance._base_manager.filter(pk=self.pk)
+            .values(*HOUR_ACCOUNT_FIELDS)
+            .first()
+        )
+
+    def employee_company_id(self):
+        """
+        This method is used to return the company id of the employee, without
+        loading the employee when it is not loaded yet
+        """
+        if self._meta.get_field("employee_id").is_cached(self):
+            return get_employee_company_id(self.employee_id)
+        return (
+            EmployeeWorkInformation._base_manager.filter(
+                employee_id=self.employee_id_id
+            )
+            .values_list("company_id", flat=True)
+            .first()
+        )
+
+    def compute_hours(self, company_id):
+        """
+        This method is used to compute the fields written with the attendance,
+        the seconds, the overtime, the attendance day and the minimum hour
+
+        Args:
+            company_id (int): company id of the employee
+        """
         minimum_hour = self.minimum_hour
         self_at_work = self.attendance_worked_hour
         self.attendance_overtime = format_time(
@@ -355,102 +437,42 @@ class Attendance(HorillaModel):
 
         self.at_work_second = strtime_seconds(self_at_work)
         self.overtime_second = strtime_seconds(self_overtime)
-        self.attendance_day = EmployeeShiftDay.objects.get(
-            day=self.attendance_date.strftime("%A").lower()
+        self.attendance_day_id = get_shift_day_id(
+            self.attendance_date.strftime("%A").lower()
         )
-        prev_attendance_approved = False
-
-        # Taking all holidays into a list
-        leaves = []
-        holidays = Holiday.objects.all()
-        for holi in holidays:
-            start_date = holi.start_date
-            end_date = holi.end_date
-
-            # Convert start_date and end_date to datetime objects
-            start_date = datetime.strptime(str(start_date), "%Y-%m-%d")
-            end_date = datetime.strptime(str(end_date), "%Y-%m-%d")
-
-            # Add dates in between start date and end date including both
-            current_date = start_date
-            while current_date <= end_date:
-                leaves.append(current_date.strftime("%Y-%m-%d"))
-                current_date += timedelta(days=1)
-
-        # Checking attendance date is in holiday list, if found making the minimum hour to 00:00
-        for leave in leaves:
-            if str(leave) == str(self.attendance_date):
-                self.minimum_hour = "00:00"
-                break
-
-        # Making a dictonary contains week day value and leave day pairs
-        company_leaves = {}
-        company_leave = CompanyLeave.objects.all()
-        for com_leave in company_leave:
-            a = dict(WEEK_DAYS).get(com_leave.based_on_week_day)
-            b = com_leave.based_on_week
-            company_leaves[b] = a
-
-        # Checking the attendance date is in which week
-        week_in_month = str(((self.attendance_date.day - 1) // 7 + 1) - 1)
-
-        # Checking the attendance date is in the company leave or not
-        for pairs in company_leaves.items():
-            # For all weeks based_on_week is None
-            if str(pairs[0]) == "None":
-                if str(pairs[1]) == str(self.attendance_day):
-                    self.minimum_hour = "00:00"
-                    break
-            # Checking with based_on_week and attendance_date week
-            if str(pairs[0]) == week_in_month:
-                if str(pairs[1]) == str(self.attendance_day):
-                    self.minimum_hour = "00:00"
-                    break
-
-        condition = AttendanceValidationCondition.objects.first()
+
+        # Holidays and company leaves don't have a minimum hour
+        if is_non_working_day(self.attendance_date, company_id):
+            self.minimum_hour = "00:00"
+
         if self.is_validate_request:
             self.is_validate_request_approved = False
             self.attendance_validated = False
 
-        if condition is not None and condition.overtime_cutoff is not None:
-            overtime_cutoff = condition.overtime_cutoff
+        overtime_cutoff = get_overtime_cutoff()
+        if overtime_cutoff is not None:
             cutoff_seconds = strtime_seconds(overtime_cutoff)
-            overtime = self.overtime_second
-            if overtime > cutoff_seconds:
+            if self.overtime_second > cutoff_seconds:
                 self.overtime_second = cutoff_seconds
                 self.attendance_overtime = format_time(cutoff_seconds)
 
-        if self.pk is not None:
-            # Get the previous values of the boolean field
-            prev_state = Attendance.objects.get(pk=self.pk)
-            prev_attendance_approved = prev_state.attendance_overtime_approve
-
-        super().save(*args, **kwargs)
-        self.first_save = False
-        employee_ot = self.employee_id.employee_overtime.filter(
-            month=self.attendance_date.strftime("%B").lower(),
-            year=self.attendance_date.strftime("%Y"),
+        self.approved_overtime_second = (
+            self.overtime_second if self.attendance_overtime_approve else 0
         )
-        if employee_ot.exists():
-            self.update_ot(employee_ot.first())
-        else:
-            self.create_ot()
-            self.update_ot(employee_ot.first())
-        approved = self.attendance_overtime_approve
-        attendance_account = self.employee_id.employee_overtime.filter(
-            month=self.attendance_date.strftime("%B").lower(),
-            year=self.attendance_date.year,
-        ).first()
-        total_ot_seconds = attendance_account.overtime_second
-        if approved and prev_attendance_approved is False:
-            self.approved_overtime_second = self.overtime_second
-            total_ot_seconds = total_ot_seconds + self.approved_overtime_second
-        elif not approved:
-            total_ot_seconds = total_ot_seconds - self.approved_overtime_second
-            self.approved_overtime_second = 0
-        attendance_account.overtime = format_time(total_ot_seconds)
-        attendance_account.save()
-        super().save(*args, **kwargs)
+        # The work record gets the status of a validated save, as it did when
+        # the attendance was written twice
+        self.first_save = False
+
+    def save(self, *args, **kwargs):
+        self.compute_hours(self.employee_company_id())
+        with transaction.atomic():
+            previous_state = self.stored_hour_account_state()
+            super().save(*args, **kwargs)
+            current_state = self.hour_account_state()
+            apply_hour_account_deltas(
+                hour_account_deltas([(previous_state, current_state)])
+            )
+        self._loaded_values = current_state
 
     def serialize(self):
         """
@@ -481,79 +503,12 @@ class Attendance(HorillaModel):
             AttendanceActivity.objects.filter(
                 attendance_date=self.attendance_date, employee_id=self.employee_id
             ).delete()
-            employee_ot = self.employee_id.employee_overtime.filter(
-                month=self.attendance_date.strftime("%B").lower(),
-                year=self.attendance_date.strftime("%Y"),
-            )
-        if employee_ot.exists():
-            self.update_ot(employee_ot.first())
-        # Call the superclass delete() method to delete the object
-        super().delete(*args, **kwargs)
-
-        # Perform additional operations after deleting the object
-
-    def create_ot(self):
-        """
-        this method is used to create new AttendanceOvertime's instance if there
-        is no existing for a specific month and year
-        """
-        employee_ot = AttendanceOverTime()
-        employee_ot.employee_id = self.employee_id
-        employee_ot.month = self.attendance_date.strftime("%B").lower()
-        employee_ot.year = self.attendance_date.year
-        if self.attendance_overtime_approve:
-            employee_ot.overtime = self.attendance_overtime
-        if self.attendance_validated:
-            employee_ot.hour_account = self.attendance_worked_hour
-        employee_ot.save()
-        return self
-
-    def update_ot(self, employee_ot):
-        """
-        This method is used to update the overtime
-
-        Args:
-            employee_ot (obj): AttendanceOverTime instance
-        """
-        approved_leave_requests = self.employee_id.leaverequest_set.filter(
-            start_date__lte=self.attendance_date,
-            end_date__gte=self.attendance_date,
-            status="approved",
-        )
-
-        # Create a Q object to combine multiple conditions for the exclude clause
-        exclude_condition = Q()
-        for leave_request in approved_leave_requests:
-            exclude_condition |= Q(
-                attendance_date__range=(
-                    leave_request.start_date,
-                    leave_request.end_date,
-                )
-            )
-
-        # Filter Attendance objects
-        month_attendances = Attendance.objects.filter(
-            employee_id=self.employee_id,
-            attendance_date__month=self.attendance_date.month,
-            attendance_date__year=self.attendance_date.year,
-            attendance_validated=True,
-        ).exclude(exclude_condition)
-        hour_balance = 0
-        hours_pending = 0
-        minimum_hour_second = 0
-        for attendance in month_attendances:
-            required_work_second = strtime_seconds(attendance.minimum_hour)
-            at_work_second = min(
-                required_work_second,
-                attendance.at_work_second,
-            )
-            hour_balance = hour_balance + at_work_second
-            minimum_hour_second += strtime_seconds(attendance.minimum_hour)
-            hours_pending = minimum_hour_second - hour_balance
-        employee_ot.worked_hours = format_time(hour_balance)
-        employee_ot.pending_hours = format_time(hours_pending)
-        employee_ot.save()
-        return employee_ot
+        with transaction.atomic():
+            previous_state = self.stored_hour_account_state()
+            # Call the superclass delete() method to delete the object
+            result = super().delete(*args, **kwargs)
+            apply_hour_account_deltas(hour_account_deltas([(previous_state, None)]))
+        return result
 
     def clean(self, *args, **kwargs):
         super().clean(*args, **kwargs)
@@ -808,6 +763,169 @@ class AttendanceLateComeEarlyOut(HorillaModel):
             {self.attendance_id.employee_id.employee_last_name} - {self.type}"
 
 
+class AttendanceDailyRollup(models.Model):
+    """
+    Daily totals of the attendance of an employee for the dashboards and
+    reports, kept in line by the attendance signals and rebuilt by the
+    rebuild_attendance_rollups command
+    """
+
+    employee_id = models.ForeignKey(
+        Employee, on_delete=models.CASCADE, related_name="attendance_rollups"
+    )
+    date = models.DateField()
+    company_id = models.ForeignKey(
+        Company, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    department_id = models.ForeignKey(
+        Department, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    present = models.IntegerField(default=0)
+    late_come = models.IntegerField(default=0)
+    early_out = models.IntegerField(default=0)
+    worked_second = models.IntegerField(default=0)
+    overtime_second = models.IntegerField(default=0)
+    pending_second = models.IntegerField(default=0)
+
+    class Meta:
+        """
+        Meta class to add some additional options
+        """
+
+        unique_together = ("employee_id", "date")
+
+
+class AttendanceDepartmentRollup(models.Model):
+    """
+    Daily totals of the attendances of a department, the sum of the
+    AttendanceDailyRollup rows of its employees
+    """
+
+    date = models.DateField()
+    company_id = models.ForeignKey(
+        Company, null=True, blank=True, on_delete=models.CASCADE
+    )
+    department_id = models.ForeignKey(
+        Department, null=True, blank=True, on_delete=models.CASCADE
+    )
+    present = models.IntegerField(default=0)
+    late_come = models.IntegerField(default=0)
+    early_out = models.IntegerField(default=0)
+    worked_second = models.IntegerField(default=0)
+    overtime_second = models.IntegerField(default=0)
+    pending_second = models.IntegerField(default=0)
+
+    class Meta:
+        """
+        Meta class to add some additional options
+        """
+
+        unique_together = ("date", "company_id", "department_id")
+
+
+@receiver(post_save, sender=Attendance)
+@receiver(post_delete, sender=Attendance)
+def attendance_rollup_post_save(sender, instance, **kwargs):
+    """
+    This method is used to refresh the daily rollups of the attendance day,
+    and of its previous day when the attendance moved
+    """
+    keys = {(instance.employee_id_id, instance.attendance_date)}
+    loaded = getattr(instance, "_loaded_values", {})
+    if loaded.get("employee_id_id") and loaded.get("attendance_date"):
+        keys.add((loaded["employee_id_id"], loaded["attendance_date"]))
+    refresh_attendance_rollups(keys)
+
+
+@receiver(post_save, sender=Attendance)
+def attendance_online_post_save(sender, instance, **kwargs):
+    """
+    This method is used to put the employee online on a clock-in and offline
+    on a clock-out
+    """
+    update_online_employees([instance])
+
+
+@receiver(post_delete, sender=Attendance)
+def attendance_online_post_delete(sender, instance, **kwargs):
+    """
+    This method is used to drop the online employees when an attendance is
+    deleted, the employee may have another open attendance
+    """
+    invalidate_online_employees()
+
+
+LEAVE_HOUR_ACCOUNT_FIELDS = ("employee_id", "start_date", "end_date", "status")
+
+
+@receiver(pre_save, sender=LeaveRequest)
+def leave_request_hour_account_state(sender, instance, **kwargs):
+    """
+    This method is used to read the stored dates and status of a leave
+    request, the hour accounts of its months follow their change
+    """
+    instance._hour_account_state = (
+        LeaveRequest._base_manager.filter(pk=instance.pk)
+        .values(*LEAVE_HOUR_ACCOUNT_FIELDS)
+        .first()
+        if instance.pk is not None
+        else None
+    )
+
+
+@receiver(post_save, sender=LeaveRequest)
+def leave_request_hour_accounts(sender, instance, **kwargs):
+    """
+    This method is used to write again the hour accounts of the months of a
+    leave request whose approval or dates changed, the days of an approved
+    leave are not counted
+    """
+    previous = getattr(instance, "_hour_account_state", None)
+    current = {
+        "employee_id": instance.employee_id_id,
+        "start_date": instance.start_date,
+        "end_date": instance.end_date,
+        "status": instance.status,
+    }
+    instance._hour_account_state = current
+    if previous != current:
+        reconcile_leave_hour_accounts([previous, current])
+
+
+@receiver(post_delete, sender=LeaveRequest)
+def leave_request_hour_accounts_delete(sender, instance, **kwargs):
+    """
+    This method is used to count again the days of a deleted approved leave
+    in the hour accounts of its months
+    """
+    reconcile_leave_hour_accounts(
+        [
+            {
+                "employee_id": instance.employee_id_id,
+                "start_date": instance.start_date,
+                "end_date": instance.end_date,
+                "status": instance.status,
+            }
+        ]
+    )
+
+
+@receiver(post_save, sender=AttendanceLateComeEarlyOut)
+@receiver(post_delete, sender=AttendanceLateComeEarlyOut)
+def late_come_early_out_rollup_post_save(sender, instance, **kwargs):
+    """
+    This method is used to refresh the daily rollup of the attendance day of
+    a late come or early out
+    """
+    attendance = (
+        Attendance._base_manager.filter(pk=instance.attendance_id_id)
+        .values_list("employee_id", "attendance_date")
+        .first()
+    )
+    if attendance is not None:
+        refresh_attendance_rollups([attendance])
+
+
 class AttendanceValidationCondition(HorillaModel):
     """
     AttendanceValidationCondition model
@@ -834,6 +952,18 @@ class AttendanceValidationCondition(HorillaModel):
             raise ValidationError(_("You cannot add more conditions."))
 
 
+@receiver(post_save, sender=AttendanceValidationCondition)
+@receiver(post_delete, sender=AttendanceValidationCondition)
+@receiver(post_save, sender=EmployeeShiftDay)
+@receiver(post_delete, sender=EmployeeShiftDay)
+def invalidate_attendance_save_lookups(sender, instance, **kwargs):
+    """
+    This method is used to drop the cached lookups of Attendance.save when the
+    validation condition or a shift day changes
+    """
+    invalidate_save_lookups()
+
+
 months = [
     "January",
     "February",
@@ -956,7 +1086,9 @@ def create_initial_stage(sender, instance, created, **kwargs):
                 available.carryforward_days = max(
                     0, (available.carryforward_days - unit)
                 )
-
+            available.record_ledger_entry(
+                "penalty", leave_request=instance.leave_request_id
+            )
             available.save()
 
 
@@ -1016,6 +1148,30 @@ class GraceTime(HorillaModel):
         super().save(*args, **kwargs)
 
 
+@receiver(post_save, sender=GraceTime)
+@receiver(post_delete, sender=GraceTime)
+@receiver(post_save, sender=EmployeeShift)
+@receiver(post_delete, sender=EmployeeShift)
+@receiver(post_save, sender=EmployeeShiftSchedule)
+@receiver(post_delete, sender=EmployeeShiftSchedule)
+def invalidate_attendance_schedule_cache(sender, instance, **kwargs):
+    """
+    This method is used to drop the cached schedules and grace times of the
+    clock-in when a grace time, a shift or a shift schedule changes
+    """
+    invalidate_schedule_cache()
+
+
+@receiver(m2m_changed, sender=GraceTime.company_id.through)
+def invalidate_grace_time_companies(sender, instance, action, **kwargs):
+    """
+    This method is used to drop the cached grace times when the companies of
+    a grace time change
+    """
+    if action in ("post_add", "post_remove", "post_clear"):
+        invalidate_schedule_cache()
+
+
 class AttendanceGeneralSetting(HorillaModel):
     """
     AttendanceGeneralSettings
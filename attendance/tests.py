@@ -1,3 +1,664 @@
-from django.test import TestCase
+"""test cases"""
 
-# Create your tests here.
+from datetime import date, time, timedelta
+from unittest.mock import patch
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, models
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from attendance.methods.bulk_validation import (
+    approve_overtimes,
+    notify_validated,
+    validate_attendances,
+)
+from attendance.methods.dashboard_metrics import day_counts, department_counts
+from attendance.methods.hour_account import reconcile_hour_accounts
+from attendance.methods.online_employees import get_online_employee_ids
+from attendance.methods.punches import ingest_punches, parse_punch
+from attendance.methods.rollups import ROLLUP_FIELDS, rebuild_attendance_rollups
+from attendance.methods.schedule_cache import grace_seconds, shift_schedule
+from attendance.models import (
+    Attendance,
+    AttendanceActivity,
+    AttendanceDailyRollup,
+    AttendanceDepartmentRollup,
+    AttendanceLateComeEarlyOut,
+    AttendanceOverTime,
+    GraceTime,
+)
+from attendance.views import process_attendance_data
+from attendance.views.process_attendance_data import process_attendance_data_bulk
+from attendance.views.views import attendance_day_checking, work_record_page
+from base.thread_local_middleware import _thread_locals
+from base.models import (
+    Company,
+    Department,
+    EmployeeShift,
+    EmployeeShiftDay,
+    EmployeeShiftSchedule,
+    WorkType,
+)
+from employee.models import Employee, EmployeeWorkInformation
+from leave.models import Holiday, LeaveRequest, LeaveType
+from notifications.models import Notification
+from payroll.models.models import WorkRecord
+
+
+class AttendanceSaveTest(TestCase):
+    """
+    Saving an attendance should issue a fixed number of queries whatever the
+    number of attendances and holidays of the month, and keep the hour
+    account of the month in line with its attendances
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        for day in [
+            "monday",
+            "tuesday",
+            "wednesday",
+            "thursday",
+            "friday",
+            "saturday",
+            "sunday",
+        ]:
+            EmployeeShiftDay.objects.create(day=day)
+        cls.shift = EmployeeShift(employee_shift="Day")
+        cls.shift.save()
+        cls.work_type = WorkType(work_type="Office")
+        cls.work_type.save()
+        for day in range(1, 11):
+            Holiday.objects.create(
+                name=f"Holiday {day}",
+                start_date=date(2024, 3, day),
+                end_date=date(2024, 3, day),
+            )
+        cls.employee = Employee.objects.create(
+            badge_id="A1",
+            employee_first_name="Attendance",
+            employee_last_name="Test",
+            email="attendance.test@example.com",
+            phone="1234567890",
+        )
+        cls.department = Department(department="Operations")
+        cls.department.save()
+        EmployeeWorkInformation.objects.create(
+            employee_id=cls.employee,
+            shift_id=cls.shift,
+            work_type_id=cls.work_type,
+            department_id=cls.department,
+        )
+
+    def attendance(self, attendance_date, worked_hour="09:00", **kwargs):
+        """
+        Unsaved attendance of the test employee
+        """
+        return Attendance(
+            employee_id=self.employee,
+            attendance_date=attendance_date,
+            shift_id=self.shift,
+            work_type_id=self.work_type,
+            attendance_clock_in_date=attendance_date,
+            attendance_clock_in=time(9),
+            attendance_clock_out_date=attendance_date,
+            attendance_clock_out=time(18),
+            attendance_worked_hour=worked_hour,
+            minimum_hour="08:00",
+            **{"attendance_validated": True, **kwargs},
+        )
+
+    def count_save_queries(self, attendance):
+        """
+        Number of queries of one attendance save
+        """
+        with CaptureQueriesContext(connection) as queries:
+            attendance.save()
+        return len(queries)
+
+    def hour_account(self, month="january"):
+        """
+        Hour account of the test employee
+        """
+        return AttendanceOverTime.objects.get(
+            employee_id=self.employee, month=month, year="2024"
+        )
+
+    def update_save_queries(self, attendance_date):
+        """
+        Number of queries of the save of a changed attendance
+        """
+        attendance = Attendance.objects.get(
+            employee_id=self.employee, attendance_date=attendance_date
+        )
+        attendance.attendance_worked_hour = "07:00"
+        return self.count_save_queries(attendance)
+
+    def test_save_queries_do_not_grow_with_month(self):
+        cache.clear()
+        self.attendance(date(2024, 1, 1)).save()
+        first_save = self.count_save_queries(self.attendance(date(2024, 1, 2)))
+        first_update = self.update_save_queries(date(2024, 1, 2))
+        for day in range(3, 28):
+            self.attendance(date(2024, 1, day)).save()
+        later_save = self.count_save_queries(self.attendance(date(2024, 1, 28)))
+        later_update = self.update_save_queries(date(2024, 1, 28))
+        self.assertEqual(first_save, later_save)
+        self.assertEqual(first_update, later_update)
+
+    def test_save_queries_do_not_grow_with_holidays(self):
+        cache.clear()
+        self.attendance(date(2024, 1, 1)).save()
+        self.attendance(date(2024, 3, 19)).save()
+        without_holidays = self.count_save_queries(self.attendance(date(2024, 1, 2)))
+        with_holidays = self.count_save_queries(self.attendance(date(2024, 3, 20)))
+        self.assertEqual(without_holidays, with_holidays)
+
+        self.attendance(date(2024, 3, 2)).save()
+        holiday_attendance = Attendance.objects.get(
+            employee_id=self.employee, attendance_date=date(2024, 3, 2)
+        )
+        self.assertEqual(holiday_attendance.minimum_hour, "00:00")
+
+    def test_minimum_hour_reads_the_company_holidays(self):
+        companies = [
+            Company.objects.create(
+                company=name,
+                address="Address",
+                country="Country",
+                state="State",
+                city="City",
+                zip="12345",
+            )
+            for name in ("North", "South")
+        ]
+        Holiday.objects.create(
+            name="North", start_date=date(2024, 4, 2), company_id=companies[0]
+        )
+        self.assertEqual(
+            attendance_day_checking("2024-04-02", "08:00", companies[0].id), "00:00"
+        )
+        self.assertEqual(
+            attendance_day_checking("2024-04-02", "08:00", companies[1].id), "08:00"
+        )
+
+    def test_hour_account_follows_attendances(self):
+        attendance_date = date(2024, 1, 1)
+        while attendance_date <= date(2024, 1, 10):
+            self.attendance(attendance_date, worked_hour="06:00").save()
+            attendance_date += timedelta(days=1)
+        account = self.hour_account()
+        self.assertEqual(account.worked_hours, "60:00")
+        self.assertEqual(account.pending_hours, "20:00")
+
+        attendance = Attendance.objects.get(
+            employee_id=self.employee, attendance_date=date(2024, 1, 1)
+        )
+        attendance.attendance_worked_hour = "10:00"
+        attendance.save()
+        account = self.hour_account()
+        self.assertEqual(account.worked_hours, "62:00")
+        self.assertEqual(account.pending_hours, "18:00")
+        self.assertEqual(account.overtime, "00:00")
+
+        attendance.attendance_overtime_approve = True
+        attendance.save()
+        self.assertEqual(self.hour_account().overtime, "02:00")
+        attendance.save()
+        self.assertEqual(self.hour_account().overtime_second, 7200)
+
+        attendance.attendance_overtime_approve = False
+        attendance.attendance_validated = False
+        attendance.save()
+        account = self.hour_account()
+        self.assertEqual(account.overtime_second, 0)
+        self.assertEqual(account.worked_hours, "54:00")
+        self.assertEqual(account.pending_hours, "18:00")
+
+    def test_hour_account_delete_and_reconcile(self):
+        for day in range(1, 6):
+            self.attendance(
+                date(2024, 1, day), worked_hour="10:00", attendance_overtime_approve=True
+            ).save()
+        Attendance.objects.get(
+            employee_id=self.employee, attendance_date=date(2024, 1, 5)
+        ).delete()
+        account = self.hour_account()
+        self.assertEqual(account.worked_hours, "32:00")
+        self.assertEqual(account.overtime, "08:00")
+        self.assertEqual(reconcile_hour_accounts(2024, 1), (0, 0))
+
+        # an approved leave takes the day out of the hour account
+        LeaveRequest.objects.bulk_create(
+            [
+                LeaveRequest(
+                    employee_id=self.employee,
+                    leave_type_id=LeaveType.objects.create(
+                        name="Casual", payment="paid", total_days=10
+                    ),
+                    start_date=date(2024, 1, 1),
+                    end_date=date(2024, 1, 1),
+                    status="approved",
+                    description="Leave",
+                    requested_days=1,
+                )
+            ]
+        )
+        AttendanceOverTime.objects.filter(employee_id=self.employee).delete()
+        with self.assertNumQueries(5):
+            self.assertEqual(reconcile_hour_accounts(2024, 1), (0, 1))
+        account = self.hour_account()
+        self.assertEqual(account.worked_hours, "24:00")
+        self.assertEqual(account.pending_hours, "00:00")
+        self.assertEqual(account.overtime, "08:00")
+
+    def test_hour_account_follows_leave_approval(self):
+        for day in range(1, 3):
+            self.attendance(date(2024, 1, day), worked_hour="06:00").save()
+        self.assertEqual(self.hour_account().worked_hours, "12:00")
+        leave_request = LeaveRequest(
+            employee_id=self.employee,
+            leave_type_id=LeaveType.objects.create(
+                name="Casual", payment="paid", total_days=10
+            ),
+            start_date=date(2024, 1, 1),
+            end_date=date(2024, 1, 1),
+            description="Leave",
+        )
+        leave_request.save()
+        self.assertEqual(self.hour_account().worked_hours, "12:00")
+
+        # an approved leave takes the day out of the hour account
+        leave_request.status = "approved"
+        leave_request.save()
+        account = self.hour_account()
+        self.assertEqual(account.worked_hours, "06:00")
+        self.assertEqual(account.pending_hours, "02:00")
+
+        leave_request.status = "cancelled"
+        leave_request.save()
+        self.assertEqual(self.hour_account().worked_hours, "12:00")
+
+        # an approved leave is only deleted in bulk or with its employee
+        leave_request.status = "approved"
+        leave_request.save()
+        LeaveRequest.objects.filter(pk=leave_request.pk).delete()
+        account = self.hour_account()
+        self.assertEqual(account.worked_hours, "12:00")
+        self.assertEqual(account.pending_hours, "04:00")
+
+    def test_bulk_import(self):
+        self.attendance(date(2024, 1, 1)).save()
+        rows = [
+            {
+                "Badge ID": badge_id,
+                "Shift": "Day",
+                "Work type": "Office",
+                "Attendance date": attendance_date,
+                "Check-in date": attendance_date,
+                "Check-in": "09:00:00",
+                "Check-out date": attendance_date,
+                "Check-out": "18:00:00",
+                "Worked hour": "09:00:00",
+                "Minimum hour": "08:00:00",
+            }
+            for badge_id, attendance_date in [
+                ("A1", "2024-01-01"),
+                # another date format than the first row
+                ("A1", "02 Jan 2024"),
+                ("A1", "2024-03-05"),
+                ("A1", "2024-03-05"),
+                ("A2", "2024-01-03"),
+            ]
+        ]
+        errors = process_attendance_data_bulk(rows, chunk_size=1)
+        self.assertEqual(
+            [sorted(key for key in error if key.startswith("Error")) for error in errors],
+            [["Error6"], ["Error6"], ["Error1"]],
+        )
+        attendance = Attendance.objects.get(
+            employee_id=self.employee, attendance_date=date(2024, 3, 5)
+        )
+        self.assertEqual(attendance.minimum_hour, "00:00")
+        self.assertEqual(attendance.attendance_overtime, "01:00")
+        self.assertEqual(
+            WorkRecord.objects.filter(
+                employee_id=self.employee, date__in=[date(2024, 1, 2), date(2024, 3, 5)]
+            ).count(),
+            2,
+        )
+
+    def test_bulk_import_errors_in_file_order(self):
+        rows = [
+            {
+                "Badge ID": badge_id,
+                "Shift": "Day",
+                "Work type": "Office",
+                "Attendance date": attendance_date,
+                "Check-in date": attendance_date,
+                "Check-in": "09:00:00",
+                "Check-out date": attendance_date,
+                "Check-out": "18:00:00",
+                "Worked hour": "09:00:00",
+                "Minimum hour": "08:00:00",
+            }
+            for badge_id, attendance_date in [
+                ("A1", "2024-01-01"),
+                ("A2", "2024-01-02"),
+                ("A1", "2024-01-03"),
+            ]
+        ]
+        save_rows = process_attendance_data._save_rows
+
+        def failing_save_rows(rows, user):
+            # the first row fails on its insert, after the validation
+            failed = {index: "Insert failed" for index, _row in rows if index == 0}
+            save_rows([row for row in rows if row[0] != 0], user)
+            return failed
+
+        with patch.object(process_attendance_data, "_save_rows", failing_save_rows):
+            errors = process_attendance_data_bulk(rows)
+        self.assertEqual(
+            [
+                (error["Badge ID"], error.get("Error1", error.get("Error17")))
+                for error in errors
+            ],
+            [("A1", "Insert failed"), ("A2", "Invalid Badge ID given A2")],
+        )
+
+    def test_punches(self):
+        for shift_day in EmployeeShiftDay.objects.all():
+            EmployeeShiftSchedule(
+                day=shift_day,
+                shift_id=self.shift,
+                minimum_working_hour="08:00",
+                start_time=time(9),
+                end_time=time(18),
+            ).save()
+        punches = [
+            parse_punch("A1", timestamp)
+            for timestamp in [
+                "2024-01-02T09:20:00",
+                "2024-01-02T13:00:00",
+                "2024-01-02T13:30:00",
+                "2024-01-02T17:30:00",
+                "2024-01-03T08:55:00",
+            ]
+        ]
+        result = ingest_punches(punches + [("A9", punches[0][1])])
+        self.assertEqual((result["clock_in"], result["clock_out"]), (3, 2))
+        self.assertEqual(result["errors"], ["Invalid Badge ID given A9"])
+        self.assertEqual(AttendanceActivity.objects.count(), 3)
+        attendance = Attendance.objects.get(
+            employee_id=self.employee, attendance_date=date(2024, 1, 2)
+        )
+        self.assertEqual(attendance.attendance_worked_hour, "07:40")
+        self.assertEqual(
+            set(
+                AttendanceLateComeEarlyOut.objects.filter(
+                    attendance_id=attendance
+                ).values_list("type", flat=True)
+            ),
+            {"late_come", "early_out"},
+        )
+
+        # the punches already applied are skipped, the check-out closes the day
+        result = ingest_punches(
+            punches + [parse_punch("A1", "2024-01-03T18:05:00")]
+        )
+        self.assertEqual(result["skipped"], 5)
+        attendance = Attendance.objects.get(
+            employee_id=self.employee, attendance_date=date(2024, 1, 3)
+        )
+        self.assertEqual(attendance.attendance_worked_hour, "09:10")
+        self.assertFalse(attendance.late_come_early_out.exists())
+
+    def test_schedule_cache(self):
+        cache.clear()
+        monday = EmployeeShiftDay.objects.get(day="monday")
+        GraceTime(allowed_time="05:00", is_default=True).save()
+        self.assertEqual(shift_schedule(self.shift.id, monday.id), ("00:00", 0, 0))
+        self.assertEqual(grace_seconds(self.shift.id), 300)
+        with self.assertNumQueries(0):
+            shift_schedule(self.shift.id, monday.id)
+            grace_seconds(self.shift.id)
+
+        # saving the configuration drops the cached values
+        EmployeeShiftSchedule(
+            day=monday,
+            shift_id=self.shift,
+            minimum_working_hour="08:00",
+            start_time=time(9),
+            end_time=time(18),
+        ).save()
+        self.shift.grace_time_id = GraceTime.objects.create(
+            allowed_time="10:00", is_active=False
+        )
+        self.shift.save()
+        self.assertEqual(
+            shift_schedule(self.shift.id, monday.id), ("08:00", 9 * 3600, 18 * 3600)
+        )
+        self.assertEqual(grace_seconds(self.shift.id), 0)
+        self.assertEqual(grace_seconds(None), 300)
+
+    def test_default_grace_time_of_the_company(self):
+        cache.clear()
+        north, south = [
+            Company.objects.create(
+                company=name,
+                address="Address",
+                country="Country",
+                state="State",
+                city="City",
+                zip="12345",
+            )
+            for name in ("North", "South")
+        ]
+        grace_time = GraceTime(allowed_time="05:00", is_default=True)
+        grace_time.save()
+        grace_time.company_id.add(north)
+        self.assertEqual(grace_seconds(None, north.id), 300)
+        self.assertEqual(grace_seconds(None, south.id), 0)
+
+        # changing the companies of the grace time drops the cached values
+        grace_time.company_id.add(south)
+        self.assertEqual(grace_seconds(None, south.id), 300)
+        grace_time.company_id.clear()
+        self.assertEqual(grace_seconds(None, south.id), 300)
+        grace_time.company_id.add(north)
+        self.assertEqual(grace_seconds(None, south.id), 0)
+
+    def page_queries(self, year, month):
+        """
+        Number of queries of a work record page
+        """
+        with CaptureQueriesContext(connection) as queries:
+            page = work_record_page(year, month, 1)
+        return page, len(queries)
+
+    def test_work_record_matrix(self):
+        request = RequestFactory().get("/")
+        request.user = User.objects.create_user(username="records", password="x")
+        request.session = {}
+        _thread_locals.request = request
+        self.addCleanup(setattr, _thread_locals, "request", None)
+        for day in range(1, 4):
+            self.attendance(date(2024, 1, day)).save()
+        _page, one_employee = self.page_queries(2024, 1)
+        for index in range(2, 6):
+            Employee.objects.create(
+                badge_id=f"A{index}",
+                employee_first_name="Employee",
+                employee_last_name=str(index),
+                email=f"employee{index}@example.com",
+                phone="1234567890",
+            )
+        page, employees = self.page_queries(2024, 1)
+        self.assertEqual(one_employee, employees)
+        rows = list(page)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(len(rows[0]["work_record"]), 31)
+        self.assertEqual(
+            [cell and cell["work_record_type"] for cell in rows[0]["work_record"][:4]],
+            ["FDP", "FDP", "FDP", None],
+        )
+        self.assertEqual(rows[1]["work_record"], [None] * 31)
+
+        # the month grid is computed once and dropped by the work record saves
+        cache.clear()
+        with override_settings(WORK_RECORD_MATRIX_CACHE_TIMEOUT=60):
+            self.page_queries(2024, 1)
+            _page, cached = self.page_queries(2024, 1)
+            self.assertEqual(cached, employees - 1)
+            self.attendance(date(2024, 1, 4)).save()
+            page, _queries = self.page_queries(2024, 1)
+            self.assertEqual(page[0]["work_record"][3]["work_record_type"], "FDP")
+
+    def test_dashboard_metrics(self):
+        cache.clear()
+        for day in range(1, 4):
+            self.attendance(date(2024, 1, day)).save()
+        attendance = Attendance.objects.get(
+            employee_id=self.employee, attendance_date=date(2024, 1, 2)
+        )
+        for record_type in ["late_come", "early_out"]:
+            AttendanceLateComeEarlyOut(
+                attendance_id=attendance, employee_id=self.employee, type=record_type
+            ).save()
+        with self.assertNumQueries(2):
+            counts = day_counts(date(2024, 1, 2))
+        self.assertEqual(
+            counts,
+            {
+                "total_employees": 1,
+                "expected": 1,
+                "attendances": 1,
+                "late_come": 1,
+                "on_time": 0,
+            },
+        )
+        # the counts are served from the cache until they expire
+        with self.assertNumQueries(0):
+            day_counts(date(2024, 1, 2))
+        self.assertEqual(
+            department_counts(date(2024, 1, 1), date(2024, 1, 31)),
+            [{"label": "Operations", "data": [2, 1, 1]}],
+        )
+
+    def rollups(self):
+        """
+        The stored employee and department rollups
+        """
+        return (
+            sorted(
+                AttendanceDailyRollup.objects.values_list(
+                    "employee_id", "date", *ROLLUP_FIELDS
+                )
+            ),
+            sorted(
+                AttendanceDepartmentRollup.objects.values_list(
+                    "date", "department_id", *ROLLUP_FIELDS
+                )
+            ),
+        )
+
+    def test_attendance_rollups(self):
+        attendance = self.attendance(
+            date(2024, 1, 2), worked_hour="10:00", attendance_overtime_approve=True
+        )
+        attendance.save()
+        self.attendance(date(2024, 1, 3), worked_hour="06:00").save()
+        AttendanceLateComeEarlyOut(
+            attendance_id=attendance, employee_id=self.employee, type="late_come"
+        ).save()
+        self.assertEqual(
+            AttendanceDepartmentRollup.objects.get(date=date(2024, 1, 2)).late_come, 1
+        )
+        self.assertEqual(
+            AttendanceDailyRollup.objects.get(date=date(2024, 1, 3)).pending_second,
+            7200,
+        )
+        # moving an attendance moves its rollup
+        attendance.attendance_date = date(2024, 1, 4)
+        attendance.save()
+        self.assertFalse(
+            AttendanceDailyRollup.objects.filter(date=date(2024, 1, 2)).exists()
+        )
+        rollup = AttendanceDailyRollup.objects.get(date=date(2024, 1, 4))
+        self.assertEqual((rollup.late_come, rollup.overtime_second), (1, 7200))
+        Attendance.objects.get(attendance_date=date(2024, 1, 3)).delete()
+        self.assertFalse(
+            AttendanceDepartmentRollup.objects.filter(date=date(2024, 1, 3)).exists()
+        )
+        # the rollups kept on save are the ones rebuilt from the attendances
+        rollups = self.rollups()
+        rebuild_attendance_rollups(date(2024, 1, 1), date(2024, 1, 31))
+        self.assertEqual(self.rollups(), rollups)
+
+    def test_bulk_validation(self):
+        for day in range(1, 6):
+            self.attendance(
+                date(2024, 1, day), worked_hour="10:00", attendance_validated=False
+            ).save()
+        self.attendance(
+            date(2024, 1, 6), attendance_validated=False, is_validate_request=True
+        ).save()
+        attendances = Attendance.objects.filter(employee_id=self.employee)
+        with CaptureQueriesContext(connection) as queries:
+            validated, pending = validate_attendances(attendances)
+        self.assertEqual((len(validated), len(pending)), (5, 1))
+        self.assertLess(len(queries), 30)
+        self.assertEqual(
+            Attendance.objects.filter(attendance_validated=True).count(), 5
+        )
+        self.assertEqual(self.hour_account().worked_hours, "40:00")
+        self.assertEqual(
+            set(
+                WorkRecord.objects.filter(date__lt=date(2024, 1, 6)).values_list(
+                    "day_percentage", flat=True
+                )
+            ),
+            {1.0},
+        )
+
+        approve_overtimes(attendances.filter(attendance_validated=True))
+        account = self.hour_account()
+        self.assertEqual(account.overtime, "10:00")
+        self.assertEqual(reconcile_hour_accounts(2024, 1), (0, 0))
+        self.assertEqual(
+            AttendanceDailyRollup.objects.aggregate(
+                overtime=models.Sum("overtime_second")
+            )["overtime"],
+            36000,
+        )
+
+        user = User.objects.create_user(username="bulk.validation")
+        Employee.objects.filter(pk=self.employee.pk).update(employee_user_id=user)
+        validated = list(
+            Attendance.objects.select_related("employee_id__employee_user_id").filter(
+                attendance_validated=True
+            )
+        )
+        # the content type of the sender and one insert
+        with CaptureQueriesContext(connection) as queries:
+            notify_validated(user, validated)
+        self.assertLessEqual(len(queries), 2)
+        self.assertEqual(Notification.objects.filter(recipient=user).count(), 5)
+
+    def test_online_employees(self):
+        cache.clear()
+        today = date.today()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_online_employee_ids(), frozenset())
+        attendance = self.attendance(today)
+        attendance.attendance_clock_out = None
+        attendance.attendance_clock_out_date = None
+        attendance.save()
+        # the clock-in updates the cached set
+        with self.assertNumQueries(0):
+            self.assertTrue(self.employee.check_online())
+        attendance.attendance_clock_out = time(18)
+        attendance.attendance_clock_out_date = today
+        attendance.save()
+        with self.assertNumQueries(0):
+            self.assertFalse(self.employee.check_online())
@@ -117,6 +117,11 @@ urlpatterns = [
     ),
     path("clock-in", attendance.views.clock_in_out.clock_in, name="clock-in"),
     path("clock-out", attendance.views.clock_in_out.clock_out, name="clock-out"),
+    path(
+        "punch-ingest",
+        attendance.views.clock_in_out.punch_ingest,
+        name="punch-ingest",
+    ),
     path(
         "on-time-view/",
         views.on_time_view,
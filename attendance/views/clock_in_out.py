@@ -4,19 +4,22 @@ clock_in_out.py
 This module is used register endpoints to the check-in check-out functionalities
 """
 
+import json
 from datetime import date, datetime, timedelta
 from django.db.models import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import require_http_methods
 from base.context_processors import timerunner_enabled
-from base.models import EmployeeShiftDay
-from horilla.decorators import login_required
+from horilla.decorators import login_required, permission_required
 from base.thread_local_middleware import _thread_locals
+from attendance.methods.punches import ingest_punches, parse_punch, read_punches
+from attendance.methods.save_lookups import get_shift_day_id
+from attendance.methods.schedule_cache import grace_seconds
 from attendance.models import (
     Attendance,
     AttendanceActivity,
     AttendanceLateComeEarlyOut,
-    GraceTime,
 )
 from attendance.views.views import (
     activity_datetime,
@@ -27,6 +30,7 @@ from attendance.views.views import (
     shift_schedule_today,
     strtime_seconds,
 )
+from leave.calendar_cache import get_employee_company_id
 
 
 def late_come_create(attendance):
@@ -58,22 +62,11 @@ def late_come(attendance, start_time, end_time, shift):
     now_sec = strtime_seconds(datetime.now().strftime("%H:%M"))
     mid_day_sec = strtime_seconds("12:00")
 
-    # Checking gracetime allowance before creating late come
-    if shift.grace_time_id:
-        # checking grace time in shift, it has the higher priority
-        if shift.grace_time_id.is_active == True:
-            # Setting allowance for the check in time
-            now_sec -= shift.grace_time_id.allowed_time_in_secs
-    # checking default grace time
-    elif GraceTime.objects.filter(is_default=True, is_active=True).exists():
-        grace_time = GraceTime.objects.filter(
-            is_default=True,
-            is_active=True,
-        ).first()
-        # Setting allowance for the check in time
-        now_sec -= grace_time.allowed_time_in_secs
-    else:
-        pass
+    # Setting the grace time allowance for the check in time, the grace time
+    # of the shift has the higher priority over the default grace time
+    now_sec -= grace_seconds(
+        shift.id if shift else None, get_employee_company_id(attendance.employee_id)
+    )
     if start_time > end_time and start_time != end_time:
         # night shift
         if now_sec < mid_day_sec:
@@ -105,7 +98,7 @@ def clock_in_attendance_and_activity(
         employee        : employee instance
         date_today      : date
         attendance_date : the date that attendance for
-        day             : shift day
+        day             : shift day id
         now             : current time
         shift           : shift object
         minimum_hour    : minimum hour in shift schedule
@@ -118,7 +111,7 @@ def clock_in_attendance_and_activity(
         employee_id=employee,
         attendance_date=attendance_date,
         clock_in_date=date_today,
-        shift_day=day,
+        shift_day_id=day,
         clock_out=None,
     ).first()
 
@@ -131,7 +124,7 @@ def clock_in_attendance_and_activity(
         employee_id=employee,
         attendance_date=attendance_date,
         clock_in_date=date_today,
-        shift_day=day,
+        shift_day_id=day,
         clock_in=in_datetime,
         in_datetime=in_datetime,
     ).save()
@@ -146,7 +139,7 @@ def clock_in_attendance_and_activity(
         attendance.shift_id = shift
         attendance.work_type_id = attendance.employee_id.employee_work_info.work_type_id
         attendance.attendance_date = attendance_date
-        attendance.attendance_day = day
+        attendance.attendance_day_id = day
         attendance.attendance_clock_in = now
         attendance.attendance_clock_in_date = date_today
         attendance.minimum_hour = minimum_hour
@@ -178,8 +171,7 @@ def clock_in(request):
         shift = work_info.shift_id
         date_today = date.today()
         attendance_date = date_today
-        day = date_today.strftime("%A").lower()
-        day = EmployeeShiftDay.objects.get(day=day)
+        day = get_shift_day_id(date_today.strftime("%A").lower())
         now = datetime.now().strftime("%H:%M")
         now_sec = strtime_seconds(now)
         mid_day_sec = strtime_seconds("12:00")
@@ -196,8 +188,9 @@ def clock_in(request):
                 # Here you need to create attendance for yesterday
 
                 date_yesterday = date_today - timedelta(days=1)
-                day_yesterday = date_yesterday.strftime("%A").lower()
-                day_yesterday = EmployeeShiftDay.objects.get(day=day_yesterday)
+                day_yesterday = get_shift_day_id(
+                    date_yesterday.strftime("%A").lower()
+                )
                 minimum_hour, start_time_sec, end_time_sec = shift_schedule_today(
                     day=day_yesterday, shift=shift
                 )
@@ -366,15 +359,14 @@ def clock_out(request):
     employee, work_info = employee_exists(request)
     shift = work_info.shift_id
     date_today = date.today()
-    day = date_today.strftime("%A").lower()
-    day = EmployeeShiftDay.objects.get(day=day)
+    day = get_shift_day_id(date_today.strftime("%A").lower())
     attendance = (
         Attendance.objects.filter(employee_id=employee)
         .order_by("id", "attendance_date")
         .last()
     )
     if attendance is not None:
-        day = attendance.attendance_day
+        day = attendance.attendance_day_id
     now = datetime.now().strftime("%H:%M")
     minimum_hour, start_time_sec, end_time_sec = shift_schedule_today(
         day=day, shift=shift
@@ -434,3 +426,39 @@ def clock_out(request):
             mouse_out=mouse_out,
         )
     )
+
+
+@login_required
+@permission_required("attendance.add_attendance")
+@require_http_methods(["POST"])
+def punch_ingest(request):
+    """
+    This method is used to apply a batch of biometric punches, the body is
+    either csv lines of badge id,timestamp or json like
+    {"punches": [{"badge_id": "PEP01", "timestamp": "2024-01-01T09:00:00"}]}
+    """
+    if request.content_type == "application/json":
+        try:
+            rows = json.loads(request.body).get("punches", [])
+        except (ValueError, AttributeError):
+            return JsonResponse({"error": "Invalid json"}, status=400)
+        punches = []
+        invalid = []
+        for row in rows:
+            if isinstance(row, dict):
+                punch = parse_punch(row.get("badge_id"), row.get("timestamp"))
+            elif isinstance(row, (list, tuple)) and len(row) == 2:
+                punch = parse_punch(*row)
+            else:
+                punch = None
+            if punch is None:
+                invalid.append(row)
+            else:
+                punches.append(punch)
+    else:
+        punches, invalid = read_punches(
+            request.body.decode("utf-8", errors="replace").splitlines()
+        )
+    result = ingest_punches(punches)
+    result["invalid"] = invalid
+    return JsonResponse(result)
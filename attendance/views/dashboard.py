@@ -6,56 +6,22 @@ This module is used to register endpoints for dashboard-related requests
 
 import calendar
 from datetime import date, datetime, timedelta
-from django.db.models import Q, Sum
 from django.shortcuts import render
 from django.http import JsonResponse
 from django.utils.translation import gettext_lazy as _
-from attendance.filters import (
-    AttendanceFilters,
-    LateComeEarlyOutFilter,
-    AttendanceOverTimeFilter,
-)
-from attendance.models import (
-    Attendance,
-    AttendanceLateComeEarlyOut,
-    AttendanceOverTime,
-    AttendanceValidationCondition,
+from attendance.filters import AttendanceOverTimeFilter
+from attendance.methods.dashboard_metrics import (
+    day_counts,
+    department_counts,
+    department_hour_accounts,
+    department_overtime_hours,
 )
+from attendance.methods.save_lookups import get_minimum_overtime_to_approve
+from attendance.models import Attendance, AttendanceLateComeEarlyOut
 from attendance.views.views import strtime_seconds
-from base.methods import filtersubordinates
-from base.models import Department, EmployeeShiftSchedule
-from employee.models import Employee
+from base.models import Department
 from employee.not_in_out_dashboard import paginator_qry
 from horilla.decorators import login_required
-from leave.models import LeaveRequest
-
-
-def find_on_time(request, today, week_day, department=None):
-    """
-    This method is used to find count for on time attendances
-    """
-
-    on_time = 0
-    attendances = Attendance.objects.filter(attendance_date=today)
-    if department is not None:
-        attendances = attendances.filter(
-            employee_id__employee_work_info__department_id=department
-        )
-    late_come = AttendanceLateComeEarlyOut.objects.filter(
-        attendance_id__attendance_date=today, type="late_come"
-    )
-    on_time = len(attendances) - len(late_come)
-    return on_time
-
-
-def find_expected_attendances(week_day):
-    """
-    This method is used to find count of expected attendances for the week day
-    """
-    employees = Employee.objects.filter(is_active=True)
-    on_leave = LeaveRequest.objects.filter(status="Approved")
-    expected_attendances = len(employees) - len(on_leave)
-    return expected_attendances
 
 
 @login_required
@@ -65,21 +31,15 @@ def dashboard(request):
     """
     page_number = request.GET.get("page")
     previous_data = request.GET.urlencode()
-    employees = Employee.objects.filter(
-        is_active=True,
-    ).filter(~Q(employee_work_info__shift_id=None))
-    total_employees = len(employees)
-
-    today = datetime.today()
-    week_day = today.strftime("%A").lower()
-
-    on_time = find_on_time(request, today=today, week_day=week_day)
-    late_come = find_late_come(start_date=today)
-    late_come_obj = len(late_come)
+    today = date.today()
+    counts = day_counts(today)
+    total_employees = counts["total_employees"]
+    on_time = counts["on_time"]
+    late_come_obj = counts["late_come"]
 
     marked_attendances = late_come_obj + on_time
 
-    expected_attendances = find_expected_attendances(week_day=week_day)
+    expected_attendances = counts["expected"]
     on_time_ratio = 0
     late_come_ratio = 0
     marked_attendances_ratio = 0
@@ -91,18 +51,15 @@ def dashboard(request):
         )
     early_outs = AttendanceLateComeEarlyOut.objects.filter(
         type="early_out", attendance_id__attendance_date=today
-    )
+    ).select_related("employee_id")
 
-    condition = AttendanceValidationCondition.objects.first()
-    min_ot = strtime_seconds("00:00")
-    if condition is not None and condition.minimum_overtime_to_approve is not None:
-        min_ot = strtime_seconds(condition.minimum_overtime_to_approve)
+    min_ot = strtime_seconds(get_minimum_overtime_to_approve())
     ot_attendances = Attendance.objects.filter(
         overtime_second__gte=min_ot,
         attendance_validated=True,
         employee_id__is_active=True,
         attendance_overtime_approve=False,
-    )
+    ).select_related("employee_id")
 
     validate_attendances = Attendance.objects.filter(
         attendance_validated=False, employee_id__is_active=True
@@ -143,68 +100,6 @@ def validated_attendances_table(request):
     return render(request, "attendance/dashboard/to_validate_table.html", context)
 
 
-def total_attendance(start_date, department, end_date=None):
-    """
-    This method is used to find total attendance
-    """
-    attendance = AttendanceFilters(
-        {
-            "attendance_date__gte": start_date,
-            "attendance_date__lte": end_date,
-            "department": department,
-        }
-    ).qs
-    return attendance
-
-
-def find_late_come(start_date, department=None, end_date=None):
-    """
-    This method is used to find late comers
-    """
-    if department is not None:
-        late_come_obj = LateComeEarlyOutFilter(
-            {
-                "type": "late_come",
-                "department": department,
-                "attendance_date__gte": start_date,
-                "attendance_date__lte": end_date,
-            }
-        ).qs
-    else:
-        late_come_obj = LateComeEarlyOutFilter(
-            {
-                "type": "late_come",
-                "attendance_date__gte": start_date,
-                "attendance_date__lte": end_date,
-            }
-        ).qs
-    return late_come_obj
-
-
-def find_early_out(start_date, end_date=None, department=None):
-    """
-    This method is used to find early out attendances and it returns query set
-    """
-    if department is not None:
-        early_out_obj = LateComeEarlyOutFilter(
-            {
-                "type": "early_out",
-                "department": department,
-                "attendance_date__gte": start_date,
-                "attendance_date__lte": end_date,
-            }
-        ).qs
-    else:
-        early_out_obj = LateComeEarlyOutFilter(
-            {
-                "type": "early_out",
-                "attendance_date__gte": start_date,
-                "attendance_date__lte": end_date,
-            }
-        ).qs
-    return early_out_obj
-
-
 def get_week_start_end_dates(week):
     """
     This method is use to return the start and end date of the week
@@ -237,51 +132,18 @@ def get_month_start_end_dates(year_month):
     return start_date, end_date
 
 
-def generate_data_set(request, start_date, type, end_date, dept):
+def dashboard_dates(start_date, chart_type, end_date):
     """
-    This method is used to generate all the dashboard data
+    This method is used to find the start and end date of the dashboard
+    charts from the chart type, a day, a week, a month or a date range
     """
-    attendance = []
-    late_come_obj = []
-    early_out_obj = []
-    on_time = 0
-    if type == "day":
-        start_date = start_date
-        end_date = start_date
-    if type == "weekly":
-        start_date, end_date = get_week_start_end_dates(start_date)
-    if type == "monthly":
-        start_date, end_date = get_month_start_end_dates(start_date)
-    if type == "date_range":
-        start_date = start_date
-        end_date = end_date
-    # below method will find all the on-time attendance corresponding to the
-    # employee shift and shift schedule.
-    attendance = total_attendance(
-        start_date=start_date, department=dept, end_date=end_date
-    )
-
-    # below method will find all the late-come attendance corresponding to the
-    # employee shift and schedule.
-    late_come_obj = find_late_come(
-        start_date=start_date, department=dept, end_date=end_date
-    )
-
-    # below method will find all the early-out attendance corresponding to the
-    # employee shift and shift schedule
-    early_out_obj = find_early_out(
-        department=dept, start_date=start_date, end_date=end_date
-    )
-    on_time = len(attendance) - len(late_come_obj)
-
-    data = {}
-    if on_time or late_come_obj or early_out_obj:
-        data = {
-            "label": dept.department,
-            "data": [on_time, len(late_come_obj), len(early_out_obj)],
-        }
-
-    return data if data else None
+    if chart_type == "weekly":
+        return get_week_start_end_dates(start_date)
+    if chart_type == "monthly":
+        return get_month_start_end_dates(start_date)
+    if chart_type == "date_range":
+        return start_date, end_date
+    return start_date, start_date
 
 
 @login_required
@@ -298,7 +160,6 @@ def dashboard_attendance(request):
         _("Early Out"),
     ]
     # initializing values
-    data_set = []
     start_date = date.today()
     end_date = start_date
     type = "date"
@@ -311,62 +172,45 @@ def dashboard_attendance(request):
     if request.GET.get("end_date"):
         end_date = request.GET.get("end_date")
 
-    # get all departments for filtration
-    departments = Department.objects.all()
-    for dept in departments:
-        data_set.append(generate_data_set(request, start_date, type, end_date, dept))
+    start_date, end_date = dashboard_dates(start_date, type, end_date)
+    data_set = department_counts(start_date, end_date)
     message = _("No data Found...")
-    data_set = list(filter(None, data_set))
     return JsonResponse({"dataSet": data_set, "labels": labels, "message": message})
 
 
-def worked_hour_data(labels, records):
+def worked_hour_data(labels, hour_accounts):
     """
     To find all the worked hours
     """
-    data = {
+    return {
         "label": "Worked Hours",
         "backgroundColor": "rgba(75, 192, 192, 0.6)",
+        "data": [hour_accounts.get(dept, (0, 0))[0] / 3600 for dept in labels],
     }
-    dept_records = []
-    for dept in labels:
-        total_sum = records.filter(
-            employee_id__employee_work_info__department_id__department=dept
-        ).aggregate(total_sum=Sum("hour_account_second"))["total_sum"]
-        dept_records.append(total_sum / 3600 if total_sum else 0)
-    data["data"] = dept_records
-    return data
 
 
-def pending_hour_data(labels, records):
+def pending_hour_data(labels, hour_accounts):
     """
     To find all the pending hours
     """
-    data = {
+    return {
         "label": "Pending Hours",
         "backgroundColor": "rgba(255, 99, 132, 0.6)",
+        "data": [hour_accounts.get(dept, (0, 0))[1] / 3600 for dept in labels],
     }
-    dept_records = []
-    for dept in labels:
-        total_sum = records.filter(
-            employee_id__employee_work_info__department_id__department=dept
-        ).aggregate(total_sum=Sum("hour_pending_second"))["total_sum"]
-        dept_records.append(total_sum / 3600 if total_sum else 0)
-    data["data"] = dept_records
-    return data
 
 
 def pending_hours(request):
     """
     pending hours chart dashboard view
     """
-    records = AttendanceOverTimeFilter(request.GET).qs
+    hour_accounts = department_hour_accounts(AttendanceOverTimeFilter(request.GET).qs)
     labels = list(Department.objects.values_list("department", flat=True))
     data = {
         "labels": labels,
         "datasets": [
-            pending_hour_data(labels, records),
-            worked_hour_data(labels, records),
+            pending_hour_data(labels, hour_accounts),
+            worked_hour_data(labels, hour_accounts),
         ],
     }
 
@@ -381,65 +225,20 @@ def department_overtime_chart(request):
         request.GET.get("end_date") if request.GET.get("end_date") else start_date
     )
 
-    if chart_type == "day":
-        start_date = start_date
-        end_date = start_date
-    if chart_type == "weekly":
-        start_date, end_date = get_week_start_end_dates(start_date)
-    if chart_type == "monthly":
-        start_date, end_date = get_month_start_end_dates(start_date)
-    if chart_type == "date_range":
-        start_date = start_date
-        end_date = end_date
-
-    attendance = total_attendance(
-        start_date=start_date, department=None, end_date=end_date
-    )
-
-    condition = AttendanceValidationCondition.objects.first()
-    min_ot = strtime_seconds("00:00")
-    if condition is not None and condition.minimum_overtime_to_approve is not None:
-        min_ot = strtime_seconds(condition.minimum_overtime_to_approve)
-    attendances = attendance.filter(
-        overtime_second__gte=min_ot,
-        attendance_validated=True,
-        employee_id__is_active=True,
-        attendance_overtime_approve=True,
-    )
-    departments = []
-    department_total = []
-
-    for attendance in attendances:
-        departments.append(
-            attendance.employee_id.employee_work_info.department_id.department
-        )
-    departments = list(set(departments))
-
-    for depart in departments:
-        department_total.append({"department": depart, "ot_hours": 0})
-
-    for attendance in attendances:
-        if attendance.employee_id.employee_work_info.department_id:
-            department = (
-                attendance.employee_id.employee_work_info.department_id.department
-            )
-            ot = attendance.approved_overtime_second
-            ot_hrs = ot / 3600
-            for depart in department_total:
-                if depart["department"] == department:
-                    depart["ot_hours"] += ot_hrs
-
+    start_date, end_date = dashboard_dates(start_date, chart_type, end_date)
+    overtime_hours = department_overtime_hours(start_date, end_date)
+    departments = list(overtime_hours)
+    department_total = [
+        {"department": depart, "ot_hours": ot_hours}
+        for depart, ot_hours in overtime_hours.items()
+    ]
     dataset = [
         {
             "label": "",
-            "data": [],
+            "data": list(overtime_hours.values()),
         }
     ]
 
-    for depart_total, depart in zip(department_total, departments):
-        if depart == depart_total["department"]:
-            dataset[0]["data"].append(depart_total["ot_hours"])
-
     response = {
         "dataset": dataset,
         "labels": departments,
@@ -1,176 +1,285 @@
 """
 process_attendance_data.py
 
-This module contains a function for processing attendance data 
+This module contains a function for processing attendance data
 from Excel files and saving it to a database.
+
+process_attendance_data_bulk validates the whole file at once in pandas and
+inserts the attendances with bulk_create in chunks.
 """
 
 from datetime import datetime
 import pandas as pd
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from simple_history.utils import bulk_create_with_history
+from base.thread_local_middleware import _thread_locals
 from employee.models import Employee
+from attendance.methods.hour_account import reconcile_hour_accounts
+from attendance.methods.online_employees import update_online_employees
+from attendance.methods.rollups import refresh_attendance_rollups
 from attendance.models import Attendance
 from base.models import EmployeeShift, WorkType
+from leave.calendar_cache import get_employee_company_id
+from payroll.methods.work_records import write_attendance_work_records
+
+ATTENDANCE_IMPORT_CHUNK_SIZE = 1000
+
+
+def _parse_dates(column):
+    parsed = pd.to_datetime(column, errors="coerce")
+    # the format is inferred from the first date, the dates written in
+    # another format are parsed one by one like the row-by-row import did
+    retry = parsed.isna() & column.notna()
+    if retry.any():
+        parsed[retry] = column[retry].map(
+            lambda value: pd.to_datetime(value, errors="coerce")
+        )
+    return parsed.dt.normalize()
+
+
+def _parse_times(column):
+    return pd.to_datetime(column.astype(str), format="%H:%M:%S", errors="coerce")
+
+
+def _time_error(column, parsed, label):
+    return column.astype(str).map(
+        lambda value: f'time data "{value}" doesn\'t match format "%H:%M:%S" of {label}'
+    ).where(parsed.isna())
 
 
-def format_time(time_obj):
-    return time_obj.strftime("%H:%M") if time_obj else None
+def _import_user():
+    request = getattr(_thread_locals, "request", None)
+    user = getattr(request, "user", None)
+    return user if user is not None and user.is_authenticated else None
+
+
+def _save_rows(rows, user):
+    """
+    Insert the attendances with their history and work records. When the
+    chunk fails they are saved one by one, the attendances created meanwhile
+    are skipped
+
+    Parameters:
+        rows (list): (row index, Attendance) of the chunk
+
+    Returns:
+        dict: {row index: error} of the attendances not saved
+    """
+    attendances = [attendance for _index, attendance in rows]
+    try:
+        with transaction.atomic():
+            bulk_create_with_history(attendances, Attendance, default_user=user)
+            write_attendance_work_records(attendances)
+        return {}
+    except IntegrityError:
+        failed = {}
+        for index, attendance in rows:
+            attendance.pk = None
+            attendance._state.adding = True
+            try:
+                with transaction.atomic():
+                    attendance.save()
+            except IntegrityError as error:
+                exists = Attendance._base_manager.filter(
+                    employee_id=attendance.employee_id_id,
+                    attendance_date=attendance.attendance_date,
+                ).exists()
+                failed[index] = (
+                    "Attendance for this date already exists" if exists else str(error)
+                )
+        return failed
 
 
-def process_attendance_data(attendance_dicts):
+def process_attendance_data_bulk(attendance_dicts, chunk_size=None):
     """
-    Process a list of attendance data dictionaries and save valid records to the database,
-    while collecting error details for invalid records.
+    Process a list of attendance data dictionaries and save the valid records,
+    the rows are parsed and validated as columns, the employees, shifts, work
+    types and existing attendances are read with one query each and the valid
+    attendances are inserted with bulk_create in chunks. The hour accounts of
+    the imported months are reconciled once at the end.
 
     Parameters:
         attendance_dicts (list of dict): A list of dictionaries containing attendance data.
+        chunk_size (int): number of attendances inserted per transaction
 
     Returns:
         list: A list of dictionaries representing errors encountered during processing.
     """
-    error_list = []
-    for attendance_data in attendance_dicts:
-        save = True
-        try:
-            today = datetime.today().date()
-            badge_id = attendance_data["Badge ID"]
-            shift_id = attendance_data["Shift"]
-            work_type_id = attendance_data["Work type"]
-            employee = Employee.objects.filter(badge_id=badge_id).first()
-            shift = EmployeeShift.objects.filter(employee_shift=shift_id).first()
-            work_type = WorkType.objects.filter(work_type=work_type_id).first()
-            attendance_date = None
-            check_in_date = None
-            check_out_date = None
+    chunk_size = chunk_size or getattr(
+        settings, "ATTENDANCE_IMPORT_CHUNK_SIZE", ATTENDANCE_IMPORT_CHUNK_SIZE
+    )
+    columns = [
+        "Badge ID",
+        "Shift",
+        "Work type",
+        "Attendance date",
+        "Check-in date",
+        "Check-in",
+        "Check-out date",
+        "Check-out",
+        "Worked hour",
+        "Minimum hour",
+    ]
+    attendance_dicts = list(attendance_dicts)
+    if not attendance_dicts:
+        return []
+    frame = pd.DataFrame(attendance_dicts).reindex(columns=columns)
+    today = pd.Timestamp(datetime.today().date())
+    errors = {}
 
-            try:
-                attendance_date = pd.to_datetime(
-                    attendance_data["Attendance date"]
-                ).date()
-                existing_attendance = Attendance.objects.filter(
-                    employee_id__badge_id=badge_id,
-                    attendance_date=attendance_data["Attendance date"],
-                ).first()
-                if existing_attendance:
-                    attendance_data["Error6"] = (
-                        "Attendance for this date already exists"
-                    )
-                    save = False
-            except Exception as exception:
-                attendance_data["Error14"] = (
-                    "The attendance date format is invalid. Please use the format YYYY-MM-DD"
-                )
-                save = False
+    attendance_date = _parse_dates(frame["Attendance date"])
+    check_in_date = _parse_dates(frame["Check-in date"])
+    check_out_date = _parse_dates(frame["Check-out date"])
+    check_in = _parse_times(frame["Check-in"])
+    check_out = _parse_times(frame["Check-out"])
+    worked_hour = _parse_times(frame["Worked hour"])
+    minimum_hour = _parse_times(frame["Minimum hour"])
 
-            try:
-                check_in_date = pd.to_datetime(attendance_data["Check-in date"]).date()
-            except Exception as exception:
-                attendance_data["Error15"] = (
-                    "The Check-in date format is invalid. Please use the format YYYY-MM-DD"
-                )
-                save = False
+    badges = frame["Badge ID"].astype(str)
+    employees = {}
+    for employee in Employee.objects.filter(badge_id__in=set(badges)).select_related(
+        "employee_work_info"
+    ):
+        employees.setdefault(employee.badge_id, employee)
+    shifts = {}
+    for shift in EmployeeShift.objects.filter(
+        employee_shift__in=set(frame["Shift"].dropna().astype(str))
+    ):
+        shifts.setdefault(shift.employee_shift, shift)
+    work_types = {}
+    for work_type in WorkType.objects.filter(
+        work_type__in=set(frame["Work type"].dropna().astype(str))
+    ):
+        work_types.setdefault(work_type.work_type, work_type)
 
-            try:
-                check_out_date = pd.to_datetime(
-                    attendance_data["Check-out date"]
-                ).date()
-            except Exception as exception:
-                attendance_data["Error16"] = (
-                    "The Check-out date format is invalid. Please use the format YYYY-MM-DD"
-                )
-                save = False
+    employee = badges.map(
+        lambda badge: (
+            employees[badge]
+            if badge in employees and employees[badge].is_active
+            else None
+        )
+    )
+    shift = frame["Shift"].map(lambda name: shifts.get(str(name)))
+    work_type = frame["Work type"].map(lambda name: work_types.get(str(name)))
+    employee_id = employee.map(lambda instance: instance.id if instance else None)
 
-            try:
-                check_in = pd.to_datetime(
-                    attendance_data["Check-in"], format="%H:%M:%S"
-                ).time()
-            except Exception as exception:
-                attendance_data["Error10"] = f"{exception} of check-in time"
-                save = False
+    # one query for the attendances of the file that already exist
+    key = pd.MultiIndex.from_arrays([employee_id, attendance_date.dt.date])
+    known = employee_id.notna() & attendance_date.notna()
+    existing = set()
+    if known.any():
+        existing = set(
+            Attendance._base_manager.filter(
+                employee_id__in=set(employee_id[known]),
+                attendance_date__range=(
+                    attendance_date[known].min().date(),
+                    attendance_date[known].max().date(),
+                ),
+            ).values_list("employee_id", "attendance_date")
+        )
+    duplicated = known & (
+        pd.Series(key.isin(existing), index=frame.index)
+        | pd.Series(key.duplicated(), index=frame.index)
+    )
 
-            try:
-                check_out = pd.to_datetime(
-                    attendance_data["Check-out"], format="%H:%M:%S"
-                ).time()
-            except Exception as exception:
-                attendance_data["Error11"] = f"{exception} of check-out time"
-                save = False
+    errors["Error1"] = ("Invalid Badge ID given " + frame["Badge ID"].astype(str)).where(
+        employee.isna()
+    )
+    errors["Error2"] = ("Invalid shift '" + frame["Shift"].astype(str) + "'").where(
+        shift.isna()
+    )
+    errors["Error3"] = (
+        "Invalid work type '" + frame["Work type"].astype(str) + "'"
+    ).where(work_type.isna())
+    errors["Error4"] = pd.Series(
+        "Attendance check-in date cannot be smaller than attendance date",
+        index=frame.index,
+    ).where(check_in_date < attendance_date)
+    errors["Error5"] = pd.Series(
+        "Attendance check-out date never smaller than attendance check-in date",
+        index=frame.index,
+    ).where(check_out_date < check_in_date)
+    errors["Error6"] = pd.Series(
+        "Attendance for this date already exists", index=frame.index
+    ).where(duplicated)
+    errors["Error7"] = pd.Series(
+        "Attendance date in future", index=frame.index
+    ).where(attendance_date >= today)
+    errors["Error8"] = pd.Series(
+        "Attendance check in date in future", index=frame.index
+    ).where(check_in_date >= today)
+    errors["Error9"] = pd.Series(
+        "Attendance check out date in future", index=frame.index
+    ).where(check_out_date >= today)
+    errors["Error10"] = _time_error(frame["Check-in"], check_in, "check-in time")
+    errors["Error11"] = _time_error(frame["Check-out"], check_out, "check-out time")
+    errors["Error12"] = _time_error(frame["Worked hour"], worked_hour, "worked hours")
+    errors["Error13"] = _time_error(
+        frame["Minimum hour"], minimum_hour, "minimum hours"
+    )
+    errors["Error14"] = pd.Series(
+        "The attendance date format is invalid. Please use the format YYYY-MM-DD",
+        index=frame.index,
+    ).where(attendance_date.isna())
+    errors["Error15"] = pd.Series(
+        "The Check-in date format is invalid. Please use the format YYYY-MM-DD",
+        index=frame.index,
+    ).where(check_in_date.isna())
+    errors["Error16"] = pd.Series(
+        "The Check-out date format is invalid. Please use the format YYYY-MM-DD",
+        index=frame.index,
+    ).where(check_out_date.isna())
+    errors = pd.DataFrame(errors)
+    invalid = errors.notna().any(axis=1)
 
-            try:
-                worked_hour = pd.to_datetime(
-                    attendance_data["Worked hour"], format="%H:%M:%S"
-                ).time()
-            except Exception as exception:
-                attendance_data["Error12"] = f"{exception} of worked hours"
-                save = False
+    error_rows = {}
+    for index, row_errors in errors[invalid].iterrows():
+        attendance_data = attendance_dicts[index]
+        attendance_data.update(row_errors.dropna().to_dict())
+        error_rows[index] = attendance_data
 
-            try:
-                minimum_hour = pd.to_datetime(
-                    attendance_data["Minimum hour"], format="%H:%M:%S"
-                ).time()
-            except Exception as exception:
-                attendance_data["Error13"] = f"{exception} of minimum hours"
-                save = False
-
-            if employee is None or not employee.is_active:
-                attendance_data["Error1"] = f"Invalid Badge ID given {badge_id}"
-                save = False
-
-            if shift is None:
-                attendance_data["Error2"] = f"Invalid shift '{shift_id}'"
-                save = False
-
-            if work_type is None:
-                attendance_data["Error3"] = f"Invalid work type '{work_type_id}'"
-                save = False
-
-            if check_in_date is not None and attendance_date is not None:
-                if check_in_date < attendance_date:
-                    attendance_data["Error4"] = (
-                        "Attendance check-in date cannot be smaller than attendance date"
-                    )
-                    save = False
-
-            if check_in_date is not None and check_out_date is not None:
-                if check_out_date < check_in_date:
-                    attendance_data["Error5"] = (
-                        "Attendance check-out date never smaller than attendance check-in date"
-                    )
-                    save = False
-
-            if attendance_date is not None:
-                if attendance_date >= today:
-                    attendance_data["Error7"] = "Attendance date in future"
-                    save = False
-
-            if check_in_date is not None:
-                if check_in_date >= today:
-                    attendance_data["Error8"] = "Attendance check in date in future"
-                    save = False
-
-            if check_out_date is not None:
-                if check_out_date >= today:
-                    attendance_data["Error9"] = "Attendance check out date in future"
-                    save = False
-
-            if save:
-                attendance = Attendance(
-                    employee_id=employee,
-                    shift_id=shift,
-                    work_type_id=work_type,
-                    attendance_date=attendance_date,
-                    attendance_clock_in_date=check_in_date,
-                    attendance_clock_in=format_time(check_in),
-                    attendance_clock_out_date=check_out_date,
-                    attendance_clock_out=format_time(check_out),
-                    attendance_worked_hour=format_time(worked_hour),
-                    minimum_hour=format_time(minimum_hour),
-                )
-                attendance.save()
+    user = _import_user()
+    attendances = []
+    valid = frame.index[~invalid]
+    for index in valid:
+        attendance = Attendance(
+            employee_id=employee[index],
+            shift_id=shift[index],
+            work_type_id=work_type[index],
+            attendance_date=attendance_date[index].date(),
+            attendance_clock_in_date=check_in_date[index].date(),
+            attendance_clock_in=check_in[index].time().replace(second=0),
+            attendance_clock_out_date=check_out_date[index].date(),
+            attendance_clock_out=check_out[index].time().replace(second=0),
+            attendance_worked_hour=worked_hour[index].strftime("%H:%M"),
+            minimum_hour=minimum_hour[index].strftime("%H:%M"),
+            created_by=user,
+        )
+        attendance.compute_hours(get_employee_company_id(employee[index]))
+        attendances.append((index, attendance))
+
+    for start in range(0, len(attendances), chunk_size):
+        failed = _save_rows(attendances[start : start + chunk_size], user)
+        for index, error in failed.items():
+            attendance_data = attendance_dicts[index]
+            if error == "Attendance for this date already exists":
+                attendance_data["Error6"] = error
             else:
-                error_list.append(attendance_data)
+                attendance_data["Error17"] = error
+            error_rows[index] = attendance_data
 
-        except Exception as exception:
-            attendance_data["Error17"] = f"{str(exception)}"
-            error_list.append(attendance_data)
+    months = {}
+    for _index, attendance in attendances:
+        day = attendance.attendance_date
+        months.setdefault((day.year, day.month), set()).add(attendance.employee_id_id)
+    for (year, month), employee_ids in months.items():
+        reconcile_hour_accounts(year, month, employee_ids)
+    refresh_attendance_rollups(
+        (attendance.employee_id_id, attendance.attendance_date)
+        for _index, attendance in attendances
+    )
+    update_online_employees(attendance for _index, attendance in attendances)
 
-    return error_list
+    # the error rows in the order of the file
+    return [error_rows[index] for index in sorted(error_rows)]
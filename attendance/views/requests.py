@@ -23,6 +23,7 @@ from employee.models import Employee
 from attendance.models import Attendance, AttendanceActivity
 from attendance.forms import AttendanceRequestForm, NewRequestForm
 from attendance.methods.differentiate import get_diff_dict
+from attendance.methods.rollups import refresh_attendance_rollups
 from attendance.views.views import paginator_qry
 from attendance.filters import AttendanceFilters, AttendanceRequestReGroup
 from base.methods import closest_numbers
@@ -322,6 +323,10 @@ def approve_validate_attendance_request(request, attendance_id):
         # DUE TO AFFECT THE OVERTIME CALCULATION ON SAVE METHOD, SAVE THE INSTANCE ONCE MORE
         attendance = Attendance.objects.get(id=attendance_id)
         attendance.save()
+        # the update moves the attendance without the signals of its former day
+        refresh_attendance_rollups(
+            [(attendance.employee_id_id, prev_attendance_date)]
+        )
     if (
         attendance.attendance_clock_out is None
         or attendance.attendance_clock_out_date is None
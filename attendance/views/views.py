@@ -11,7 +11,6 @@ This module is part of the recruitment project and is intended to
 provide the main entry points for interacting with the application's functionality.
 """
 
-import calendar
 import json
 import contextlib
 from datetime import datetime, timedelta
@@ -26,7 +25,7 @@ from django.core.paginator import Paginator
 from django.db.models import ProtectedError
 from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
 from django.views.decorators.http import require_http_methods
-from employee.models import Employee
+from employee.models import Employee, EmployeeWorkInformation
 from horilla.decorators import (
     permission_required,
     login_required,
@@ -37,10 +36,18 @@ from base.methods import closest_numbers, export_data, get_pagination
 from base.methods import get_key_instances
 from base.models import EmployeeShiftSchedule
 from base.methods import filtersubordinates, choosesubordinates
-from leave.models import WEEK_DAYS, CompanyLeave, Holiday
+from leave.calendar_cache import get_employee_company_id, is_non_working_day
 from notifications.signals import notify
+from attendance.methods.bulk_validation import (
+    approve_overtimes,
+    notify_overtime_approved,
+    notify_validated,
+    validate_attendances,
+)
+from attendance.methods.save_lookups import get_validation_at_work
+from attendance.methods.schedule_cache import shift_schedule
 from attendance.views.handle_attendance_errors import handle_attendance_errors
-from attendance.views.process_attendance_data import process_attendance_data
+from attendance.views.process_attendance_data import process_attendance_data_bulk
 from attendance.filters import (
     AttendanceFilters,
     AttendanceOverTimeFilter,
@@ -77,7 +84,7 @@ from attendance.filters import (
     LateComeEarlyOutReGroup,
     AttendanceActivityReGroup,
 )
-from payroll.models.models import WorkRecord
+from payroll.methods.work_record_matrix import month_dates, work_record_matrix
 
 
 # Create your views here.
@@ -141,71 +148,36 @@ def attendance_validate(attendance):
         attendance : attendance object
     """
 
-    conditions = AttendanceValidationCondition.objects.all()
-    # Set the default condition for 'at work' to 9:00 AM
-    condition_for_at_work = strtime_seconds("09:00")
-    if conditions.exists():
-        condition_for_at_work = strtime_seconds(conditions[0].validation_at_work)
+    condition_for_at_work = strtime_seconds(get_validation_at_work())
     at_work = strtime_seconds(attendance.attendance_worked_hour)
     return condition_for_at_work >= at_work
 
 
-def attendance_day_checking(attendance_date, minimum_hour):
+def attendance_day_checking(attendance_date, minimum_hour, company_id=None):
     # Convert the string to a datetime object
     attendance_datetime = datetime.strptime(attendance_date, "%Y-%m-%d")
 
-    # Extract name of the day
-    attendance_day = attendance_datetime.strftime("%A")
-
-    # Taking all holidays into a list
-    leaves = []
-    holidays = Holiday.objects.all()
-    for holi in holidays:
-        start_date = holi.start_date
-        end_date = holi.end_date
-
-        # Convert start_date and end_date to datetime objects
-        start_date = datetime.strptime(str(start_date), "%Y-%m-%d")
-        end_date = datetime.strptime(str(end_date), "%Y-%m-%d")
-
-        # Add dates in between start date and end date including both
-        current_date = start_date
-        while current_date <= end_date:
-            leaves.append(current_date.strftime("%Y-%m-%d"))
-            current_date += timedelta(days=1)
-
-    # Checking attendance date is in holiday list, if found making the minimum hour to 00:00
-    for leave in leaves:
-        if str(leave) == str(attendance_date):
-            minimum_hour = "00:00"
-            break
-
-    # Making a dictonary contains week day value and leave day pairs
-    company_leaves = {}
-    company_leave = CompanyLeave.objects.all()
-    for com_leave in company_leave:
-        a = dict(WEEK_DAYS).get(com_leave.based_on_week_day)
-        b = com_leave.based_on_week
-        company_leaves[b] = a
-
-    # Checking the attendance date is in which week
-    week_in_month = str(((attendance_datetime.day - 1) // 7 + 1) - 1)
-
-    # Checking the attendance date is in the company leave or not
-    for pairs in company_leaves.items():
-        # For all weeks based_on_week is None
-        if str(pairs[0]) == "None":
-            if str(pairs[1]) == str(attendance_day):
-                minimum_hour = "00:00"
-                break
-        # Checking with based_on_week and attendance_date week
-        if str(pairs[0]) == week_in_month:
-            if str(pairs[1]) == str(attendance_day):
-                minimum_hour = "00:00"
-                break
+    # Holidays and company leaves don't have a minimum hour
+    if is_non_working_day(attendance_datetime, company_id):
+        minimum_hour = "00:00"
     return minimum_hour
 
 
+def posted_employee_company_id(request):
+    """
+    This method is used to return the company of the employee of the posted
+    attendance form, the company of the user when no employee is posted
+    """
+    employee_id = request.POST.get("employee_id")
+    if employee_id and employee_id.isdigit():
+        return (
+            EmployeeWorkInformation.objects.filter(employee_id=employee_id)
+            .values_list("company_id", flat=True)
+            .first()
+        )
+    return get_employee_company_id(getattr(request.user, "employee_get", None))
+
+
 @login_required
 @manager_can_enter("attendance.add_attendance")
 def attendance_create(request):
@@ -291,7 +263,7 @@ def attendance_import(request):
         file = request.FILES["attendance_import"]
         data_frame = pd.read_excel(file)
         attendance_dicts = data_frame.to_dict("records")
-        attendance_import = process_attendance_data(attendance_dicts)
+        attendance_import = process_attendance_data_bulk(attendance_dicts)
 
         if attendance_import:
             error_data = handle_attendance_errors(attendance_import)
@@ -901,16 +873,9 @@ def shift_schedule_today(day, shift):
     it will returns min hour,start time seconds  end time seconds
     args:
         shift   : shift instance
-        day     : shift day object
+        day     : shift day id
     """
-    schedule_today = day.day_schedule.filter(shift_id=shift)
-    start_time_sec, end_time_sec, minimum_hour = 0, 0, "00:00"
-    if schedule_today.exists():
-        schedule_today = schedule_today[0]
-        minimum_hour = schedule_today.minimum_working_hour
-        start_time_sec = strtime_seconds(schedule_today.start_time.strftime("%H:%M"))
-        end_time_sec = strtime_seconds(schedule_today.end_time.strftime("%H:%M"))
-    return (minimum_hour, start_time_sec, end_time_sec)
+    return shift_schedule(shift.id if shift else None, day)
 
 
 def overtime_calculation(attendance):
@@ -1182,33 +1147,25 @@ def validate_bulk_attendance(request):
     """
     ids = request.POST["ids"]
     ids = json.loads(ids)
-    for obj_id in ids:
-        try:
-            attendance = Attendance.objects.get(id=obj_id)
-            if not attendance.is_validate_request:
-                attendance.attendance_validated = True
-                attendance.save()
-                messages.success(request, _("Attendance validated."))
-            else:
-                messages.info(
-                    request,
-                    _(
-                        "Pending attendance update request for {}'s attendance on {}!"
-                    ).format(attendance.employee_id, attendance.attendance_date),
-                )
-            notify.send(
-                request.user.employee_get,
-                recipient=attendance.employee_id.employee_user_id,
-                verb=f"Your attendance for the date {attendance.attendance_date} is validated",
-                verb_ar=f"تم التحقق من حضورك في تاريخ {attendance.attendance_date}",
-                verb_de=f"Ihre Anwesenheit für das Datum {attendance.attendance_date} wurde bestätigt",
-                verb_es=f"Se ha validado su asistencia para la fecha {attendance.attendance_date}",
-                verb_fr=f"Votre présence pour la date {attendance.attendance_date} est validée",
-                redirect=f"/attendance/view-my-attendance?id={attendance.id}",
-                icon="checkmark",
-            )
-        except (Attendance.DoesNotExist, OverflowError, ValueError):
-            messages.error(request, _("Attendance not found"))
+    try:
+        attendances = Attendance.objects.filter(id__in=ids)
+        validated, pending = validate_attendances(attendances, request.user)
+    except (OverflowError, ValueError):
+        validated, pending = [], []
+    if validated:
+        messages.success(
+            request, _("{} attendances validated.").format(len(validated))
+        )
+        notify_validated(request.user.employee_get, validated)
+    for attendance in pending:
+        messages.info(
+            request,
+            _("Pending attendance update request for {}'s attendance on {}!").format(
+                attendance.employee_id, attendance.attendance_date
+            ),
+        )
+    if len(validated) + len(pending) < len(ids):
+        messages.error(request, _("Attendance not found"))
     return JsonResponse({"message": "success"})
 
 
@@ -1335,30 +1292,17 @@ def approve_bulk_overtime(request):
     """
     ids = request.POST["ids"]
     ids = json.loads(ids)
-    for attendance_id in ids:
-        try:
-            attendance = Attendance.objects.get(id=attendance_id)
-            attendance.attendance_overtime_approve = True
-            attendance.save()
-            messages.success(request, _("Overtime approved"))
-            notify.send(
-                request.user.employee_get,
-                recipient=attendance.employee_id.employee_user_id,
-                verb=f"Overtime approved for\
-                      {attendance.attendance_date}'s attendance",
-                verb_ar=f"تمت الموافقة على العمل الإضافي لحضور تاريخ \
-                    {attendance.attendance_date}",
-                verb_de=f"Überstunden für die Anwesenheit am \
-                    {attendance.attendance_date} genehmigt",
-                verb_es=f"Horas extra aprobadas para la asistencia del \
-                    {attendance.attendance_date}",
-                verb_fr=f"Heures supplémentaires approuvées pour la présence du \
-                    {attendance.attendance_date}",
-                redirect=f"/attendance/attendance-overtime-view?id={attendance.id}",
-                icon="checkmark",
-            )
-        except (Attendance.DoesNotExist, OverflowError, ValueError):
-            messages.error(request, _("Attendance not found"))
+    try:
+        attendances = approve_overtimes(
+            Attendance.objects.filter(id__in=ids), request.user
+        )
+    except (OverflowError, ValueError):
+        attendances = []
+    if attendances:
+        messages.success(request, _("Overtime approved"))
+        notify_overtime_approved(request.user.employee_get, attendances)
+    if len(attendances) < len(ids):
+        messages.error(request, _("Attendance not found"))
     return JsonResponse({"message": "Success"})
 
 
@@ -1391,7 +1335,9 @@ def form_shift_dynamic_data(request):
         shift_end_time = datetime.now().strftime("%H:%M")
         worked_hour = "00:00"
 
-    minimum_hour = attendance_day_checking(str(attendance_date), minimum_hour)
+    minimum_hour = attendance_day_checking(
+        str(attendance_date), minimum_hour, posted_employee_company_id(request)
+    )
 
     return JsonResponse(
         {
@@ -1424,7 +1370,9 @@ def form_date_checking(request):
             minimum_hour = schedule_today.minimum_working_hour
 
     attendance_date = str(attendance_date)
-    minimum_hour = attendance_day_checking(attendance_date, minimum_hour)
+    minimum_hour = attendance_day_checking(
+        attendance_date, minimum_hour, posted_employee_company_id(request)
+    )
 
     return JsonResponse(
         {
@@ -1932,41 +1880,34 @@ def delete_comment_file(request):
     )
 
 
-@login_required
-def work_records(request):
-    employees = Employee.objects.filter(is_active=True)
-    data = []
-    today = date.today()
-    month_matrix = calendar.monthcalendar(today.year, today.month)
-
-    days = [day for week in month_matrix for day in week if day != 0]
-    current_month_date_list = [
-        datetime(today.year, today.month, day).date() for day in days
-    ]
-
-    for employee in employees:
-        work_record_list = []
-        work_records_dict = {
-            record.date: record
-            for record in WorkRecord.objects.filter(
-                employee_id=employee, date__in=current_month_date_list
-            )
+def work_record_page(year, month, page_number):
+    """
+    This method is used to paginate the active employees and fill the page
+    with their work records of the month
+    """
+    employees = paginator_qry(
+        Employee.objects.filter(is_active=True).order_by("id"), page_number
+    )
+    matrix = work_record_matrix(
+        [employee.id for employee in employees], year, month
+    )
+    employees.object_list = [
+        {
+            "employee": employee,
+            "work_record": matrix[employee.id],
         }
+        for employee in employees
+    ]
+    return employees
 
-        for day in current_month_date_list:
-            work_record = work_records_dict.get(day, None)
-            work_record_list.append(work_record)
-        data.append(
-            {
-                "employee": employee,
-                "work_record": work_record_list,
-            }
-        )
 
+@login_required
+def work_records(request):
+    today = date.today()
     context = {
         "current_date": today,
-        "current_month_dates_list": current_month_date_list,
-        "data": paginator_qry(data, 1),
+        "current_month_dates_list": month_dates(today.year, today.month),
+        "data": work_record_page(today.year, today.month, 1),
     }
     return render(
         request, "attendance/work_record/work_record_view.html", context=context
@@ -1984,35 +1925,9 @@ def work_records_change_month(request):
         month = date.today().month
         year = date.today().year
 
-    employees = Employee.objects.filter(is_active=True)
-    data = []
-    month_matrix = calendar.monthcalendar(year, month)
-
-    days = [day for week in month_matrix for day in week if day != 0]
-    current_month_date_list = [datetime(year, month, day).date() for day in days]
-
-    for employee in employees:
-        work_record_list = []
-        work_records_dict = {
-            record.date: record
-            for record in WorkRecord.objects.filter(
-                employee_id=employee, date__in=current_month_date_list
-            )
-        }
-
-        for day in current_month_date_list:
-            work_record = work_records_dict.get(day, None)
-            work_record_list.append(work_record)
-        data.append(
-            {
-                "employee": employee,
-                "work_record": work_record_list,
-            }
-        )
-
     context = {
-        "current_month_dates_list": current_month_date_list,
-        "data": paginator_qry(data, request.GET.get("page")),
+        "current_month_dates_list": month_dates(year, month),
+        "data": work_record_page(year, month, request.GET.get("page")),
     }
     return render(
         request, "attendance/work_record/work_record_list.html", context=context
@@ -1,4 +1,5 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+from horilla.horilla_scheduler import start_scheduler
 from datetime import datetime, timedelta, date
 import calendar
 from notifications.signals import notify
@@ -439,4 +440,4 @@ except:
     pass
 
 
-scheduler.start()
+start_scheduler(scheduler)
@@ -5,7 +5,7 @@ This module is used to register models for employee app
 
 """
 
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User, Permission
@@ -344,19 +344,14 @@ class Employee(models.Model):
         """
         This method is used to check the user in online users or not
         """
-        from attendance.models import Attendance
+        from attendance.methods.online_employees import get_online_employee_ids
 
         request = getattr(thread_local_middleware._thread_locals, "request", None)
-        if not getattr(request, "working_employees", None):
-            today = datetime.now().date()
-            yesterday = today - timedelta(days=1)
-            working_employees = Attendance.objects.filter(
-                attendance_date__gte=yesterday,
-                attendance_date__lte=today,
-                attendance_clock_out_date__isnull=True,
-            ).values_list("employee_id", flat=True)
-            setattr(request, "working_employees", working_employees)
-        working_employees = request.working_employees
+        working_employees = getattr(request, "working_employees", None)
+        if working_employees is None:
+            working_employees = get_online_employee_ids()
+            if request is not None:
+                setattr(request, "working_employees", working_employees)
         return self.pk in working_employees
 
     class Meta:
@@ -1,6 +1,7 @@
 import datetime
 from datetime import timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
+from horilla.horilla_scheduler import start_scheduler
 
 
 def update_experience():
@@ -133,4 +134,4 @@ def block_unblock_disciplinary():
 scheduler = BackgroundScheduler()
 scheduler.add_job(update_experience, "interval", days=1)
 scheduler.add_job(block_unblock_disciplinary, "interval", seconds=10)
-scheduler.start()
+start_scheduler(scheduler)
@@ -0,0 +1,30 @@
+"""
+horilla_scheduler
+
+This module is used to start the schedulers of the apps. The worker
+processes of the payroll pools load the apps too, the schedulers are not
+started in them so every scheduled job runs once, in the main processes.
+"""
+
+import os
+import django
+
+SCHEDULER_DISABLED_ENV = "HORILLA_SCHEDULER_DISABLED"
+
+
+def start_scheduler(scheduler):
+    """
+    This method is used to start the scheduler of an app, unless the
+    process is a worker process
+    """
+    if not os.environ.get(SCHEDULER_DISABLED_ENV):
+        scheduler.start()
+
+
+def setup_worker():
+    """
+    This method is used to set up django in a worker process of a pool,
+    without starting the schedulers of the apps
+    """
+    os.environ[SCHEDULER_DISABLED_ENV] = "1"
+    django.setup()
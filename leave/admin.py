@@ -14,7 +14,8 @@ from .models import (
     LeaveAllocationRequest,
     LeaveallocationrequestComment,
     LeaverequestComment,
-    RestrictLeave
+    RestrictLeave,
+    LeaveLedgerEntry,
 )
 from simple_history.admin import SimpleHistoryAdmin
 
@@ -30,3 +31,4 @@ admin.site.register(LeaveRequestConditionApproval)
 admin.site.register(LeaverequestComment)
 admin.site.register(LeaveallocationrequestComment)
 admin.site.register(RestrictLeave)
+admin.site.register(LeaveLedgerEntry)
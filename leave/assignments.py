@@ -0,0 +1,121 @@
+"""
+assignments.py
+
+This module is used to assign leave types to many employees at once. The
+reset and expiry dates of the assignments of a day only depend on the leave
+type, so they are computed once per leave type. The assignments that
+already exist are found with one query, the new ones and their leave ledger
+entries are inserted with bulk_create and the employees get one
+notification each for the batch.
+"""
+
+from django.db import transaction
+from django.utils import timezone
+from simple_history.utils import bulk_create_with_history
+from base.thread_local_middleware import _thread_locals
+from leave.ledger import write_ledger_entries
+from notifications.models import bulk_notify
+
+
+def assign_leave_types(assignments, assigned_date=None, batch_size=1000):
+    """
+    This method is used to assign leave types to employees
+
+    Args:
+        assignments (list): (LeaveType, employee id) to assign
+        assigned_date (date): the assigned date, today when not given
+
+    Returns:
+        tuple: (created AvailableLeave list, (leave type id, employee id) of
+            the assignments that already existed)
+    """
+    from leave.models import AvailableLeave
+
+    assigned_date = assigned_date or timezone.localdate()
+    assignments = list(
+        {
+            (leave_type.pk, int(employee_id)): leave_type
+            for leave_type, employee_id in assignments
+        }.items()
+    )
+    if not assignments:
+        return [], set()
+    pairs = [pair for pair, _leave_type in assignments]
+    existing = set(
+        AvailableLeave._base_manager.filter(
+            leave_type_id__in={leave_type_id for leave_type_id, _ in pairs},
+            employee_id__in={employee_id for _, employee_id in pairs},
+        ).values_list("leave_type_id", "employee_id")
+    )
+    # the creator HorillaModel.save sets, bulk_create does not call it
+    request = getattr(_thread_locals, "request", None)
+    created_by = (
+        request.user if request and request.user.is_authenticated else None
+    )
+    templates = {}
+    available_leaves = []
+    for (leave_type_id, employee_id), leave_type in assignments:
+        if (leave_type_id, employee_id) in existing:
+            continue
+        template = templates.get(leave_type_id)
+        if template is None:
+            # the dates of an assignment depend on the leave type only
+            template = AvailableLeave(
+                leave_type_id=leave_type,
+                available_days=leave_type.total_days,
+                assigned_date=assigned_date,
+            )
+            template.set_leave_dates()
+            templates[leave_type_id] = template
+        available_leaves.append(
+            AvailableLeave(
+                leave_type_id=leave_type,
+                employee_id_id=employee_id,
+                available_days=template.available_days,
+                carryforward_days=template.carryforward_days,
+                total_leave_days=template.total_leave_days,
+                assigned_date=assigned_date,
+                reset_date=template.reset_date,
+                expired_date=template.expired_date,
+                created_by=created_by,
+            )
+        )
+    with transaction.atomic():
+        bulk_create_with_history(
+            available_leaves, AvailableLeave, batch_size=batch_size
+        )
+        write_ledger_entries(
+            available_leaves, entry_type="accrual", entry_date=assigned_date
+        )
+    skipped = {pair for pair, _leave_type in assignments if pair in existing}
+    return available_leaves, skipped
+
+
+def notify_assigned(sender, available_leaves):
+    """
+    This method is used to notify the employees of their new leave types,
+    one notification per employee with one insert
+    """
+    from employee.models import Employee
+
+    employee_ids = {
+        available_leave.employee_id_id for available_leave in available_leaves
+    }
+    if not employee_ids:
+        return
+    bulk_notify(
+        sender,
+        [
+            {"recipient": employee.employee_user_id}
+            for employee in Employee._base_manager.filter(
+                id__in=employee_ids
+            ).select_related("employee_user_id")
+        ],
+        verb="New leave type is assigned to you",
+        verb_ar="تم تعيين نوع إجازة جديد لك",
+        verb_de="Ihnen wurde ein neuer Urlaubstyp zugewiesen",
+        verb_es="Se le ha asignado un nuevo tipo de permiso",
+        verb_fr="Un nouveau type de congé vous a été attribué",
+        icon="people-circle",
+        redirect="/leave/user-request-view",
+    )
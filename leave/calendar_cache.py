@@ -0,0 +1,174 @@
+"""
+calendar_cache.py
+
+This module is used to keep the non working days (holidays and company leaves)
+of every company and year in the cache. The leave, attendance and payroll apps
+read the dates from here instead of expanding the Holiday and CompanyLeave
+records again, the index is invalidated by the Holiday/CompanyLeave signals.
+"""
+
+import calendar
+import time
+from datetime import date, datetime, timedelta
+from django.core.cache import cache
+from django.db.models import Q
+
+CACHE_KEY = "non_working_days"
+CACHE_TIMEOUT = 60 * 60 * 24
+VERSION_KEY = f"{CACHE_KEY}_version"
+
+# Sunday is the first day of the week for the based on week company leaves
+SUNDAY_FIRST = calendar.Calendar(firstweekday=6)
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def get_employee_company_id(employee):
+    """
+    :return: company id of the employee, the key of the employee's calendar
+    """
+    work_info = getattr(employee, "employee_work_info", None)
+    return getattr(work_info, "company_id_id", None)
+
+
+def _version():
+    return cache.get_or_set(VERSION_KEY, time.time_ns(), None)
+
+
+def invalidate_non_working_days():
+    """
+    This method is used to drop the cached calendar of every company and year
+    """
+    cache.set(VERSION_KEY, time.time_ns(), None)
+
+
+def company_leave_days(year, based_on_week, based_on_week_day):
+    """
+    :return: This function returns the dates of a company leave rule in the year
+    """
+    week_day = int(based_on_week_day)
+    leave_dates = []
+    for month in range(1, 13):
+        if based_on_week is not None:
+            weeks = SUNDAY_FIRST.monthdayscalendar(year, month)
+            if int(based_on_week) >= len(weeks):
+                continue
+            days = [day for day in weeks[int(based_on_week)] if day != 0]
+        else:
+            days = range(1, calendar.monthrange(year, month)[1] + 1)
+        for day in days:
+            leave_date = date(year, month, day)
+            if leave_date.weekday() == week_day:
+                leave_dates.append(leave_date)
+    return leave_dates
+
+
+def _build_year(year, company_id):
+    from leave.models import CompanyLeave, Holiday
+
+    year_start = date(year, 1, 1)
+    year_end = date(year, 12, 31)
+    company_filter = (
+        Q()
+        if company_id is None
+        else Q(company_id=company_id) | Q(company_id__isnull=True)
+    )
+
+    holidays = set()
+    for start_date, end_date in (
+        Holiday._base_manager.filter(company_filter, start_date__lte=year_end)
+        .filter(
+            Q(end_date__gte=year_start)
+            | Q(end_date__isnull=True, start_date__gte=year_start)
+        )
+        .values_list("start_date", "end_date")
+    ):
+        day = max(start_date, year_start)
+        last_day = min(end_date or start_date, year_end)
+        while day <= last_day:
+            holidays.add(day)
+            day += timedelta(days=1)
+
+    company_leaves = set()
+    for based_on_week, based_on_week_day in CompanyLeave._base_manager.filter(
+        company_filter
+    ).values_list("based_on_week", "based_on_week_day"):
+        company_leaves.update(
+            company_leave_days(year, based_on_week, based_on_week_day)
+        )
+
+    return {
+        "holidays": frozenset(holidays),
+        "company_leaves": frozenset(company_leaves),
+    }
+
+
+def get_non_working_days(year, company_id=None):
+    """
+    This method is used to get the holidays and company leave dates of the year
+
+    Args:
+        year (int): calendar year
+        company_id (int): company of the employee, None for all the companies
+
+    Returns:
+        dict: {"holidays": frozenset, "company_leaves": frozenset}
+    """
+    key = f"{CACHE_KEY}_{_version()}_{company_id or 'all'}_{year}"
+    days = cache.get(key)
+    if days is None:
+        days = _build_year(year, company_id)
+        cache.set(key, days, CACHE_TIMEOUT)
+    return days
+
+
+def _dates_between(kind, start_date, end_date, company_id):
+    start_date = _as_date(start_date)
+    end_date = _as_date(end_date or start_date)
+    dates = []
+    for year in range(start_date.year, end_date.year + 1):
+        dates.extend(
+            day
+            for day in get_non_working_days(year, company_id)[kind]
+            if start_date <= day <= end_date
+        )
+    return sorted(dates)
+
+
+def holiday_dates_between(start_date, end_date, company_id=None):
+    """
+    :return: this functions returns the sorted holiday dates in the range.
+    """
+    return _dates_between("holidays", start_date, end_date, company_id)
+
+
+def company_leave_dates_between(start_date, end_date, company_id=None):
+    """
+    :return: this functions returns the sorted company leave dates in the range.
+    """
+    return _dates_between("company_leaves", start_date, end_date, company_id)
+
+
+def is_holiday(day, company_id=None):
+    """
+    Whether the date is a holiday
+    """
+    day = _as_date(day)
+    return day in get_non_working_days(day.year, company_id)["holidays"]
+
+
+def is_company_leave(day, company_id=None):
+    """
+    Whether the date is a company leave
+    """
+    day = _as_date(day)
+    return day in get_non_working_days(day.year, company_id)["company_leaves"]
+
+
+def is_non_working_day(day, company_id=None):
+    """
+    Whether the date is a holiday or a company leave
+    """
+    return is_holiday(day, company_id) or is_company_leave(day, company_id)
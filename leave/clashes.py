@@ -0,0 +1,386 @@
+"""
+clashes.py
+
+This module is used to find the leave clashes of the leave requests. Two
+leave requests clash when their dates overlap and their employees share the
+department or the job position.
+
+The leave clashes count stored on the leave requests is kept up to date on
+save: only the requests clashing with the former and the new dates of a
+created, moved or deleted request are found, with a date range query, and
+their counts are incremented or decremented in the database.
+
+The list views count the clashes of their page on demand instead. The
+requests of a department or a job position in a month are read once and
+kept in the cache until a request of the department, the job position and
+the month changes.
+
+When an employee moves to another department or job position the stored
+counts of the employee's requests and of the requests overlapping them are
+counted again.
+"""
+
+import time
+from datetime import date
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+
+CACHE_TIMEOUT = 60 * 60 * 24
+VERSION_KEY = "leave_clashes_version"
+CLASHES_KEY = "leave_clashes_{version}_{group}_{value}_{year}_{month}"
+CLASH_GROUPS = {
+    "department": "employee_id__employee_work_info__department_id",
+    "job_position": "employee_id__employee_work_info__job_position_id",
+}
+
+
+def _work_info(employee_id):
+    from employee.models import EmployeeWorkInformation
+
+    return (
+        EmployeeWorkInformation._base_manager.filter(employee_id=employee_id)
+        .values("department_id", "job_position_id")
+        .first()
+    ) or {"department_id": None, "job_position_id": None}
+
+
+def _months(start_date, end_date):
+    """
+    (year, month) of the months between the dates
+    """
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _version():
+    return cache.get_or_set(VERSION_KEY, time.time_ns(), None)
+
+
+def _group_keys(version, groups, start_date, end_date):
+    """
+    Cache keys of the groups, {group: value}, in the months between the dates
+    """
+    return {
+        CLASHES_KEY.format(
+            version=version, group=group, value=value, year=year, month=month
+        ): (group, value, year, month)
+        for group, value in groups.items()
+        for year, month in _months(start_date, end_date or start_date)
+    }
+
+
+def invalidate_leave_clashes(employee_id=None, start_date=None, end_date=None):
+    """
+    This method is used to drop the cached leave requests of the department
+    and the job position of the employee in the months between the dates,
+    the cached requests of every group are dropped when no employee is given
+    """
+    if employee_id is None:
+        cache.set(VERSION_KEY, time.time_ns(), None)
+        return
+    work_info = _work_info(employee_id)
+    cache.delete_many(
+        list(
+            _group_keys(
+                _version(),
+                {
+                    "department": work_info["department_id"],
+                    "job_position": work_info["job_position_id"],
+                },
+                start_date,
+                end_date,
+            )
+        )
+    )
+
+
+def clashing_leave_requests(employee_id, start_date, end_date, exclude_id=None):
+    """
+    This method is used to get the leave requests clashing with a leave of
+    the employee between the dates
+
+    Args:
+        employee_id (int): id of the employee on leave
+        start_date (date): first day of the leave
+        end_date (date): last day of the leave, the first day when None
+        exclude_id (int): id of the leave request itself
+
+    Returns:
+        queryset: the clashing LeaveRequest records
+    """
+    from leave.models import LeaveRequest
+
+    work_info = _work_info(employee_id)
+    return LeaveRequest._base_manager.filter(
+        Q(employee_id__employee_work_info__department_id=work_info["department_id"])
+        | Q(
+            employee_id__employee_work_info__job_position_id=work_info[
+                "job_position_id"
+            ]
+        ),
+        start_date__lte=end_date or start_date,
+        end_date__gte=start_date,
+    ).exclude(id=exclude_id)
+
+
+def _clash_ids(leave_request):
+    return set(
+        clashing_leave_requests(
+            leave_request["employee_id"],
+            leave_request["start_date"],
+            leave_request["end_date"],
+            leave_request["id"],
+        ).values_list("id", flat=True)
+    )
+
+
+def _add_to_counts(ids, change):
+    from leave.models import LeaveRequest
+
+    if ids:
+        LeaveRequest._base_manager.filter(id__in=ids).update(
+            leave_clashes_count=F("leave_clashes_count") + change
+        )
+
+
+def update_leave_clashes(leave_request):
+    """
+    This method is used to set the clashes count of a leave request being
+    saved, and to move the counts of the requests it stops or starts to
+    clash with. Nothing but the count of the request is read when its
+    employee and dates did not change.
+
+    Args:
+        leave_request (LeaveRequest): the leave request, before its save
+    """
+    from leave.models import LeaveRequest
+
+    current = {
+        "id": leave_request.pk,
+        "employee_id": leave_request.employee_id_id,
+        "start_date": leave_request.start_date,
+        "end_date": leave_request.end_date,
+    }
+    previous = None
+    if leave_request.pk is not None:
+        previous = (
+            LeaveRequest._base_manager.filter(pk=leave_request.pk)
+            .values("id", "employee_id", "start_date", "end_date")
+            .first()
+        )
+    if previous == current:
+        leave_request.leave_clashes_count = clashing_leave_requests(
+            current["employee_id"],
+            current["start_date"],
+            current["end_date"],
+            current["id"],
+        ).count()
+        return
+    clash_ids = _clash_ids(current)
+    previous_ids = _clash_ids(previous) if previous is not None else set()
+    with transaction.atomic():
+        _add_to_counts(previous_ids - clash_ids, -1)
+        _add_to_counts(clash_ids - previous_ids, 1)
+    leave_request.leave_clashes_count = len(clash_ids)
+    for state in (previous, current):
+        if state is not None:
+            transaction.on_commit(
+                lambda state=state: invalidate_leave_clashes(
+                    state["employee_id"], state["start_date"], state["end_date"]
+                )
+            )
+
+
+def remove_leave_clashes(leave_request):
+    """
+    This method is used to decrement the counts of the requests clashing with
+    a deleted leave request
+    """
+    transaction.on_commit(
+        lambda: invalidate_leave_clashes(
+            leave_request.employee_id_id,
+            leave_request.start_date,
+            leave_request.end_date,
+        )
+    )
+    _add_to_counts(
+        _clash_ids(
+            {
+                "id": leave_request.pk,
+                "employee_id": leave_request.employee_id_id,
+                "start_date": leave_request.start_date,
+                "end_date": leave_request.end_date,
+            }
+        ),
+        -1,
+    )
+
+
+def _month_range(year, month):
+    """
+    First day of the month and first day of the next month
+    """
+    return date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+
+
+def _grouped_requests(keys):
+    """
+    The (id, start date, end date) of the leave requests of each cache key,
+    the missing keys are read with one query and cached
+    """
+    from leave.models import LeaveRequest
+
+    groups = cache.get_many(list(keys))
+    missing = {key: group for key, group in keys.items() if key not in groups}
+    if not missing:
+        return groups
+    condition = Q()
+    for group, value, year, month in missing.values():
+        month_start, next_month = _month_range(year, month)
+        condition |= Q(
+            **{CLASH_GROUPS[group]: value},
+            start_date__lt=next_month,
+            end_date__gte=month_start,
+        )
+    rows = [
+        {
+            "id": leave_id,
+            "start_date": start_date,
+            "end_date": end_date or start_date,
+            "department": department_id,
+            "job_position": job_position_id,
+        }
+        for leave_id, start_date, end_date, department_id, job_position_id in (
+            LeaveRequest._base_manager.filter(condition)
+            .order_by()
+            .values_list(
+                "id",
+                "start_date",
+                "end_date",
+                CLASH_GROUPS["department"],
+                CLASH_GROUPS["job_position"],
+            )
+        )
+    ]
+    for key, (group, value, year, month) in missing.items():
+        month_start, next_month = _month_range(year, month)
+        groups[key] = [
+            (row["id"], row["start_date"], row["end_date"])
+            for row in rows
+            if row[group] == value
+            and row["start_date"] < next_month
+            and row["end_date"] >= month_start
+        ]
+    cache.set_many({key: groups[key] for key in missing}, CACHE_TIMEOUT)
+    return groups
+
+
+def leave_clashes_counts(leave_requests):
+    """
+    This method is used to count the clashes of leave requests, like the
+    leave requests of a page, from the cached requests of their departments
+    and job positions
+
+    Args:
+        leave_requests (list): LeaveRequest instances
+
+    Returns:
+        dict: {leave request id: clashes count}
+    """
+    from leave.models import LeaveRequest
+
+    ids = [leave_request.pk for leave_request in leave_requests]
+    if not ids:
+        return {}
+    version = _version()
+    requests = {}
+    keys = {}
+    for leave_id, start_date, end_date, department_id, job_position_id in (
+        LeaveRequest._base_manager.filter(pk__in=ids).values_list(
+            "id",
+            "start_date",
+            "end_date",
+            CLASH_GROUPS["department"],
+            CLASH_GROUPS["job_position"],
+        )
+    ):
+        end_date = end_date or start_date
+        request_keys = _group_keys(
+            version,
+            {"department": department_id, "job_position": job_position_id},
+            start_date,
+            end_date,
+        )
+        requests[leave_id] = (start_date, end_date, list(request_keys))
+        keys.update(request_keys)
+    groups = _grouped_requests(keys)
+    counts = {}
+    for leave_id, (start_date, end_date, request_keys) in requests.items():
+        counts[leave_id] = len(
+            {
+                other_id
+                for key in request_keys
+                for other_id, other_start, other_end in groups[key]
+                if other_id != leave_id
+                and other_start <= end_date
+                and other_end >= start_date
+            }
+        )
+    return counts
+
+
+def set_leave_clashes(leave_requests):
+    """
+    This method is used to count the clashes of the leave requests of a page
+    at once, the counts are kept on the instances for clashes_count
+    """
+    counts = leave_clashes_counts(leave_requests)
+    for leave_request in leave_requests:
+        leave_request._clashes_count = counts.get(leave_request.pk, 0)
+    return leave_requests
+
+
+def recount_leave_clashes(employee_id, previous):
+    """
+    This method is used to count again the stored clashes counts of the
+    leave requests of an employee who moved to another department or job
+    position, and of the requests overlapping them in the former and the
+    new department and job position
+
+    Args:
+        employee_id (int): id of the moved employee
+        previous (dict): department_id and job_position_id before the move
+    """
+    from leave.models import LeaveRequest
+
+    dates = Q()
+    for start_date, end_date in LeaveRequest._base_manager.filter(
+        employee_id=employee_id
+    ).values_list("start_date", "end_date"):
+        dates |= Q(start_date__lte=end_date or start_date, end_date__gte=start_date)
+    if not dates:
+        return
+    # the cached requests of the groups still have the employee in the
+    # former department and job position
+    invalidate_leave_clashes()
+    groups = Q(employee_id=employee_id)
+    for work_info in (previous, _work_info(employee_id)):
+        groups |= Q(**{CLASH_GROUPS["department"]: work_info["department_id"]})
+        groups |= Q(**{CLASH_GROUPS["job_position"]: work_info["job_position_id"]})
+    leave_requests = list(
+        LeaveRequest._base_manager.filter(groups, dates).only(
+            "id", "leave_clashes_count"
+        )
+    )
+    counts = leave_clashes_counts(leave_requests)
+    changed = []
+    for leave_request in leave_requests:
+        if leave_request.leave_clashes_count != counts[leave_request.pk]:
+            leave_request.leave_clashes_count = counts[leave_request.pk]
+            changed.append(leave_request)
+    LeaveRequest._base_manager.bulk_update(
+        changed, ["leave_clashes_count"], batch_size=1000
+    )
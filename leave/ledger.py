@@ -0,0 +1,243 @@
+"""
+ledger.py
+
+This module is used to keep the leave ledger, the append-only record of the
+changes of the available leaves. The available leave stays the materialised
+current balance of the employee and leave type, and each change of its
+available and carryforward days appends an entry of its kind, accrual,
+consumption, carryforward, expiry, penalty and so on, with its deltas and
+the balance after it.
+
+The balance of a day is the balance of the last entry up to the day, so the
+balances of the past are read with one index lookup instead of replaying
+the history.
+
+The callers tell the kind of a change with record_ledger_entry before they
+save the available leave, the rest of the change is recorded as an
+adjustment when it is saved. The bulk writers insert the entries of their
+available leaves with write_ledger_entries. The entries of a leave request
+not saved yet are inserted when the leave request is saved.
+"""
+
+from datetime import date, datetime
+from django.db.models import OuterRef, Subquery
+
+LEDGER_FIELDS = ("available_days", "carryforward_days")
+
+
+def _day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value or date.today()
+
+
+def recorded_state(available_leave):
+    """
+    The available and carryforward days of the available leave as last
+    recorded in the ledger, nothing for a new available leave
+    """
+    return getattr(
+        available_leave,
+        "_ledger_values",
+        {field: 0 for field in LEDGER_FIELDS},
+    )
+
+
+def record_ledger_entry(
+    available_leave,
+    entry_type,
+    leave_request=None,
+    entry_date=None,
+    fields=LEDGER_FIELDS,
+):
+    """
+    This method is used to record the change of the fields of an available
+    leave since its last entry as an entry of the type, it is inserted when
+    the available leave is saved
+
+    Args:
+        available_leave (AvailableLeave): the changed available leave
+        entry_type (str): kind of the change, one of LEDGER_ENTRY_TYPES
+        leave_request (LeaveRequest): the leave request of the change
+        entry_date (date): the day of the change, today when not given
+        fields (tuple): the fields of the change
+    """
+    from leave.models import LeaveLedgerEntry
+
+    previous = recorded_state(available_leave)
+    current = {
+        **previous,
+        **{field: getattr(available_leave, field) for field in fields},
+    }
+    if current == previous:
+        return
+    available_leave._ledger_values = current
+    available_leave.__dict__.setdefault("_ledger_entries", []).append(
+        LeaveLedgerEntry(
+            available_leave=available_leave,
+            employee_id_id=available_leave.employee_id_id,
+            leave_type_id_id=available_leave.leave_type_id_id,
+            entry_type=entry_type,
+            entry_date=_day(entry_date),
+            available_days=current["available_days"] - previous["available_days"],
+            carryforward_days=current["carryforward_days"]
+            - previous["carryforward_days"],
+            available_days_balance=current["available_days"],
+            carryforward_days_balance=current["carryforward_days"],
+            leave_request=leave_request,
+        )
+    )
+
+
+def write_ledger_entries(available_leaves, entry_type="adjustment", entry_date=None):
+    """
+    This method is used to insert the recorded entries of saved available
+    leaves with one query, their changes left unrecorded are recorded as
+    entries of the type first
+    """
+    from leave.models import LeaveLedgerEntry
+
+    entries = []
+    for available_leave in available_leaves:
+        record_ledger_entry(available_leave, entry_type, entry_date=entry_date)
+        entries.extend(available_leave.__dict__.pop("_ledger_entries", []))
+    written = []
+    for entry in entries:
+        entry.available_leave_id = entry.available_leave.pk
+        if entry.leave_request is not None and entry.leave_request.pk is None:
+            # the leave request is saved after its available leave, the
+            # entry is inserted with it by write_leave_request_entries
+            entry.leave_request.__dict__.setdefault("_ledger_entries", []).append(
+                entry
+            )
+        else:
+            written.append(entry)
+    rebase_later_entries(written)
+    LeaveLedgerEntry._base_manager.bulk_create(written, batch_size=500)
+    return entries
+
+
+def rebase_later_entries(entries):
+    """
+    This method is used to keep the balances in the order of the days when
+    entries are dated before entries already written, like the resets of the
+    days caught up by the daily jobs. The later entries get the deltas of the
+    new entries in their balances, and the new entries leave the deltas of
+    the later entries out of theirs.
+
+    Args:
+        entries (list): the LeaveLedgerEntry instances not inserted yet
+    """
+    from leave.models import LeaveLedgerEntry
+
+    today = date.today()
+    backdated = [entry for entry in entries if entry.entry_date < today]
+    if not backdated:
+        return
+    later = list(
+        LeaveLedgerEntry._base_manager.filter(
+            available_leave_id__in={entry.available_leave_id for entry in backdated},
+            entry_date__gt=min(entry.entry_date for entry in backdated),
+        )
+    )
+    changed = {}
+    for entry in backdated:
+        for other in later:
+            if (
+                other.available_leave_id != entry.available_leave_id
+                or other.entry_date <= entry.entry_date
+            ):
+                continue
+            other.available_days_balance += entry.available_days
+            other.carryforward_days_balance += entry.carryforward_days
+            entry.available_days_balance -= other.available_days
+            entry.carryforward_days_balance -= other.carryforward_days
+            changed[other.pk] = other
+    LeaveLedgerEntry._base_manager.bulk_update(
+        list(changed.values()),
+        ["available_days_balance", "carryforward_days_balance"],
+        batch_size=500,
+    )
+
+
+def write_leave_request_entries(leave_request):
+    """
+    This method is used to insert the entries recorded with a leave request
+    before the leave request was saved, linked to the saved request
+    """
+    from leave.models import LeaveLedgerEntry
+
+    entries = leave_request.__dict__.pop("_ledger_entries", [])
+    for entry in entries:
+        entry.leave_request = leave_request
+    LeaveLedgerEntry._base_manager.bulk_create(entries, batch_size=500)
+
+
+def _balance_entries(day):
+    from leave.models import LeaveLedgerEntry
+
+    return LeaveLedgerEntry._base_manager.filter(
+        available_leave_id=OuterRef("pk"), entry_date__lte=day
+    ).order_by("-entry_date", "-id")
+
+
+def leave_balances_on(day, **filters):
+    """
+    This method is used to get the balances of the available leaves on a
+    day, from the last ledger entry of each up to the day
+
+    Args:
+        day (date): the day of the balances
+        filters: the filters of the available leaves, like employee_id
+
+    Returns:
+        dict: {available leave id: {"available_days": ..., "carryforward_days":
+            ...}}, without the available leaves having no entry up to the day
+    """
+    from leave.models import AvailableLeave
+
+    entries = _balance_entries(day)
+    return {
+        available_leave_id: {
+            "available_days": available_days,
+            "carryforward_days": carryforward_days,
+        }
+        for available_leave_id, available_days, carryforward_days in (
+            AvailableLeave._base_manager.filter(**filters)
+            .annotate(
+                balance_available_days=Subquery(
+                    entries.values("available_days_balance")[:1]
+                ),
+                balance_carryforward_days=Subquery(
+                    entries.values("carryforward_days_balance")[:1]
+                ),
+            )
+            .filter(balance_available_days__isnull=False)
+            .values_list(
+                "id", "balance_available_days", "balance_carryforward_days"
+            )
+        )
+    }
+
+
+def leave_balance_on(available_leave, day):
+    """
+    This method is used to get the balance of an available leave on a day
+
+    Returns:
+        dict: the available and carryforward days, None when the available
+            leave has no entry up to the day
+    """
+    from leave.models import LeaveLedgerEntry
+
+    balance = (
+        LeaveLedgerEntry._base_manager.filter(
+            available_leave_id=available_leave.pk, entry_date__lte=day
+        )
+        .order_by("-entry_date", "-id")
+        .values_list("available_days_balance", "carryforward_days_balance")
+        .first()
+    )
+    if balance is None:
+        return None
+    return {"available_days": balance[0], "carryforward_days": balance[1]}
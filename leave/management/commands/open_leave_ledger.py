@@ -0,0 +1,44 @@
+from datetime import date
+from django.core.management.base import BaseCommand
+from leave.models import AvailableLeave, LeaveLedgerEntry
+
+
+class Command(BaseCommand):
+    help = (
+        "Opens the leave ledger of the available leaves having no entry yet "
+        "with their current days"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--date",
+            type=date.fromisoformat,
+            help="Day of the opening entries, YYYY-MM-DD, today by default",
+        )
+
+    def handle(self, *args, **options):
+        entry_date = options["date"] or date.today()
+        entries = [
+            LeaveLedgerEntry(
+                available_leave_id=available_leave.pk,
+                employee_id_id=available_leave.employee_id_id,
+                leave_type_id_id=available_leave.leave_type_id_id,
+                entry_type="opening",
+                entry_date=entry_date,
+                available_days=available_leave.available_days,
+                carryforward_days=available_leave.carryforward_days,
+                available_days_balance=available_leave.available_days,
+                carryforward_days_balance=available_leave.carryforward_days,
+            )
+            for available_leave in AvailableLeave._base_manager.filter(
+                ledger_entries__isnull=True
+            ).only(
+                "employee_id", "leave_type_id", "available_days", "carryforward_days"
+            )
+        ]
+        LeaveLedgerEntry._base_manager.bulk_create(entries, batch_size=500)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Leave ledger opened for {len(entries)} available leaves"
+            )
+        )
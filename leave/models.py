@@ -1,11 +1,11 @@
-import calendar
 from collections.abc import Iterable
 from datetime import date, datetime, timedelta
 import math
 import operator
 import sys
-from django.db.models import Q
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 from dateutil.relativedelta import relativedelta
@@ -13,11 +13,31 @@ from django.utils.translation import gettext_lazy as _
 from base import thread_local_middleware
 from base.models import Company, Department, JobPosition, MultipleApprovalCondition, clear_messages
 from base.horilla_company_manager import HorillaCompanyManager
-from employee.models import Employee
+from employee.models import Employee, EmployeeWorkInformation
 from horilla.models import HorillaModel
 from horilla_audit.models import HorillaAuditInfo, HorillaAuditLog
-from leave.threading import LeaveClashThread
 from .methods import calculate_requested_days
+from .clashes import (
+    clashing_leave_requests,
+    invalidate_leave_clashes,
+    recount_leave_clashes,
+    remove_leave_clashes,
+    set_leave_clashes,
+    update_leave_clashes,
+)
+from .calendar_cache import (
+    company_leave_dates_between,
+    get_employee_company_id,
+    holiday_dates_between,
+    invalidate_non_working_days,
+)
+from .ledger import (
+    LEDGER_FIELDS,
+    leave_balance_on,
+    record_ledger_entry,
+    write_ledger_entries,
+    write_leave_request_entries,
+)
 from django.core.files.storage import default_storage
 from django.conf import settings
 from horilla_audit.methods import get_diff
@@ -116,6 +136,18 @@ LEAVE_STATUS = (
     ("rejected", _("Rejected")),
 )
 
+LEDGER_ENTRY_TYPES = (
+    ("accrual", _("Accrual")),
+    ("consumption", _("Consumption")),
+    ("cancellation", _("Cancellation")),
+    ("carryforward", _("Carry Forward")),
+    ("expiry", _("Expiry")),
+    ("penalty", _("Penalty")),
+    ("encashment", _("Encashment")),
+    ("adjustment", _("Adjustment")),
+    ("opening", _("Opening Balance")),
+)
+
 LEAVE_ALLOCATION_STATUS = (
     ("requested", _("Requested")),
     ("approved", _("Approved")),
@@ -273,10 +305,13 @@ class AvailableLeave(HorillaModel):
         default=timezone.now, verbose_name=_("Assigned Date")
     )
     reset_date = models.DateField(
-        blank=True, null=True, verbose_name=_("Leave Reset Date")
+        blank=True, null=True, db_index=True, verbose_name=_("Leave Reset Date")
     )
     expired_date = models.DateField(
-        blank=True, null=True, verbose_name=_("CarryForward Expired Date")
+        blank=True,
+        null=True,
+        db_index=True,
+        verbose_name=_("CarryForward Expired Date"),
     )
     objects = HorillaCompanyManager(
         related_company_field="employee_id__employee_work_info__company_id"
@@ -294,6 +329,33 @@ class AvailableLeave(HorillaModel):
     def __str__(self):
         return f"{self.employee_id} | {self.leave_type_id}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        loaded_values = dict(zip(field_names, values))
+        if all(field in loaded_values for field in LEDGER_FIELDS):
+            # the days the next ledger entry is counted from
+            instance._ledger_values = {
+                field: loaded_values[field] for field in LEDGER_FIELDS
+            }
+        return instance
+
+    def record_ledger_entry(self, entry_type, leave_request=None, entry_date=None):
+        """
+        This method is used to record the change of the days as an entry of
+        the type, before the available leave is saved
+        """
+        record_ledger_entry(
+            self, entry_type, leave_request=leave_request, entry_date=entry_date
+        )
+
+    def balance_on(self, day):
+        """
+        This method is used to return the available and carryforward days of
+        the day from the leave ledger
+        """
+        return leave_balance_on(self, day)
+
     def forcasted_leaves(self):
         forecasted_leave = {}
         if self.leave_type_id.reset_based == "monthly":
@@ -397,7 +459,11 @@ class AvailableLeave(HorillaModel):
         available_leave.available_days = available_leave.leave_type_id.total_days
         return expired_date
 
-    def save(self, *args, **kwargs):
+    def set_leave_dates(self):
+        """
+        This method is used to set the reset and expiry dates of a new
+        assignment and the total leave days, as they are saved
+        """
         # if self.assigned_date == datetime.now().date() or self.assigned_date.date() == datetime.now().date():
         if self.reset_date is None:
             # Check whether the reset is enabled
@@ -415,6 +481,9 @@ class AvailableLeave(HorillaModel):
 
         self.total_leave_days = max(self.available_days + self.carryforward_days, 0)
         self.carryforward_days = max(self.carryforward_days, 0)
+
+    def save(self, *args, **kwargs):
+        self.set_leave_dates()
         super().save(*args, **kwargs)
 
 
@@ -499,6 +568,7 @@ class LeaveRequest(HorillaModel):
 
     class Meta:
         ordering = ["-id"]
+        indexes = [models.Index(fields=["start_date", "end_date"])]
 
     def tracking(self):
         return get_diff(self)
@@ -529,59 +599,18 @@ class LeaveRequest(HorillaModel):
 
     def holiday_dates(self):
         """
-        :return: this functions returns a list of all holiday dates.
+        :return: this functions returns a list of the holiday dates on the requested period.
         """
-        holiday_dates = []
-        holidays = Holiday.objects.all()
-        for holiday in holidays:
-            holiday_start_date = holiday.start_date
-            holiday_end_date = holiday.end_date
-            if holiday_end_date is None:
-                holiday_end_date = holiday_start_date
-            holiday_days = holiday_end_date - holiday_start_date
-            for i in range(holiday_days.days + 1):
-                date = holiday_start_date + timedelta(i)
-                holiday_dates.append(date)
-        return holiday_dates
+        return holiday_dates_between(
+            self.start_date, self.end_date, get_employee_company_id(self.employee_id)
+        )
 
     def company_leave_dates(self):
         """
-        :return: This function returns a list of all company leave dates"""
-        company_leaves = CompanyLeave.objects.all()
-        company_leave_dates = []
-        for company_leave in company_leaves:
-            year = self.start_date.year
-            based_on_week = company_leave.based_on_week
-            based_on_week_day = company_leave.based_on_week_day
-            for month in range(1, 13):
-                if based_on_week != None:
-                    # Set Sunday as the first day of the week
-                    calendar.setfirstweekday(6)
-                    month_calendar = calendar.monthcalendar(year, month)
-                    weeks = month_calendar[int(based_on_week)]
-                    weekdays_in_weeks = [day for day in weeks if day != 0]
-                    for day in weekdays_in_weeks:
-                        date = datetime.strptime(
-                            f"{year}-{month:02}-{day:02}", "%Y-%m-%d"
-                        ).date()
-                        if (
-                            date.weekday() == int(based_on_week_day)
-                            and date not in company_leave_dates
-                        ):
-                            company_leave_dates.append(date)
-                else:
-                    # Set Monday as the first day of the week
-                    calendar.setfirstweekday(0)
-                    month_calendar = calendar.monthcalendar(year, month)
-                    for week in month_calendar:
-                        if week[int(based_on_week_day)] != 0:
-                            date = datetime.strptime(
-                                f"{year}-{month:02}-{week[int(based_on_week_day)]:02}",
-                                "%Y-%m-%d",
-                            ).date()
-                            if date not in company_leave_dates:
-                                company_leave_dates.append(date)
-        return company_leave_dates
+        :return: This function returns a list of the company leave dates on the requested period"""
+        return company_leave_dates_between(
+            self.start_date, self.end_date, get_employee_company_id(self.employee_id)
+        )
 
     def save(self, *args, **kwargs):
         
@@ -599,9 +628,7 @@ class LeaveRequest(HorillaModel):
         else:
             self.exclude_leaves()
 
-        self.leave_clashes_count = self.count_leave_clashes()
-
-        self.update_leave_clashes_count()
+        update_leave_clashes(self)
         super().save(*args, **kwargs)
 
         department_id = self.employee_id.employee_work_info.department_id
@@ -723,6 +750,7 @@ class LeaveRequest(HorillaModel):
             )
             self.approved_available_days = self.requested_days
         self.status = "approved"
+        available_leave.record_ledger_entry("consumption", self)
         available_leave.save()
 
     def multiple_approvals(self, *args, **kwargs):
@@ -762,49 +790,32 @@ class LeaveRequest(HorillaModel):
             """
             Override the delete method to update the leave clashes count of related leave requests.
             """
-            leave_request = self
-
-            super().delete(*args, **kwargs)
-
-            clash_thread = LeaveClashThread(leave_request)
-            clash_thread.start()
+            with transaction.atomic():
+                remove_leave_clashes(self)
+                super().delete(*args, **kwargs)
 
         else:
             if request:
                 clear_messages(request)
                 messages.warning(request, _("The {} leave request cannot be deleted !").format(self.status))
 
-    def update_leave_clashes_count(self):
+    def clashes_count(self):
         """
-        Update the leave clashes count for all leave requests.
+        This method is used to return the leave clashes count, the list views
+        count the clashes of their whole page with set_leave_clashes
         """
-        leave_requests_to_update = LeaveRequest.objects.all().exclude(id=self.id)
-
-        for leave_request in leave_requests_to_update:
-            leave_request.leave_clashes_count = leave_request.count_leave_clashes()
-
-        # Bulk update leave clashes count for all leave requests
-        LeaveRequest.objects.bulk_update(
-            leave_requests_to_update, ["leave_clashes_count"]
-        )
+        if not hasattr(self, "_clashes_count"):
+            set_leave_clashes([self])
+        return self._clashes_count
 
     def count_leave_clashes(self):
         """
         Method to count leave clashes where this employee's leave request overlaps
         with other employees' requested dates.
         """
-        overlapping_requests = LeaveRequest.objects.exclude(id=self.id).filter(
-            Q(
-                employee_id__employee_work_info__department_id=self.employee_id.employee_work_info.department_id
-            )
-            | Q(
-                employee_id__employee_work_info__job_position_id=self.employee_id.employee_work_info.job_position_id
-            ),
-            start_date__lte=self.end_date,
-            end_date__gte=self.start_date,
-        )
-
-        return overlapping_requests.count()
+        return clashing_leave_requests(
+            self.employee_id_id, self.start_date, self.end_date, self.id
+        ).count()
 
 
 class LeaverequestFile(models.Model):
@@ -919,3 +930,140 @@ class RestrictLeave(HorillaModel):
  
     def __str__(self) -> str:
         return f"{self.title}"
+
+
+class LeaveJobRun(models.Model):
+    """
+    The last day a daily leave job ran for, the row is also locked while the
+    job runs so one server runs it
+    """
+
+    name = models.CharField(max_length=50, unique=True)
+    last_run_date = models.DateField(null=True, blank=True)
+    last_run_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self) -> str:
+        return f"{self.name} | {self.last_run_date}"
+
+
+class LeaveLedgerEntry(models.Model):
+    """
+    A change of the available and carryforward days of an available leave,
+    with the balance after it. The entries are only appended.
+    """
+
+    available_leave = models.ForeignKey(
+        AvailableLeave, on_delete=models.CASCADE, related_name="ledger_entries"
+    )
+    employee_id = models.ForeignKey(
+        Employee, on_delete=models.CASCADE, verbose_name=_("Employee")
+    )
+    leave_type_id = models.ForeignKey(
+        LeaveType, on_delete=models.CASCADE, verbose_name=_("Leave type")
+    )
+    leave_request = models.ForeignKey(
+        LeaveRequest, on_delete=models.SET_NULL, null=True, blank=True
+    )
+    entry_type = models.CharField(max_length=20, choices=LEDGER_ENTRY_TYPES)
+    entry_date = models.DateField()
+    available_days = models.FloatField(default=0)
+    carryforward_days = models.FloatField(default=0)
+    available_days_balance = models.FloatField(default=0)
+    carryforward_days_balance = models.FloatField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    objects = HorillaCompanyManager(
+        related_company_field="employee_id__employee_work_info__company_id"
+    )
+
+    class Meta:
+        ordering = ["entry_date", "id"]
+        indexes = [
+            models.Index(fields=["available_leave", "entry_date", "id"]),
+            models.Index(fields=["employee_id", "entry_date"]),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.available_leave_id} | {self.entry_type} | {self.entry_date}"
+
+
+@receiver(post_save, sender=Holiday)
+@receiver(post_delete, sender=Holiday)
+@receiver(post_save, sender=CompanyLeave)
+@receiver(post_delete, sender=CompanyLeave)
+def invalidate_non_working_days_cache(sender, **kwargs):
+    """
+    Drop the cached non working days when a holiday or company leave changes
+    """
+    invalidate_non_working_days()
+
+
+@receiver(pre_save, sender=AvailableLeave)
+def available_leave_ledger_state(sender, instance, **kwargs):
+    """
+    Read the stored days of an available leave saved without being loaded,
+    its change is recorded from them
+    """
+    if instance.pk is not None and not hasattr(instance, "_ledger_values"):
+        stored = (
+            AvailableLeave._base_manager.filter(pk=instance.pk)
+            .values(*LEDGER_FIELDS)
+            .first()
+        )
+        if stored is not None:
+            instance._ledger_values = stored
+
+
+@receiver(post_save, sender=AvailableLeave)
+def write_available_leave_ledger(sender, instance, created, **kwargs):
+    """
+    Append the ledger entries of a saved available leave, a new one is
+    credited with its days on its assigned date
+    """
+    if created:
+        record_ledger_entry(instance, "accrual", entry_date=instance.assigned_date)
+    write_ledger_entries([instance])
+
+
+@receiver(post_save, sender=LeaveRequest)
+def write_leave_request_ledger(sender, instance, **kwargs):
+    """
+    Insert the ledger entries recorded with the leave request before it was
+    saved, linked to the saved request
+    """
+    write_leave_request_entries(instance)
+
+
+@receiver(pre_save, sender=EmployeeWorkInformation)
+def leave_clash_groups_state(sender, instance, **kwargs):
+    """
+    Read the stored department and job position of the work information,
+    the clashes are counted again when they change
+    """
+    instance._clash_groups = (
+        EmployeeWorkInformation._base_manager.filter(pk=instance.pk)
+        .values("department_id", "job_position_id")
+        .first()
+        if instance.pk is not None
+        else None
+    ) or {"department_id": None, "job_position_id": None}
+
+
+@receiver(post_save, sender=EmployeeWorkInformation)
+def invalidate_leave_clashes_cache(sender, instance, **kwargs):
+    """
+    Drop the cached leave clashes when an employee may change of department
+    or job position, the stored clashes counts are counted again once the
+    move is committed
+    """
+    invalidate_leave_clashes()
+    previous = getattr(instance, "_clash_groups", None)
+    if instance.employee_id_id is None or previous is None:
+        return
+    if previous == {
+        "department_id": instance.department_id_id,
+        "job_position_id": instance.job_position_id_id,
+    }:
+        return
+    transaction.on_commit(
+        lambda: recount_leave_clashes(instance.employee_id_id, previous)
+    )
@@ -1,64 +1,141 @@
-import datetime as dt
+"""
+scheduler.py
+
+This module is used to register the daily leave jobs, the reset and the
+carryforward expiry of the available leaves, written to the leave ledger,
+and the move of the recurring holidays to the next year. The jobs of a day
+select only the records due that day and write them in bulk. They run once
+per day for all the servers, under a lock on their LeaveJobRun row, and the
+days missed while no server was running are caught up on the next run.
+"""
+
+from datetime import date, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime, timedelta
+from horilla.horilla_scheduler import start_scheduler
 from dateutil.relativedelta import relativedelta
-import calendar
-
-today = datetime.now()
-
-
-def leave_reset():
-    from leave.models import LeaveType
-
-    today_date = today.date()
-    leave_types = LeaveType.objects.filter(reset=True)
-    # Looping through filtered leave types with reset is true
-    for leave_type in leave_types:
-        # #Looping through all available leaves
-        available_leaves = leave_type.employee_available_leave.all()
-
-        for available_leave in available_leaves:
-            reset_date = available_leave.reset_date
-            expired_date = available_leave.expired_date
-            if reset_date == today_date:
-                available_leave.update_carryforward()
-                # new_reset_date = available_leave.set_reset_date(assigned_date=today_date,available_leave = available_leave)
-                new_reset_date = available_leave.set_reset_date(
-                    assigned_date=today_date, available_leave=available_leave
-                )
-                available_leave.reset_date = new_reset_date
-                available_leave.save()
-            if expired_date == today_date:
-                new_expired_date = available_leave.set_expired_date(
-                    available_leave=available_leave, assigned_date=today_date
-                )
-                available_leave.expired_date = new_expired_date
-                available_leave.save()
-
-
-def recurring_holiday():
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from simple_history.utils import bulk_update_with_history
+from leave.ledger import record_ledger_entry, write_ledger_entries
+
+DAILY_LEAVE_JOB = "daily_leave_jobs"
+
+
+def leave_reset(day):
+    """
+    This method is used to reset the available leaves whose reset or
+    carryforward expiry date is the day
+    """
+    from leave.models import AvailableLeave
+
+    available_leaves = list(
+        AvailableLeave._base_manager.filter(
+            Q(reset_date=day) | Q(expired_date=day), leave_type_id__reset=True
+        ).select_related("leave_type_id")
+    )
+    for available_leave in available_leaves:
+        if available_leave.reset_date == day:
+            available_leave.update_carryforward()
+            record_ledger_entry(
+                available_leave,
+                "carryforward",
+                entry_date=day,
+                fields=("carryforward_days",),
+            )
+            record_ledger_entry(available_leave, "accrual", entry_date=day)
+            available_leave.reset_date = available_leave.set_reset_date(
+                assigned_date=day, available_leave=available_leave
+            )
+        if available_leave.expired_date == day:
+            available_leave.expired_date = available_leave.set_expired_date(
+                available_leave=available_leave, assigned_date=day
+            )
+            record_ledger_entry(available_leave, "expiry", entry_date=day)
+        available_leave.total_leave_days = max(
+            available_leave.available_days + available_leave.carryforward_days, 0
+        )
+        available_leave.carryforward_days = max(available_leave.carryforward_days, 0)
+    with transaction.atomic():
+        bulk_update_with_history(
+            available_leaves,
+            AvailableLeave,
+            [
+                "available_days",
+                "carryforward_days",
+                "total_leave_days",
+                "reset_date",
+                "expired_date",
+            ],
+            batch_size=500,
+            manager=AvailableLeave._base_manager,
+        )
+        write_ledger_entries(available_leaves, entry_date=day)
+    return len(available_leaves)
+
+
+def recurring_holiday(day):
+    """
+    This method is used to move the recurring holidays that ended the day
+    before to the next year
+    """
+    from leave.calendar_cache import invalidate_non_working_days
     from leave.models import Holiday
 
-    recurring_holidays = Holiday.objects.filter(recurring=True)
-    # Looping through all recurring holiday
-    for recurring_holiday in recurring_holidays:
-        start_date = recurring_holiday.start_date
-        end_date = recurring_holiday.end_date
-        new_start_date = dt.date(start_date.year + 1, start_date.month, start_date.day)
-        new_end_date = dt.date(end_date.year + 1, end_date.month, end_date.day)
-        # Checking that end date is not none
-        if end_date is None:
-            # checking if that start date is day before today
-            if start_date == (today - timedelta(days=1)).date():
-                recurring_holiday.start_date = new_start_date
-        elif end_date == (today - timedelta(days=1)).date():
-            recurring_holiday.start_date = new_start_date
-            recurring_holiday.end_date = new_end_date
-        recurring_holiday.save()
+    yesterday = day - timedelta(days=1)
+    holidays = list(
+        Holiday._base_manager.filter(
+            Q(end_date=yesterday) | Q(end_date__isnull=True, start_date=yesterday),
+            recurring=True,
+        )
+    )
+    for holiday in holidays:
+        holiday.start_date += relativedelta(years=1)
+        if holiday.end_date is not None:
+            holiday.end_date += relativedelta(years=1)
+    if holidays:
+        Holiday._base_manager.bulk_update(holidays, ["start_date", "end_date"])
+        invalidate_non_working_days()
+    return len(holidays)
+
+
+def run_daily_leave_jobs(today=None):
+    """
+    This method is used to run the daily leave jobs of the days since their
+    last run, up to today
+
+    Returns:
+        list: the days the jobs ran for
+    """
+    from leave.models import LeaveJobRun
+
+    today = today or date.today()
+    with transaction.atomic():
+        LeaveJobRun._base_manager.get_or_create(name=DAILY_LEAVE_JOB)
+        # the other servers wait here and find the day done
+        job_run = LeaveJobRun._base_manager.select_for_update().get(
+            name=DAILY_LEAVE_JOB
+        )
+        day = (
+            job_run.last_run_date + timedelta(days=1)
+            if job_run.last_run_date
+            else today
+        )
+        days = []
+        while day <= today:
+            leave_reset(day)
+            recurring_holiday(day)
+            days.append(day)
+            day += timedelta(days=1)
+        if days:
+            job_run.last_run_date = today
+            job_run.last_run_at = timezone.now()
+            job_run.save()
+    return days
 
 
 scheduler = BackgroundScheduler()
-scheduler.add_job(leave_reset, "interval", seconds=10)
-scheduler.add_job(recurring_holiday, "interval", seconds=10)
+# every hour, the runs after the first of the day find the day done
+scheduler.add_job(run_daily_leave_jobs, "cron", minute=5)
 
-scheduler.start()
+start_scheduler(scheduler)
@@ -1,3 +1,499 @@
+from datetime import date, timedelta
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from base.models import Department, JobPosition
+from employee.models import Employee, EmployeeWorkInformation
+from leave.assignments import assign_leave_types
+from leave.clashes import leave_clashes_counts
+from leave.ledger import leave_balances_on
+from leave.models import (
+    AvailableLeave,
+    Holiday,
+    LeaveJobRun,
+    LeaveLedgerEntry,
+    LeaveRequest,
+    LeaveType,
+)
+from leave.scheduler import DAILY_LEAVE_JOB, run_daily_leave_jobs
 
-# Create your tests here.
+
+class LeaveClashTest(TestCase):
+    """
+    The leave clashes counts should follow the leave requests without
+    counting the clashes of every leave request on each save
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.leave_type = LeaveType.objects.create(
+            name="Casual", payment="paid", total_days=10
+        )
+        operations = Department(department="Operations")
+        operations.save()
+        sales = Department(department="Sales")
+        sales.save()
+        positions = {}
+        for department in [operations, sales]:
+            positions[department] = JobPosition(
+                job_position=f"{department} staff", department_id=department
+            )
+            positions[department].save()
+        cls.employees = []
+        for index, department in enumerate([operations, operations, operations, sales]):
+            employee = Employee.objects.create(
+                badge_id=f"L{index}",
+                employee_first_name="Leave",
+                employee_last_name=f"Test {index}",
+                email=f"leave.test{index}@example.com",
+                phone="1234567890",
+            )
+            EmployeeWorkInformation.objects.create(
+                employee_id=employee,
+                department_id=department,
+                job_position_id=positions[department],
+            )
+            cls.employees.append(employee)
+
+    def leave_request(self, employee, start_date, days=3):
+        leave_request = LeaveRequest(
+            employee_id=employee,
+            leave_type_id=self.leave_type,
+            start_date=start_date,
+            end_date=start_date + timedelta(days=days - 1),
+            description="Leave",
+        )
+        leave_request.save()
+        return leave_request
+
+    def assert_counts(self):
+        """
+        The stored counts are the counted clashes
+        """
+        for leave_request in LeaveRequest.objects.all():
+            self.assertEqual(
+                leave_request.leave_clashes_count,
+                leave_request.count_leave_clashes(),
+                leave_request,
+            )
+
+    def test_clash_counts_follow_requests(self):
+        first = self.leave_request(self.employees[0], date(2024, 5, 6))
+        self.leave_request(self.employees[1], date(2024, 5, 7))
+        self.leave_request(self.employees[2], date(2024, 5, 20))
+        self.leave_request(self.employees[3], date(2024, 5, 6))
+        self.assert_counts()
+        self.assertEqual(
+            LeaveRequest.objects.get(pk=first.pk).leave_clashes_count, 1
+        )
+
+        # moving a request moves it from a clash to another
+        first.start_date = date(2024, 5, 19)
+        first.end_date = date(2024, 5, 21)
+        first.save()
+        self.assert_counts()
+
+        first.delete()
+        self.assert_counts()
+        self.assertFalse(
+            LeaveRequest.objects.filter(leave_clashes_count__gt=0).exists()
+        )
+
+    def test_clash_counts_follow_department_move(self):
+        moved = self.leave_request(self.employees[3], date(2024, 5, 6))
+        self.leave_request(self.employees[0], date(2024, 5, 7))
+        self.leave_request(self.employees[1], date(2024, 5, 8))
+        self.assertEqual(LeaveRequest.objects.get(pk=moved.pk).leave_clashes_count, 0)
+
+        work_info = EmployeeWorkInformation.objects.get(employee_id=self.employees[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            moved_info = EmployeeWorkInformation.objects.get(
+                employee_id=self.employees[3]
+            )
+            moved_info.department_id = work_info.department_id
+            moved_info.job_position_id = work_info.job_position_id
+            moved_info.save()
+        self.assert_counts()
+        self.assertEqual(LeaveRequest.objects.get(pk=moved.pk).leave_clashes_count, 2)
+
+    def test_save_queries_do_not_grow_with_requests(self):
+        def save_queries():
+            leave_request = LeaveRequest(
+                employee_id=self.employees[0],
+                leave_type_id=self.leave_type,
+                start_date=date(2024, 6, 3),
+                end_date=date(2024, 6, 4),
+                description="Leave",
+            )
+            with CaptureQueriesContext(connection) as queries:
+                leave_request.save()
+            leave_request.delete()
+            return len(queries)
+
+        few = save_queries()
+        for day in range(20):
+            self.leave_request(
+                self.employees[day % 4], date(2024, 1, 1) + timedelta(days=day)
+            )
+        self.assertEqual(save_queries(), few)
+
+    def test_page_clashes_from_cache(self):
+        cache.clear()
+        requests = [
+            self.leave_request(self.employees[index], date(2024, 5, 6 + index))
+            for index in range(4)
+        ]
+        # a request across two months
+        requests.append(self.leave_request(self.employees[0], date(2024, 5, 30)))
+        # the requests of the page, then the requests of their groups
+        with self.assertNumQueries(2):
+            counts = leave_clashes_counts(requests)
+        self.assertEqual(
+            counts,
+            {
+                leave_request.pk: leave_request.count_leave_clashes()
+                for leave_request in requests
+            },
+        )
+        self.assertEqual(counts[requests[3].pk], 0)
+        # the requests of the departments are cached
+        with self.assertNumQueries(1):
+            leave_clashes_counts(requests)
+
+        # a new request drops the cached requests of its department and month
+        with self.captureOnCommitCallbacks(execute=True):
+            self.leave_request(self.employees[1], date(2024, 6, 1))
+        counts = leave_clashes_counts(requests)
+        self.assertEqual(counts[requests[4].pk], 1)
+        self.assertEqual(requests[4].clashes_count(), 1)
+
+
+class DailyLeaveJobTest(TestCase):
+    """
+    The daily leave jobs should touch only the records due on the day, once
+    per day, and catch up the days they missed
+    """
+
+    def test_daily_jobs_catch_up(self):
+        leave_type = LeaveType(
+            name="Annual",
+            payment="paid",
+            total_days=2,
+            reset=True,
+            reset_based="monthly",
+            reset_day="1",
+            carryforward_type="carryforward",
+            carryforward_max=5,
+        )
+        leave_type.save()
+        employee = Employee.objects.create(
+            badge_id="R1",
+            employee_first_name="Reset",
+            employee_last_name="Test",
+            email="reset.test@example.com",
+            phone="1234567890",
+        )
+        available_leave = AvailableLeave(
+            employee_id=employee,
+            leave_type_id=leave_type,
+            available_days=1,
+            assigned_date=date(2024, 1, 15),
+        )
+        available_leave.save()
+        self.assertEqual(available_leave.reset_date, date(2024, 2, 1))
+        holiday = Holiday.objects.create(
+            name="New year",
+            start_date=date(2024, 1, 31),
+            end_date=date(2024, 1, 31),
+            recurring=True,
+        )
+        LeaveJobRun.objects.create(
+            name=DAILY_LEAVE_JOB, last_run_date=date(2024, 1, 29)
+        )
+
+        self.assertEqual(
+            run_daily_leave_jobs(date(2024, 2, 2)),
+            [
+                date(2024, 1, 30),
+                date(2024, 1, 31),
+                date(2024, 2, 1),
+                date(2024, 2, 2),
+            ],
+        )
+        available_leave.refresh_from_db()
+        self.assertEqual(available_leave.reset_date, date(2024, 3, 1))
+        self.assertEqual(available_leave.available_days, 2)
+        self.assertEqual(available_leave.carryforward_days, 1)
+        self.assertEqual(available_leave.total_leave_days, 3)
+        holiday.refresh_from_db()
+        self.assertEqual(holiday.start_date, date(2025, 1, 31))
+
+        # the day is done for every server
+        with self.assertNumQueries(4):
+            self.assertEqual(run_daily_leave_jobs(date(2024, 2, 2)), [])
+
+
+class LeaveAssignmentTest(TestCase):
+    """
+    The bulk assignment should give the dates of a save of each assignment,
+    skip the assigned leave types and not query per employee
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.leave_types = []
+        for name, reset_based in [("Annual", "yearly"), ("Sick", "monthly")]:
+            leave_type = LeaveType(
+                name=name,
+                payment="paid",
+                total_days=4,
+                reset=True,
+                reset_based=reset_based,
+                reset_month="1",
+                reset_day="1",
+                carryforward_type="carryforward expire",
+                carryforward_max=5,
+                carryforward_expire_in=2,
+                carryforward_expire_period="month",
+            )
+            leave_type.save()
+            cls.leave_types.append(leave_type)
+        cls.employees = [
+            Employee.objects.create(
+                badge_id=f"A{index}",
+                employee_first_name="Assign",
+                employee_last_name=f"Test {index}",
+                email=f"assign.test{index}@example.com",
+                phone="1234567890",
+            )
+            for index in range(6)
+        ]
+
+    def assign(self, employees):
+        return assign_leave_types(
+            [
+                (leave_type, employee.pk)
+                for leave_type in self.leave_types
+                for employee in employees
+            ],
+            assigned_date=date(2024, 3, 15),
+        )
+
+    def test_bulk_assignment(self):
+        saved = AvailableLeave(
+            employee_id=self.employees[0],
+            leave_type_id=self.leave_types[0],
+            available_days=self.leave_types[0].total_days,
+            assigned_date=date(2024, 3, 15),
+        )
+        saved.save()
+
+        available_leaves, skipped = self.assign(self.employees[:3])
+        self.assertEqual(len(available_leaves), 5)
+        self.assertEqual(skipped, {(self.leave_types[0].pk, self.employees[0].pk)})
+        created = AvailableLeave.objects.get(
+            employee_id=self.employees[1], leave_type_id=self.leave_types[0]
+        )
+        for field in [
+            "available_days",
+            "carryforward_days",
+            "total_leave_days",
+            "reset_date",
+            "expired_date",
+        ]:
+            self.assertEqual(getattr(created, field), getattr(saved, field), field)
+        self.assertEqual(
+            AvailableLeave.objects.get(
+                employee_id=self.employees[1], leave_type_id=self.leave_types[1]
+            ).reset_date,
+            date(2024, 4, 1),
+        )
+
+        def assign_queries(employees):
+            with CaptureQueriesContext(connection) as queries:
+                self.assign(employees)
+            return len(queries)
+
+        AvailableLeave.objects.all().delete()
+        few = assign_queries(self.employees[:1])
+        AvailableLeave.objects.all().delete()
+        self.assertEqual(assign_queries(self.employees), few)
+
+
+class LeaveLedgerTest(TestCase):
+    """
+    The changes of the available leaves should be appended to the leave
+    ledger, and the balances of the past read from it
+    """
+
+    def test_ledger_follows_available_leave(self):
+        leave_type = LeaveType(
+            name="Annual",
+            payment="paid",
+            total_days=2,
+            reset=True,
+            reset_based="monthly",
+            reset_day="1",
+            carryforward_type="carryforward",
+            carryforward_max=5,
+        )
+        leave_type.save()
+        employee = Employee.objects.create(
+            badge_id="B1",
+            employee_first_name="Ledger",
+            employee_last_name="Test",
+            email="ledger.test@example.com",
+            phone="1234567890",
+        )
+        EmployeeWorkInformation.objects.create(employee_id=employee)
+        LeaveJobRun.objects.create(
+            name=DAILY_LEAVE_JOB, last_run_date=date(2024, 1, 30)
+        )
+        (available_leave,), _skipped = assign_leave_types(
+            [(leave_type, employee.pk)], assigned_date=date(2024, 1, 15)
+        )
+        leave_request = LeaveRequest(
+            employee_id=employee,
+            leave_type_id=leave_type,
+            start_date=date(2024, 1, 22),
+            end_date=date(2024, 1, 22),
+            description="Leave",
+        )
+        leave_request.save()
+        # approved as by leave_request_approve, without AvailableLeave.save
+        available_leave = AvailableLeave.objects.get(pk=available_leave.pk)
+        available_leave.available_days -= 1
+        available_leave.record_ledger_entry(
+            "consumption", leave_request, entry_date=date(2024, 1, 22)
+        )
+        super(AvailableLeave, available_leave).save()
+        run_daily_leave_jobs(date(2024, 2, 1))
+        available_leave = AvailableLeave.objects.get(pk=available_leave.pk)
+        reset_balance = {
+            "available_days": available_leave.available_days,
+            "carryforward_days": available_leave.carryforward_days,
+        }
+        available_leave.available_days += 1
+        available_leave.save()
+
+        entries = list(
+            LeaveLedgerEntry.objects.filter(available_leave=available_leave)
+        )
+        self.assertEqual(
+            [entry.entry_type for entry in entries],
+            ["accrual", "consumption", "carryforward", "accrual", "adjustment"],
+        )
+        self.assertEqual(entries[1].leave_request, leave_request)
+        self.assertEqual(
+            sum(entry.available_days for entry in entries),
+            available_leave.available_days,
+        )
+        self.assertEqual(
+            sum(entry.carryforward_days for entry in entries),
+            available_leave.carryforward_days,
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                available_leave.balance_on(date(2024, 1, 25)),
+                {"available_days": 1, "carryforward_days": 0},
+            )
+        self.assertIsNone(available_leave.balance_on(date(2024, 1, 1)))
+        self.assertEqual(
+            leave_balances_on(date(2024, 2, 1), employee_id=employee),
+            {available_leave.pk: reset_balance},
+        )
+
+    def test_caught_up_entries_before_later_entries(self):
+        leave_type = LeaveType(
+            name="Annual",
+            payment="paid",
+            total_days=2,
+            reset=True,
+            reset_based="monthly",
+            reset_day="1",
+            carryforward_type="carryforward",
+            carryforward_max=5,
+        )
+        leave_type.save()
+        employee = Employee.objects.create(
+            badge_id="B2",
+            employee_first_name="Ledger",
+            employee_last_name="Catch up",
+            email="ledger.catchup@example.com",
+            phone="1234567890",
+        )
+        EmployeeWorkInformation.objects.create(employee_id=employee)
+        LeaveJobRun.objects.create(
+            name=DAILY_LEAVE_JOB, last_run_date=date(2024, 1, 30)
+        )
+        (available_leave,), _skipped = assign_leave_types(
+            [(leave_type, employee.pk)], assigned_date=date(2024, 1, 15)
+        )
+        # written on the day before the daily jobs caught up the reset
+        available_leave = AvailableLeave.objects.get(pk=available_leave.pk)
+        available_leave.available_days -= 1
+        available_leave.record_ledger_entry(
+            "consumption", entry_date=date(2024, 2, 2)
+        )
+        super(AvailableLeave, available_leave).save()
+        run_daily_leave_jobs(date(2024, 2, 2))
+        available_leave = AvailableLeave.objects.get(pk=available_leave.pk)
+
+        self.assertEqual(
+            available_leave.balance_on(date(2024, 2, 2)),
+            {
+                "available_days": available_leave.available_days,
+                "carryforward_days": available_leave.carryforward_days,
+            },
+        )
+        balance = {"available_days": 0, "carryforward_days": 0}
+        for entry in LeaveLedgerEntry.objects.filter(
+            available_leave=available_leave
+        ).order_by("entry_date", "id"):
+            balance["available_days"] += entry.available_days
+            balance["carryforward_days"] += entry.carryforward_days
+            self.assertEqual(
+                balance,
+                {
+                    "available_days": entry.available_days_balance,
+                    "carryforward_days": entry.carryforward_days_balance,
+                },
+                entry.entry_type,
+            )
+
+    def test_entry_of_request_saved_after_available_leave(self):
+        leave_type = LeaveType(name="Casual", payment="paid", total_days=3)
+        leave_type.save()
+        employee = Employee.objects.create(
+            badge_id="B3",
+            employee_first_name="Ledger",
+            employee_last_name="Request",
+            email="ledger.request@example.com",
+            phone="1234567890",
+        )
+        EmployeeWorkInformation.objects.create(employee_id=employee)
+        (available_leave,), _skipped = assign_leave_types(
+            [(leave_type, employee.pk)], assigned_date=date(2024, 1, 15)
+        )
+        # approved as by leave_request_create, the request is saved last
+        leave_request = LeaveRequest(
+            employee_id=employee,
+            leave_type_id=leave_type,
+            start_date=date(2024, 1, 22),
+            end_date=date(2024, 1, 22),
+            description="Leave",
+            status="approved",
+        )
+        available_leave = AvailableLeave.objects.get(pk=available_leave.pk)
+        available_leave.available_days -= 1
+        available_leave.record_ledger_entry("consumption", leave_request)
+        available_leave.save()
+        self.assertFalse(
+            LeaveLedgerEntry.objects.filter(entry_type="consumption").exists()
+        )
+        leave_request.save()
+        self.assertEqual(
+            LeaveLedgerEntry.objects.get(entry_type="consumption").leave_request,
+            leave_request,
+        )
@@ -11,6 +11,7 @@ from urllib.parse import parse_qs
 from django.db.models import Q
 from django.shortcuts import get_object_or_404, render, redirect
 from django.db.models import ProtectedError
+from django.db.models.functions import Lower
 from django.utils.translation import gettext as __
 from django.core.paginator import Paginator
 from django.contrib import messages
@@ -46,9 +47,14 @@ from attendance.methods.group_by import group_by_queryset
 from .methods import (
     calculate_requested_days,
     leave_requested_dates,
-    holiday_dates_list,
-    company_leave_dates_list,
 )
+from .calendar_cache import (
+    company_leave_dates_between,
+    get_employee_company_id,
+    holiday_dates_between,
+)
+from .clashes import clashing_leave_requests, set_leave_clashes
+from .assignments import assign_leave_types, notify_assigned
 
 
 def generate_error_report(error_list, error_data, file_name):
@@ -321,6 +327,7 @@ def leave_request_creation(request, type_id=None, emp_id=None):
                     )
                     leave_request.approved_available_days = leave_request.requested_days
                 leave_request.status = "approved"
+                available_leave.record_ledger_entry("consumption", leave_request)
                 available_leave.save()
             leave_request.created_by = request.user.employee_get
             leave_request.save()
@@ -374,6 +381,7 @@ def leave_request_view(request):
     export_filter = LeaveRequestFilter()
     requests = queryset.filter(status="requested").count()
     requests_ids = json.dumps(list(page_obj.object_list.values_list("id", flat=True)))
+    page_obj.object_list = set_leave_clashes(list(page_obj.object_list))
     approved_requests = queryset.filter(status="approved").count()
     rejected_requests = queryset.filter(status="cancelled").count()
     previous_data = request.GET.urlencode()
@@ -451,6 +459,9 @@ def leave_request_filter(request):
         leave_request_filter = paginator_qry(
             leave_request_filter, request.GET.get("page")
         )
+        leave_request_filter.object_list = set_leave_clashes(
+            list(leave_request_filter.object_list)
+        )
         requests_ids = json.dumps(
             [instance.id for instance in leave_request_filter.object_list]
         )
@@ -601,6 +612,7 @@ def leave_request_approve(request, id, emp_id=None):
                 available_leave.available_days = temp - leave_request.requested_days
                 leave_request.approved_available_days = leave_request.requested_days
             leave_request.status = "approved"
+            available_leave.record_ledger_entry("consumption", leave_request)
             if not leave_request.multiple_approvals():
                 super(AvailableLeave, available_leave).save()
                 leave_request.save()
@@ -728,6 +740,7 @@ def leave_request_cancel(request, id, emp_id=None):
             available_leave.carryforward_days += (
                 leave_request.approved_carryforward_days
             )
+            available_leave.record_ledger_entry("cancellation", leave_request)
             leave_request.approved_available_days = 0
             leave_request.approved_carryforward_days = 0
             leave_request.status = "rejected"
@@ -875,33 +888,17 @@ def leave_assign_one(request, id):
     if request.method == "POST":
         leave_type = LeaveType.objects.get(id=id)
         employee_ids = request.POST.getlist("employee_id")
-        for employee_id in employee_ids:
-            employee = Employee.objects.get(id=employee_id)
-            if not AvailableLeave.objects.filter(
-                leave_type_id=leave_type, employee_id=employee
-            ).exists():
-                AvailableLeave(
-                    leave_type_id=leave_type,
-                    employee_id=employee,
-                    available_days=leave_type.total_days,
-                ).save()
-                messages.success(request, _("Leave type assign is successfull.."))
-                with contextlib.suppress(Exception):
-                    notify.send(
-                        request.user.employee_get,
-                        recipient=employee.employee_user_id,
-                        verb="New leave type is assigned to you",
-                        verb_ar="تم تعيين نوع إجازة جديد لك",
-                        verb_de="Ihnen wurde ein neuer Urlaubstyp zugewiesen",
-                        verb_es="Se le ha asignado un nuevo tipo de permiso",
-                        verb_fr="Un nouveau type de congé vous a été attribué",
-                        icon="people-circle",
-                        redirect="/leave/user-request-view",
-                    )
-            else:
-                messages.info(
-                    request, _("leave type is already assigned to the employee..")
-                )
+        available_leaves, skipped = assign_leave_types(
+            [(leave_type, employee_id) for employee_id in employee_ids]
+        )
+        if available_leaves:
+            messages.success(request, _("Leave type assign is successfull.."))
+            with contextlib.suppress(Exception):
+                notify_assigned(request.user.employee_get, available_leaves)
+        if skipped:
+            messages.info(
+                request, _("leave type is already assigned to the employee..")
+            )
         response = render(
             request,
             "leave/leave_assign/leave_assign_one_form.html",
@@ -1066,35 +1063,26 @@ def leave_assign(request):
     if request.method == "POST":
         leave_type_ids = request.POST.getlist("leave_type_id")
         employee_ids = request.POST.getlist("employee_id")
-        for employee_id in employee_ids:
-            if employee_id != "":
-                for leave_type_id in leave_type_ids:
-                    if leave_type_id != "":
-                        employee = Employee.objects.get(id=employee_id)
-                        leave_type = LeaveType.objects.get(id=leave_type_id)
-                        if not AvailableLeave.objects.filter(
-                            leave_type_id=leave_type, employee_id=employee
-                        ).exists():
-                            AvailableLeave(
-                                leave_type_id=leave_type,
-                                employee_id=employee,
-                                available_days=leave_type.total_days,
-                            ).save()
-                            messages.success(
-                                request, _("Leave type assign is successful..")
-                            )
-                            with contextlib.suppress(Exception):
-                                notify.send(
-                                    request.user.employee_get,
-                                    recipient=employee.employee_user_id,
-                                    verb="New leave type is assigned to you",
-                                    # ... (remaining notify.send parameters)
-                                )
-                        else:
-                            messages.info(
-                                request,
-                                _("Leave type is already assigned to the employee.."),
-                            )
+        leave_types = LeaveType.objects.filter(
+            id__in=[leave_type_id for leave_type_id in leave_type_ids if leave_type_id]
+        )
+        available_leaves, skipped = assign_leave_types(
+            [
+                (leave_type, employee_id)
+                for employee_id in employee_ids
+                if employee_id != ""
+                for leave_type in leave_types
+            ]
+        )
+        if available_leaves:
+            messages.success(request, _("Leave type assign is successful.."))
+            with contextlib.suppress(Exception):
+                notify_assigned(request.user.employee_get, available_leaves)
+        if skipped:
+            messages.info(
+                request,
+                _("Leave type is already assigned to the employee.."),
+            )
         return HttpResponse("<script>window.location.reload()</script>")
     return render(
         request, "leave/leave_assign/leave_assign_form.html", {"assign_form": form}
@@ -1246,15 +1234,38 @@ def assign_leave_type_import(request):
         file = request.FILES["assign_leave_type_import"]
         data_frame = pd.read_excel(file)
         assign_leave_dicts = data_frame.to_dict("records")
+        badge_ids = {
+            str(assign_leave["Employee Badge ID"]).lower()
+            for assign_leave in assign_leave_dicts
+        }
+        leave_type_names = {
+            str(assign_leave["Leave Type"]).lower()
+            for assign_leave in assign_leave_dicts
+        }
+        employees = {}
+        for employee in Employee.objects.annotate(
+            lower_badge_id=Lower("badge_id")
+        ).filter(lower_badge_id__in=badge_ids):
+            employees.setdefault(employee.lower_badge_id, employee)
+        leave_types = {}
+        for leave_type in LeaveType.objects.annotate(
+            lower_name=Lower("name")
+        ).filter(lower_name__in=leave_type_names):
+            leave_types.setdefault(leave_type.lower_name, leave_type)
+        assigned = set(
+            AvailableLeave.objects.filter(
+                leave_type_id__in=leave_types.values(),
+                employee_id__in=employees.values(),
+            ).values_list("leave_type_id", "employee_id")
+        )
+        assignments = []
         for assign_leave in assign_leave_dicts:
             try:
                 save = True
-                assign_leave_type = assign_leave["Leave Type"]
-                badge_id = assign_leave["Employee Badge ID"]
-                employee = Employee.objects.filter(badge_id__iexact=badge_id).first()
-                leave_type = LeaveType.objects.filter(
-                    name__iexact=assign_leave_type
-                ).first()
+                employee = employees.get(
+                    str(assign_leave["Employee Badge ID"]).lower()
+                )
+                leave_type = leave_types.get(str(assign_leave["Leave Type"]).lower())
                 if employee is None:
                     save = False
                     assign_leave["Error1"] = _("This badge id does not exist.")
@@ -1262,24 +1273,25 @@ def assign_leave_type_import(request):
                 if leave_type is None:
                     save = False
                     assign_leave["Error2"] = _("This leave type does not exist.")
-                if AvailableLeave.objects.filter(
-                    leave_type_id=leave_type, employee_id=employee
-                ).exists():
+                if (
+                    employee is not None
+                    and leave_type is not None
+                    and (leave_type.pk, employee.pk) in assigned
+                ):
                     save = False
                     assign_leave["Error3"] = _(
                         "Leave type has already been assigned to the employee."
                     )
                 if save:
-                    AvailableLeave(
-                        leave_type_id=leave_type,
-                        employee_id=employee,
-                        available_days=leave_type.total_days,
-                    ).save()
+                    # a repeated row of the file is already assigned
+                    assigned.add((leave_type.pk, employee.pk))
+                    assignments.append((leave_type, employee.pk))
                 else:
                     error_list.append(assign_leave)
             except Exception as exception:
                 assign_leave["Error4"] = f"{str(exception)}"
                 error_list.append(assign_leave)
+        assign_leave_types(assignments)
         if error_list:
             response = generate_error_report(error_list, error_data, file_name)
             return response
@@ -1910,10 +1922,11 @@ def user_leave_request(request, id):
         )
         requested_dates = leave_requested_dates(start_date, end_date)
         requested_dates = [date.date() for date in requested_dates]
-        holidays = Holiday.objects.all()
-        holiday_dates = holiday_dates_list(holidays)
-        company_leaves = CompanyLeave.objects.all()
-        company_leave_dates = company_leave_dates_list(company_leaves, start_date)
+        company_id = get_employee_company_id(employee)
+        holiday_dates = holiday_dates_between(start_date, end_date, company_id)
+        company_leave_dates = company_leave_dates_between(
+            start_date, end_date, company_id
+        )
         if leave_type.require_attachment == "yes":
             if attachment is None:
                 form.add_error(
@@ -1983,6 +1996,7 @@ def user_leave_request(request, id):
                             leave_request.requested_days
                         )
                     leave_request.status = "approved"
+                    available_leave.record_ledger_entry("consumption", leave_request)
                     available_leave.save()
                 leave_request.created_by = employee
                 leave_request.save()
@@ -2061,11 +2075,12 @@ def user_request_update(request, id):
                         start_date, end_date, start_date_breakdown, end_date_breakdown
                     )
                     requested_dates = leave_requested_dates(start_date, end_date)
-                    holidays = Holiday.objects.all()
-                    holiday_dates = holiday_dates_list(holidays)
-                    company_leaves = CompanyLeave.objects.all()
-                    company_leave_dates = company_leave_dates_list(
-                        company_leaves, start_date
+                    company_id = get_employee_company_id(employee)
+                    holiday_dates = holiday_dates_between(
+                        start_date, end_date, company_id
+                    )
+                    company_leave_dates = company_leave_dates_between(
+                        start_date, end_date, company_id
                     )
                     if (
                         leave_type.exclude_company_leave == "yes"
@@ -2863,10 +2878,15 @@ def leave_request_create(request):
                             leave_request.requested_days
                         )
                     leave_request.status = "approved"
-                    available_leave.save()
                 if save:
                     leave_request.created_by = request.user.employee_get
                     leave_request.save()
+                    if leave_request.leave_type_id.require_approval == "no":
+                        # the consumption is recorded with the saved request
+                        available_leave.record_ledger_entry(
+                            "consumption", leave_request
+                        )
+                        available_leave.save()
                     messages.success(request, _("Leave request created successfully.."))
                     with contextlib.suppress(Exception):
                         notify.send(
@@ -3235,6 +3255,7 @@ def leave_allocation_request_approve(request, req_id):
                 employee_id=employee,
             )
         available_leave.available_days += leave_allocation_request.requested_days
+        available_leave.record_ledger_entry("accrual")
         available_leave.save()
         leave_allocation_request.status = "approved"
         leave_allocation_request.save()
@@ -3614,14 +3635,22 @@ def employee_leave_details(request):
     if request.POST["leave_type"] and request.POST["employee_id"]:
         leave_type_id = request.POST["leave_type"]
         leave_type = LeaveType.objects.filter(id=leave_type_id).first()
-        balance = AvailableLeave.objects.filter(
+        available_leave = AvailableLeave.objects.filter(
             Q(leave_type_id=leave_type.id) & Q(employee_id=employee)
-        )
-        for i in balance:
-            balance_count = i.available_days
-        if date:
+        ).first()
+        if available_leave:
+            balance_count = available_leave.available_days
+        if available_leave and date:
             try:
-                balance_count += balance.first().forcasted_leaves()[date[:7]]
+                balance_on = None
+                day = datetime.strptime(date, "%Y-%m-%d").date()
+                if day < datetime.today().date():
+                    # the balance of a past day is read from the leave ledger
+                    balance_on = available_leave.balance_on(day)
+                if balance_on is not None:
+                    balance_count = balance_on["available_days"]
+                else:
+                    balance_count += available_leave.forcasted_leaves()[date[:7]]
             except:
                 pass
 
@@ -4033,15 +4062,10 @@ def view_clashes(request, leave_request_id):
     """
     record = get_object_or_404(LeaveRequest, id=leave_request_id)
     overlapping_requests = LeaveRequest.objects.filter(
-        Q(
-            employee_id__employee_work_info__department_id=record.employee_id.employee_work_info.department_id
-        )
-        | Q(
-            employee_id__employee_work_info__job_position_id=record.employee_id.employee_work_info.job_position_id
-        ),
-        start_date__lte=record.end_date,
-        end_date__gte=record.start_date,
-    ).exclude(id=leave_request_id)
+        id__in=clashing_leave_requests(
+            record.employee_id_id, record.start_date, record.end_date, record.id
+        ).values("id")
+    )
 
     clashed_due_to_department = overlapping_requests.filter(
         employee_id__employee_work_info__department_id=record.employee_id.employee_work_info.department_id
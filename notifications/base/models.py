@@ -331,5 +331,41 @@ def notify_handler(verb, **kwargs):
     return new_notifications
 
 
+def bulk_notify(sender, notices, **kwargs):
+    """
+    Create the notifications of many recipients with one query. A notice is
+    a dict of the recipient, the verb and the extra data of one
+    notification, the keyword arguments are shared by all of them.
+    """
+    Notification = load_model("notifications", "Notification")
+    level = kwargs.pop("level", Notification.LEVELS.info)
+    actor_content_type = ContentType.objects.get_for_model(sender)
+    timestamp = timezone.now()
+
+    new_notifications = []
+    for notice in notices:
+        data = {**kwargs, **notice}
+        recipient = data.pop("recipient")
+        if recipient is None:
+            continue
+        newnotify = Notification(
+            recipient=recipient,
+            actor_content_type=actor_content_type,
+            actor_object_id=sender.pk,
+            verb=str(data.pop("verb")),
+            public=True,
+            timestamp=timestamp,
+            level=level,
+        )
+        if data and EXTRA_DATA:
+            newnotify.data = data
+            newnotify.verb_ar = data.get("verb_ar", None)
+            newnotify.verb_de = data.get("verb_de", None)
+            newnotify.verb_es = data.get("verb_es", None)
+            newnotify.verb_fr = data.get("verb_fr", None)
+        new_notifications.append(newnotify)
+    return Notification.objects.bulk_create(new_notifications, batch_size=500)
+
+
 # connect the signal
 notify.connect(notify_handler, dispatch_uid="notifications.models.notification")
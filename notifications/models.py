@@ -1,6 +1,6 @@
 from swapper import swappable_setting
 from django.db import models
-from .base.models import AbstractNotification, notify_handler  # noqa
+from .base.models import AbstractNotification, bulk_notify, notify_handler  # noqa
 
 
 class Notification(AbstractNotification):
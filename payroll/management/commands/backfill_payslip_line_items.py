@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from payroll.methods.line_items import write_line_items
+from payroll.models.models import Payslip
+
+
+class Command(BaseCommand):
+    help = "Writes the line items of the existing payslips from their pay head data"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of payslips written per batch",
+        )
+        parser.add_argument(
+            "--missing-only",
+            action="store_true",
+            help="Only the payslips without line items",
+        )
+
+    def handle(self, *args, **options):
+        payslips = Payslip._base_manager.order_by("id")
+        if options["missing_only"]:
+            payslips = payslips.filter(line_items__isnull=True).distinct()
+        batch_size = options["batch_size"]
+        last_id = 0
+        count = 0
+        while True:
+            batch = list(
+                payslips.filter(id__gt=last_id).only(
+                    "id", "employee_id", "start_date", "end_date", "pay_head_data"
+                )[:batch_size]
+            )
+            if not batch:
+                break
+            write_line_items(batch)
+            count += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f"{count} payslips written")
+        self.stdout.write(self.style.SUCCESS(f"Line items written for {count} payslips"))
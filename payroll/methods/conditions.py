@@ -0,0 +1,210 @@
+"""
+conditions.py
+
+This module is used to evaluate the conditions of the condition based
+allowances and deductions. The conditions of a pay head are compiled once
+into (field path, operator, value) rules, and the employee values of every
+field path are resolved for a whole batch of employees with a few queries.
+"""
+
+import operator
+from collections import defaultdict
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import prefetch_related_objects
+from employee.models import Employee
+from payroll.models.models import Contract
+
+operator_mapping = {
+    "equal": operator.eq,
+    "notequal": operator.ne,
+    "lt": operator.lt,
+    "gt": operator.gt,
+    "le": operator.le,
+    "ge": operator.ge,
+    "icontains": operator.contains,
+}
+
+CONTRACT_RELATION = "contract_set"
+
+
+def compile_conditions(component):
+    """
+    This method is used to compile the conditions of an allowance/deduction,
+    the MultipleCondition rows included, into (field path, operator, value)
+    rules
+
+    Args:
+        component (Allowance/Deduction): condition based pay head
+    """
+    rules = [
+        (condition.field, operator_mapping.get(condition.condition), condition.value)
+        for condition in component.other_conditions.all()
+    ]
+    rules.append(
+        (
+            component.field,
+            operator_mapping.get(component.condition),
+            (component.value or "").lower().replace(" ", "_"),
+        )
+    )
+    return rules
+
+
+def rules_match(rules, resolve):
+    """
+    Whether all the compiled rules match, resolve(field_path) returns the
+    employee value of the field path
+    """
+    for field_path, operator_func, value in rules:
+        employee_value = resolve(field_path)
+        if employee_value is None or operator_func is None:
+            return False
+        try:
+            if not operator_func(employee_value, type(employee_value)(value)):
+                return False
+        except (TypeError, ValueError):
+            return False
+    return True
+
+
+def _relation_lookup(model, attributes):
+    """
+    Returns the longest prefix of the attributes that can be prefetched
+    """
+    relations = []
+    for attribute in attributes:
+        try:
+            field = model._meta.get_field(attribute)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation or field.many_to_many or field.one_to_many:
+            break
+        relations.append(attribute)
+        model = field.related_model
+    return "__".join(relations)
+
+
+class EmployeeValueResolver:
+    """
+    Resolves the value of employee field paths like
+    "employee_work_info__department_id__department" or
+    "contract_set__wage_type" the same way payslip_calc.dynamic_attr does,
+    the related objects of all the employees are loaded in bulk beforehand.
+    """
+
+    def __init__(self, employees, field_paths):
+        self.employees = list(employees)
+        self.contracts = {}
+        self._values = {}
+
+        employee_lookups = set()
+        contract_lookups = set()
+        load_contracts = False
+        for field_path in field_paths:
+            attributes = (field_path or "").split("__")
+            if attributes[0] == CONTRACT_RELATION:
+                load_contracts = True
+                lookup = _relation_lookup(Contract, attributes[1:-1])
+                if lookup:
+                    contract_lookups.add(lookup)
+                continue
+            lookup = _relation_lookup(Employee, attributes[:-1])
+            if lookup:
+                employee_lookups.add(lookup)
+
+        if employee_lookups:
+            prefetch_related_objects(self.employees, *employee_lookups)
+        if load_contracts:
+            for contract in Contract.objects.filter(
+                employee_id__in=[employee.id for employee in self.employees],
+                is_active=True,
+            ).order_by("pk"):
+                self.contracts.setdefault(contract.employee_id_id, contract)
+            if contract_lookups:
+                prefetch_related_objects(
+                    list(self.contracts.values()), *contract_lookups
+                )
+
+    def resolve(self, employee, field_path):
+        """
+        Value of the field path for the employee, None when it doesn't exist
+        """
+        key = (employee.id, field_path)
+        if key not in self._values:
+            value = employee
+            for attribute in (field_path or "").split("__"):
+                if value is employee and attribute == CONTRACT_RELATION:
+                    value = self.contracts.get(employee.id)
+                else:
+                    value = getattr(value, attribute, None)
+                if value is None:
+                    break
+            self._values[key] = value
+        return self._values[key]
+
+    def eligible_employee_ids(self, rules):
+        """
+        Ids of the employees matching all the compiled rules
+        """
+        return {
+            employee.id
+            for employee in self.employees
+            if rules_match(
+                rules,
+                lambda field_path, employee=employee: self.resolve(
+                    employee, field_path
+                ),
+            )
+        }
+
+
+def resolve_eligibility(components, employees):
+    """
+    This method is used to compile the conditions of the condition based
+    components and resolve the eligible employees of each in bulk, the
+    result is set on component.eligible_employee_ids
+
+    Args:
+        components (list): Allowance/Deduction instances with other_conditions
+            prefetched
+        employees (list): Employee instances
+    """
+    conditional_components = [
+        component for component in components if component.is_condition_based
+    ]
+    rules = {
+        id(component): compile_conditions(component)
+        for component in conditional_components
+    }
+    field_paths = {
+        field_path
+        for component_rules in rules.values()
+        for field_path, _operator, _value in component_rules
+    }
+    resolver = EmployeeValueResolver(employees, field_paths)
+    eligible = defaultdict(set)
+    for component in conditional_components:
+        eligible[id(component)] = resolver.eligible_employee_ids(rules[id(component)])
+        component.eligible_employee_ids = eligible[id(component)]
+    return eligible
+
+
+def component_applies(component, employee, context=None):
+    """
+    Whether the conditions of the condition based component match the employee
+
+    Args:
+        component (Allowance/Deduction): condition based pay head
+        employee (Employee): Employee instance
+        context (PayrollPeriodContext): when given, the eligibility resolved in
+            bulk for the batch is used
+    """
+    eligible_employee_ids = getattr(component, "eligible_employee_ids", None)
+    if context is not None and eligible_employee_ids is not None:
+        return employee.id in eligible_employee_ids
+    from payroll.methods.payslip_calc import dynamic_attr
+
+    return rules_match(
+        compile_conditions(component),
+        lambda field_path: dynamic_attr(employee, field_path),
+    )
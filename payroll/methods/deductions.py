@@ -4,25 +4,24 @@ deductions.py
 This module is used to compute the deductions of employees
 """
 
-from payroll.models.models import Deduction
-
 
 def update_compensation_deduction(
-    employee, compensation_amount, compensation_type, start_date, end_date
+    employee,
+    compensation_amount,
+    compensation_type,
+    start_date,
+    end_date,
+    context,
 ):
     """
     This method is used to update the basic or gross pay
 
     Args:
         compensation_amount (_type_): Gross pay or Basic pay or employee
+        context (obj): PayrollPeriodContext with the preloaded deductions
     """
-    deduction_heads = (
-        Deduction.objects.filter(
-            update_compensation=compensation_type, specific_employees=employee
-        )
-        .exclude(one_time_date__lt=start_date)
-        .exclude(one_time_date__gt=end_date)
-        # .exclude(exclude_employees=employee)
+    deduction_heads = context.compensation_deductions(
+        employee, compensation_type, start_date, end_date
     )
     deductions = []
     temp = compensation_amount
@@ -0,0 +1,415 @@
+"""
+engine.py
+
+This module is used to compute payslips, one at a time or for a whole batch
+of employees sharing the same pay period
+"""
+
+import json
+import logging
+from base import thread_local_middleware
+from payroll.methods.deductions import update_compensation_deduction
+from payroll.methods.line_items import write_line_items
+from payroll.methods.methods import (
+    calculate_employer_contribution,
+    compute_salary_on_period,
+)
+from payroll.methods.payslip_calc import (
+    calculate_allowance,
+    calculate_gross_pay,
+    calculate_net_pay_deduction,
+    calculate_post_tax_deduction,
+    calculate_pre_tax_deduction,
+    calculate_tax_deduction,
+    calculate_taxable_gross_pay,
+)
+from payroll.methods.period_context import PayrollPeriodContext, get_period_context
+from payroll.methods.tax_calc import annualised_taxable_income, calculate_period_taxes
+from payroll.models.models import Payslip
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+
+logger = logging.getLogger(__name__)
+
+PAYSLIP_BATCH_SIZE = 500
+
+
+def payroll_calculation(employee, start_date, end_date, context=None):
+    """
+    Calculate payroll components for the specified employee within the given date range.
+
+
+    Args:
+        employee (Employee): The employee for whom the payroll is calculated.
+        start_date (date): The start date of the payroll period.
+        end_date (date): The end date of the payroll period.
+        context (PayrollPeriodContext): Optional preloaded period data, used when
+            the payslips of a batch are computed together. The period of the
+            employee alone is loaded when it is not given.
+
+
+    Returns:
+        dict: A dictionary containing the calculated payroll components:
+    """
+
+    context = get_period_context(employee, start_date, end_date, context)
+    payroll = _compute_until_tax(employee, start_date, end_date, context)
+    federal_tax = calculate_period_taxes([payroll["taxable_income"]])[0]
+    return _complete_payroll(payroll, federal_tax)
+
+
+def _compute_until_tax(employee, start_date, end_date, context):
+    """
+    First step of payroll_calculation, everything the federal tax depends on.
+    The federal tax of a batch is computed at once between the two steps.
+    """
+    basic_pay_details = compute_salary_on_period(
+        employee, start_date, end_date, context=context
+    )
+    contract = basic_pay_details["contract"]
+    contract_wage = basic_pay_details["contract_wage"]
+    basic_pay = basic_pay_details["basic_pay"]
+    loss_of_pay = basic_pay_details["loss_of_pay"]
+    paid_days = basic_pay_details["paid_days"]
+    unpaid_days = basic_pay_details["unpaid_days"]
+
+    working_days_details = basic_pay_details["month_data"]
+
+    updated_basic_pay_data = update_compensation_deduction(
+        employee, basic_pay, "basic_pay", start_date, end_date, context
+    )
+    basic_pay = updated_basic_pay_data["compensation_amount"]
+    basic_pay_deductions = updated_basic_pay_data["deductions"]
+
+    loss_of_pay_amount = (
+        float(loss_of_pay) if not contract.deduct_leave_from_basic_pay else 0
+    )
+
+    basic_pay = basic_pay - loss_of_pay_amount
+
+    kwargs = {
+        "employee": employee,
+        "start_date": start_date,
+        "end_date": end_date,
+        "basic_pay": basic_pay,
+        "day_dict": working_days_details,
+        "context": context,
+    }
+    # basic pay will be basic_pay = basic_pay - update_compensation_amount
+    allowances = calculate_allowance(**kwargs)
+
+    # finding the total allowance
+    total_allowance = sum(allowance["amount"] for allowance in allowances["allowances"])
+
+    kwargs["allowances"] = allowances
+    kwargs["total_allowance"] = total_allowance
+    gross_pay = calculate_gross_pay(**kwargs)["gross_pay"]
+    updated_gross_pay_data = update_compensation_deduction(
+        employee, gross_pay, "gross_pay", start_date, end_date, context
+    )
+    gross_pay = updated_gross_pay_data["compensation_amount"]
+    gross_pay_deductions = updated_gross_pay_data["deductions"]
+
+    kwargs["gross_pay"] = gross_pay
+    pretax_deductions = calculate_pre_tax_deduction(**kwargs)
+    post_tax_deductions = calculate_post_tax_deduction(**kwargs)
+
+    installments = (
+        pretax_deductions["installments"] + post_tax_deductions["installments"]
+    )
+
+    taxable_gross_pay = calculate_taxable_gross_pay(**kwargs)
+    tax_deductions = calculate_tax_deduction(**kwargs)
+    return {
+        "kwargs": kwargs,
+        "contract_wage": contract_wage,
+        "loss_of_pay": loss_of_pay,
+        "loss_of_pay_amount": loss_of_pay_amount,
+        "paid_days": paid_days,
+        "unpaid_days": unpaid_days,
+        "basic_pay_deductions": basic_pay_deductions,
+        "gross_pay_deductions": gross_pay_deductions,
+        "allowances": allowances,
+        "pretax_deductions": pretax_deductions,
+        "post_tax_deductions": post_tax_deductions,
+        "tax_deductions": tax_deductions,
+        "taxable_gross_pay": taxable_gross_pay,
+        "installments": installments,
+        "taxable_income": annualised_taxable_income(**kwargs),
+    }
+
+
+def _complete_payroll(payroll, federal_tax):
+    """
+    Second step of payroll_calculation, the deductions and net pay once the
+    federal tax is known
+    """
+    kwargs = payroll["kwargs"]
+    employee = kwargs["employee"]
+    start_date = kwargs["start_date"]
+    end_date = kwargs["end_date"]
+    context = kwargs["context"]
+    basic_pay = kwargs["basic_pay"]
+    gross_pay = kwargs["gross_pay"]
+    contract_wage = payroll["contract_wage"]
+    loss_of_pay = payroll["loss_of_pay"]
+    loss_of_pay_amount = payroll["loss_of_pay_amount"]
+    paid_days = payroll["paid_days"]
+    unpaid_days = payroll["unpaid_days"]
+    basic_pay_deductions = payroll["basic_pay_deductions"]
+    gross_pay_deductions = payroll["gross_pay_deductions"]
+    allowances = payroll["allowances"]
+    pretax_deductions = payroll["pretax_deductions"]
+    post_tax_deductions = payroll["post_tax_deductions"]
+    tax_deductions = payroll["tax_deductions"]
+    taxable_gross_pay = payroll["taxable_gross_pay"]
+    installments = payroll["installments"]
+
+    # gross_pay = (basic_pay + total_allowances)
+    # deduction = (
+    #   post_tax_deductions_amount
+    #   + pre_tax_deductions _amount
+    #   + tax_deductions + federal_tax_amount
+    #   + lop_amount
+    #   + one_time_basic_deduction_amount
+    #   + one_time_gross_deduction_amount
+    #   )
+    # net_pay = gross_pay - deduction
+    # net_pay = net_pay - net_pay_deduction
+
+    total_allowance = sum(item["amount"] for item in allowances["allowances"])
+    total_pretax_deduction = sum(
+        item["amount"] for item in pretax_deductions["pretax_deductions"]
+    )
+    total_post_tax_deduction = sum(
+        item["amount"] for item in post_tax_deductions["post_tax_deductions"]
+    )
+    total_tax_deductions = sum(
+        item["amount"] for item in tax_deductions["tax_deductions"]
+    )
+
+    total_deductions = (
+        total_pretax_deduction
+        + total_post_tax_deduction
+        + total_tax_deductions
+        + federal_tax
+        + loss_of_pay_amount
+    )
+
+    net_pay = (basic_pay + total_allowance) - total_deductions
+    updated_net_pay_data = update_compensation_deduction(
+        employee, net_pay, "net_pay", start_date, end_date, context
+    )
+    net_pay = updated_net_pay_data["compensation_amount"]
+    update_net_pay_deductions = updated_net_pay_data["deductions"]
+
+    net_pay_deductions = calculate_net_pay_deduction(
+        net_pay,
+        post_tax_deductions["net_pay_deduction"],
+        **kwargs,
+    )
+    net_pay_deduction_list = net_pay_deductions["net_pay_deductions"]
+    for deduction in update_net_pay_deductions:
+        net_pay_deduction_list.append(deduction)
+    net_pay = net_pay - net_pay_deductions["net_deduction"]
+    payslip_data = {
+        "employee": employee,
+        "contract_wage": contract_wage,
+        "basic_pay": basic_pay,
+        "gross_pay": gross_pay,
+        "taxable_gross_pay": taxable_gross_pay["taxable_gross_pay"],
+        "net_pay": net_pay,
+        "allowances": allowances["allowances"],
+        "paid_days": paid_days,
+        "unpaid_days": unpaid_days,
+        "basic_pay_deductions": basic_pay_deductions,
+        "gross_pay_deductions": gross_pay_deductions,
+        "pretax_deductions": pretax_deductions["pretax_deductions"],
+        "post_tax_deductions": post_tax_deductions["post_tax_deductions"],
+        "tax_deductions": tax_deductions["tax_deductions"],
+        "net_deductions": net_pay_deduction_list,
+        "total_deductions": total_deductions,
+        "loss_of_pay": loss_of_pay,
+        "federal_tax": federal_tax,
+        "start_date": start_date,
+        "end_date": end_date,
+        "range": f"{start_date.strftime('%b %d %Y')} - {end_date.strftime('%b %d %Y')}",
+    }
+    data_to_json = payslip_data.copy()
+    data_to_json["employee"] = employee.id
+    data_to_json["start_date"] = start_date.strftime("%Y-%m-%d")
+    data_to_json["end_date"] = end_date.strftime("%Y-%m-%d")
+    json_data = json.dumps(data_to_json)
+
+    payslip_data["json_data"] = json_data
+    payslip_data["installments"] = installments
+    return payslip_data
+
+
+def payslip_record(payslip, group_name=None, status="draft"):
+    """
+    This method is used to convert the computed payslip data to the keyword
+    arguments of save_payslip / bulk_save_payslips
+    """
+    return {
+        "employee": payslip["employee"],
+        "group_name": group_name,
+        "start_date": payslip["start_date"],
+        "end_date": payslip["end_date"],
+        "status": status,
+        "contract_wage": payslip["contract_wage"],
+        "basic_pay": payslip["basic_pay"],
+        "gross_pay": payslip["gross_pay"],
+        "deduction": payslip["total_deductions"],
+        "net_pay": payslip["net_pay"],
+        "pay_data": json.loads(payslip["json_data"]),
+        "installments": payslip["installments"],
+    }
+
+
+def bulk_save_payslips(records, created_by=None):
+    """
+    This method is used to save the generated payslips of a batch with bulk
+    queries, existing payslips of the same employee and period are updated.
+
+    Args:
+        records (list): save_payslip keyword arguments of every payslip
+        created_by (User): creator of the new payslips, defaults to the
+            user of the current request
+
+    Returns:
+        list: the saved Payslip instances
+    """
+    if not records:
+        return []
+    existing = {
+        (payslip.employee_id_id, payslip.start_date, payslip.end_date): payslip
+        for payslip in Payslip.objects.filter(
+            employee_id__in=[record["employee"].id for record in records],
+            end_date__in={record["end_date"] for record in records},
+        )
+    }
+    if created_by is None:
+        request = getattr(thread_local_middleware._thread_locals, "request", None)
+        user = getattr(request, "user", None)
+        created_by = user if user is not None and user.is_authenticated else None
+
+    instances = []
+    to_create = []
+    to_update = []
+    for record in records:
+        key = (record["employee"].id, record["start_date"], record["end_date"])
+        instance = existing.get(key)
+        if instance is None:
+            instance = Payslip(created_by=created_by)
+            to_create.append(instance)
+        else:
+            to_update.append(instance)
+        instance.employee_id = record["employee"]
+        instance.group_name = record.get("group_name")
+        instance.start_date = record["start_date"]
+        instance.end_date = record["end_date"]
+        instance.status = record["status"]
+        instance.basic_pay = round(record["basic_pay"], 2)
+        instance.contract_wage = round(record["contract_wage"], 2)
+        instance.gross_pay = round(record["gross_pay"], 2)
+        instance.deduction = round(record["deduction"], 2)
+        instance.net_pay = round(record["net_pay"], 2)
+        instance.pay_head_data = record["pay_data"]
+        instances.append(instance)
+
+    if to_create:
+        bulk_create_with_history(
+            to_create, Payslip, batch_size=PAYSLIP_BATCH_SIZE, default_user=created_by
+        )
+    if to_update:
+        bulk_update_with_history(
+            to_update,
+            Payslip,
+            [
+                "group_name",
+                "status",
+                "basic_pay",
+                "contract_wage",
+                "gross_pay",
+                "deduction",
+                "net_pay",
+                "pay_head_data",
+            ],
+            batch_size=PAYSLIP_BATCH_SIZE,
+            default_user=created_by,
+        )
+
+    through = Payslip.installment_ids.through
+    through.objects.filter(payslip_id__in=[instance.id for instance in instances]).delete()
+    through.objects.bulk_create(
+        [
+            through(payslip_id=instance.id, deduction_id=installment.id)
+            for instance, record in zip(instances, records)
+            for installment in record["installments"]
+        ],
+        batch_size=PAYSLIP_BATCH_SIZE,
+    )
+    write_line_items(instances)
+    return instances
+
+
+def generate_payslip_batch(
+    employees, start_date, end_date, group_name=None, created_by=None, errors=None
+):
+    """
+    This method is used to generate the payslips of all the employees for the
+    period. The period data is loaded once through PayrollPeriodContext, every
+    payslip is computed in memory and the batch is written with bulk queries.
+
+    Args:
+        employees (QuerySet): Employee queryset
+        start_date (date): start date of the pay period
+        end_date (date): end date of the pay period
+        group_name (str): batch name
+        created_by (User): creator of the new payslips
+        errors (dict): when given, an employee whose payslip cannot be
+            computed is recorded here as {employee_id: message} and skipped
+            instead of aborting the batch
+
+    Returns:
+        list: the saved Payslip instances
+    """
+    context = PayrollPeriodContext(employees, start_date, end_date)
+
+    def failed(employee, error):
+        if errors is None:
+            raise error
+        logger.exception("Payslip generation failed for employee %s", employee.id)
+        errors[employee.id] = str(error) or error.__class__.__name__
+
+    payrolls = []
+    for employee in context.employees:
+        contract = context.contract(employee)
+        if contract is None:
+            if errors is not None:
+                errors[employee.id] = "No active contract"
+            continue
+        employee_start_date = max(start_date, contract.contract_start_date)
+        try:
+            payrolls.append(
+                _compute_until_tax(employee, employee_start_date, end_date, context)
+            )
+        except Exception as error:
+            failed(employee, error)
+
+    # the federal tax of the whole batch, one vectorized call per filing status
+    federal_taxes = calculate_period_taxes(
+        [payroll["taxable_income"] for payroll in payrolls]
+    )
+
+    records = []
+    for payroll, federal_tax in zip(payrolls, federal_taxes):
+        try:
+            payslip = _complete_payroll(payroll, federal_tax)
+            record = payslip_record(payslip, group_name)
+            calculate_employer_contribution(record, context)
+        except Exception as error:
+            failed(payroll["kwargs"]["employee"], error)
+            continue
+        records.append(record)
+    return bulk_save_payslips(records, created_by)
@@ -0,0 +1,113 @@
+"""
+line_items.py
+
+This module is used to keep the PayslipLineItem table in sync with the
+pay_head_data of the payslips, and to aggregate the line items for the
+contribution reports.
+"""
+
+from django.db.models import Min, Sum
+from payroll.models.models import PayslipLineItem
+
+LINE_ITEM_BATCH_SIZE = 1000
+
+# pay_head_data list: (line item kind, key of the pay head id)
+LINE_ITEM_SOURCES = {
+    "allowances": ("allowance", "allowance_id"),
+    "basic_pay_deductions": ("basic_pay_deduction", "deduction_id"),
+    "gross_pay_deductions": ("gross_pay_deduction", "deduction_id"),
+    "pretax_deductions": ("pretax_deduction", "deduction_id"),
+    "post_tax_deductions": ("post_tax_deduction", "deduction_id"),
+    "tax_deductions": ("tax_deduction", "deduction_id"),
+    "net_deductions": ("net_deduction", "deduction_id"),
+}
+
+DEDUCTION_KINDS = [
+    kind for kind, _id_key in LINE_ITEM_SOURCES.values() if kind != "allowance"
+]
+
+
+def _amount(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def payslip_line_items(payslip):
+    """
+    This method is used to build the (unsaved) line items of the payslip
+    from its pay_head_data
+    """
+    data = payslip.pay_head_data if isinstance(payslip.pay_head_data, dict) else {}
+    line_items = []
+    for source, (kind, id_key) in LINE_ITEM_SOURCES.items():
+        for item in data.get(source) or []:
+            if not isinstance(item, dict):
+                continue
+            line_items.append(
+                PayslipLineItem(
+                    payslip_id_id=payslip.id,
+                    employee_id_id=payslip.employee_id_id,
+                    start_date=payslip.start_date,
+                    end_date=payslip.end_date,
+                    kind=kind,
+                    component_id=item.get(id_key),
+                    title=item.get("title"),
+                    amount=_amount(item.get("amount")),
+                    employer_contribution=_amount(
+                        item.get("employer_contribution_amount")
+                    ),
+                )
+            )
+    return line_items
+
+
+def write_line_items(payslips):
+    """
+    This method is used to replace the line items of the saved payslips
+
+    Args:
+        payslips (list): saved Payslip instances
+    """
+    payslips = list(payslips)
+    if not payslips:
+        return
+    PayslipLineItem.objects.filter(
+        payslip_id__in=[payslip.id for payslip in payslips]
+    ).delete()
+    PayslipLineItem.objects.bulk_create(
+        [
+            line_item
+            for payslip in payslips
+            for line_item in payslip_line_items(payslip)
+        ],
+        batch_size=LINE_ITEM_BATCH_SIZE,
+    )
+
+
+def contribution_totals(line_items, *group_by):
+    """
+    This method is used to sum the employee and employer contributions of
+    the deductions having an employer contribution
+
+    Args:
+        line_items (QuerySet): PayslipLineItem queryset
+        group_by (str): fields grouped on besides the deduction, like
+            "employee_id"
+
+    Returns:
+        QuerySet: rows with component_id, title, employee_contribution and
+            employer_contribution
+    """
+    return (
+        line_items.filter(kind__in=DEDUCTION_KINDS, component_id__isnull=False)
+        .values(*group_by, "component_id")
+        .annotate(
+            component_title=Min("title"),
+            employee_contribution=Sum("amount"),
+            employer_contribution=Sum("employer_contribution"),
+        )
+        .filter(employer_contribution__gt=0)
+        .order_by(*group_by, "component_id")
+    )
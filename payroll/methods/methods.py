@@ -5,73 +5,33 @@ Payroll related module to write custom calculation methods
 """
 
 import calendar
-from datetime import timedelta, datetime, date
-from django.db.models import F, Q
+from datetime import timedelta, date
 from django.core.paginator import Paginator
 from dateutil.relativedelta import relativedelta
 from base.methods import get_pagination
-from leave.models import Holiday, CompanyLeave
-from attendance.models import Attendance
-from payroll.models.models import Contract, Deduction, Payslip
+from leave.calendar_cache import (
+    company_leave_dates_between,
+    get_employee_company_id,
+    get_non_working_days,
+    holiday_dates_between,
+)
+from payroll.methods.line_items import write_line_items
+from payroll.methods.period_context import get_period_context
+from payroll.models.models import Deduction, Payslip
 
 
 def get_holiday_dates(range_start: date, range_end: date) -> list:
     """
     :return: this functions returns a list of all holiday dates.
     """
-    pay_range_dates = get_date_range(start_date=range_start, end_date=range_end)
-    query = Q()
-    for check_date in pay_range_dates:
-        query |= Q(start_date__lte=check_date, end_date__gte=check_date)
-    holidays = Holiday.objects.filter(query)
-    holiday_dates = set([])
-    for holiday in holidays:
-        holiday_dates = holiday_dates | (
-            set(
-                get_date_range(start_date=holiday.start_date, end_date=holiday.end_date)
-            )
-        )
-    return list(set(holiday_dates))
+    return holiday_dates_between(range_start, range_end)
 
 
 def get_company_leave_dates(year):
     """
     :return: This function returns a list of all company leave dates
     """
-    company_leaves = CompanyLeave.objects.all()
-    company_leave_dates = []
-    for company_leave in company_leaves:
-        based_on_week = company_leave.based_on_week
-        based_on_week_day = company_leave.based_on_week_day
-        for month in range(1, 13):
-            if based_on_week is not None:
-                # Set Sunday as the first day of the week
-                calendar.setfirstweekday(6)
-                month_calendar = calendar.monthcalendar(year, month)
-                weeks = month_calendar[int(based_on_week)]
-                weekdays_in_weeks = [day for day in weeks if day != 0]
-                for day in weekdays_in_weeks:
-                    leave_date = datetime.strptime(
-                        f"{year}-{month:02}-{day:02}", "%Y-%m-%d"
-                    ).date()
-                    if (
-                        leave_date.weekday() == int(based_on_week_day)
-                        and leave_date not in company_leave_dates
-                    ):
-                        company_leave_dates.append(leave_date)
-            else:
-                # Set Monday as the first day of the week
-                calendar.setfirstweekday(0)
-                month_calendar = calendar.monthcalendar(year, month)
-                for week in month_calendar:
-                    if week[int(based_on_week_day)] != 0:
-                        leave_date = datetime.strptime(
-                            f"{year}-{month:02}-{week[int(based_on_week_day)]:02}",
-                            "%Y-%m-%d",
-                        ).date()
-                        if leave_date not in company_leave_dates:
-                            company_leave_dates.append(leave_date)
-    return company_leave_dates
+    return sorted(get_non_working_days(year)["company_leaves"])
 
 
 def get_date_range(start_date, end_date):
@@ -123,40 +83,29 @@ def get_total_days(start_date, end_date):
     return total_days
 
 
-def get_working_days(start_date, end_date):
+def get_working_days(start_date, end_date, context=None, employee=None):
     """
     This method is used to calculate the total working days, total leave, worked days on that period
 
     Args:
         start_date (_type_): the start date from the data needed
         end_date (_type_): the end date till the date needed
+        context (obj): optional PayrollPeriodContext with the preloaded calendar
+        employee (obj): optional Employee, the calendar of their company is used
     """
+    if context is not None and context.covers(start_date, end_date):
+        return context.working_days(start_date, end_date, employee)
 
-    holiday_dates = get_holiday_dates(start_date, end_date)
-
-    # appending company/holiday leaves
-    # Note: Duplicate entry may exist
-    company_leave_dates = (
-        list(
-            set(
-                get_company_leave_dates(start_date.year)
-                + get_company_leave_dates(end_date.year)
-            )
-        )
-        + holiday_dates
-    )
-
+    # company/holiday leave dates between the start and end date
+    company_id = get_employee_company_id(employee)
+    non_working_dates = set(
+        holiday_dates_between(start_date, end_date, company_id)
+    ) | set(company_leave_dates_between(start_date, end_date, company_id))
     date_range = get_date_range(start_date, end_date)
-
-    # making unique list of company/holiday leave dates then filtering
-    # the leave dates only between the start and end date
-    company_leave_dates = [
-        date
-        for date in list(set(company_leave_dates))
-        if start_date <= date <= end_date
+    company_leave_dates = [date for date in date_range if date in non_working_dates]
+    working_days_between_ranges = [
+        date for date in date_range if date not in non_working_dates
     ]
-
-    working_days_between_ranges = list(set(date_range) - set(company_leave_dates))
     total_working_days = len(working_days_between_ranges)
 
     return {
@@ -169,7 +118,7 @@ def get_working_days(start_date, end_date):
     }
 
 
-def get_leaves(employee, start_date, end_date):
+def get_leaves(employee, start_date, end_date, context=None):
     """
     This method is used to return all the leaves taken by the employee
     between the period.
@@ -178,17 +127,21 @@ def get_leaves(employee, start_date, end_date):
         employee (obj): Employee model instance
         start_date (obj): the start date from the data needed
         end_date (obj): the end date till the date needed
+        context (obj): optional PayrollPeriodContext with the preloaded leaves
     """
-    approved_leaves = employee.leaverequest_set.filter(status="approved")
+    context = get_period_context(employee, start_date, end_date, context)
+    approved_leaves = context.approved_leaves(employee)
     paid_leave = 0
     unpaid_leave = 0
     paid_half = 0
     unpaid_half = 0
     paid_leave_dates = []
     unpaid_leave_dates = []
-    company_leave_dates = get_working_days(start_date, end_date)["company_leave_dates"]
+    company_leave_dates = get_working_days(start_date, end_date, context, employee)[
+        "company_leave_dates"
+    ]
 
-    if approved_leaves.exists():
+    if approved_leaves:
         for instance in approved_leaves:
             if instance.leave_type_id.payment == "paid":
                 # if the taken leave is paid
@@ -231,7 +184,7 @@ def get_leaves(employee, start_date, end_date):
     }
 
 
-def get_attendance(employee, start_date, end_date):
+def get_attendance(employee, start_date, end_date, context=None):
     """
     This method is used to render attendance details between the range
 
@@ -239,32 +192,23 @@ def get_attendance(employee, start_date, end_date):
         employee (obj): Employee user instance
         start_date (obj): start date of the period
         end_date (obj): end date of the period
+        context (obj): optional PayrollPeriodContext with the preloaded attendances
     """
 
-    attendances_on_period = Attendance.objects.filter(
-        employee_id=employee,
-        attendance_date__range=(start_date, end_date),
-        attendance_validated=True,
+    context = get_period_context(employee, start_date, end_date, context)
+    attendances_on_period = context.employee_attendances(
+        employee, start_date, end_date, attendance_validated=True
     )
     present_on = [attendance.attendance_date for attendance in attendances_on_period]
-    working_days_between_range = get_working_days(start_date, end_date)[
-        "working_days_on"
-    ]
-    leave_dates = get_leaves(employee, start_date, end_date)["leave_dates"]
+    working_days_between_range = get_working_days(
+        start_date, end_date, context, employee
+    )["working_days_on"]
+    leave_dates = get_leaves(employee, start_date, end_date, context)["leave_dates"]
     conflict_dates = list(
         set(working_days_between_range) - set(attendances_on_period) - set(leave_dates)
     )
     conflict_dates = conflict_dates + [
-        date
-        for date in present_on
-        if date in get_holiday_dates(start_date, end_date)
-        or date
-        in list(
-            set(
-                get_company_leave_dates(start_date.year)
-                + get_company_leave_dates(end_date.year)
-            )
-        )
+        date for date in present_on if date in context.non_working_dates(employee)
     ]
 
     return {
@@ -274,7 +218,7 @@ def get_attendance(employee, start_date, end_date):
     }
 
 
-def hourly_computation(employee, wage, start_date, end_date):
+def hourly_computation(employee, wage, start_date, end_date, context=None):
     """
     Hourly salary computation for period.
 
@@ -283,8 +227,9 @@ def hourly_computation(employee, wage, start_date, end_date):
         wage (float): wage of the employee
         start_date (obj): start of the pay period
         end_date (obj): end date of the period
+        context (obj): optional PayrollPeriodContext
     """
-    attendance_data = get_attendance(employee, start_date, end_date)
+    attendance_data = get_attendance(employee, start_date, end_date, context)
     attendances_on_period = attendance_data["attendances_on_period"]
     total_worked_hour_in_second = 0
     for attendance in attendances_on_period:
@@ -300,6 +245,8 @@ def hourly_computation(employee, wage, start_date, end_date):
     return {
         "basic_pay": basic_pay,
         "loss_of_pay": 0,
+        "paid_days": len(attendance_data["present_on"]),
+        "unpaid_days": 0,
     }
 
 
@@ -330,7 +277,55 @@ def find_half_day_leaves():
     }
 
 
-def daily_computation(employee, wage, start_date, end_date):
+def get_unpaid_half_leaves(employee, start_date, end_date, context=None):
+    """
+    This method is used to return the unpaid half day leaves starting or ending
+    on the period
+
+    Args:
+        employee (obj): Employee instance
+        start_date (obj): start of the pay period
+        end_date (obj): end date of the period
+        context (obj): optional PayrollPeriodContext with the preloaded leaves
+    """
+    context = get_period_context(employee, start_date, end_date, context)
+    leaves = [
+        leave
+        for leave in context.approved_leaves(employee)
+        if leave.leave_type_id.payment == "unpaid"
+    ]
+    half_day_leaves_between_period_on_start_date = sum(
+        1
+        for leave in leaves
+        if start_date <= leave.start_date <= end_date
+        and leave.start_date_breakdown != "full_day"
+    )
+    half_day_leaves_between_period_on_end_date = sum(
+        1
+        for leave in leaves
+        if leave.end_date is not None
+        and start_date <= leave.end_date <= end_date
+        and leave.end_date_breakdown != "full_day"
+        and leave.start_date != leave.end_date
+    )
+    return (
+        half_day_leaves_between_period_on_start_date
+        + half_day_leaves_between_period_on_end_date
+    ) * 0.5
+
+
+def get_active_contract(employee, context=None):
+    """
+    This method is used to return the active contract of the employee
+    """
+    if context is not None:
+        return context.contract(employee)
+    return employee.contract_set.filter(
+        is_active=True, contract_status="active"
+    ).first()
+
+
+def daily_computation(employee, wage, start_date, end_date, context=None):
     """
     Hourly salary computation for period.
 
@@ -339,43 +334,19 @@ def daily_computation(employee, wage, start_date, end_date):
         wage (float): wage of the employee
         start_date (obj): start of the pay period
         end_date (obj): end date of the period
+        context (obj): optional PayrollPeriodContext
     """
-    working_day_data = get_working_days(start_date, end_date)
+    working_day_data = get_working_days(start_date, end_date, context, employee)
     total_working_days = working_day_data["total_working_days"]
 
-    leave_data = get_leaves(employee, start_date, end_date)
+    leave_data = get_leaves(employee, start_date, end_date, context)
 
-    contract = employee.contract_set.filter(contract_status="active").first()
     basic_pay = wage * total_working_days
     loss_of_pay = 0
 
-    date_range = get_date_range(start_date, end_date)
-    half_day_leaves_between_period_on_start_date = (
-        employee.leaverequest_set.filter(
-            leave_type_id__payment="unpaid",
-            start_date__in=date_range,
-            status="approved",
-        )
-        .exclude(start_date_breakdown="full_day")
-        .count()
-    )
-
-    half_day_leaves_between_period_on_end_date = (
-        employee.leaverequest_set.filter(
-            leave_type_id__payment="unpaid", end_date__in=date_range, status="approved"
-        )
-        .exclude(end_date_breakdown="full_day")
-        .exclude(start_date=F("end_date"))
-        .count()
-    )
-    unpaid_half_leaves = (
-        half_day_leaves_between_period_on_start_date
-        + half_day_leaves_between_period_on_end_date
-    ) * 0.5
+    unpaid_half_leaves = get_unpaid_half_leaves(employee, start_date, end_date, context)
 
-    contract = employee.contract_set.filter(
-        is_active=True, contract_status="active"
-    ).first()
+    contract = get_active_contract(employee, context)
 
     unpaid_leaves = leave_data["unpaid_leaves"] - unpaid_half_leaves
     if contract.calculate_daily_leave_amount:
@@ -389,17 +360,21 @@ def daily_computation(employee, wage, start_date, end_date):
     return {
         "basic_pay": basic_pay,
         "loss_of_pay": loss_of_pay,
+        "paid_days": total_working_days - unpaid_leaves,
+        "unpaid_days": unpaid_leaves,
     }
 
 
-def get_daily_salary(wage, wage_date) -> dict:
+def get_daily_salary(wage, wage_date, context=None, employee=None) -> dict:
     """
     This method is used to calculate daily salary for the date
     """
     last_day = calendar.monthrange(wage_date.year, wage_date.month)[1]
     end_date = date(wage_date.year, wage_date.month, last_day)
     start_date = date(wage_date.year, wage_date.month, 1)
-    working_days = get_working_days(start_date, end_date)["total_working_days"]
+    working_days = get_working_days(start_date, end_date, context, employee)[
+        "total_working_days"
+    ]
     day_wage = wage / working_days  # if working_days != 0 else 0
 
     return {
@@ -407,7 +382,7 @@ def get_daily_salary(wage, wage_date) -> dict:
     }
 
 
-def months_between_range(wage, start_date, end_date):
+def months_between_range(wage, start_date, end_date, context=None, employee=None):
     """
     This method is used to find the months between range
     """
@@ -433,7 +408,10 @@ def months_between_range(wage, start_date, end_date):
         current_end_date = current_date + relativedelta(day=days_in_month)
         current_end_date = min(current_end_date, end_date)
         working_days_on_month = get_working_days(
-            current_date.replace(day=1), current_date.replace(day=days_in_month)
+            current_date.replace(day=1),
+            current_date.replace(day=days_in_month),
+            context,
+            employee,
         )["total_working_days"]
 
         month_start_date = (
@@ -442,7 +420,7 @@ def months_between_range(wage, start_date, end_date):
             else start_date
         )
         total_working_days_on_period = get_working_days(
-            month_start_date, current_end_date
+            month_start_date, current_end_date, context, employee
         )["total_working_days"]
 
         month_info = {
@@ -465,7 +443,7 @@ def months_between_range(wage, start_date, end_date):
     return months_data
 
 
-def monthly_computation(employee, wage, start_date, end_date):
+def monthly_computation(employee, wage, start_date, end_date, context=None):
     """
     Hourly salary computation for period.
 
@@ -474,51 +452,29 @@ def monthly_computation(employee, wage, start_date, end_date):
         wage (float): wage of the employee
         start_date (obj): start of the pay period
         end_date (obj): end date of the period
+        context (obj): optional PayrollPeriodContext
     """
     basic_pay = 0
-    month_data = months_between_range(wage, start_date, end_date)
+    month_data = months_between_range(
+        wage, start_date, end_date, context, employee
+    )
 
-    leave_data = get_leaves(employee, start_date, end_date)
+    leave_data = get_leaves(employee, start_date, end_date, context)
 
     for data in month_data:
         basic_pay = basic_pay + (
             data["working_days_on_period"] * data["per_day_amount"]
         )
 
-    contract = employee.contract_set.filter(contract_status="active").first()
     loss_of_pay = 0
-    date_range = get_date_range(start_date, end_date)
-    half_day_leaves_between_period_on_start_date = (
-        employee.leaverequest_set.filter(
-            leave_type_id__payment="unpaid",
-            start_date__in=date_range,
-            status="approved",
-        )
-        .exclude(start_date_breakdown="full_day")
-        .count()
-    )
-
-    half_day_leaves_between_period_on_end_date = (
-        employee.leaverequest_set.filter(
-            leave_type_id__payment="unpaid", end_date__in=date_range, status="approved"
-        )
-        .exclude(end_date_breakdown="full_day")
-        .exclude(start_date=F("end_date"))
-        .count()
-    )
-    unpaid_half_leaves = (
-        half_day_leaves_between_period_on_start_date
-        + half_day_leaves_between_period_on_end_date
-    ) * 0.5
+    unpaid_half_leaves = get_unpaid_half_leaves(employee, start_date, end_date, context)
 
-    contract = employee.contract_set.filter(
-        is_active=True, contract_status="active"
-    ).first()
+    contract = get_active_contract(employee, context)
     unpaid_leaves = abs(leave_data["unpaid_leaves"] - unpaid_half_leaves)
     paid_days = month_data[0]["working_days_on_period"] - unpaid_leaves
-    daily_computed_salary = get_daily_salary(wage=wage, wage_date=start_date)[
-        "day_wage"
-    ]
+    daily_computed_salary = get_daily_salary(
+        wage=wage, wage_date=start_date, context=context, employee=employee
+    )["day_wage"]
     if contract.calculate_daily_leave_amount:
         loss_of_pay = (unpaid_leaves) * daily_computed_salary
     else:
@@ -536,7 +492,7 @@ def monthly_computation(employee, wage, start_date, end_date):
     }
 
 
-def compute_salary_on_period(employee, start_date, end_date, wage=None):
+def compute_salary_on_period(employee, start_date, end_date, wage=None, context=None):
     """
     This method is used to compute salary on the start to end date period
 
@@ -544,10 +500,10 @@ def compute_salary_on_period(employee, start_date, end_date, wage=None):
         employee (obj): Employee instance
         start_date (obj): start date of the period
         end_date (obj): end date of the period
+        context (obj): optional PayrollPeriodContext
     """
-    contract = Contract.objects.filter(
-        employee_id=employee, contract_status="active"
-    ).first()
+    context = get_period_context(employee, start_date, end_date, context)
+    contract = context.contract(employee)
     if contract is None:
         return contract
 
@@ -555,16 +511,20 @@ def compute_salary_on_period(employee, start_date, end_date, wage=None):
     wage_type = contract.wage_type
     data = None
     if wage_type == "hourly":
-        data = hourly_computation(employee, wage, start_date, end_date)
-        month_data = months_between_range(wage, start_date, end_date)
+        data = hourly_computation(employee, wage, start_date, end_date, context)
+        month_data = months_between_range(
+            wage, start_date, end_date, context, employee
+        )
         data["month_data"] = month_data
     elif wage_type == "daily":
-        data = daily_computation(employee, wage, start_date, end_date)
-        month_data = months_between_range(wage, start_date, end_date)
+        data = daily_computation(employee, wage, start_date, end_date, context)
+        month_data = months_between_range(
+            wage, start_date, end_date, context, employee
+        )
         data["month_data"] = month_data
 
     else:
-        data = monthly_computation(employee, wage, start_date, end_date)
+        data = monthly_computation(employee, wage, start_date, end_date, context)
     data["contract_wage"] = wage
     data["contract"] = contract
     return data
@@ -579,7 +539,7 @@ def paginator_qry(qryset, page_number):
     return qryset
 
 
-def calculate_employer_contribution(data):
+def calculate_employer_contribution(data, context=None):
     """
     This method is used to calculate the employer contribution
     """
@@ -598,9 +558,14 @@ def calculate_employer_contribution(data):
                     deduction.get("deduction_id")
                     and deduction.get("employer_contribution_rate", 0) > 0
                 ):
-                    object = Deduction.objects.filter(
-                        id=deduction.get("deduction_id")
-                    ).first()
+                    if context is not None:
+                        object = context.deduction_by_id.get(
+                            deduction.get("deduction_id")
+                        )
+                    else:
+                        object = Deduction.objects.filter(
+                            id=deduction.get("deduction_id")
+                        ).first()
                     if object:
                         amount = pay_head_data.get(object.based_on)
                         employer_contribution_amount = (
@@ -636,4 +601,5 @@ def save_payslip(**kwargs):
     instance.pay_head_data = kwargs["pay_data"]
     instance.save()
     instance.installment_ids.set(kwargs["installments"])
+    write_line_items([instance])
     return instance
@@ -5,10 +5,7 @@ pre-tax deductions, and post-tax deductions.
 
 """
 
-import operator
 import contextlib
-from attendance.models import Attendance
-from payroll.models import models
 from payroll.models.models import (
     Contract,
     Allowance,
@@ -16,55 +13,30 @@ from payroll.models.models import (
     LoanAccount,
     MultipleCondition,
 )
+from payroll.methods.conditions import component_applies, operator_mapping
 from payroll.methods.limits import compute_limit
 
-operator_mapping = {
-    "equal": operator.eq,
-    "notequal": operator.ne,
-    "lt": operator.lt,
-    "gt": operator.gt,
-    "le": operator.le,
-    "ge": operator.ge,
-    "icontains": operator.contains,
-}
-filter_mapping = {
-    "work_type_id": {
-        "filter": lambda employee, allowance, start_date, end_date: {
-            "employee_id": employee,
-            "work_type_id__id": allowance.work_type_id.id,
-            "attendance_date__range": (start_date, end_date),
-            "attendance_validated": True,
-        }
+# Attendance conditions of the attendance based allowances, on the attributes
+# of the preloaded attendances
+attendance_attr_mapping = {
+    "work_type_id": lambda allowance: {
+        "work_type_id_id": allowance.work_type_id_id,
+        "attendance_validated": True,
     },
-    "shift_id": {
-        "filter": lambda employee, allowance, start_date, end_date: {
-            "employee_id": employee,
-            "shift_id__id": allowance.shift_id.id,
-            "attendance_date__range": (start_date, end_date),
-            "attendance_validated": True,
-        }
+    "shift_id": lambda allowance: {
+        "shift_id_id": allowance.shift_id_id,
+        "attendance_validated": True,
     },
-    "overtime": {
-        "filter": lambda employee, allowance, start_date, end_date: {
-            "employee_id": employee,
-            "attendance_date__range": (start_date, end_date),
-            "attendance_overtime_approve": True,
-            "attendance_validated": True,
-        }
+    "overtime": lambda allowance: {
+        "attendance_overtime_approve": True,
+        "attendance_validated": True,
     },
-    "attendance": {
-        "filter": lambda employee, allowance, start_date, end_date: {
-            "employee_id": employee,
-            "attendance_date__range": (start_date, end_date),
-            "attendance_validated": True,
-        }
+    "attendance": lambda allowance: {
+        "attendance_validated": True,
     },
 }
 
 
-
-
-
 tets = {
     "net_pay": 35140.905000000006,
     "employee": 1,
@@ -264,19 +236,8 @@ def calculate_allowance(**kwargs):
     end_date = kwargs["end_date"]
     basic_pay = kwargs["basic_pay"]
     day_dict = kwargs["day_dict"]
-    specific_allowances = Allowance.objects.filter(specific_employees=employee)
-    conditional_allowances = Allowance.objects.filter(is_condition_based=True).exclude(
-        exclude_employees=employee
-    )
-    active_employees = Allowance.objects.filter(include_active_employees=True).exclude(
-        exclude_employees=employee
-    )
-
-    allowances = specific_allowances | conditional_allowances | active_employees
-
-    allowances = allowances.exclude(one_time_date__lt=start_date).exclude(
-        one_time_date__gt=end_date
-    )
+    context = kwargs["context"]
+    allowances = context.employee_allowances(employee, start_date, end_date)
 
     employee_allowances = []
     tax_allowances = []
@@ -286,36 +247,17 @@ def calculate_allowance(**kwargs):
     # Append allowances based on condition, or unconditionally to employee
     for allowance in allowances:
         if allowance.is_condition_based:
-            conditions = list(
-                allowance.other_conditions.values_list("field", "condition", "value")
-            )
-            condition_field = allowance.field
-            condition_operator = allowance.condition
-            condition_value = allowance.value.lower().replace(" ", "_")
-            conditions.append((condition_field, condition_operator, condition_value))
-            applicable = True
-            for condition in conditions:
-                val = dynamic_attr(employee, condition[0])
-                if val is not None:
-                    operator_func = operator_mapping.get(condition[1])
-                    condition_value = type(val)(condition[2])
-                    if operator_func(val, condition_value):
-                        applicable = applicable * True
-                        continue
-                    else:
-                        applicable = False
-                        break
-                else:
-                    applicable = False
-                    break
-            if applicable:
+            if component_applies(allowance, employee, context):
                 employee_allowances.append(allowance)
         else:
-            if allowance.based_on in filter_mapping:
-                filter_params = filter_mapping[allowance.based_on]["filter"](
-                    employee, allowance, start_date, end_date
+            if allowance.based_on in attendance_attr_mapping:
+                has_attendance = context.employee_attendances(
+                    employee,
+                    start_date,
+                    end_date,
+                    **attendance_attr_mapping[allowance.based_on](allowance),
                 )
-                if Attendance.objects.filter(**filter_params):
+                if has_attendance:
                     employee_allowances.append(allowance)
             else:
                 employee_allowances.append(allowance)
@@ -346,6 +288,7 @@ def calculate_allowance(**kwargs):
                     "total_allowance": None,
                     "basic_pay": basic_pay,
                     "day_dict": day_dict,
+                    "context": context,
                 },
             )
             kwargs["amount"] = amount
@@ -371,6 +314,7 @@ def calculate_allowance(**kwargs):
                     "component": allowance,
                     "day_dict": day_dict,
                     "basic_pay": basic_pay,
+                    "context": context,
                 }
             )
             kwargs["amount"] = amount
@@ -420,17 +364,14 @@ def calculate_tax_deduction(*_args, **kwargs):
     employee = kwargs["employee"]
     start_date = kwargs["start_date"]
     end_date = kwargs["end_date"]
-    specific_deductions = models.Deduction.objects.filter(
-        specific_employees=employee, is_pretax=False, is_tax=True
-    )
-    active_employee_deduction = models.Deduction.objects.filter(
-        include_active_employees=True, is_pretax=False, is_tax=True
-    ).exclude(exclude_employees=employee)
-    deductions = specific_deductions | active_employee_deduction
-    deductions = (
-        deductions.exclude(one_time_date__lt=start_date)
-        .exclude(one_time_date__gt=end_date)
-        .exclude(update_compensation__isnull=False)
+    context = kwargs["context"]
+    deductions = context.employee_deductions(
+        employee,
+        start_date,
+        end_date,
+        conditional=False,
+        is_pretax=False,
+        is_tax=True,
     )
     deductions_amt = []
     serialized_deductions = []
@@ -446,6 +387,7 @@ def calculate_tax_deduction(*_args, **kwargs):
                 "total_allowance": kwargs["total_allowance"],
                 "basic_pay": kwargs["basic_pay"],
                 "day_dict": kwargs["day_dict"],
+                "context": context,
             }
         )
         kwargs["amount"] = amount
@@ -481,25 +423,13 @@ def calculate_pre_tax_deduction(*_args, **kwargs):
     employee = kwargs["employee"]
     start_date = kwargs["start_date"]
     end_date = kwargs["end_date"]
+    context = kwargs["context"]
 
-    specific_deductions = models.Deduction.objects.filter(
-        specific_employees=employee, is_pretax=True, is_tax=False
-    )
-    conditional_deduction = models.Deduction.objects.filter(
-        is_condition_based=True, is_pretax=True, is_tax=False
-    ).exclude(exclude_employees=employee)
-    active_employee_deduction = models.Deduction.objects.filter(
-        include_active_employees=True, is_pretax=True, is_tax=False
-    ).exclude(exclude_employees=employee)
-
-    deductions = specific_deductions | conditional_deduction | active_employee_deduction
-    deductions = (
-        deductions.exclude(one_time_date__lt=start_date)
-        .exclude(one_time_date__gt=end_date)
-        .exclude(update_compensation__isnull=False)
+    deductions = context.employee_deductions(
+        employee, start_date, end_date, is_pretax=True, is_tax=False
     )
     # Installment deductions
-    installments = deductions.filter(is_installment=True)
+    installments = [deduction for deduction in deductions if deduction.is_installment]
 
     pre_tax_deductions = []
     pre_tax_deductions_amt = []
@@ -507,30 +437,7 @@ def calculate_pre_tax_deduction(*_args, **kwargs):
 
     for deduction in deductions:
         if deduction.is_condition_based:
-            conditions = list(
-                deduction.other_conditions.values_list("field", "condition", "value")
-            )
-            condition_field = deduction.field
-            condition_operator = deduction.condition
-            condition_value = deduction.value.lower().replace(" ", "_")
-            conditions.append((condition_field, condition_operator, condition_value))
-            operator_func = operator_mapping.get(condition_operator)
-            applicable = True
-            for condition in conditions:
-                val = dynamic_attr(employee, condition[0])
-                if val is not None:
-                    operator_func = operator_mapping.get(condition[1])
-                    condition_value = type(val)(condition[2])
-                    if operator_func(val, condition_value):
-                        applicable = applicable * True
-                        continue
-                    else:
-                        applicable = False
-                        break
-                else:
-                    applicable = False
-                    break
-            if applicable:
+            if component_applies(deduction, employee, context):
                 pre_tax_deductions.append(deduction)
         else:
             pre_tax_deductions.append(deduction)
@@ -552,6 +459,7 @@ def calculate_pre_tax_deduction(*_args, **kwargs):
                     "total_allowance": kwargs["total_allowance"],
                     "basic_pay": kwargs["basic_pay"],
                     "day_dict": kwargs["day_dict"],
+                    "context": context,
                 }
             )
             kwargs["amount"] = amount
@@ -590,23 +498,12 @@ def calculate_post_tax_deduction(*_args, **kwargs):
     total_allowance = kwargs["total_allowance"]
     basic_pay = kwargs["basic_pay"]
     day_dict = kwargs["day_dict"]
-    specific_deductions = models.Deduction.objects.filter(
-        specific_employees=employee, is_pretax=False, is_tax=False
-    )
-    conditional_deduction = models.Deduction.objects.filter(
-        is_condition_based=True, is_pretax=False, is_tax=False
-    ).exclude(exclude_employees=employee)
-    active_employee_deduction = models.Deduction.objects.filter(
-        include_active_employees=True, is_pretax=False, is_tax=False
-    ).exclude(exclude_employees=employee)
-    deductions = specific_deductions | conditional_deduction | active_employee_deduction
-    deductions = (
-        deductions.exclude(one_time_date__lt=start_date)
-        .exclude(one_time_date__gt=end_date)
-        .exclude(update_compensation__isnull=False)
+    context = kwargs["context"]
+    deductions = context.employee_deductions(
+        employee, start_date, end_date, is_pretax=False, is_tax=False
     )
     # Installment deductions
-    installments = deductions.filter(is_installment=True)
+    installments = [deduction for deduction in deductions if deduction.is_installment]
 
     post_tax_deductions = []
     post_tax_deductions_amt = []
@@ -615,15 +512,8 @@ def calculate_post_tax_deduction(*_args, **kwargs):
 
     for deduction in deductions:
         if deduction.is_condition_based:
-            condition_field = deduction.field
-            condition_operator = deduction.condition
-            condition_value = deduction.value.lower().replace(" ", "_")
-            employee_value = dynamic_attr(employee, condition_field)
-            operator_func = operator_mapping.get(condition_operator)
-            if employee_value is not None:
-                condition_value = type(employee_value)(condition_value)
-                if operator_func(employee_value, condition_value):
-                    post_tax_deductions.append(deduction)
+            if component_applies(deduction, employee, context):
+                post_tax_deductions.append(deduction)
         else:
             post_tax_deductions.append(deduction)
     for deduction in post_tax_deductions:
@@ -646,6 +536,7 @@ def calculate_post_tax_deduction(*_args, **kwargs):
                         "total_allowance": total_allowance,
                         "basic_pay": basic_pay,
                         "day_dict": day_dict,
+                        "context": context,
                     }
                 )
                 kwargs["amount"] = amount
@@ -855,12 +746,13 @@ def calculate_based_on_attendance(*_args, **kwargs):
     end_date = kwargs["end_date"]
     component = kwargs["component"]
     day_dict = kwargs["day_dict"]
+    context = kwargs["context"]
 
-    count = Attendance.objects.filter(
-        employee_id=employee,
-        attendance_date__range=(start_date, end_date),
-        attendance_validated=True,
-    ).count()
+    count = len(
+        context.employee_attendances(
+            employee, start_date, end_date, attendance_validated=True
+        )
+    )
     amount = count * component.per_attendance_fixed_amount
 
     amount = compute_limit(component, amount, day_dict)
@@ -888,13 +780,17 @@ def calculate_based_on_shift(*_args, **kwargs):
     component = kwargs["component"]
     day_dict = kwargs["day_dict"]
 
-    shift_id = component.shift_id.id
-    count = Attendance.objects.filter(
-        employee_id=employee,
-        shift_id=shift_id,
-        attendance_date__range=(start_date, end_date),
-        attendance_validated=True,
-    ).count()
+    context = kwargs["context"]
+
+    count = len(
+        context.employee_attendances(
+            employee,
+            start_date,
+            end_date,
+            shift_id_id=component.shift_id_id,
+            attendance_validated=True,
+        )
+    )
     amount = count * component.shift_per_attendance_amount
 
     amount = compute_limit(component, amount, day_dict)
@@ -922,10 +818,10 @@ def calculate_based_on_overtime(*_args, **kwargs):
     component = kwargs["component"]
     day_dict = kwargs["day_dict"]
 
-    attendances = Attendance.objects.filter(
-        employee_id=employee,
-        attendance_date__range=(start_date, end_date),
-        attendance_overtime_approve=True,
+    context = kwargs["context"]
+
+    attendances = context.employee_attendances(
+        employee, start_date, end_date, attendance_overtime_approve=True
     )
     overtime = sum(attendance.overtime_second for attendance in attendances)
     amount_per_hour = component.amount_per_one_hr
@@ -960,13 +856,17 @@ def calculate_based_on_work_type(*_args, **kwargs):
     component = kwargs["component"]
     day_dict = kwargs["day_dict"]
 
-    work_type_id = component.work_type_id.id
-    count = Attendance.objects.filter(
-        employee_id=employee,
-        work_type_id=work_type_id,
-        attendance_date__range=(start_date, end_date),
-        attendance_validated=True,
-    ).count()
+    context = kwargs["context"]
+
+    count = len(
+        context.employee_attendances(
+            employee,
+            start_date,
+            end_date,
+            work_type_id_id=component.work_type_id_id,
+            attendance_validated=True,
+        )
+    )
     amount = count * component.work_type_per_attendance_amount
 
     amount = compute_limit(component, amount, day_dict)
@@ -0,0 +1,240 @@
+"""
+payslip_jobs.py
+
+This module is used to run the bulk payslip generation outside the request.
+A PayslipBatchJob is split in employee chunks that are handed over to a
+worker pool, every chunk updates the progress counters of the job.
+
+The chunks not processed yet are kept on the job, so the chunks of a job
+left queued or running by a restart or a dead worker are queued again by
+resume_payslip_jobs. A chunk run twice only saves its payslips again.
+
+The pool is a process pool by default, set PAYSLIP_JOB_EXECUTOR = "local" in
+the settings to run the chunks in the calling thread (tests, development).
+The workers of the pool clear their cache before every chunk when the cache
+is local to the process, the invalidations of the holidays, the company
+leaves and the tax brackets done by the web process don't reach it.
+"""
+
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.utils import timezone
+from employee.models import Employee
+from horilla.horilla_scheduler import setup_worker
+from notifications.models import bulk_notify
+from payroll.methods.engine import generate_payslip_batch
+from payroll.models.models import PayslipBatchJob
+
+logger = logging.getLogger(__name__)
+
+PAYSLIP_JOB_CHUNK_SIZE = 50
+PAYSLIP_JOB_STALE_SECONDS = 60 * 30
+
+_executor = None
+_in_worker = False
+# the futures of the chunks running, kept until they are done
+_futures = set()
+
+
+class LocalExecutor:
+    """
+    Stand-in for the process pool, the submitted call runs immediately in
+    the calling thread
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run the call and return its completed future
+        """
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def _init_worker():
+    global _in_worker
+    setup_worker()
+    _in_worker = True
+
+
+def get_executor():
+    """
+    This method is used to get the worker pool of the payslip jobs
+    """
+    global _executor
+    if _executor is None:
+        if getattr(settings, "PAYSLIP_JOB_EXECUTOR", "process") == "local":
+            _executor = LocalExecutor()
+        else:
+            # spawned workers don't share the database connections of the
+            # web process, django is set up before the first chunk is read,
+            # without starting the schedulers of the apps again
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, "PAYSLIP_JOB_WORKERS", None),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+    return _executor
+
+
+def _chunk_done(future):
+    """
+    Log the error of a chunk raised outside its own error handling
+    """
+    _futures.discard(future)
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Payslip job chunk failed", exc_info=future.exception())
+
+
+def queue_payslip_chunks(job_id, chunks):
+    """
+    This method is used to hand the employee chunks of a job over to the
+    worker pool
+
+    Returns:
+        list: the futures of the chunks
+    """
+    executor = get_executor()
+    futures = []
+    for chunk in chunks:
+        future = executor.submit(run_payslip_job_chunk, job_id, chunk)
+        _futures.add(future)
+        future.add_done_callback(_chunk_done)
+        futures.append(future)
+    return futures
+
+
+def submit_payslip_job(job):
+    """
+    This method is used to split the job in employee chunks, kept on the
+    job, and queue them once the job is committed
+
+    Args:
+        job (PayslipBatchJob): the saved job
+    """
+    employee_ids = list(job.employee_ids)
+    chunk_size = getattr(settings, "PAYSLIP_JOB_CHUNK_SIZE", PAYSLIP_JOB_CHUNK_SIZE)
+    job.pending_chunks = [
+        employee_ids[index : index + chunk_size]
+        for index in range(0, len(employee_ids), chunk_size)
+    ]
+    if not job.pending_chunks:
+        job.status = "completed"
+    job.save()
+    chunks = list(job.pending_chunks)
+    transaction.on_commit(lambda: queue_payslip_chunks(job.id, chunks))
+
+
+def resume_payslip_jobs(stale_seconds=None):
+    """
+    This method is used to queue again the pending chunks of the jobs whose
+    progress stopped for stale_seconds, after a restart or a dead worker
+
+    Returns:
+        list: the resumed jobs
+    """
+    stale_seconds = stale_seconds or getattr(
+        settings, "PAYSLIP_JOB_STALE_SECONDS", PAYSLIP_JOB_STALE_SECONDS
+    )
+    resumed = []
+    for job in PayslipBatchJob.objects.filter(
+        status__in=["queued", "running"],
+        updated_at__lt=timezone.now() - timedelta(seconds=stale_seconds),
+    ):
+        if not job.pending_chunks:
+            continue
+        # not stale again before the queued chunks had their time
+        PayslipBatchJob.objects.filter(id=job.id).update(updated_at=timezone.now())
+        queue_payslip_chunks(job.id, job.pending_chunks)
+        resumed.append(job)
+    return resumed
+
+
+def _clear_worker_cache():
+    """
+    Clear the cache of a pool worker when it is local to its process
+    """
+    if _in_worker and isinstance(caches["default"], LocMemCache):
+        caches["default"].clear()
+
+
+def run_payslip_job_chunk(job_id, employee_ids):
+    """
+    This method is used to generate the payslips of a chunk of employees of
+    the job. An employee whose payslip fails is recorded on the job and the
+    rest of the chunk is still saved.
+
+    Args:
+        job_id (int): PayslipBatchJob id
+        employee_ids (list): ids of the employees in the chunk
+    """
+    _clear_worker_cache()
+    job = PayslipBatchJob.objects.select_related("created_by").get(id=job_id)
+    PayslipBatchJob.objects.filter(id=job_id, status="queued").update(
+        status="running", updated_at=timezone.now()
+    )
+    errors = {}
+    instances = []
+    try:
+        instances = generate_payslip_batch(
+            Employee.objects.filter(id__in=employee_ids),
+            job.start_date,
+            job.end_date,
+            job.group_name,
+            created_by=job.created_by,
+            errors=errors,
+        )
+    except Exception as error:
+        logger.exception("Payslip job %s failed on chunk %s", job_id, employee_ids)
+        instances = []
+        errors = {
+            employee_id: str(error) or error.__class__.__name__
+            for employee_id in employee_ids
+        }
+    processed = {instance.employee_id_id for instance in instances}
+    for employee_id in employee_ids:
+        if employee_id not in processed and employee_id not in errors:
+            errors[employee_id] = "Employee not found"
+
+    with transaction.atomic():
+        job = PayslipBatchJob.objects.select_for_update().get(id=job_id)
+        if employee_ids not in job.pending_chunks:
+            # counted by an earlier run of the chunk
+            return job.progress()
+        job.pending_chunks.remove(employee_ids)
+        job.done_count += len(instances)
+        job.failed_count += len(errors)
+        job.errors.update(
+            {str(employee_id): message for employee_id, message in errors.items()}
+        )
+        job.status = "running" if job.pending_chunks else "completed"
+        job.save()
+
+    sender = getattr(job.created_by, "employee_get", None)
+    if instances and sender is not None:
+        bulk_notify(
+            sender,
+            [
+                {
+                    "recipient": instance.employee_id.employee_user_id,
+                    "redirect": f"/payroll/view-payslip/{instance.id}",
+                }
+                for instance in instances
+            ],
+            verb="Payslip has been generated for you.",
+            verb_ar="تم إصدار كشف راتب لك.",
+            verb_de="Gehaltsabrechnung wurde für Sie erstellt.",
+            verb_es="Se ha generado la nómina para usted.",
+            verb_fr="La fiche de paie a été générée pour vous.",
+            icon="close",
+        )
+    return job.progress()
@@ -0,0 +1,208 @@
+"""
+payslip_mail.py
+
+This module is used to mail the payslips to the employees. One mail
+connection is opened for the whole dispatch, the addresses of all the
+employees are resolved with one query, the PDFs are rendered in chunks and
+the delivery status of the payslips is written with bulk updates. The mails
+are sent one by one on the connection, so a connection error only resends
+the mails not sent yet.
+"""
+
+import logging
+import smtplib
+from collections import defaultdict
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.template.loader import render_to_string
+from employee.models import EmployeeWorkInformation
+from payroll.methods.payslip_pdf import render_payslip_pdfs
+from payroll.models.models import Payslip
+
+logger = logging.getLogger(__name__)
+
+PAYSLIP_MAIL_CHUNK_SIZE = 50
+PAYSLIP_MAIL_RETRIES = 2
+
+# errors after which the connection is opened again and the mail resent
+RETRY_ERRORS = (
+    smtplib.SMTPServerDisconnected,
+    smtplib.SMTPConnectError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class PayslipMailDispatcher:
+    """
+    Sends the payslips of many employees, every employee gets one mail with
+    the PDFs of all their payslips attached
+    """
+
+    def __init__(self, connection=None, host="", protocol="http"):
+        self.connection = connection or get_connection()
+        self.host = host
+        self.protocol = protocol
+        self.chunk_size = getattr(
+            settings, "PAYSLIP_MAIL_CHUNK_SIZE", PAYSLIP_MAIL_CHUNK_SIZE
+        )
+        self.retries = getattr(settings, "PAYSLIP_MAIL_RETRIES", PAYSLIP_MAIL_RETRIES)
+        self.from_email = getattr(
+            self.connection,
+            "dynamic_username_with_display_name",
+            settings.DEFAULT_FROM_EMAIL,
+        )
+
+    def _records(self, payslips):
+        """
+        Payslips grouped by employee, in the shape the mail template reads
+        """
+        records = defaultdict(
+            lambda: {"employee_id": None, "instances": [], "count": 0}
+        )
+        for payslip in payslips:
+            record = records[payslip.employee_id_id]
+            record["employee_id"] = payslip.employee_id
+            record["instances"].append(payslip)
+            record["count"] += 1
+        return records
+
+    def _message(self, record, recipients, pdf_paths):
+        """
+        Mail of an employee with the PDFs of the payslips attached
+        """
+        html_message = render_to_string(
+            "payroll/mail_templates/default.html",
+            {
+                "record": record,
+                "host": self.host,
+                "protocol": self.protocol,
+            },
+        )
+        email = EmailMessage(
+            f"Hello, {record['instances'][0].get_name()} Your Payslips is Ready!",
+            html_message,
+            self.from_email,
+            recipients,
+        )
+        for instance in record["instances"]:
+            with open(pdf_paths[instance.id], "rb") as file:
+                email.attach(
+                    f"{instance.get_payslip_title()}.pdf",
+                    file.read(),
+                    "application/pdf",
+                )
+        email.content_subtype = "html"
+        return email
+
+    def _send_chunk(self, messages):
+        """
+        Send the messages one by one on the open connection. After a
+        connection error the connection is opened again and the sending goes
+        on from the message that failed, the messages already sent are not
+        sent again.
+
+        Returns:
+            list: for every message, None when it was sent, the error otherwise
+        """
+        errors = [None] * len(messages)
+        index = 0
+        attempt = 0
+        while index < len(messages):
+            try:
+                if attempt:
+                    self.connection.close()
+                self.connection.open()
+                if not self.connection.send_messages([messages[index]]):
+                    errors[index] = "Mail server did not accept the mail"
+            except RETRY_ERRORS as retry_error:
+                attempt += 1
+                logger.warning("Payslip mail failed, attempt %s", attempt)
+                if attempt <= self.retries:
+                    continue
+                # the mail server stays unreachable, the rest is not sent
+                error = str(retry_error) or retry_error.__class__.__name__
+                errors[index:] = [error] * (len(messages) - index)
+                break
+            except Exception as send_error:
+                logger.exception(send_error)
+                errors[index] = str(send_error) or send_error.__class__.__name__
+            attempt = 0
+            index += 1
+        return errors
+
+    def dispatch(self, payslips):
+        """
+        This method is used to mail the payslips
+
+        Args:
+            payslips (QuerySet): Payslip queryset
+
+        Returns:
+            dict: {payslip id: None when sent, the error message otherwise}
+        """
+        payslips = payslips.select_related(
+            "employee_id", "employee_id__employee_work_info__company_id"
+        ).order_by("employee_id", "id")
+        records = self._records(payslips)
+        addresses = defaultdict(list)
+        for employee_id, email in EmployeeWorkInformation.objects.filter(
+            employee_id__in=list(records), email__isnull=False
+        ).values_list("employee_id", "email"):
+            if email:
+                addresses[employee_id].append(email)
+
+        status = {}
+        employee_ids = []
+        for employee_id, record in records.items():
+            if addresses[employee_id]:
+                employee_ids.append(employee_id)
+            else:
+                for instance in record["instances"]:
+                    status[instance.id] = "No email address"
+
+        try:
+            for index in range(0, len(employee_ids), self.chunk_size):
+                chunk = [
+                    records[employee_id]
+                    for employee_id in employee_ids[index : index + self.chunk_size]
+                ]
+                instances = [
+                    instance for record in chunk for instance in record["instances"]
+                ]
+                pdf_paths = dict(
+                    render_payslip_pdfs([instance.id for instance in instances])
+                )
+                messages = []
+                message_instances = []
+                for record in chunk:
+                    rendered = []
+                    for instance in record["instances"]:
+                        if pdf_paths.get(instance.id) is None:
+                            status[instance.id] = "PDF not rendered"
+                        else:
+                            rendered.append(instance)
+                    if not rendered:
+                        continue
+                    record = {**record, "instances": rendered, "count": len(rendered)}
+                    messages.append(
+                        self._message(
+                            record, addresses[record["employee_id"].id], pdf_paths
+                        )
+                    )
+                    message_instances.append(rendered)
+                for rendered, error in zip(
+                    message_instances, self._send_chunk(messages)
+                ):
+                    for instance in rendered:
+                        status[instance.id] = error
+        finally:
+            self.connection.close()
+
+        sent_ids = {payslip_id for payslip_id, error in status.items() if error is None}
+        Payslip.objects.filter(id__in=sent_ids).update(sent_to_employee=True)
+        # a failed resend keeps the record of the earlier delivery
+        Payslip.objects.filter(id__in=set(status) - sent_ids).exclude(
+            sent_to_employee=True
+        ).update(sent_to_employee=False)
+        return status
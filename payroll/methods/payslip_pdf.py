@@ -0,0 +1,311 @@
+"""
+payslip_pdf.py
+
+This module is used to render the payslip PDFs once per payslip revision.
+The rendered PDFs are stored on disk under PAYSLIP_PDF_ROOT
+(MEDIA_ROOT/payslip_pdfs by default) keyed by the payslip id and a hash of
+its pay head data, a payslip is rendered again only when that data changes.
+Many payslips are rendered at once in a process pool, set
+PAYSLIP_PDF_EXECUTOR = "local" in the settings to render them in the calling
+thread (tests, development).
+"""
+
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from base.methods import generate_pdf
+from employee.models import Employee
+from horilla.horilla_scheduler import setup_worker
+from payroll.methods.payslip_jobs import LocalExecutor
+from payroll.models.models import Payslip
+from payroll.models.tax_models import PayrollSettings
+
+logger = logging.getLogger(__name__)
+
+PDF_TEMPLATE = "payroll/payslip/individual_pdf.html"
+
+DEFAULT_DATE_FORMAT = "MMM. D, YYYY"
+
+date_formats = {
+    "DD-MM-YYYY": "%d-%m-%Y",
+    "DD.MM.YYYY": "%d.%m.%Y",
+    "DD/MM/YYYY": "%d/%m/%Y",
+    "MM/DD/YYYY": "%m/%d/%Y",
+    "YYYY-MM-DD": "%Y-%m-%d",
+    "YYYY/MM/DD": "%Y/%m/%d",
+    "MMMM D, YYYY": "%B %d, %Y",
+    "DD MMMM, YYYY": "%d %B, %Y",
+    "MMM. D, YYYY": "%b. %d, %Y",
+    "D MMM. YYYY": "%d %b. %Y",
+    "dddd, MMMM D, YYYY": "%A, %B %d, %Y",
+}
+
+ZIP_CHUNK_SIZE = 64 * 1024
+
+_executor = None
+
+
+def get_pdf_root():
+    """
+    Directory of the rendered payslip PDFs
+    """
+    return getattr(
+        settings,
+        "PAYSLIP_PDF_ROOT",
+        os.path.join(settings.MEDIA_ROOT, "payslip_pdfs"),
+    )
+
+
+def get_pdf_executor():
+    """
+    This method is used to get the worker pool rendering the payslip PDFs
+    """
+    global _executor
+    if _executor is None:
+        if getattr(settings, "PAYSLIP_PDF_EXECUTOR", "process") == "local":
+            _executor = LocalExecutor()
+        else:
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, "PAYSLIP_PDF_WORKERS", None),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=setup_worker,
+            )
+    return _executor
+
+
+def _render_settings(payslip):
+    """
+    The date format of the employee's company, the currency symbol and the
+    employee details printed on the PDF (name, badge id, department and bank
+    account number), the inputs of the PDF besides the pay head data
+    """
+    details = (
+        Employee._base_manager.filter(id=payslip.employee_id_id)
+        .values_list(
+            "employee_work_info__company_id__date_format",
+            "employee_first_name",
+            "employee_last_name",
+            "badge_id",
+            "employee_work_info__department_id__department",
+            "employee_bank_details__account_number",
+        )
+        .first()
+    ) or (None,)
+    date_format = details[0] if details[0] in date_formats else DEFAULT_DATE_FORMAT
+    payroll_settings = PayrollSettings.objects.first()
+    currency = payroll_settings.currency_symbol if payroll_settings else "$"
+    return date_format, currency, list(details[1:])
+
+
+def payslip_revision(payslip, render_settings=None):
+    """
+    This method is used to get the hash of the data the payslip PDF is
+    rendered from, it changes whenever the payslip or the employee details
+    printed on it change
+    """
+    if render_settings is None:
+        render_settings = _render_settings(payslip)
+    content = json.dumps(
+        [payslip.pay_head_data, *render_settings],
+        sort_keys=True,
+        cls=DjangoJSONEncoder,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+
+def payslip_pdf_path(payslip_id, revision):
+    """
+    Stored PDF of the payslip revision
+    """
+    return os.path.join(get_pdf_root(), str(payslip_id), f"{revision}.pdf")
+
+
+def payslip_pdf_title(payslip):
+    """
+    File name of the payslip PDF
+    """
+    return f"{payslip.employee_id}'s payslip for {payslip.pay_head_data.get('range')}.pdf"
+
+
+def payslip_pdf_context(payslip, date_format, currency):
+    """
+    This method is used to build the template context of the payslip PDF
+    """
+    data = dict(payslip.pay_head_data)
+    format_string = date_formats[date_format]
+    start_date = datetime.strptime(data["start_date"], "%Y-%m-%d").date()
+    end_date = datetime.strptime(data["end_date"], "%Y-%m-%d").date()
+    data["formatted_start_date"] = start_date.strftime(format_string)
+    data["formatted_end_date"] = end_date.strftime(format_string)
+    data["employee"] = payslip.employee_id
+    data["payslip"] = payslip
+    data["json_data"] = data.copy()
+    data["json_data"]["employee"] = payslip.employee_id.id
+    data["json_data"]["payslip"] = payslip.id
+    data["instance"] = payslip
+    data["currency"] = currency
+    return data
+
+
+def _write_pdf(path, content):
+    """
+    Write the PDF atomically and drop the older revisions of the payslip
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as file:
+        file.write(content)
+    os.replace(file.name, path)
+    for name in os.listdir(directory):
+        if name != os.path.basename(path) and name.endswith(".pdf"):
+            stale_path = os.path.join(directory, name)
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+
+
+def render_payslip_pdf(payslip_id):
+    """
+    This method is used to render the PDF of the payslip if its current
+    revision is not stored yet, it runs in the workers of the PDF pool
+
+    Args:
+        payslip_id (int): Payslip id
+
+    Returns:
+        str: path of the stored PDF, None when the rendering failed
+    """
+    payslip = Payslip.objects.select_related("employee_id").get(id=payslip_id)
+    render_settings = _render_settings(payslip)
+    date_format, currency, _employee_details = render_settings
+    path = payslip_pdf_path(payslip.id, payslip_revision(payslip, render_settings))
+    if os.path.exists(path):
+        return path
+    response = generate_pdf(
+        PDF_TEMPLATE, context=payslip_pdf_context(payslip, date_format, currency)
+    )
+    if response is None:
+        logger.error("Payslip %s PDF could not be rendered", payslip_id)
+        return None
+    _write_pdf(path, response.content)
+    return path
+
+
+def render_payslip_pdfs(payslip_ids):
+    """
+    This method is used to render the PDFs of many payslips in the pool,
+    the paths are yielded in the order of the ids as they are ready
+
+    Args:
+        payslip_ids (list): Payslip ids
+
+    Yields:
+        tuple: (payslip id, path of the stored PDF or None)
+    """
+    executor = get_pdf_executor()
+    futures = [
+        (payslip_id, executor.submit(render_payslip_pdf, payslip_id))
+        for payslip_id in payslip_ids
+    ]
+    for payslip_id, future in futures:
+        try:
+            yield payslip_id, future.result()
+        except Exception:
+            logger.exception("Payslip %s PDF could not be rendered", payslip_id)
+            yield payslip_id, None
+
+
+def get_payslip_pdf(payslip):
+    """
+    This method is used to get the content of the payslip PDF from the
+    store, the current revision is rendered first when it is missing
+
+    Args:
+        payslip (Payslip): Payslip instance
+
+    Returns:
+        bytes: the PDF, None when the rendering failed
+    """
+    path = payslip_pdf_path(payslip.id, payslip_revision(payslip))
+    if not os.path.exists(path):
+        path = render_payslip_pdf(payslip.id)
+        if path is None:
+            return None
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def delete_payslip_pdfs(payslip_id):
+    """
+    This method is used to drop the stored PDFs of a deleted payslip
+    """
+    shutil.rmtree(os.path.join(get_pdf_root(), str(payslip_id)), ignore_errors=True)
+
+
+class _ZipStream(io.RawIOBase):
+    """
+    Write only, not seekable file the zip archive is written to, the written
+    bytes are handed over to the response as they come
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        """
+        The bytes written since the last call
+        """
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_payslip_zip(payslips):
+    """
+    This method is used to stream a zip archive of the payslip PDFs. The
+    PDFs are rendered in the pool and every PDF is added to the archive and
+    handed over as soon as it is ready, the archive is never held in memory.
+
+    Args:
+        payslips (QuerySet): Payslip queryset
+
+    Yields:
+        bytes: the next part of the zip archive
+    """
+    names = {}
+    used_names = set()
+    for payslip in payslips.select_related("employee_id"):
+        name = payslip_pdf_title(payslip)
+        if name in used_names:
+            name = f"{name[:-4]} ({payslip.id}).pdf"
+        used_names.add(name)
+        names[payslip.id] = name
+
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+        for payslip_id, path in render_payslip_pdfs(list(names)):
+            if path is None:
+                continue
+            with open(path, "rb") as pdf, archive.open(names[payslip_id], "w") as entry:
+                shutil.copyfileobj(pdf, entry, ZIP_CHUNK_SIZE)
+            yield stream.pop()
+    yield stream.pop()
@@ -0,0 +1,293 @@
+"""
+period_context.py
+
+This module is used to preload the data needed to compute the payslips of a
+payroll period, so that a batch of employees can be computed in memory
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from django.db.models import Q
+from dateutil.relativedelta import relativedelta
+from attendance.models import Attendance
+from employee.models import Employee
+from leave.calendar_cache import get_employee_company_id, get_non_working_days
+from leave.models import LeaveRequest
+from payroll.methods.conditions import resolve_eligibility
+from payroll.models.models import Allowance, Contract, Deduction
+
+
+def _date_range(start_date, end_date):
+    return [
+        start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)
+    ]
+
+
+def _m2m_ids(field, component_ids):
+    """
+    Returns {component_id: {employee_id, ...}} for a component to employee m2m field
+    """
+    through = field.through
+    source = field.field.m2m_field_name()
+    target = field.field.m2m_reverse_field_name()
+    mapping = defaultdict(set)
+    for component_id, employee_id in through.objects.filter(
+        **{f"{source}_id__in": component_ids}
+    ).values_list(f"{source}_id", f"{target}_id"):
+        mapping[component_id].add(employee_id)
+    return mapping
+
+
+class PayrollPeriodContext:
+    """
+    Period data shared by all the payslips generated for the same pay period.
+
+    Holidays and company leaves come from the cached non working day
+    calendar of the company of each employee, active contracts, allowance/deduction heads,
+    attendances and approved leaves of all the employees are loaded with a
+    handful of queries when the context is built, the payroll methods then
+    read them from memory instead of querying per employee.
+    """
+
+    def __init__(self, employees, start_date, end_date):
+        self.start_date = start_date
+        self.end_date = end_date
+        # monthly wages are computed on whole months, so the calendar
+        # has to cover the months the period touches
+        self.span_start = start_date.replace(day=1)
+        self.span_end = end_date + relativedelta(day=31)
+
+        self.employees = list(
+            employees.select_related("employee_user_id", "employee_work_info")
+        )
+        employee_ids = [employee.id for employee in self.employees]
+        self.employee_ids = set(employee_ids)
+
+        self._working_days = {}
+        self._non_working_dates = {}
+        self.company_ids = {
+            employee.id: get_employee_company_id(employee) for employee in self.employees
+        }
+
+        self.contracts = {}
+        for contract in Contract._base_manager.filter(
+            employee_id__in=employee_ids, is_active=True, contract_status="active"
+        ).select_related("filing_status"):
+            self.contracts.setdefault(contract.employee_id_id, contract)
+
+        self.attendances = defaultdict(list)
+        for attendance in (
+            Attendance._base_manager.filter(
+                employee_id__in=employee_ids,
+                attendance_date__range=(start_date, end_date),
+            )
+            .filter(Q(attendance_validated=True) | Q(attendance_overtime_approve=True))
+            .order_by("attendance_date")
+        ):
+            self.attendances[attendance.employee_id_id].append(attendance)
+
+        self.leaves = defaultdict(list)
+        for leave in (
+            LeaveRequest._base_manager.filter(
+                employee_id__in=employee_ids,
+                status="approved",
+                start_date__lte=end_date,
+            )
+            .filter(
+                Q(end_date__gte=start_date)
+                | Q(end_date__isnull=True, start_date__gte=start_date)
+            )
+            .select_related("leave_type_id")
+        ):
+            self.leaves[leave.employee_id_id].append(leave)
+
+        self.allowances = self._load_components(Allowance)
+        self.deductions = self._load_components(Deduction)
+        self.deduction_by_id = {
+            deduction.id: deduction for deduction in self.deductions
+        }
+        # the conditions of the condition based heads are resolved for all
+        # the employees at once instead of walking the relations per payslip
+        resolve_eligibility(self.allowances + self.deductions, self.employees)
+
+    def _company_id(self, employee):
+        return self.company_ids.get(employee.id) if employee is not None else None
+
+    def non_working_dates(self, employee=None):
+        """
+        Holidays and company leaves of the calendar of the employee's company,
+        the days of all the companies are read when no employee is given
+        """
+        company_id = self._company_id(employee)
+        if company_id not in self._non_working_dates:
+            self._non_working_dates[company_id] = {
+                day
+                for year in range(self.span_start.year, self.span_end.year + 1)
+                for kind in ("holidays", "company_leaves")
+                for day in get_non_working_days(year, company_id)[kind]
+            }
+        return self._non_working_dates[company_id]
+
+    def _load_components(self, model):
+        # read without the company of the request, the batches also run in
+        # the workers and the scheduler, the heads of the companies of the
+        # employees and the heads shared by all the companies are loaded
+        company_ids = {
+            company_id for company_id in self.company_ids.values() if company_id
+        }
+        components = list(
+            model._base_manager.filter(
+                Q(company_id__in=company_ids) | Q(company_id__isnull=True)
+            )
+            .exclude(one_time_date__lt=self.start_date)
+            .exclude(one_time_date__gt=self.end_date)
+            .prefetch_related("other_conditions")
+        )
+        component_ids = [component.id for component in components]
+        specific = _m2m_ids(model.specific_employees, component_ids)
+        excluded = _m2m_ids(model.exclude_employees, component_ids)
+        for component in components:
+            component.specific_employee_ids = specific[component.id]
+            component.exclude_employee_ids = excluded[component.id]
+        return components
+
+    def covers(self, start_date, end_date):
+        """
+        Whether the preloaded calendar covers the date range
+        """
+        return self.span_start <= start_date and end_date <= self.span_end
+
+    def includes(self, employee, start_date, end_date):
+        """
+        Whether the employee's data for the date range is preloaded
+        """
+        return (
+            employee.id in self.employee_ids
+            and self.start_date <= start_date
+            and end_date <= self.end_date
+        )
+
+    def working_days(self, start_date, end_date, employee=None):
+        """
+        Same result as payroll.methods.methods.get_working_days, memoized per
+        range and company
+        """
+        non_working_dates = self.non_working_dates(employee)
+        key = (start_date, end_date, self._company_id(employee))
+        if key not in self._working_days:
+            date_range = _date_range(start_date, end_date)
+            company_leave_dates = [
+                day for day in date_range if day in non_working_dates
+            ]
+            working_days_on = [
+                day for day in date_range if day not in non_working_dates
+            ]
+            self._working_days[key] = {
+                "total_working_days": len(working_days_on),
+                "working_days_on": working_days_on,
+                "company_leave_dates": company_leave_dates,
+            }
+        return self._working_days[key]
+
+    def contract(self, employee):
+        """
+        Active contract of the employee
+        """
+        return self.contracts.get(employee.id)
+
+    def approved_leaves(self, employee):
+        """
+        Approved leave requests of the employee overlapping the period
+        """
+        return self.leaves[employee.id]
+
+    def employee_attendances(self, employee, start_date, end_date, **filters):
+        """
+        Preloaded attendances of the employee between the dates, filtered by
+        attribute values like validated/overtime approval/shift
+        """
+        return [
+            attendance
+            for attendance in self.attendances[employee.id]
+            if start_date <= attendance.attendance_date <= end_date
+            and all(
+                getattr(attendance, attr) == value for attr, value in filters.items()
+            )
+        ]
+
+    @staticmethod
+    def _in_period(component, start_date, end_date):
+        return component.one_time_date is None or (
+            start_date <= component.one_time_date <= end_date
+        )
+
+    def _targets(self, component, employee, conditional=True):
+        if employee.id in component.specific_employee_ids:
+            return True
+        if employee.id in component.exclude_employee_ids:
+            return False
+        # the heads of all or the conditional employees of a company don't
+        # reach the employees of the other companies
+        if component.company_id_id not in (None, self._company_id(employee)):
+            return False
+        return component.include_active_employees or (
+            conditional and component.is_condition_based
+        )
+
+    def employee_allowances(self, employee, start_date, end_date):
+        """
+        Allowances targeting the employee on the period
+        """
+        return [
+            allowance
+            for allowance in self.allowances
+            if self._in_period(allowance, start_date, end_date)
+            and self._targets(allowance, employee)
+        ]
+
+    def employee_deductions(
+        self, employee, start_date, end_date, conditional=True, **flags
+    ):
+        """
+        Deductions (not updating compensations) targeting the employee on the
+        period, filtered by flags like is_pretax/is_tax
+        """
+        return [
+            deduction
+            for deduction in self.deductions
+            if deduction.update_compensation is None
+            and self._in_period(deduction, start_date, end_date)
+            and all(getattr(deduction, attr) == value for attr, value in flags.items())
+            and self._targets(deduction, employee, conditional)
+        ]
+
+    def compensation_deductions(self, employee, compensation_type, start_date, end_date):
+        """
+        One time deductions updating the basic/gross/net pay of the employee
+        """
+        return [
+            deduction
+            for deduction in self.deductions
+            if deduction.update_compensation == compensation_type
+            and employee.id in deduction.specific_employee_ids
+            and self._in_period(deduction, start_date, end_date)
+        ]
+
+
+def get_period_context(employee, start_date, end_date, context=None):
+    """
+    This method is used to get the period context of an employee, the given
+    context is reused when it holds the employee's period, otherwise the
+    period of the employee alone is loaded
+
+    Args:
+        employee (Employee): Employee instance
+        start_date (date): start date of the period
+        end_date (date): end date of the period
+        context (PayrollPeriodContext): context of the current batch, if any
+    """
+    if context is not None and context.includes(employee, start_date, end_date):
+        return context
+    return PayrollPeriodContext(
+        Employee._base_manager.filter(id=employee.id), start_date, end_date
+    )
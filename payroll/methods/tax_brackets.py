@@ -0,0 +1,136 @@
+"""
+tax_brackets.py
+
+This module is used to keep the tax brackets of every filing status in the
+cache as NumPy arrays, so that the federal tax of a whole batch of employees
+is computed with one vectorized call per filing status. The cached table is
+dropped by the TaxBracket signals.
+"""
+
+import math
+import numpy as np
+from django.core.cache import cache
+
+CACHE_KEY = "tax_bracket_table"
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+class TaxBracketTable:
+    """
+    Tax brackets of a filing status ordered by minimum income.
+
+    Like the bracket walk it replaces, the income is spread over the brackets
+    in order, every bracket taxing at most max_income - min_income of it, and
+    no tax is due below the minimum income of the first bracket.
+    """
+
+    def __init__(self, brackets):
+        self.min_income = brackets[0][0] if brackets else None
+        self.widths = np.array(
+            [
+                (math.inf if max_income is None else max_income) - min_income
+                for min_income, max_income, _tax_rate in brackets
+            ],
+            dtype=float,
+        )
+        self.rates = np.array(
+            [tax_rate for _min_income, _max_income, tax_rate in brackets], dtype=float
+        )
+        # income already taxed by the previous brackets
+        self.lower = np.concatenate(([0.0], np.cumsum(self.widths)[:-1]))[
+            : len(brackets)
+        ]
+
+    def annual_tax(self, yearly_incomes):
+        """
+        This method is used to compute the yearly tax of the yearly incomes
+
+        Args:
+            yearly_incomes (array like): annualised incomes
+
+        Returns:
+            numpy.ndarray: yearly tax of every income
+        """
+        incomes = np.atleast_1d(np.asarray(yearly_incomes, dtype=float))
+        if self.min_income is None:
+            return np.zeros_like(incomes)
+        taxable = np.clip(
+            incomes[:, np.newaxis] - self.lower, 0, self.widths[np.newaxis, :]
+        )
+        taxes = (taxable * self.rates / 100).sum(axis=1)
+        return np.where(incomes >= self.min_income, taxes, 0.0)
+
+    def period_tax(self, yearly_incomes, num_days, total_days):
+        """
+        This method is used to compute the tax of the pay period from the
+        annualised incomes
+
+        Args:
+            yearly_incomes (array like): annualised incomes
+            num_days (array like or int): days in the pay period
+            total_days (array like or int): days in the year of the period
+
+        Returns:
+            numpy.ndarray: period tax of every income
+        """
+        return (
+            self.annual_tax(yearly_incomes)
+            / np.asarray(total_days, dtype=float)
+            * np.asarray(num_days, dtype=float)
+        )
+
+
+def _cache_key(filing_status_id):
+    return f"{CACHE_KEY}_{filing_status_id}"
+
+
+def invalidate_tax_brackets(filing_status_id):
+    """
+    This method is used to drop the cached brackets of the filing status
+    """
+    cache.delete(_cache_key(filing_status_id))
+
+
+def get_tax_bracket_table(filing_status_id):
+    """
+    This method is used to get the bracket table of the filing status
+
+    Args:
+        filing_status_id (int): FilingStatus id
+
+    Returns:
+        TaxBracketTable: the cached bracket table
+    """
+    from payroll.models.tax_models import TaxBracket
+
+    key = _cache_key(filing_status_id)
+    table = cache.get(key)
+    if table is None:
+        table = TaxBracketTable(
+            list(
+                TaxBracket.objects.filter(filing_status_id=filing_status_id)
+                .order_by("min_income")
+                .values_list("min_income", "max_income", "tax_rate")
+            )
+        )
+        cache.set(key, table, CACHE_TIMEOUT)
+    return table
+
+
+def compute_period_tax(filing_status_id, yearly_incomes, num_days, total_days):
+    """
+    This method is used to compute the period tax of a batch of employees
+    sharing the filing status in one call
+
+    Args:
+        filing_status_id (int): FilingStatus id
+        yearly_incomes (array like): annualised incomes of the employees
+        num_days (array like or int): days in the pay period of the employees
+        total_days (array like or int): days in the year of the pay periods
+
+    Returns:
+        numpy.ndarray: period tax of every employee
+    """
+    return get_tax_bracket_table(filing_status_id).period_tax(
+        yearly_incomes, num_days, total_days
+    )
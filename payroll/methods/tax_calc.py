@@ -1,17 +1,91 @@
 """
 Module: payroll.tax_calc
 
-This module contains a function for calculating the taxable amount for an employee 
-based on their contract details and income information.
+This module contains the functions for calculating the taxable amount for an employee,
+or a batch of employees, based on their contract details and income information.
 """
 
 import datetime
+from collections import defaultdict
 from payroll.methods.payslip_calc import (
     calculate_taxable_gross_pay,
     calculate_gross_pay,
 )
-from payroll.models.models import Contract
-from payroll.models.tax_models import TaxBracket
+from payroll.methods.tax_brackets import compute_period_tax
+
+
+def annualised_taxable_income(**kwargs):
+    """Annualise the income the federal tax of an employee is based on.
+
+    Args:
+        Same keyword arguments as calculate_taxable_amount.
+
+    Returns:
+        dict: the filing status id, yearly income, days of the period and days
+            of the year, None when the contract has no filing status.
+    """
+    employee = kwargs["employee"]
+    start_date = kwargs["start_date"]
+    end_date = kwargs["end_date"]
+    basic_pay = kwargs["basic_pay"]
+    contract = kwargs["context"].contract(employee)
+    filing = contract.filing_status
+    if filing is None:
+        return None
+    based = filing.based_on
+    num_days = (end_date - start_date).days + 1
+    calculation_functions = {
+        "taxable_gross_pay": calculate_taxable_gross_pay,
+        "gross_pay": calculate_gross_pay,
+    }
+    if based in calculation_functions:
+        calculation_function = calculation_functions[based]
+        income = calculation_function(**kwargs)
+        income = float(income[based])
+    else:
+        income = float(basic_pay)
+    year = end_date.year
+    check_start_date = datetime.date(year, 1, 1)
+    check_end_date = datetime.date(year, 12, 31)
+    total_days = (check_end_date - check_start_date).days + 1
+    yearly_income = income / num_days * total_days
+    yearly_income = round(yearly_income, 2)
+    return {
+        "filing_status_id": filing.id,
+        "yearly_income": yearly_income,
+        "num_days": num_days,
+        "total_days": total_days,
+    }
+
+
+def calculate_period_taxes(taxable_incomes):
+    """Calculate the federal tax of a batch of employees.
+
+    The employees are grouped by filing status and the tax of every group is
+    computed with one vectorized call on the cached bracket table.
+
+    Args:
+        taxable_incomes (list): annualised_taxable_income results, None for
+            the employees without filing status.
+
+    Returns:
+        list: the federal tax amount for the period of every employee.
+    """
+    federal_taxes = [0] * len(taxable_incomes)
+    groups = defaultdict(list)
+    for index, taxable_income in enumerate(taxable_incomes):
+        if taxable_income is not None:
+            groups[taxable_income["filing_status_id"]].append(index)
+    for filing_status_id, indexes in groups.items():
+        period_taxes = compute_period_tax(
+            filing_status_id,
+            [taxable_incomes[index]["yearly_income"] for index in indexes],
+            [taxable_incomes[index]["num_days"] for index in indexes],
+            [taxable_incomes[index]["total_days"] for index in indexes],
+        )
+        for index, period_tax in zip(indexes, period_taxes.tolist()):
+            federal_taxes[index] = period_tax
+    return federal_taxes
 
 
 def calculate_taxable_amount(**kwargs):
@@ -29,53 +103,4 @@ def calculate_taxable_amount(**kwargs):
     Returns:
         float: The federal tax amount for the specified period.
     """
-    employee = kwargs["employee"]
-    start_date = kwargs["start_date"]
-    end_date = kwargs["end_date"]
-    basic_pay = kwargs["basic_pay"]
-    contract = Contract.objects.filter(
-        employee_id=employee, contract_status="active"
-    ).first()
-    filing = contract.filing_status
-    federal_tax_for_period = 0
-    if filing is not None:
-        based = filing.based_on
-        num_days = (end_date - start_date).days + 1
-        calculation_functions = {
-            "taxable_gross_pay": calculate_taxable_gross_pay,
-            "gross_pay": calculate_gross_pay,
-        }
-        if based in calculation_functions:
-            calculation_function = calculation_functions[based]
-            income = calculation_function(**kwargs)
-            income = float(income[based])
-        else:
-            income = float(basic_pay)
-        year = end_date.year
-        check_start_date = datetime.date(year, 1, 1)
-        check_end_date = datetime.date(year, 12, 31)
-        total_days = (check_end_date - check_start_date).days + 1
-        yearly_income = income / num_days * total_days
-        yearly_income = round(yearly_income, 2)
-        tax_brackets = TaxBracket.objects.filter(filing_status_id=filing).order_by(
-            "min_income"
-        )
-        federal_tax = 0
-        remaining_income = yearly_income
-        if tax_brackets.exists():
-            if tax_brackets.first().min_income <= yearly_income:
-                for tax_bracket in tax_brackets:
-                    min_income = tax_bracket.min_income
-                    max_income = tax_bracket.max_income
-                    tax_rate = tax_bracket.tax_rate
-                    if remaining_income <= 0:
-                        break
-                    taxable_amount = min(remaining_income, max_income - min_income)
-                    tax_amount = taxable_amount * tax_rate / 100
-                    federal_tax += tax_amount
-                    remaining_income -= taxable_amount
-            daily_federal_tax = federal_tax / total_days
-            federal_tax_for_period = daily_federal_tax * num_days
-        else:
-            federal_tax_for_period = 0
-    return federal_tax_for_period
+    return calculate_period_taxes([annualised_taxable_income(**kwargs)])[0]
@@ -0,0 +1,89 @@
+"""
+work_record_matrix.py
+
+This module is used to build the month grid of the work records, one row
+per employee and one cell per day of the month. The work records of the
+employees are read with one query and pivoted in memory. When the
+WORK_RECORD_MATRIX_CACHE_TIMEOUT setting is set, the grid of the whole
+month is computed once and kept in the cache for that many seconds, so the
+pages of a large company share it.
+"""
+
+import calendar
+from datetime import date
+from django.conf import settings
+from django.core.cache import cache
+
+WORK_RECORD_MATRIX_KEY = "payroll_work_record_matrix_{year}_{month}"
+WORK_RECORD_MATRIX_FIELDS = ["employee_id", "date", "work_record_type", "message"]
+
+
+def month_dates(year, month):
+    """
+    This method is used to get the dates of the month
+    """
+    return [
+        date(year, month, day)
+        for day in range(1, calendar.monthrange(year, month)[1] + 1)
+    ]
+
+
+def _month_cells(year, month, employee_ids=None):
+    """
+    The work records of the month as {employee id: {day: cell}}, a cell is a
+    dict of the WORK_RECORD_MATRIX_FIELDS values
+    """
+    from payroll.models.models import WorkRecord
+
+    dates = month_dates(year, month)
+    records = WorkRecord._base_manager.filter(date__range=(dates[0], dates[-1]))
+    if employee_ids is not None:
+        records = records.filter(employee_id__in=employee_ids)
+    cells = {}
+    # the last record of the day is shown when there are many
+    for record in records.order_by("id").values(*WORK_RECORD_MATRIX_FIELDS):
+        cells.setdefault(record["employee_id"], {})[record["date"].day] = record
+    return cells
+
+
+def work_record_matrix(employee_ids, year, month):
+    """
+    This method is used to get the work record grid of the employees
+
+    Args:
+        employee_ids (list): ids of the employees of the page
+        year (int): year
+        month (int): month number, 1 to 12
+
+    Returns:
+        dict: {employee id: [cell or None for each day of the month]}
+    """
+    timeout = getattr(settings, "WORK_RECORD_MATRIX_CACHE_TIMEOUT", None)
+    if timeout:
+        key = WORK_RECORD_MATRIX_KEY.format(year=year, month=month)
+        cells = cache.get(key)
+        if cells is None:
+            cells = _month_cells(year, month)
+            cache.set(key, cells, timeout)
+    else:
+        cells = _month_cells(year, month, employee_ids)
+    days = range(1, calendar.monthrange(year, month)[1] + 1)
+    return {
+        employee_id: [cells.get(employee_id, {}).get(day) for day in days]
+        for employee_id in employee_ids
+    }
+
+
+def invalidate_work_record_matrix(dates):
+    """
+    This method is used to drop the cached grids of the months of the dates
+    """
+    cache.delete_many(
+        list(
+            {
+                WORK_RECORD_MATRIX_KEY.format(year=day.year, month=day.month)
+                for day in dates
+                if day is not None
+            }
+        )
+    )
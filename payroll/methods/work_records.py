@@ -0,0 +1,63 @@
+"""
+work_records.py
+
+This module is used to write the attendance work records of many
+attendances at once, for the attendances written with bulk_create.
+"""
+
+from collections import defaultdict
+from django.utils import timezone
+from payroll.methods.work_record_matrix import invalidate_work_record_matrix
+from payroll.models.models import WorkRecord, attendance_work_record
+
+WORK_RECORD_FIELDS = [
+    "employee_id",
+    "date",
+    "at_work",
+    "min_hour",
+    "min_hour_second",
+    "at_work_second",
+    "work_record_type",
+    "message",
+    "is_attendance_record",
+    "day_percentage",
+    "last_update",
+]
+
+
+def write_attendance_work_records(attendances, batch_size=1000):
+    """
+    This method is used to create or update the work records of the
+    attendances, the existing records are read with one query
+
+    Args:
+        attendances (list): saved Attendance instances
+    """
+    attendances = list(attendances)
+    if not attendances:
+        return
+    dates = [attendance.attendance_date for attendance in attendances]
+    existing = defaultdict(list)
+    for record in WorkRecord._base_manager.filter(
+        employee_id__in={attendance.employee_id_id for attendance in attendances},
+        date__range=(min(dates), max(dates)),
+    ).order_by("id"):
+        existing[(record.employee_id_id, record.date)].append(record)
+
+    to_create = []
+    to_update = []
+    now = timezone.now()
+    for attendance in attendances:
+        records = existing[(attendance.employee_id_id, attendance.attendance_date)]
+        work_record = attendance_work_record(attendance, records)
+        work_record.last_update = now
+        if work_record.pk is None:
+            to_create.append(work_record)
+        else:
+            to_update.append(work_record)
+    WorkRecord._base_manager.bulk_create(to_create, batch_size=batch_size)
+    WorkRecord._base_manager.bulk_update(
+        to_update, WORK_RECORD_FIELDS, batch_size=batch_size
+    )
+    invalidate_work_record_matrix(dates)
+
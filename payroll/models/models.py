@@ -13,7 +13,7 @@ from django.db.models.signals import post_save
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
-from django.db.models.signals import pre_save, pre_delete
+from django.db.models.signals import pre_save, pre_delete, post_delete
 from django.http import QueryDict
 from horilla.models import HorillaModel
 from horilla_audit.models import HorillaAuditInfo, HorillaAuditLog
@@ -35,6 +35,7 @@ from attendance.models import (
     validate_time_format,
 )
 from leave.models import LeaveRequest, LeaveType
+from payroll.methods.work_record_matrix import invalidate_work_record_matrix
 
 
 # Create your models here.
@@ -429,111 +430,87 @@ class WorkRecord(models.Model):
         )
 
 
-class OverrideAttendance(Attendance):
+@receiver(post_save, sender=WorkRecord)
+@receiver(post_delete, sender=WorkRecord)
+def work_record_post_save(sender, instance, **_kwargs):
     """
-    Class to override Attendance model save method
+    This method is used to drop the cached work record grid of the month
     """
+    invalidate_work_record_matrix([instance.date])
 
-    # Additional fields and methods specific to AnotherModel
-    @receiver(pre_save, sender=Attendance)
-    def attendance_pre_save(sender, instance, **_kwargs):
-        """
-        Overriding Attendance model save method
-        """
-        min_hour_second = strtime_seconds(instance.minimum_hour)
-        at_work_second = strtime_seconds(instance.attendance_worked_hour)
-
-        status = "FDP" if instance.at_work_second >= min_hour_second else "HDP"
-        status = "ABS" if instance.at_work_second <= min_hour_second / 2 else status
-        if instance.first_save:
-            status = (
-                "CONF"
-                if WorkRecord.objects.filter(
-                    date=instance.attendance_date,
-                    is_attendance_record=True,
-                    employee_id=instance.employee_id,
-                ).exists()
-                or instance.attendance_validated is False
-                else status
-            )
 
-        message = _("Validate the attendance") if status == "CONF" else _("Validated")
+def attendance_work_record(instance, work_records):
+    """
+    This method is used to fill the attendance work record of the day from
+    the attendance, without saving it
 
-        if (
-            status == "CONF"
-            and WorkRecord.objects.filter(
-                date=instance.attendance_date,
-                is_attendance_record=True,
-                employee_id=instance.employee_id,
-            ).exists()
-        ):
-            message = _("Work record already exists")
-        message = (
-            _("Incomplete minimum hour")
-            if status == "HDP" and min_hour_second / 2 > at_work_second
-            else message
-        )
-        work_record = WorkRecord.objects.filter(
-            date=instance.attendance_date,
-            is_attendance_record=True,
-            employee_id=instance.employee_id,
+    Args:
+        instance (Attendance): attendance
+        work_records (list): the work records of the employee on the day
+
+    Returns:
+        WorkRecord: the existing work record of the day, or a new one
+    """
+    min_hour_second = strtime_seconds(instance.minimum_hour)
+    at_work_second = strtime_seconds(instance.attendance_worked_hour)
+    record_exists = any(record.is_attendance_record for record in work_records)
+
+    status = "FDP" if instance.at_work_second >= min_hour_second else "HDP"
+    status = "ABS" if instance.at_work_second <= min_hour_second / 2 else status
+    if instance.first_save:
+        status = (
+            "CONF"
+            if record_exists or instance.attendance_validated is False
+            else status
         )
-        work_record = (
-            WorkRecord()
-            if not WorkRecord.objects.filter(
-                date=instance.attendance_date,
-                employee_id=instance.employee_id,
-            ).exists()
-            else WorkRecord.objects.filter(
-                date=instance.attendance_date,
-                employee_id=instance.employee_id,
-            ).first()
+
+    message = _("Validate the attendance") if status == "CONF" else _("Validated")
+    if status == "CONF" and record_exists:
+        message = _("Work record already exists")
+    message = (
+        _("Incomplete minimum hour")
+        if status == "HDP" and min_hour_second / 2 > at_work_second
+        else message
+    )
+    if not instance.attendance_clock_out:
+        status = "FDP"
+        message = _("Currently working")
+
+    work_record = work_records[0] if work_records else WorkRecord()
+    work_record.employee_id_id = instance.employee_id_id
+    work_record.date = instance.attendance_date
+    work_record.at_work = instance.attendance_worked_hour
+    work_record.min_hour = instance.minimum_hour
+    work_record.min_hour_second = min_hour_second
+    work_record.at_work_second = at_work_second
+    work_record.work_record_type = status
+    work_record.message = message
+    work_record.is_attendance_record = True
+    if instance.attendance_validated:
+        work_record.day_percentage = (
+            1.00 if at_work_second > min_hour_second / 2 else 0.50
         )
-        work_record.employee_id = instance.employee_id
-        work_record.date = instance.attendance_date
-        work_record.at_work = instance.attendance_worked_hour
-        work_record.min_hour = instance.minimum_hour
-        work_record.min_hour_second = min_hour_second
-        work_record.at_work_second = at_work_second
-        work_record.work_record_type = status
-        work_record.message = message
-        work_record.is_attendance_record = True
-        if instance.attendance_validated:
-            work_record.day_percentage = (
-                1.00 if at_work_second > min_hour_second / 2 else 0.50
-            )
-        work_record.save()
+    return work_record
 
-        if status == "HDP" and work_record.is_leave_record:
-            message = _("Half day leave")
 
-        if status == "FDP":
-            message = _("Present")
+class OverrideAttendance(Attendance):
+    """
+    Class to override Attendance model save method
+    """
 
-    @receiver(post_save, sender=Attendance)
-    def attendance_post_save(sender, instance, **_kwargs):
+    # Additional fields and methods specific to AnotherModel
+    @receiver(pre_save, sender=Attendance)
+    def attendance_pre_save(sender, instance, **_kwargs):
         """
-        Function triggered after saving an instance of Attendance.
+        Overriding Attendance model save method
         """
-        work_record = (
-            WorkRecord()
-            if not WorkRecord.objects.filter(
-                date=instance.attendance_date,
-                employee_id=instance.employee_id,
-            ).exists()
-            else WorkRecord.objects.filter(
+        work_records = list(
+            WorkRecord._base_manager.filter(
                 date=instance.attendance_date,
-                employee_id=instance.employee_id,
-            ).first()
+                employee_id=instance.employee_id_id,
+            ).order_by("id")
         )
-        message = work_record.message
-        status = work_record.work_record_type
-        if not instance.attendance_clock_out:
-            status = "FDP"
-            message = _("Currently working")
-        work_record.message = message
-        work_record.work_record_type = status
-        work_record.save()
+        attendance_work_record(instance, work_records).save()
 
     @receiver(pre_delete, sender=Attendance)
     def attendance_pre_delete(sender, instance, **_kwargs):
@@ -1422,6 +1399,112 @@ class Payslip(HorillaModel):
         ]
 
 
+class PayslipBatchJob(HorillaModel):
+    """
+    PayslipBatchJob model, a bulk payslip generation handed over to the
+    payslip workers. The counters are updated by the workers as the employee
+    chunks are processed, so the progress can be polled.
+    """
+
+    status_choices = [
+        ("queued", _("Queued")),
+        ("running", _("Running")),
+        ("completed", _("Completed")),
+    ]
+    group_name = models.CharField(
+        max_length=50, null=True, blank=True, verbose_name=_("Batch name")
+    )
+    start_date = models.DateField()
+    end_date = models.DateField()
+    employee_ids = models.JSONField(default=list)
+    total_count = models.IntegerField(default=0)
+    done_count = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    errors = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, default="queued", choices=status_choices)
+    # the employee id chunks not processed yet, requeued when the job stalls
+    pending_chunks = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+    objects = models.Manager()
+
+    def __str__(self) -> str:
+        return f"{self.group_name or 'Payslip batch'} ({self.start_date} to {self.end_date})"
+
+    def remaining_count(self):
+        """
+        Number of employees not processed yet
+        """
+        return max(self.total_count - self.done_count - self.failed_count, 0)
+
+    def progress(self):
+        """
+        Method is used to get the progress of the batch
+        """
+        return {
+            "job_id": self.id,
+            "group_name": self.group_name,
+            "status": self.status,
+            "total": self.total_count,
+            "done": self.done_count,
+            "failed": self.failed_count,
+            "remaining": self.remaining_count(),
+            "errors": self.errors,
+        }
+
+    class Meta:
+        """
+        Meta class for additional options
+        """
+
+        ordering = [
+            "-created_at",
+        ]
+
+
+class PayslipLineItem(models.Model):
+    """
+    Allowances and deductions of the payslips, one row per pay head line of
+    the pay_head_data, written with the payslip so that the reports are
+    computed with SQL aggregates
+    """
+
+    kind_choices = [
+        ("allowance", _("Allowance")),
+        ("basic_pay_deduction", _("Basic Pay Deduction")),
+        ("gross_pay_deduction", _("Gross Pay Deduction")),
+        ("pretax_deduction", _("Pre-tax Deduction")),
+        ("post_tax_deduction", _("Post-tax Deduction")),
+        ("tax_deduction", _("Tax Deduction")),
+        ("net_deduction", _("Net Pay Deduction")),
+    ]
+    payslip_id = models.ForeignKey(
+        Payslip, on_delete=models.CASCADE, related_name="line_items"
+    )
+    employee_id = models.ForeignKey(Employee, on_delete=models.CASCADE)
+    start_date = models.DateField()
+    end_date = models.DateField()
+    kind = models.CharField(max_length=30, choices=kind_choices)
+    # id of the allowance/deduction, the pay head may be deleted since
+    component_id = models.IntegerField(null=True, blank=True)
+    title = models.CharField(max_length=255, null=True, blank=True)
+    amount = models.FloatField(default=0)
+    employer_contribution = models.FloatField(default=0)
+    objects = models.Manager()
+
+    def __str__(self) -> str:
+        return f"{self.title} - {self.amount}"
+
+    class Meta:
+        """
+        Meta class for additional options
+        """
+
+        indexes = [
+            models.Index(fields=["employee_id", "kind", "component_id"]),
+            models.Index(fields=["kind", "component_id", "start_date"]),
+        ]
+
+
 class LoanAccount(HorillaModel):
     """
     This modal is used to store the loan Account details
@@ -1698,6 +1781,7 @@ class Reimbursement(HorillaModel):
                             assigned_leave.carryforward_days = (
                                 carryforward_days - self.cfd_to_encash
                             )
+                            assigned_leave.record_ledger_entry("encashment")
                             assigned_leave.save()
                         else:
                             request = getattr(
@@ -1740,6 +1824,7 @@ class Reimbursement(HorillaModel):
                         assigned_leave.carryforward_days = (
                             assigned_leave.carryforward_days + cfd_days
                         )
+                        assigned_leave.record_ledger_entry("cancellation")
                         assigned_leave.save()
                     self.allowance_id.delete()
 
@@ -1803,3 +1888,13 @@ class EncashmentGeneralSettings(models.Model):
     bonus_amount = models.IntegerField(default=1)
     leave_amount = models.IntegerField(blank=True, null=True, verbose_name="Amount")
     objects = models.Manager()
+
+
+@receiver(post_delete, sender=Payslip)
+def delete_payslip_pdf(sender, instance, **kwargs):
+    """
+    Post delete method to drop the stored PDFs of the payslip
+    """
+    from payroll.methods.payslip_pdf import delete_payslip_pdfs
+
+    delete_payslip_pdfs(instance.id)
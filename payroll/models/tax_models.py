@@ -7,11 +7,14 @@ This module contains the models for the tax calculation of taxable income.
 import math
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.text import format_lazy
 from django.utils.translation import gettext_lazy as _
 from base.models import Company
 
 from horilla.models import HorillaModel
+from payroll.methods.tax_brackets import invalidate_tax_brackets
 from payroll.models.models import FilingStatus
 
 
@@ -113,3 +116,12 @@ class TaxBracket(HorillaModel):
                         )
                     }
                 )
+
+
+@receiver(post_save, sender=TaxBracket)
+@receiver(post_delete, sender=TaxBracket)
+def invalidate_tax_bracket_cache(sender, instance, **kwargs):
+    """
+    Drop the cached bracket table of the filing status when a bracket changes
+    """
+    invalidate_tax_brackets(instance.filing_status_id_id)
@@ -6,7 +6,7 @@ This module is used to register scheduled tasks
 
 from datetime import date
 from apscheduler.schedulers.background import BackgroundScheduler
-from .models.models import Contract
+from horilla.horilla_scheduler import start_scheduler
 
 
 def generate_work_entry():
@@ -21,13 +21,26 @@ def expire_contract():
     Finds all active contracts whose end date is earlier than the current date
     and updates their status to "expired".
     """
+    from payroll.models.models import Contract
+
     Contract.objects.filter(
         contract_status="active", contract_end_date__lt=date.today()
     ).update(contract_status="expired")
     return
 
 
+def resume_payslip_jobs():
+    """
+    Queues again the payslip batch jobs left unfinished by a restart or a
+    dead worker
+    """
+    from payroll.methods.payslip_jobs import resume_payslip_jobs as resume
+
+    resume()
+
+
 scheduler = BackgroundScheduler()
 scheduler.add_job(generate_work_entry, "interval", seconds=10)
 scheduler.add_job(expire_contract, "interval", seconds=5)
-scheduler.start()
+scheduler.add_job(resume_payslip_jobs, "interval", minutes=5)
+start_scheduler(scheduler)
@@ -1,5 +1,920 @@
 """test cases"""
 
-from django.test import TestCase
+import io
+import os
+import smtplib
+import tempfile
+import zipfile
+from datetime import date, time, timedelta
+from unittest.mock import patch
+from apscheduler.schedulers.background import BackgroundScheduler
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.core.mail.backends import locmem
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from attendance.models import Attendance
+from base.models import (
+    Company,
+    Department,
+    EmployeeShift,
+    EmployeeShiftDay,
+    WorkType,
+)
+from base.thread_local_middleware import _thread_locals
+from employee.models import Employee, EmployeeBankDetails, EmployeeWorkInformation
+from horilla.horilla_scheduler import SCHEDULER_DISABLED_ENV, start_scheduler
+from leave.models import CompanyLeave, Holiday, LeaveRequest, LeaveType
+from notifications.models import Notification
+from payroll import scheduler as payroll_scheduler
+from payroll.methods import payslip_jobs, payslip_mail, payslip_pdf
+from payroll.methods.conditions import (
+    compile_conditions,
+    component_applies,
+    resolve_eligibility,
+    rules_match,
+)
+from payroll.methods.engine import generate_payslip_batch, payroll_calculation
+from payroll.methods.line_items import contribution_totals
+from payroll.methods.methods import (
+    get_active_contract,
+    get_attendance,
+    get_leaves,
+    get_working_days,
+)
+from payroll.methods.payslip_mail import PayslipMailDispatcher
+from payroll.methods.payslip_pdf import payslip_revision
+from payroll.methods.period_context import PayrollPeriodContext
+from payroll.methods.tax_brackets import get_tax_bracket_table
+from payroll.models.models import (
+    Allowance,
+    Contract,
+    Deduction,
+    FilingStatus,
+    MultipleCondition,
+    Payslip,
+    PayslipBatchJob,
+    PayslipLineItem,
+)
+from payroll.models.tax_models import PayrollSettings, TaxBracket
 
-# Create your tests here.
+
+def payroll_employee(name, wage=None, filing_status=None):
+    """
+    An employee with an active monthly contract of the wage, no contract
+    when the wage is not given
+    """
+    employee = Employee.objects.create(
+        employee_first_name=name,
+        employee_last_name="Test",
+        email=f"{name.lower()}.test@example.com",
+        phone="1234567890",
+    )
+    EmployeeWorkInformation.objects.create(employee_id=employee)
+    if wage is not None:
+        Contract.objects.create(
+            contract_name="Contract",
+            employee_id=employee,
+            contract_start_date=date(2023, 1, 1),
+            wage_type="monthly",
+            wage=wage,
+            contract_status="active",
+            filing_status=filing_status,
+        )
+    return employee
+
+
+class PayrollCalculationQueryTest(TestCase):
+    """
+    The payslip computation should issue a fixed number of queries whatever
+    the length of the period and the number of attendances and allowances
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        for day in [
+            "monday",
+            "tuesday",
+            "wednesday",
+            "thursday",
+            "friday",
+            "saturday",
+            "sunday",
+        ]:
+            EmployeeShiftDay.objects.create(day=day)
+        shift = EmployeeShift(employee_shift="Day")
+        shift.save()
+        work_type = WorkType(work_type="Office")
+        work_type.save()
+        filing_status = FilingStatus.objects.create(
+            filing_status="Single", based_on="taxable_gross_pay"
+        )
+        TaxBracket.objects.create(
+            filing_status_id=filing_status, min_income=0, max_income=1e12, tax_rate=10
+        )
+        Holiday.objects.create(
+            name="Holiday", start_date=date(2024, 1, 15), end_date=date(2024, 1, 16)
+        )
+        CompanyLeave.objects.create(based_on_week=None, based_on_week_day="6")
+
+        cls.employee = Employee.objects.create(
+            employee_first_name="Payroll",
+            employee_last_name="Test",
+            email="payroll.test@example.com",
+            phone="1234567890",
+        )
+        EmployeeWorkInformation.objects.create(
+            employee_id=cls.employee, shift_id=shift, work_type_id=work_type
+        )
+        Contract.objects.create(
+            contract_name="Contract",
+            employee_id=cls.employee,
+            contract_start_date=date(2023, 1, 1),
+            wage_type="monthly",
+            wage=30000,
+            contract_status="active",
+            filing_status=filing_status,
+        )
+        allowance = Allowance(
+            title="Attendance",
+            include_active_employees=True,
+            is_fixed=False,
+            based_on="attendance",
+            per_attendance_fixed_amount=50,
+            if_choice="basic_pay",
+            if_condition="gt",
+            if_amount=0,
+        )
+        allowance.save()
+        LeaveRequest.objects.bulk_create(
+            [
+                LeaveRequest(
+                    employee_id=cls.employee,
+                    leave_type_id=LeaveType.objects.create(
+                        name="Unpaid", payment="unpaid", total_days=10
+                    ),
+                    start_date=date(2024, 2, 5),
+                    end_date=date(2024, 2, 6),
+                    status="approved",
+                    description="Leave",
+                    requested_days=2,
+                )
+            ]
+        )
+
+        attendance_date = date(2024, 1, 1)
+        while attendance_date <= date(2024, 3, 31):
+            Attendance(
+                employee_id=cls.employee,
+                attendance_date=attendance_date,
+                shift_id=shift,
+                work_type_id=work_type,
+                attendance_clock_in_date=attendance_date,
+                attendance_clock_in=time(9),
+                attendance_clock_out_date=attendance_date,
+                attendance_clock_out=time(18),
+                attendance_worked_hour="09:00",
+                minimum_hour="08:00",
+                attendance_validated=True,
+            ).save()
+            attendance_date += timedelta(days=1)
+
+    def count_queries(self, start_date, end_date):
+        """
+        Number of queries of one payslip computation with a cold calendar cache
+        """
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            payroll_calculation(self.employee, start_date, end_date)
+        return len(queries)
+
+    def test_payslip_queries_do_not_grow_with_period(self):
+        one_month = self.count_queries(date(2024, 1, 1), date(2024, 1, 31))
+        three_months = self.count_queries(date(2024, 1, 1), date(2024, 3, 31))
+        self.assertEqual(one_month, three_months)
+
+    def test_payslip_queries_are_fixed(self):
+        start_date = date(2024, 1, 1)
+        end_date = date(2024, 1, 31)
+        queries = self.count_queries(start_date, end_date)
+        self.assertEqual(queries, 12)
+
+        Attendance.objects.filter(attendance_date__day__gt=15).delete()
+        for extra in (
+            {"title": "Fixed", "is_fixed": True, "amount": 100},
+            {"title": "Overtime", "based_on": "overtime", "amount_per_one_hr": 10},
+            {"title": "Presence", "per_attendance_fixed_amount": 5},
+        ):
+            Allowance(
+                **{
+                    "include_active_employees": True,
+                    "is_fixed": False,
+                    "based_on": "attendance",
+                    "if_choice": "basic_pay",
+                    "if_condition": "gt",
+                    "if_amount": 0,
+                    **extra,
+                }
+            ).save()
+        self.assertEqual(self.count_queries(start_date, end_date), queries)
+
+    def test_period_helpers_read_the_context(self):
+        start_date = date(2024, 1, 1)
+        end_date = date(2024, 3, 31)
+        context = PayrollPeriodContext(
+            Employee.objects.filter(id=self.employee.id), start_date, end_date
+        )
+        with self.assertNumQueries(0):
+            working_days = get_working_days(start_date, end_date, context)
+            leaves = get_leaves(self.employee, start_date, end_date, context)
+            attendances = get_attendance(self.employee, start_date, end_date, context)
+        self.assertNotIn(date(2024, 1, 15), working_days["working_days_on"])
+        self.assertEqual(leaves["unpaid_leaves"], 2)
+        self.assertEqual(len(attendances["present_on"]), 91)
+
+
+class CompanyCalendarTest(TestCase):
+    """
+    The working days of an employee only skip the holidays of their company
+    and the holidays shared by all the companies
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.employees = {}
+        for name, day in (("North", 10), ("South", 11)):
+            company = Company.objects.create(
+                company=name,
+                address="Address",
+                country="Country",
+                state="State",
+                city="City",
+                zip="12345",
+            )
+            employee = Employee.objects.create(
+                employee_first_name=name,
+                employee_last_name="Test",
+                email=f"{name.lower()}.test@example.com",
+                phone="1234567890",
+            )
+            EmployeeWorkInformation.objects.create(
+                employee_id=employee, company_id=company
+            )
+            Holiday.objects.create(
+                name=name, start_date=date(2024, 1, day), company_id=company
+            )
+            cls.employees[name] = employee
+        Holiday.objects.create(name="Shared", start_date=date(2024, 1, 1))
+
+    def setUp(self):
+        cache.clear()
+
+    def assertHolidays(self, working_days, holidays):
+        self.assertEqual(set(working_days["company_leave_dates"]), holidays)
+
+    def test_context_reads_the_employee_company(self):
+        start_date = date(2024, 1, 1)
+        end_date = date(2024, 1, 31)
+        context = PayrollPeriodContext(
+            Employee.objects.filter(
+                id__in=[employee.id for employee in self.employees.values()]
+            ),
+            start_date,
+            end_date,
+        )
+        for name, day in (("North", 10), ("South", 11)):
+            employee = self.employees[name]
+            self.assertHolidays(
+                context.working_days(start_date, end_date, employee),
+                {date(2024, 1, 1), date(2024, 1, day)},
+            )
+            self.assertHolidays(
+                get_working_days(start_date, end_date, employee=employee),
+                {date(2024, 1, 1), date(2024, 1, day)},
+            )
+
+
+    def test_context_reads_the_pay_heads_of_the_employee_company(self):
+        # run as by the batch workers, without a request
+        self.assertIsNone(getattr(_thread_locals, "request", None))
+        for name in ("North", "South"):
+            allowance = Allowance(
+                title=f"{name} bonus",
+                include_active_employees=True,
+                is_fixed=True,
+                amount=100,
+                if_choice="basic_pay",
+                if_condition="gt",
+                if_amount=0,
+                company_id=Company.objects.get(company=name),
+            )
+            allowance.save()
+        Allowance(
+            title="Shared bonus",
+            include_active_employees=True,
+            is_fixed=True,
+            amount=100,
+            if_choice="basic_pay",
+            if_condition="gt",
+            if_amount=0,
+        ).save()
+        start_date = date(2024, 1, 1)
+        end_date = date(2024, 1, 31)
+        context = PayrollPeriodContext(
+            Employee.objects.filter(
+                id__in=[employee.id for employee in self.employees.values()]
+            ),
+            start_date,
+            end_date,
+        )
+        for name in ("North", "South"):
+            self.assertEqual(
+                {
+                    allowance.title
+                    for allowance in context.employee_allowances(
+                        self.employees[name], start_date, end_date
+                    )
+                },
+                {f"{name} bonus", "Shared bonus"},
+            )
+
+
+class PayHeadConditionTest(TestCase):
+    """
+    The conditions of the condition based pay heads, the other conditions
+    included, are compiled once and resolved for a batch of employees
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        departments = {}
+        for name in ("sales", "support"):
+            departments[name] = Department(department=name)
+            departments[name].save()
+        cls.employees = {}
+        for name, department in (
+            ("NorthSales", "sales"),
+            ("SouthSales", "sales"),
+            ("NorthSupport", "support"),
+        ):
+            employee = payroll_employee(name, 30000)
+            EmployeeWorkInformation.objects.filter(employee_id=employee).update(
+                department_id=departments[department]
+            )
+            cls.employees[name] = Employee.objects.get(id=employee.id)
+        cls.deduction = Deduction(
+            title="Union fee",
+            is_condition_based=True,
+            field="employee_work_info__department_id__department",
+            condition="equal",
+            value="Sales",
+            is_fixed=True,
+            amount=100,
+            is_pretax=False,
+        )
+        cls.deduction.save()
+        cls.deduction.other_conditions.add(
+            MultipleCondition.objects.create(
+                field="email", condition="icontains", value="north"
+            )
+        )
+
+    def test_compiled_conditions(self):
+        rules = compile_conditions(self.deduction)
+        self.assertEqual(
+            [(field, value) for field, _operator, value in rules],
+            [
+                ("email", "north"),
+                ("employee_work_info__department_id__department", "sales"),
+            ],
+        )
+        values = {
+            "email": "north.test@example.com",
+            "employee_work_info__department_id__department": "sales",
+        }
+        self.assertTrue(rules_match(rules, values.get))
+        self.assertFalse(rules_match(rules, {**values, "email": "south"}.get))
+        self.assertFalse(rules_match(rules, {"email": "north"}.get))
+
+    def test_bulk_eligibility_matches_single_checks(self):
+        def eligible(employees):
+            deduction = Deduction.objects.prefetch_related("other_conditions").get(
+                id=self.deduction.id
+            )
+            employees = list(
+                Employee.objects.filter(id__in=[employee.id for employee in employees])
+            )
+            with CaptureQueriesContext(connection) as queries:
+                resolve_eligibility([deduction], employees)
+            return deduction.eligible_employee_ids, len(queries)
+
+        employees = list(self.employees.values())
+        eligible_ids, queries = eligible(employees)
+        self.assertEqual(
+            eligible_ids,
+            {
+                employee.id
+                for employee in employees
+                if component_applies(self.deduction, employee)
+            },
+        )
+        self.assertEqual(eligible_ids, {self.employees["NorthSales"].id})
+        self.assertEqual(eligible(employees[:1])[1], queries)
+
+    def test_post_tax_deduction_other_conditions(self):
+        # post-tax deductions check their other conditions like the
+        # allowances and the pre-tax deductions
+        for name, applies in (
+            ("NorthSales", True),
+            ("SouthSales", False),
+            ("NorthSupport", False),
+        ):
+            payroll = payroll_calculation(
+                self.employees[name], date(2024, 1, 1), date(2024, 1, 31)
+            )
+            titles = [
+                deduction["title"] for deduction in payroll["post_tax_deductions"]
+            ]
+            self.assertEqual("Union fee" in titles, applies, name)
+
+
+def bracket_walk(brackets, yearly_income):
+    """
+    Yearly tax of the income with the per bracket loop the table replaced
+    """
+    federal_tax = 0
+    remaining_income = yearly_income
+    if brackets and brackets[0][0] <= yearly_income:
+        for min_income, max_income, tax_rate in brackets:
+            if remaining_income <= 0:
+                break
+            taxable_amount = min(remaining_income, max_income - min_income)
+            federal_tax += taxable_amount * tax_rate / 100
+            remaining_income -= taxable_amount
+    return federal_tax
+
+
+class TaxBracketTableTest(TestCase):
+    """
+    The cached bracket table should tax like the bracket loop and follow the
+    changes of the brackets
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.filing_status = FilingStatus.objects.create(
+            filing_status="Single", based_on="basic_pay"
+        )
+        cls.brackets = [(5000, 10000, 0), (10000, 40000, 10), (40000, 1e12, 20)]
+        for min_income, max_income, tax_rate in cls.brackets:
+            TaxBracket.objects.create(
+                filing_status_id=cls.filing_status,
+                min_income=min_income,
+                max_income=max_income,
+                tax_rate=tax_rate,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_bracket_boundaries_match_the_bracket_walk(self):
+        incomes = [0, 4999.99, 5000, 9999.99, 10000, 10000.01, 40000, 40000.01, 1e6]
+        taxes = get_tax_bracket_table(self.filing_status.id).annual_tax(incomes)
+        for income, tax in zip(incomes, taxes):
+            self.assertAlmostEqual(tax, bracket_walk(self.brackets, income), 6, income)
+
+    def test_saved_bracket_drops_the_cached_table(self):
+        def annual_tax():
+            return get_tax_bracket_table(self.filing_status.id).annual_tax(20000)[0]
+
+        self.assertAlmostEqual(annual_tax(), 1500)
+        bracket = TaxBracket.objects.get(
+            filing_status_id=self.filing_status, min_income=10000
+        )
+        bracket.tax_rate = 15
+        bracket.save()
+        self.assertAlmostEqual(annual_tax(), 2250)
+        bracket.delete()
+        self.assertAlmostEqual(annual_tax(), 3000)
+
+
+@override_settings(
+    EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+    PAYSLIP_PDF_EXECUTOR="local",
+    PAYSLIP_PDF_ROOT=tempfile.mkdtemp(),
+    PAYSLIP_MAIL_CHUNK_SIZE=1,
+    # the mail template reads the static files, not collected for the tests
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+)
+class PayslipMailDispatcherTest(TestCase):
+    """
+    The payslips are mailed in chunks and their delivery status is recorded,
+    their stored PDFs are streamed as a zip archive
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        PayrollSettings.objects.create(currency_symbol="$")
+        employees = []
+        for index in range(3):
+            employee = Employee.objects.create(
+                employee_first_name=f"Mail{index}",
+                employee_last_name="Test",
+                email=f"mail{index}.test@example.com",
+                phone="1234567890",
+            )
+            EmployeeWorkInformation.objects.create(
+                employee_id=employee,
+                email=f"work{index}@example.com" if index else None,
+            )
+            Contract.objects.create(
+                contract_name="Contract",
+                employee_id=employee,
+                contract_start_date=date(2023, 1, 1),
+                wage_type="monthly",
+                wage=30000,
+                contract_status="active",
+            )
+            employees.append(employee)
+        generate_payslip_batch(
+            Employee.objects.filter(id__in=[employee.id for employee in employees]),
+            date(2024, 1, 1),
+            date(2024, 1, 31),
+            "January",
+        )
+
+    def test_payslips_are_mailed_in_chunks(self):
+        status = PayslipMailDispatcher().dispatch(Payslip.objects.all())
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ["work1@example.com", "work2@example.com"],
+        )
+        self.assertTrue(
+            all(
+                message.attachments[0][2] == "application/pdf"
+                for message in mail.outbox
+            )
+        )
+        self.assertEqual(Payslip.objects.filter(sent_to_employee=True).count(), 2)
+        self.assertEqual(list(status.values()).count("No email address"), 1)
+
+    @override_settings(PAYSLIP_MAIL_CHUNK_SIZE=50)
+    def test_connection_error_resends_only_the_failed_mail(self):
+        class DroppingBackend(locmem.EmailBackend):
+            """
+            Drops the connection once, on the second mail
+            """
+
+            dropped = False
+
+            def send_messages(self, messages):
+                for message in messages:
+                    if len(mail.outbox) == 1 and not self.dropped:
+                        self.dropped = True
+                        raise smtplib.SMTPServerDisconnected("Connection lost")
+                    super().send_messages([message])
+                return len(messages)
+
+        status = PayslipMailDispatcher(connection=DroppingBackend()).dispatch(
+            Payslip.objects.all()
+        )
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ["work1@example.com", "work2@example.com"],
+        )
+        self.assertEqual(list(status.values()).count(None), 2)
+
+    def test_unrendered_pdf_is_not_marked_sent(self):
+        failed = Payslip.objects.filter(
+            employee_id__employee_work_info__email="work1@example.com"
+        ).first()
+
+        def render_payslip_pdfs(payslip_ids):
+            for payslip_id, path in payslip_pdf.render_payslip_pdfs(payslip_ids):
+                yield payslip_id, None if payslip_id == failed.id else path
+
+        with patch.object(payslip_mail, "render_payslip_pdfs", render_payslip_pdfs):
+            status = PayslipMailDispatcher().dispatch(Payslip.objects.all())
+        self.assertEqual(status[failed.id], "PDF not rendered")
+        self.assertEqual(
+            [message.to[0] for message in mail.outbox], ["work2@example.com"]
+        )
+        failed.refresh_from_db()
+        self.assertFalse(failed.sent_to_employee)
+
+    def test_failed_resend_keeps_the_delivery(self):
+        class FailingBackend(locmem.EmailBackend):
+            """
+            Refuses every mail
+            """
+
+            def send_messages(self, messages):
+                return 0
+
+        PayslipMailDispatcher().dispatch(Payslip.objects.all())
+        status = PayslipMailDispatcher(connection=FailingBackend()).dispatch(
+            Payslip.objects.all()
+        )
+        self.assertEqual(
+            list(status.values()).count("Mail server did not accept the mail"), 2
+        )
+        self.assertEqual(Payslip.objects.filter(sent_to_employee=True).count(), 2)
+
+    def test_batch_zip_is_streamed(self):
+        user = User.objects.create_superuser("payroll.admin", password="password")
+        self.client.force_login(user)
+        # the middleware keeps the request of the view for the later saves
+        self.addCleanup(setattr, _thread_locals, "request", None)
+        response = self.client.get(
+            reverse("payslip-batch-zip"), {"group_name": "January"}
+        )
+        self.assertTrue(response.streaming)
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        payslips = Payslip.objects.select_related("employee_id")
+        self.assertEqual(
+            sorted(archive.namelist()),
+            sorted(payslip_pdf.payslip_pdf_title(payslip) for payslip in payslips),
+        )
+        for name in archive.namelist():
+            self.assertTrue(archive.read(name).startswith(b"%PDF"))
+
+    def test_pdf_revision_follows_the_employee_details(self):
+        payslip = Payslip.objects.select_related("employee_id").first()
+        bank_details = EmployeeBankDetails.objects.create(
+            employee_id=payslip.employee_id,
+            bank_name="Bank",
+            account_number="1111",
+            branch="Branch",
+            address="Address",
+        )
+        revision = payslip_revision(payslip)
+        self.assertEqual(payslip_revision(payslip), revision)
+        bank_details.account_number = "2222"
+        bank_details.save()
+        self.assertNotEqual(payslip_revision(payslip), revision)
+
+
+@override_settings(PAYSLIP_JOB_EXECUTOR="local", PAYSLIP_JOB_CHUNK_SIZE=2)
+class PayslipBatchJobTest(TestCase):
+    """
+    The chunks of a payslip batch job should record the progress and the
+    failures of their employees, and the chunks of a stalled job be resumed
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.employees = []
+        for index in range(4):
+            employee = Employee.objects.create(
+                employee_first_name=f"Job{index}",
+                employee_last_name="Test",
+                email=f"job{index}.test@example.com",
+                phone="1234567890",
+            )
+            EmployeeWorkInformation.objects.create(employee_id=employee)
+            if index < 3:
+                Contract.objects.create(
+                    contract_name="Contract",
+                    employee_id=employee,
+                    contract_start_date=date(2023, 1, 1),
+                    wage_type="monthly",
+                    wage=30000,
+                    contract_status="active",
+                )
+            cls.employees.append(employee)
+
+    def setUp(self):
+        self.addCleanup(setattr, payslip_jobs, "_executor", payslip_jobs._executor)
+        payslip_jobs._executor = None
+
+    def job(self, employee_ids):
+        job = PayslipBatchJob(
+            group_name="January",
+            start_date=date(2024, 1, 1),
+            end_date=date(2024, 1, 31),
+            employee_ids=employee_ids,
+            total_count=len(employee_ids),
+            created_by=self.employees[0].employee_user_id,
+        )
+        job.save()
+        return job
+
+    def test_job_progress_and_failures(self):
+        missing_id = max(employee.id for employee in self.employees) + 1
+        job = self.job([employee.id for employee in self.employees] + [missing_id])
+        with self.captureOnCommitCallbacks(execute=True):
+            payslip_jobs.submit_payslip_job(job)
+        job.refresh_from_db()
+        self.assertEqual(
+            job.progress(),
+            {
+                "job_id": job.id,
+                "group_name": "January",
+                "status": "completed",
+                "total": 5,
+                "done": 3,
+                "failed": 2,
+                "remaining": 0,
+                "errors": {
+                    str(self.employees[3].id): "No active contract",
+                    str(missing_id): "Employee not found",
+                },
+            },
+        )
+        self.assertEqual(job.pending_chunks, [])
+        # each employee is sent to their own payslip
+        self.assertEqual(
+            sorted(
+                notification.data["redirect"]
+                for notification in Notification.objects.filter(
+                    verb="Payslip has been generated for you."
+                )
+            ),
+            sorted(
+                f"/payroll/view-payslip/{payslip.id}"
+                for payslip in Payslip.objects.all()
+            ),
+        )
+
+    def test_stalled_job_is_resumed(self):
+        job = self.job([employee.id for employee in self.employees[:3]])
+        # the chunks of a job queued by a web process that stopped
+        job.pending_chunks = [[self.employees[0].id, self.employees[1].id]]
+        job.done_count = 1
+        job.save()
+        self.assertEqual(payslip_jobs.resume_payslip_jobs(), [])
+        PayslipBatchJob.objects.filter(id=job.id).update(
+            updated_at=job.updated_at - timedelta(hours=1)
+        )
+
+        self.assertEqual(payslip_jobs.resume_payslip_jobs(), [job])
+        job.refresh_from_db()
+        self.assertEqual(
+            (job.status, job.done_count, job.pending_chunks), ("completed", 3, [])
+        )
+        # a chunk run again is not counted twice
+        payslip_jobs.run_payslip_job_chunk(
+            job.id, [self.employees[0].id, self.employees[1].id]
+        )
+        job.refresh_from_db()
+        self.assertEqual(job.done_count, 3)
+
+    def test_archived_contract_is_not_used(self):
+        Contract.objects.filter(employee_id=self.employees[0]).update(
+            is_active=False
+        )
+        context = PayrollPeriodContext(
+            Employee.objects.filter(id=self.employees[0].id),
+            date(2024, 1, 1),
+            date(2024, 1, 31),
+        )
+        self.assertIsNone(get_active_contract(self.employees[0], context))
+
+    def test_resume_is_scheduled(self):
+        # registered when the payroll app is loaded
+        self.assertIn(
+            payroll_scheduler.resume_payslip_jobs,
+            [job.func for job in payroll_scheduler.scheduler.get_jobs()],
+        )
+
+    def test_workers_do_not_start_the_schedulers(self):
+        scheduler = BackgroundScheduler()
+        with patch.dict(os.environ, {SCHEDULER_DISABLED_ENV: "1"}):
+            start_scheduler(scheduler)
+        self.assertFalse(scheduler.running)
+
+
+class PayslipBatchEngineTest(TestCase):
+    """
+    The payslips of a batch should be the payslips computed one by one, with
+    a number of queries that does not depend on the number of employees
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        filing_status = FilingStatus.objects.create(
+            filing_status="Single", based_on="taxable_gross_pay"
+        )
+        TaxBracket.objects.create(
+            filing_status_id=filing_status, min_income=0, max_income=100000, tax_rate=5
+        )
+        TaxBracket.objects.create(
+            filing_status_id=filing_status,
+            min_income=100000,
+            max_income=1e12,
+            tax_rate=20,
+        )
+        Allowance(
+            title="Travel",
+            include_active_employees=True,
+            is_fixed=True,
+            amount=1200,
+            if_choice="basic_pay",
+            if_condition="gt",
+            if_amount=0,
+        ).save()
+        Deduction(
+            title="Provident fund",
+            include_active_employees=True,
+            is_fixed=False,
+            based_on="basic_pay",
+            rate=10,
+            employer_rate=5,
+            is_pretax=True,
+        ).save()
+        cls.employees = [
+            payroll_employee(f"Engine{index}", wage, filing_status)
+            for index, wage in enumerate([12000, 30000, 45000, 80000])
+        ]
+        cls.without_contract = payroll_employee("Engine4")
+
+    def batch(self, employees, errors=None):
+        return generate_payslip_batch(
+            Employee.objects.filter(id__in=[employee.id for employee in employees]),
+            date(2024, 1, 1),
+            date(2024, 1, 31),
+            "January",
+            errors=errors,
+        )
+
+    def test_batch_matches_single_payslips(self):
+        errors = {}
+        payslips = {
+            payslip.employee_id_id: payslip
+            for payslip in self.batch(self.employees + [self.without_contract], errors)
+        }
+        self.assertEqual(errors, {self.without_contract.id: "No active contract"})
+        self.assertEqual(set(payslips), {employee.id for employee in self.employees})
+        for employee in self.employees:
+            expected = payroll_calculation(employee, date(2024, 1, 1), date(2024, 1, 31))
+            payslip = payslips[employee.id]
+            self.assertGreater(expected["federal_tax"], 0)
+            for field, key in [
+                ("basic_pay", "basic_pay"),
+                ("gross_pay", "gross_pay"),
+                ("deduction", "total_deductions"),
+                ("net_pay", "net_pay"),
+            ]:
+                self.assertAlmostEqual(
+                    getattr(payslip, field), round(expected[key], 2), 2, field
+                )
+            self.assertEqual(
+                payslip.pay_head_data["federal_tax"], expected["federal_tax"]
+            )
+
+    def test_employee_without_contract_is_skipped(self):
+        payslips = self.batch([self.without_contract, self.employees[0]])
+        self.assertEqual(
+            [payslip.employee_id_id for payslip in payslips], [self.employees[0].id]
+        )
+
+    def test_backfilled_line_items_match_pay_head_data(self):
+        self.batch(self.employees)
+        PayslipLineItem.objects.all().delete()
+        call_command(
+            "backfill_payslip_line_items",
+            "--missing-only",
+            "--batch-size=3",
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(
+            PayslipLineItem.objects.filter(kind="allowance").count(),
+            len(self.employees),
+        )
+        expected = {
+            (payslip.employee_id_id, deduction["deduction_id"]): deduction
+            for payslip in Payslip.objects.all()
+            for deduction in payslip.pay_head_data["pretax_deductions"]
+        }
+        totals = {
+            (row["employee_id"], row["component_id"]): row
+            for row in contribution_totals(
+                PayslipLineItem.objects.all(), "employee_id"
+            )
+        }
+        self.assertEqual(len(totals), len(self.employees))
+        self.assertEqual(set(totals), set(expected))
+        for key, deduction in expected.items():
+            self.assertAlmostEqual(
+                totals[key]["employee_contribution"], deduction["amount"]
+            )
+            self.assertAlmostEqual(
+                totals[key]["employer_contribution"],
+                deduction["employer_contribution_amount"],
+            )
+
+    def test_batch_queries_are_fixed(self):
+        def batch_queries(employees):
+            cache.clear()
+            Payslip.objects.all().delete()
+            with CaptureQueriesContext(connection) as queries:
+                self.batch(employees)
+            return len(queries)
+
+        self.assertEqual(batch_queries(self.employees[:1]), 27)
+        self.assertEqual(batch_queries(self.employees), 27)
@@ -59,6 +59,16 @@ urlpatterns = [
     ),
     path("create-payslip", component_views.create_payslip, name="create-payslip"),
     path("generate-payslip", component_views.generate_payslip, name="generate-payslip"),
+    path(
+        "payslip-batch-status/<int:job_id>",
+        component_views.payslip_batch_status,
+        name="payslip-batch-status",
+    ),
+    path(
+        "payslip-batch-progress",
+        component_views.payslip_batch_progress,
+        name="payslip-batch-progress",
+    ),
     path(
         "validate-start-date",
         component_views.validate_start_date,
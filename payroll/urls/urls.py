@@ -46,6 +46,7 @@ urlpatterns = [
         name="single-contract-view",
     ),
     path("payslip-pdf/<int:id>", views.payslip_pdf, name="payslip-pdf"),
+    path("payslip-batch-zip", views.payslip_batch_zip, name="payslip-batch-zip"),
     path("contract-filter", views.contract_filter, name="contract-filter"),
     path("contract-create", views.work_record_create, name="contract-create"),
     path("work-record-view", views.work_record_view, name="work-record-view"),
@@ -5,7 +5,6 @@ This module is used to write methods to the component_urls patterns respectively
 """
 
 from collections import defaultdict
-from itertools import groupby
 import json
 import operator
 from datetime import date, datetime
@@ -31,19 +30,11 @@ from payroll.models.models import (
     Deduction,
     LoanAccount,
     Payslip,
+    PayslipBatchJob,
+    PayslipLineItem,
     Reimbursement,
     ReimbursementMultipleAttachment,
 )
-from payroll.methods.payslip_calc import (
-    calculate_allowance,
-    calculate_gross_pay,
-    calculate_taxable_gross_pay,
-)
-from payroll.methods.payslip_calc import (
-    calculate_post_tax_deduction,
-    calculate_pre_tax_deduction,
-    calculate_tax_deduction,
-)
 from payroll.filters import (
     AllowanceFilter,
     DeductionFilter,
@@ -53,17 +44,14 @@ from payroll.filters import (
     ReimbursementFilter,
 )
 from payroll.forms import component_forms as forms
-from payroll.methods.payslip_calc import (
-    calculate_net_pay_deduction,
-)
-from payroll.methods.tax_calc import calculate_taxable_amount
 from payroll.methods.methods import (
     calculate_employer_contribution,
-    compute_salary_on_period,
     paginator_qry,
     save_payslip,
 )
-from payroll.methods.deductions import update_compensation_deduction
+from payroll.methods.engine import payroll_calculation
+from payroll.methods.line_items import contribution_totals
+from payroll.methods.payslip_jobs import submit_payslip_job
 from payroll.threadings.mail import MailSendThread
 from payroll.views.views import view_created_payslip
 
@@ -78,158 +66,6 @@ operator_mapping = {
 }
 
 
-def payroll_calculation(employee, start_date, end_date):
-    """
-    Calculate payroll components for the specified employee within the given date range.
-
-
-    Args:
-        employee (Employee): The employee for whom the payroll is calculated.
-        start_date (date): The start date of the payroll period.
-        end_date (date): The end date of the payroll period.
-
-
-    Returns:
-        dict: A dictionary containing the calculated payroll components:
-    """
-
-    basic_pay_details = compute_salary_on_period(employee, start_date, end_date)
-    contract = basic_pay_details["contract"]
-    contract_wage = basic_pay_details["contract_wage"]
-    basic_pay = basic_pay_details["basic_pay"]
-    loss_of_pay = basic_pay_details["loss_of_pay"]
-    paid_days = basic_pay_details["paid_days"]
-    unpaid_days = basic_pay_details["unpaid_days"]
-
-    working_days_details = basic_pay_details["month_data"]
-
-    updated_basic_pay_data = update_compensation_deduction(
-        employee, basic_pay, "basic_pay", start_date, end_date
-    )
-    basic_pay = updated_basic_pay_data["compensation_amount"]
-    basic_pay_deductions = updated_basic_pay_data["deductions"]
-
-    loss_of_pay_amount = (
-        float(loss_of_pay) if not contract.deduct_leave_from_basic_pay else 0
-    )
-
-    basic_pay = basic_pay - loss_of_pay_amount
-
-    kwargs = {
-        "employee": employee,
-        "start_date": start_date,
-        "end_date": end_date,
-        "basic_pay": basic_pay,
-        "day_dict": working_days_details,
-    }
-    # basic pay will be basic_pay = basic_pay - update_compensation_amount
-    allowances = calculate_allowance(**kwargs)
-
-    # finding the total allowance
-    total_allowance = sum(allowance["amount"] for allowance in allowances["allowances"])
-
-    kwargs["allowances"] = allowances
-    kwargs["total_allowance"] = total_allowance
-    gross_pay = calculate_gross_pay(**kwargs)["gross_pay"]
-    updated_gross_pay_data = update_compensation_deduction(
-        employee, gross_pay, "gross_pay", start_date, end_date
-    )
-    gross_pay = updated_gross_pay_data["compensation_amount"]
-    gross_pay_deductions = updated_gross_pay_data["deductions"]
-
-    kwargs["gross_pay"] = gross_pay
-    pretax_deductions = calculate_pre_tax_deduction(**kwargs)
-    post_tax_deductions = calculate_post_tax_deduction(**kwargs)
-
-    installments = (
-        pretax_deductions["installments"] | post_tax_deductions["installments"]
-    )
-
-    taxable_gross_pay = calculate_taxable_gross_pay(**kwargs)
-    tax_deductions = calculate_tax_deduction(**kwargs)
-    federal_tax = calculate_taxable_amount(**kwargs)
-
-    # gross_pay = (basic_pay + total_allowances)
-    # deduction = (
-    #   post_tax_deductions_amount
-    #   + pre_tax_deductions _amount
-    #   + tax_deductions + federal_tax_amount
-    #   + lop_amount
-    #   + one_time_basic_deduction_amount
-    #   + one_time_gross_deduction_amount
-    #   )
-    # net_pay = gross_pay - deduction
-    # net_pay = net_pay - net_pay_deduction
-
-    total_allowance = sum(item["amount"] for item in allowances["allowances"])
-    total_pretax_deduction = sum(
-        item["amount"] for item in pretax_deductions["pretax_deductions"]
-    )
-    total_post_tax_deduction = sum(
-        item["amount"] for item in post_tax_deductions["post_tax_deductions"]
-    )
-    total_tax_deductions = sum(
-        item["amount"] for item in tax_deductions["tax_deductions"]
-    )
-
-    total_deductions = (
-        total_pretax_deduction
-        + total_post_tax_deduction
-        + total_tax_deductions
-        + federal_tax
-        + loss_of_pay_amount
-    )
-
-    net_pay = (basic_pay + total_allowance) - total_deductions
-    updated_net_pay_data = update_compensation_deduction(
-        employee, net_pay, "net_pay", start_date, end_date
-    )
-    net_pay = updated_net_pay_data["compensation_amount"]
-    update_net_pay_deductions = updated_net_pay_data["deductions"]
-
-    net_pay_deductions = calculate_net_pay_deduction(
-        net_pay,
-        post_tax_deductions["net_pay_deduction"],
-        **kwargs,
-    )
-    net_pay_deduction_list = net_pay_deductions["net_pay_deductions"]
-    for deduction in update_net_pay_deductions:
-        net_pay_deduction_list.append(deduction)
-    net_pay = net_pay - net_pay_deductions["net_deduction"]
-    payslip_data = {
-        "employee": employee,
-        "contract_wage": contract_wage,
-        "basic_pay": basic_pay,
-        "gross_pay": gross_pay,
-        "taxable_gross_pay": taxable_gross_pay["taxable_gross_pay"],
-        "net_pay": net_pay,
-        "allowances": allowances["allowances"],
-        "paid_days": paid_days,
-        "unpaid_days": unpaid_days,
-        "basic_pay_deductions": basic_pay_deductions,
-        "gross_pay_deductions": gross_pay_deductions,
-        "pretax_deductions": pretax_deductions["pretax_deductions"],
-        "post_tax_deductions": post_tax_deductions["post_tax_deductions"],
-        "tax_deductions": tax_deductions["tax_deductions"],
-        "net_deductions": net_pay_deduction_list,
-        "total_deductions": total_deductions,
-        "loss_of_pay": loss_of_pay,
-        "federal_tax": federal_tax,
-        "start_date": start_date,
-        "end_date": end_date,
-        "range": f"{start_date.strftime('%b %d %Y')} - {end_date.strftime('%b %d %Y')}",
-    }
-    data_to_json = payslip_data.copy()
-    data_to_json["employee"] = employee.id
-    data_to_json["start_date"] = start_date.strftime("%Y-%m-%d")
-    data_to_json["end_date"] = end_date.strftime("%Y-%m-%d")
-    json_data = json.dumps(data_to_json)
-
-    payslip_data["json_data"] = json_data
-    payslip_data["installments"] = installments
-    return payslip_data
-
-
 @login_required
 @permission_required("payroll.add_allowance")
 def create_allowance(request):
@@ -546,62 +382,65 @@ def generate_payslip(request):
     Requires the user to be logged in and have the 'payroll.add_payslip' permission.
 
     """
-    payslips = []
-    json_data = []
     form = forms.GeneratePayslipForm()
     if request.method == "POST":
         form = forms.GeneratePayslipForm(request.POST)
         if form.is_valid():
-            instances = []
             employees = form.cleaned_data["employee_id"]
             start_date = form.cleaned_data["start_date"]
             end_date = form.cleaned_data["end_date"]
             group_name = form.cleaned_data["group_name"]
-            for employee in employees:
-                contract = payroll.models.models.Contract.objects.filter(
-                    employee_id=employee, contract_status="active"
-                ).first()
-                if start_date < contract.contract_start_date:
-                    start_date = contract.contract_start_date
-                payslip = payroll_calculation(employee, start_date, end_date)
-                payslips.append(payslip)
-                json_data.append(payslip["json_data"])
-
-                payslip["payslip"] = payslip
-                data = {}
-                data["employee"] = employee
-                data["group_name"] = group_name
-                data["start_date"] = payslip["start_date"]
-                data["end_date"] = payslip["end_date"]
-                data["status"] = "draft"
-                data["contract_wage"] = payslip["contract_wage"]
-                data["basic_pay"] = payslip["basic_pay"]
-                data["gross_pay"] = payslip["gross_pay"]
-                data["deduction"] = payslip["total_deductions"]
-                data["net_pay"] = payslip["net_pay"]
-                data["pay_data"] = json.loads(payslip["json_data"])
-                data["installments"] = payslip["installments"]
-                instance = save_payslip(**data)
-                instances.append(instance)
-                notify.send(
-                    request.user.employee_get,
-                    recipient=employee.employee_user_id,
-                    verb="Payslip has been generated for you.",
-                    verb_ar="تم إصدار كشف راتب لك.",
-                    verb_de="Gehaltsabrechnung wurde für Sie erstellt.",
-                    verb_es="Se ha generado la nómina para usted.",
-                    verb_fr="La fiche de paie a été générée pour vous.",
-                    redirect=f"/payroll/view-payslip/{instance.id}",
-                    icon="close",
-                )
-            messages.success(request, f"{employees.count()} payslip saved as draft")
-            return redirect(
-                f"/payroll/view-payslip?group_by=group_name&active_group={group_name}"
+            employee_ids = list(employees.values_list("id", flat=True))
+            job = PayslipBatchJob(
+                group_name=group_name,
+                start_date=start_date,
+                end_date=end_date,
+                employee_ids=employee_ids,
+                total_count=len(employee_ids),
             )
+            job.save()
+            submit_payslip_job(job)
+            messages.info(
+                request, f"Generating payslips for {len(employee_ids)} employees"
+            )
+            return redirect("payslip-batch-status", job_id=job.id)
 
     return render(request, "payroll/common/form.html", {"form": form})
 
 
+@login_required
+@permission_required("payroll.add_payslip")
+def payslip_batch_status(request, job_id):
+    """
+    This method is used to render the progress page of a payslip batch, the
+    page polls payslip_batch_progress until the batch is completed
+    """
+    job = PayslipBatchJob.objects.filter(id=job_id).first()
+    if job is None:
+        messages.error(request, _("Payslip batch not found."))
+        return redirect("view-payslip")
+    return render(request, "payroll/payslip/batch_progress.html", {"job": job})
+
+
+@login_required
+@permission_required("payroll.view_payslip")
+def payslip_batch_progress(request):
+    """
+    This method is used to return the done/failed/remaining counts of the
+    latest payslip batch of the group_name (or of the job_id) as json
+    """
+    jobs = PayslipBatchJob.objects.all()
+    job_id = request.GET.get("job_id")
+    if job_id:
+        jobs = jobs.filter(id=job_id)
+    else:
+        jobs = jobs.filter(group_name=request.GET.get("group_name"))
+    job = jobs.first()
+    if job is None:
+        return JsonResponse({"error": "Payslip batch not found"}, status=404)
+    return JsonResponse(job.progress())
+
+
 @login_required
 @permission_required("payroll.add_payslip")
 def create_payslip(request, new_post_data=None):
@@ -1526,53 +1365,19 @@ def get_contribution_report(request):
     This method is used to get the contribution report
     """
     employee_id = request.GET["employee_id"]
-    pay_heads = Payslip.objects.filter(employee_id__id=employee_id).values_list(
-        "pay_head_data", flat=True
-    )
-    contribution_deductions = []
-    deductions = []
-    for head in pay_heads:
-        for deduction in head["gross_pay_deductions"]:
-            if deduction.get("deduction_id"):
-                deductions.append(deduction)
-        for deduction in head["basic_pay_deductions"]:
-            if deduction.get("deduction_id"):
-                deductions.append(deduction)
-        for deduction in head["pretax_deductions"]:
-            if deduction.get("deduction_id"):
-                deductions.append(deduction)
-        for deduction in head["post_tax_deductions"]:
-            if deduction.get("deduction_id"):
-                deductions.append(deduction)
-        for deduction in head["tax_deductions"]:
-            if deduction.get("deduction_id"):
-                deductions.append(deduction)
-        for deduction in head["net_deductions"]:
-            deductions.append(deduction)
-
-    deductions.sort(key=lambda x: x["deduction_id"])
-    grouped_deductions = {
-        key: list(group)
-        for key, group in groupby(deductions, key=lambda x: x["deduction_id"])
-    }
-
-    for deduction_id, group in grouped_deductions.items():
-        title = group[0]["title"]
-        employee_contribution = sum(item.get("amount", 0) for item in group)
-        employer_contribution = sum(
-            item.get("employer_contribution_amount", 0) for item in group
+    contribution_deductions = [
+        {
+            "deduction_id": total["component_id"],
+            "title": total["component_title"],
+            "employee_contribution": total["employee_contribution"],
+            "employer_contribution": total["employer_contribution"],
+            "total_contribution": total["employee_contribution"]
+            + total["employer_contribution"],
+        }
+        for total in contribution_totals(
+            PayslipLineItem.objects.filter(employee_id__id=employee_id)
         )
-        total_contribution = employee_contribution + employer_contribution
-        if employer_contribution > 0:
-            contribution_deductions.append(
-                {
-                    "deduction_id": deduction_id,
-                    "title": title,
-                    "employee_contribution": employee_contribution,
-                    "employer_contribution": employer_contribution,
-                    "total_contribution": total_contribution,
-                }
-            )
+    ]
 
     return render(
         request,
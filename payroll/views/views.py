@@ -5,14 +5,18 @@ This module is used to define the method for the path in the urls
 """
 
 from collections import defaultdict
-from itertools import groupby
 from urllib.parse import parse_qs
 import pandas as pd
 import json
 from datetime import date, datetime, timedelta
 from django.utils import timezone
 from django.shortcuts import get_object_or_404, render, redirect
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import (
+    HttpResponse,
+    JsonResponse,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.contrib import messages
 from django.db.models import Q, ProtectedError
 from attendance.methods.group_by import group_by_queryset
@@ -22,12 +26,12 @@ from horilla.decorators import login_required, owner_can_enter, permission_requi
 from base.methods import export_data, generate_colors, get_key_instances, sortby
 from employee.models import Employee, EmployeeWorkInformation
 from base.methods import closest_numbers
-from base.methods import generate_pdf
 from payroll.context_processors import get_active_employees
 from payroll.models.models import (
     FilingStatus,
     PayrollGeneralSetting,
     Payslip,
+    PayslipLineItem,
     Reimbursement,
     ReimbursementFile,
     ReimbursementrequestComment,
@@ -36,7 +40,13 @@ from payroll.models.models import (
 )
 from payroll.models.tax_models import PayrollSettings
 from payroll.forms.component_forms import ContractExportFieldForm, PayrollSettingsForm
+from payroll.methods.line_items import contribution_totals, write_line_items
 from payroll.methods.methods import save_payslip
+from payroll.methods.payslip_pdf import (
+    get_payslip_pdf,
+    payslip_pdf_title,
+    stream_payslip_zip,
+)
 from django.utils.translation import gettext_lazy as _
 from payroll.filters import ContractFilter, ContractReGroup, PayslipFilter
 from payroll.methods.methods import paginator_qry
@@ -527,6 +537,7 @@ def bulk_update_payslip_status(request):
         instance.net_pay = data["net_pay"]
         instance.pay_head_data = data
         instance.save()
+        write_line_items([instance])
 
     return JsonResponse({"type": "success", "message": "Payslips status updated"})
 
@@ -879,70 +890,24 @@ def payslip_export(request):
 
     emp = request.user.employee_get
 
-    for employ in contributions:
-        payslips = Payslip.objects.filter(employee_id__id=employ)
-        if end_date:
-            payslips = Payslip.objects.filter(
-                employee_id__id=employ, end_date__lte=end_date
-            )
-        if start_date:
-            payslips = Payslip.objects.filter(
-                employee_id__id=employ, start_date__gte=start_date
-            )
-            if end_date:
-                payslips = payslips.filter(end_date__lte=end_date)
-        pay_heads = payslips.values_list("pay_head_data", flat=True)
-        contribution_deductions = []
-        deductions = []
-        for head in pay_heads:
-            for deduction in head["gross_pay_deductions"]:
-                if deduction.get("deduction_id"):
-                    deductions.append(deduction)
-            for deduction in head["basic_pay_deductions"]:
-                if deduction.get("deduction_id"):
-                    deductions.append(deduction)
-            for deduction in head["pretax_deductions"]:
-                if deduction.get("deduction_id"):
-                    deductions.append(deduction)
-            for deduction in head["post_tax_deductions"]:
-                if deduction.get("deduction_id"):
-                    deductions.append(deduction)
-            for deduction in head["tax_deductions"]:
-                if deduction.get("deduction_id"):
-                    deductions.append(deduction)
-            for deduction in head["net_deductions"]:
-                deductions.append(deduction)
-
-        deductions.sort(key=lambda x: x["deduction_id"])
-        grouped_deductions = {
-            key: list(group)
-            for key, group in groupby(deductions, key=lambda x: x["deduction_id"])
-        }
-
-        for deduction_id, group in grouped_deductions.items():
-            title = group[0]["title"]
-            employee_contribution = sum(item["amount"] for item in group)
-            employer_contribution = sum(
-                item["employer_contribution_amount"] for item in group
-            )
-            total_contribution = employee_contribution + employer_contribution
-            if employer_contribution > 0:
-                contribution_deductions.append(
-                    {
-                        "deduction_id": deduction_id,
-                        "title": title,
-                        "employee_contribution": employee_contribution,
-                        "employer_contribution": employer_contribution,
-                        "total_contribution": total_contribution,
-                    }
-                )
-                table5_data.append(
-                    {
-                        "Employee": Employee.objects.get(id=emp),
-                        "Employer Contribution": employer_contribution,
-                        "Employee Contribution": employee_contribution,
-                    }
-                )
+    line_items = PayslipLineItem.objects.filter(employee_id__in=contributions)
+    if start_date:
+        line_items = line_items.filter(start_date__gte=start_date)
+    if end_date:
+        line_items = line_items.filter(end_date__lte=end_date)
+    contribution_employees = Employee.objects.in_bulk(
+        list(
+            line_items.values_list("employee_id", flat=True).distinct().order_by()
+        )
+    )
+    for total in contribution_totals(line_items, "employee_id"):
+        table5_data.append(
+            {
+                "Employee": contribution_employees.get(total["employee_id"]),
+                "Employer Contribution": total["employer_contribution"],
+                "Employee Contribution": total["employee_contribution"],
+            }
+        )
 
     if employee_payslip_list:
         for payslip in employee_payslip_list:
@@ -1292,6 +1257,22 @@ def slip_group_name_update(request):
     )
 
 
+@login_required
+@permission_required("payroll.view_payslip")
+def payslip_batch_zip(request):
+    """
+    This method is used to download the PDFs of all the payslips of a batch
+    as a streamed zip archive
+    """
+    group_name = request.GET.get("group_name")
+    payslips = Payslip.objects.filter(group_name=group_name).order_by("id")
+    response = StreamingHttpResponse(
+        stream_payslip_zip(payslips), content_type="application/zip"
+    )
+    response["Content-Disposition"] = f'''attachment;filename="{group_name}.zip"'''
+    return response
+
+
 @login_required
 @permission_required("payroll.add_contract")
 def contract_export(request):
@@ -1332,74 +1313,27 @@ def contract_bulk_delete(request):
 
 
 def payslip_pdf(request, id):
+    """
+    This method is used to download the payslip PDF, served from the PDF
+    store and rendered only when the payslip changed since the last render
+    """
+    payslip = Payslip.objects.select_related("employee_id").get(id=id)
     if (
         request.user.has_perm("payroll.view_payslip")
         or payslip.employee_id.employee_user_id == request.user
     ):
-        user = request.user
-        employee = user.employee_get
-
-        # Taking the company_name of the user
-        info = EmployeeWorkInformation.objects.filter(employee_id=employee)
-        if info.exists():
-            for data in info:
-                employee_company = data.company_id
-            company_name = Company.objects.filter(company=employee_company)
-            emp_company = company_name.first()
-
-            # Access the date_format attribute directly
-            date_format = (
-                emp_company.date_format
-                if emp_company and emp_company.date_format
-                else "MMM. D, YYYY"
+        content = get_payslip_pdf(payslip)
+        if content is not None:
+            response = HttpResponse(content, content_type="application/pdf")
+            response["Content-Disposition"] = (
+                f'''attachment;filename="{payslip_pdf_title(payslip)}"'''
             )
-        else:
-            date_format = "MMM. D, YYYY"
-
-        payslip = Payslip.objects.get(id=id)
-        data = payslip.pay_head_data
-        start_date_str = data["start_date"]
-        end_date_str = data["end_date"]
-
-        # Define date formats
-        date_formats = {
-            "DD-MM-YYYY": "%d-%m-%Y",
-            "DD.MM.YYYY": "%d.%m.%Y",
-            "DD/MM/YYYY": "%d/%m/%Y",
-            "MM/DD/YYYY": "%m/%d/%Y",
-            "YYYY-MM-DD": "%Y-%m-%d",
-            "YYYY/MM/DD": "%Y/%m/%d",
-            "MMMM D, YYYY": "%B %d, %Y",
-            "DD MMMM, YYYY": "%d %B, %Y",
-            "MMM. D, YYYY": "%b. %d, %Y",
-            "D MMM. YYYY": "%d %b. %Y",
-            "dddd, MMMM D, YYYY": "%A, %B %d, %Y",
-        }
-
-        # Convert the string to a datetime.date object
-        start_date = datetime.strptime(start_date_str, "%Y-%m-%d").date()
-        end_date = datetime.strptime(end_date_str, "%Y-%m-%d").date()
-
-        # Print the formatted date for each format
-        for format_name, format_string in date_formats.items():
-            if format_name == date_format:
-                formatted_start_date = start_date.strftime(format_string)
-
-        for format_name, format_string in date_formats.items():
-            if format_name == date_format:
-                formatted_end_date = end_date.strftime(format_string)
-
-        data["formatted_start_date"] = formatted_start_date
-        data["formatted_end_date"] = formatted_end_date
-        data["employee"] = payslip.employee_id
-        data["payslip"] = payslip
-        data["json_data"] = data.copy()
-        data["json_data"]["employee"] = payslip.employee_id.id
-        data["json_data"]["payslip"] = payslip.id
-        data["instance"] = payslip
-        data["currency"] = PayrollSettings.objects.first().currency_symbol
-
-    return generate_pdf("payroll/payslip/individual_pdf.html", context=data)
+            return response
+        messages.error(request, _("The payslip PDF could not be generated."))
+    else:
+        messages.info(request, _("You dont have permission."))
+    previous_url = request.META.get("HTTP_REFERER", "/")
+    return HttpResponse(f'<script>window.location.href = "{previous_url}"</script>')
 
 
 @login_required
@@ -1,4 +1,5 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+from horilla.horilla_scheduler import start_scheduler
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime
 from notifications.signals import notify
@@ -44,4 +45,4 @@ def cyclic_feedback_creation():
 scheduler = BackgroundScheduler()
 cron_trigger = CronTrigger(hour=8)
 scheduler.add_job(cyclic_feedback_creation, cron_trigger)
-scheduler.start()
+start_scheduler(scheduler)